@@ -10,6 +10,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from app.core.database import Base
 from app.models.diagram import Diagram
+from app.models.usage import AIUsageRecord
 from app.core.config import settings
 
 # this is the Alembic Config object
@@ -0,0 +1,52 @@
+"""Add ai_usage table for token accounting
+
+Revision ID: 003
+Revises: 002
+Create Date: 2024-01-22
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '003'
+down_revision: Union[str, None] = '002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ai_usage',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('key_hash', sa.String(length=16), nullable=False),
+        sa.Column('provider', sa.String(length=20), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('endpoint', sa.String(length=30), nullable=False),
+        sa.Column('diagram_type', sa.String(length=20), nullable=True),
+        sa.Column('diagram_format', sa.String(length=10), nullable=True),
+        sa.Column('diagram_id', sa.String(), nullable=True),
+        sa.Column('status', sa.String(length=10), nullable=False),
+        sa.Column('input_tokens', sa.Integer(), nullable=False),
+        sa.Column('output_tokens', sa.Integer(), nullable=False),
+        sa.Column('reasoning_tokens', sa.Integer(), nullable=False),
+        sa.Column('cached_input_tokens', sa.Integer(), nullable=False),
+        sa.Column('cache_write_tokens', sa.Integer(), nullable=False),
+        sa.Column('latency_ms', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['diagram_id'], ['diagrams.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ai_usage_created_at', 'ai_usage', ['created_at'], unique=False)
+    op.create_index('ix_ai_usage_key_hash_created_at', 'ai_usage', ['key_hash', 'created_at'], unique=False)
+    op.create_index(op.f('ix_ai_usage_diagram_id'), 'ai_usage', ['diagram_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_ai_usage_diagram_id'), table_name='ai_usage')
+    op.drop_index('ix_ai_usage_key_hash_created_at', table_name='ai_usage')
+    op.drop_index('ix_ai_usage_created_at', table_name='ai_usage')
+    op.drop_table('ai_usage')
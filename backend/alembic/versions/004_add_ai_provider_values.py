@@ -0,0 +1,36 @@
+"""Add deepseek and fake to the diagrams ai_provider enum
+
+Revision ID: 004
+Revises: 003
+Create Date: 2024-01-23
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '004'
+down_revision: Union[str, None] = '003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # ALTER TYPE ... ADD VALUE cannot run inside a transaction block before PostgreSQL 12
+    with op.get_context().autocommit_block():
+        op.execute("ALTER TYPE aiproviderenum ADD VALUE IF NOT EXISTS 'deepseek'")
+        op.execute("ALTER TYPE aiproviderenum ADD VALUE IF NOT EXISTS 'fake'")
+
+
+def downgrade() -> None:
+    # Enum values cannot be dropped; rebuild the type without them
+    op.execute("UPDATE diagrams SET ai_provider = NULL WHERE ai_provider IN ('deepseek', 'fake')")
+    op.execute("ALTER TYPE aiproviderenum RENAME TO aiproviderenum_old")
+    op.execute("CREATE TYPE aiproviderenum AS ENUM ('claude', 'openai')")
+    op.execute(
+        "ALTER TABLE diagrams ALTER COLUMN ai_provider TYPE aiproviderenum "
+        "USING ai_provider::text::aiproviderenum"
+    )
+    op.execute("DROP TYPE aiproviderenum_old")
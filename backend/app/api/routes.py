@@ -1,17 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+from datetime import datetime
 from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import logging
 import uuid
-import os
 import json
+import time
+from urllib.parse import quote
 
-from app.core.database import get_db
+from app.core.database import SessionLocal, get_db
 from app.models.diagram import Diagram
 from app.schemas.diagram import (
     DiagramCreate,
     DiagramUpdate,
     DiagramResponse,
+    BatchGenerateItem,
+    BatchGenerateRequest,
+    BulkExportRequest,
     GenerateDiagramRequest,
     GenerateDiagramResponse,
     RefineDiagramRequest,
@@ -19,14 +31,46 @@ from app.schemas.diagram import (
     ExplainDiagramResponse,
     AIProvider,
     ChatRequest,
+    DiagramFormat,
+    RefineMode,
 )
 from app.services.ai.claude_service import claude_service
 from app.services.ai.openai_service import openai_service
 from app.services.ai.deepseek_service import deepseek_service
+from app.services.ai.fake_service import fake_service
+from app.services.ai.client_pool import client_pool, key_fingerprint
+from app.services.ai.code_extraction import IncrementalCodeExtractor
+from app.services.ai.drawio_stream import DrawioCellParser, DrawioStreamTracker
+from app.services.ai.usage import track_usage
+from app.services.ai.chat_history import chat_history_compactor, prompt_tokens
+from app.services.ai.diagram_patch import PatchError, apply_patch, parse_patch
+from app.services.response_cache import (
+    CACHE_STATUS_HEADER,
+    normalize_code,
+    normalize_prompt,
+    response_cache,
+)
+from app.services.semantic_cache import semantic_cache
+from app.services.single_flight import SingleFlightError, single_flight
+from app.services.rate_limiter import RateLimitExceeded, rate_limiter
 from app.services.export_service import export_service
+from app.services.render_cache import etag_matches, render_cache
+from app.services.zip_stream import ZipStream, member_name
+from app.services.jobs import JobContext, JobRetry, job_queue
+from app.services.stream_resume import TERMINAL_EVENT_TYPES, chat_streams
+from app.services.usage_ledger import (
+    GROUP_BY_COLUMNS,
+    BudgetExceeded,
+    UsageEntry,
+    summarize as summarize_usage,
+    usage_ledger,
+)
 from app.core.config import settings
+from app.core.metrics import observe_ai_call, observe_export, observe_stream
+from app.core.tracing import span, traced_stream
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 def get_api_keys_from_request(request: Request) -> dict:
@@ -35,6 +79,7 @@ def get_api_keys_from_request(request: Request) -> dict:
         'anthropic': request.headers.get('X-Anthropic-Key') or settings.ANTHROPIC_API_KEY,
         'openai': request.headers.get('X-OpenAI-Key') or settings.OPENAI_API_KEY,
         'deepseek': request.headers.get('X-DeepSeek-Key') or settings.DEEPSEEK_API_KEY,
+        'fake': '',
     }
 
 
@@ -44,42 +89,260 @@ def get_api_base_urls_from_request(request: Request) -> dict:
         'anthropic': request.headers.get('X-Anthropic-Base-Url'),
         'openai': request.headers.get('X-OpenAI-Base-Url'),
         'deepseek': request.headers.get('X-DeepSeek-Base-Url'),
+        'fake': None,
     }
 
 
-def set_service_api_key(service, provider: AIProvider, api_keys: dict, base_urls: dict):
-    """Temporarily set API key and base URL for a service if client-side values are provided"""
-    if provider == AIProvider.CLAUDE and api_keys['anthropic']:
-        # Temporarily override the API key
-        original_key = os.environ.get('ANTHROPIC_API_KEY')
-        os.environ['ANTHROPIC_API_KEY'] = api_keys['anthropic']
-        settings.ANTHROPIC_API_KEY = api_keys['anthropic']
-        # Reset client to use new key
-        service._client = None
-        return original_key
-    elif provider == AIProvider.OPENAI and api_keys['openai']:
-        original_key = os.environ.get('OPENAI_API_KEY')
-        os.environ['OPENAI_API_KEY'] = api_keys['openai']
-        settings.OPENAI_API_KEY = api_keys['openai']
-        service._client = None
-        return original_key
-    elif provider == AIProvider.DEEPSEEK and api_keys['deepseek']:
-        original_key = os.environ.get('DEEPSEEK_API_KEY')
-        os.environ['DEEPSEEK_API_KEY'] = api_keys['deepseek']
-        settings.DEEPSEEK_API_KEY = api_keys['deepseek']
-        service._client = None
-        return original_key
-    return None
-
-
-def set_service_base_url(service, provider: AIProvider, base_urls: dict):
-    """Set custom base URL for a service if provided"""
-    if provider == AIProvider.CLAUDE and base_urls.get('anthropic'):
-        service.base_url = base_urls['anthropic']
-    elif provider == AIProvider.OPENAI and base_urls.get('openai'):
-        service.base_url = base_urls['openai']
-    elif provider == AIProvider.DEEPSEEK and base_urls.get('deepseek'):
-        service.base_url = base_urls['deepseek']
+PROVIDER_CREDENTIAL_NAMES = {
+    AIProvider.CLAUDE: 'anthropic',
+    AIProvider.OPENAI: 'openai',
+    AIProvider.DEEPSEEK: 'deepseek',
+    AIProvider.FAKE: 'fake',
+}
+
+
+def get_ai_service(provider: AIProvider):
+    """Return the service that handles the given provider"""
+    if provider == AIProvider.CLAUDE:
+        return claude_service
+    if provider == AIProvider.DEEPSEEK:
+        return deepseek_service
+    if provider == AIProvider.FAKE:
+        if not settings.FAKE_PROVIDER_ENABLED:
+            raise HTTPException(status_code=400, detail="The fake provider is disabled")
+        return fake_service
+    return openai_service
+
+
+def resolve_ai_credentials(provider: AIProvider, http_request: Request):
+    """Return (service, api_key, base_url) for a provider and the caller's headers"""
+    service = get_ai_service(provider)
+    name = PROVIDER_CREDENTIAL_NAMES[provider]
+    api_key = get_api_keys_from_request(http_request)[name]
+    base_url = get_api_base_urls_from_request(http_request)[name] or service.base_url
+    return service, api_key, base_url
+
+
+async def admit_ai_call(provider: AIProvider, api_key: str):
+    """Check the key's token budget, then wait for an upstream slot"""
+    await usage_ledger.check_budget(key_fingerprint(api_key))
+    with span("ratelimit.acquire", provider=provider.value):
+        return await rate_limiter.acquire(provider.value, api_key)
+
+
+async def acquire_ai_lease(provider: AIProvider, http_request: Request):
+    """Wait for an upstream slot under the provider's budget, concurrency and rate limits"""
+    _, api_key, _ = resolve_ai_credentials(provider, http_request)
+    return await admit_ai_call(provider, api_key)
+
+
+def rate_limited(e: RateLimitExceeded | BudgetExceeded) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+@asynccontextmanager
+async def borrow_ai_client(provider: AIProvider, http_request: Request, limit: bool = True):
+    """Borrow a pooled SDK client for the caller's credentials
+
+    Client-side keys and base URLs come from the request headers; server
+    defaults are used otherwise. Global settings are never modified. Unless
+    ``limit`` is False (the caller already holds a lease), the borrow waits
+    for a slot under the provider's rate limits.
+    """
+    service, api_key, base_url = resolve_ai_credentials(provider, http_request)
+    lease = await admit_ai_call(provider, api_key) if limit else None
+    try:
+        async with client_pool.borrow(provider.value, api_key, base_url, service.create_client) as client:
+            yield service, client
+    finally:
+        if lease is not None:
+            await lease.release()
+
+
+@asynccontextmanager
+async def account_ai_call(endpoint: str, provider: AIProvider, http_request: Request, request=None):
+    """Track an AI request's token usage and latency and store them in the usage ledger
+
+    Yields the ``UsageCounter`` the provider calls record into. ``request`` is
+    the API request model, for its diagram type, format and id. Requests
+    turned away before reaching the provider (rate limit, budget) are not
+    recorded.
+    """
+    service, api_key, _ = resolve_ai_credentials(provider, http_request)
+    diagram_type = getattr(request, "diagramType", None)
+    diagram_format = getattr(request, "format", None)
+    started = time.perf_counter()
+    status = "ok"
+    with track_usage() as usage:
+        try:
+            yield usage
+        except (RateLimitExceeded, BudgetExceeded):
+            status = None
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            if status is not None and (usage.calls or status == "error"):
+                await usage_ledger.record(UsageEntry(
+                    key_hash=key_fingerprint(api_key),
+                    provider=provider.value,
+                    model=service.model,
+                    endpoint=endpoint,
+                    latency_ms=elapsed_ms(started),
+                    status=status,
+                    diagram_type=diagram_type.value if diagram_type else None,
+                    diagram_format=diagram_format.value if diagram_format else None,
+                    diagram_id=getattr(request, "diagramId", None),
+                    **usage.as_dict(),
+                ))
+
+
+def without_usage(payload: dict) -> dict:
+    """Payload minus token usage, which only applies to the request that made the call"""
+    return {key: value for key, value in payload.items() if key != "usage"}
+
+
+def generate_cache_identity(request: GenerateDiagramRequest, service) -> tuple[str, str]:
+    """Exact cache key and semantic namespace for a generation request
+
+    Both include the system prompt's content hash, so editing a prompt stops
+    serving diagrams generated with the old one.
+    """
+    prompt = service.prompts.get(request.diagramType, request.format)
+    cache_key = response_cache.build_key(
+        "generate", request.aiProvider.value, service.model,
+        request.diagramType.value, request.format.value,
+        prompt.hash, normalize_prompt(request.description),
+    )
+    namespace = ":".join([
+        request.aiProvider.value, service.model, request.diagramType.value, request.format.value, prompt.hash,
+    ])
+    return cache_key, namespace
+
+
+async def refine_with_patch(service, client, request: RefineDiagramRequest, usage=None) -> Optional[str]:
+    """Refine by applying model-proposed edits; None when they cannot be applied"""
+    with observe_ai_call(request.aiProvider.value, service.model, "refine_patch", usage):
+        answer = await service.refine_patch(request.code, request.instruction, request.format, client=client)
+    try:
+        return apply_patch(request.code, request.format, parse_patch(answer))
+    except PatchError as e:
+        logger.info("Patch refine fell back to full refine: %s", e)
+        return None
+
+
+def stored_diagram_code(diagram_id: str) -> str:
+    """Code of a saved diagram; 404 when there is no such diagram"""
+    with SessionLocal() as db:
+        diagram = db.query(Diagram).filter(Diagram.id == diagram_id).first()
+        if not diagram:
+            raise HTTPException(status_code=404, detail="Diagram not found")
+        return diagram.code
+
+
+async def run_cached_ai_call(
+    endpoint: str,
+    provider: AIProvider,
+    cache_key: str,
+    http_request: Request,
+    response: Response,
+    call,
+    semantic: Optional[tuple[str, str]] = None,
+) -> dict:
+    """Serve an AI result from the response cache, or compute it and store it
+
+    Concurrent identical requests made with the same API key are coalesced
+    into a single upstream call, which runs under that key's limits and budget.
+    ``semantic`` is an optional (namespace, prompt) pair; when given, prompts that
+    are near-duplicates of an earlier one in the same namespace reuse its result.
+    """
+    read, write = response_cache.policy(endpoint, http_request.headers.get("Cache-Control"))
+    use_semantic = semantic is not None and settings.SEMANTIC_CACHE_ENABLED
+    if read:
+        with span("cache.lookup", endpoint=endpoint) as lookup:
+            cached = await response_cache.get(cache_key)
+            match = await semantic_cache.lookup(*semantic) if cached is None and use_semantic else None
+            lookup.set(result="hit" if cached is not None else "semantic" if match is not None else "miss")
+        if cached is not None:
+            response.headers[CACHE_STATUS_HEADER] = "HIT"
+            return cached
+        if match is not None:
+            payload, similarity = match
+            response.headers[CACHE_STATUS_HEADER] = "SEMANTIC"
+            response.headers["X-Cache-Similarity"] = f"{similarity:.4f}"
+            return payload
+
+    async def compute() -> dict:
+        payload = await call()
+        if write:
+            stored = without_usage(payload)
+            await response_cache.set(cache_key, stored)
+            if use_semantic:
+                await semantic_cache.add(*semantic, stored)
+        return payload
+
+    if settings.AI_SINGLE_FLIGHT_ENABLED:
+        # Identical concurrent requests share one upstream call. Only requests on the same key
+        # share one: the call is admitted and charged against the leader's key.
+        _, api_key, _ = resolve_ai_credentials(provider, http_request)
+        try:
+            payload, shared = await single_flight.do(f"{cache_key}:{key_fingerprint(api_key)}", compute)
+        except SingleFlightError as e:
+            # The leader in another worker failed; answer with the status it got
+            headers = {"Retry-After": str(e.retry_after)} if e.retry_after is not None else None
+            raise HTTPException(status_code=e.status_code, detail=str(e), headers=headers)
+    else:
+        payload, shared = await compute(), False
+    if shared:
+        response.headers[CACHE_STATUS_HEADER] = "COALESCED"
+        payload = without_usage(payload)  # The tokens were spent by another request
+    else:
+        response.headers[CACHE_STATUS_HEADER] = "MISS" if read else "BYPASS"
+    return payload
+
+
+def sse_event(payload: dict, event_id: Optional[int] = None) -> str:
+    """Format a payload as a server-sent event"""
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json.dumps(payload)}\n\n"
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # Disable proxy buffering (nginx) so events flush immediately
+}
+
+
+STREAM_ID_HEADER = "X-Stream-Id"
+
+
+async def resumable_sse(stream_id: str, events):
+    """SSE body for a resumable stream; the turn keeps running if the client goes away"""
+    ended = False
+    try:
+        async for item in events:
+            if item is None:
+                yield ": keepalive\n\n"
+                continue
+            event_id, payload = item
+            ended = payload.get('type') in TERMINAL_EVENT_TYPES
+            yield sse_event(payload, event_id)
+    finally:
+        if not ended and not chat_streams.resumable:
+            # Nobody can come back for the rest, so stop paying for it
+            chat_streams.cancel(stream_id)
+
+
+def elapsed_ms(started: float) -> int:
+    return int((time.perf_counter() - started) * 1000)
+
+
+def cell_events(cells: list[dict]):
+    """SSE events for Draw.io cells that finished streaming"""
+    for cell in cells:
+        yield sse_event({'type': 'cell', 'cell': cell})
 
 
 def sanitize_chat_messages(messages: list[dict]) -> list[dict]:
@@ -101,177 +364,593 @@ def sanitize_chat_messages(messages: list[dict]) -> list[dict]:
     return sanitized
 
 
+async def generate_cached(
+    request: GenerateDiagramRequest, http_request: Request, response: Response, endpoint: str = "generate"
+) -> dict:
+    """Generate a diagram through the response cache; ``endpoint`` labels the usage record"""
+    cache_key, semantic_namespace = generate_cache_identity(request, get_ai_service(request.aiProvider))
+
+    async def call():
+        async with account_ai_call(endpoint, request.aiProvider, http_request, request) as usage:
+            async with borrow_ai_client(request.aiProvider, http_request) as (service, client):
+                with observe_ai_call(request.aiProvider.value, service.model, "generate", usage):
+                    code = await service.generate_diagram(
+                        request.description, request.diagramType, request.format, client=client
+                    )
+        return {"code": code, "usage": usage.summary()}
+
+    return await run_cached_ai_call(
+        "generate", request.aiProvider, cache_key, http_request, response, call,
+        semantic=(semantic_namespace, request.description),
+    )
+
+
 # AI Generation endpoints
 @router.post("/ai/generate", response_model=GenerateDiagramResponse)
-async def generate_diagram(request: GenerateDiagramRequest, http_request: Request):
+async def generate_diagram(request: GenerateDiagramRequest, http_request: Request, response: Response):
     """Generate diagram using AI"""
-    api_keys = get_api_keys_from_request(http_request)
-    base_urls = get_api_base_urls_from_request(http_request)
-
     try:
-        if request.aiProvider == AIProvider.CLAUDE:
-            set_service_base_url(claude_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(claude_service, request.aiProvider, api_keys, base_urls)
-            code = await claude_service.generate_diagram(
-                request.description, request.diagramType, request.format
-            )
-            # Restore original key if it was temporarily changed
-            if original_key is not None:
-                os.environ['ANTHROPIC_API_KEY'] = original_key
-                settings.ANTHROPIC_API_KEY = original_key
-                claude_service._client = None
-        elif request.aiProvider == AIProvider.DEEPSEEK:
-            set_service_base_url(deepseek_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(deepseek_service, request.aiProvider, api_keys, base_urls)
-            code = await deepseek_service.generate_diagram(
-                request.description, request.diagramType, request.format
-            )
-            if original_key is not None:
-                os.environ['DEEPSEEK_API_KEY'] = original_key
-                settings.DEEPSEEK_API_KEY = original_key
-                deepseek_service._client = None
-        else:
-            set_service_base_url(openai_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(openai_service, request.aiProvider, api_keys, base_urls)
-            code = await openai_service.generate_diagram(
-                request.description, request.diagramType, request.format
-            )
-            if original_key is not None:
-                os.environ['OPENAI_API_KEY'] = original_key
-                settings.OPENAI_API_KEY = original_key
-                openai_service._client = None
-
-        return GenerateDiagramResponse(code=code)
+        payload = await generate_cached(request, http_request, response)
+        return GenerateDiagramResponse(**payload)
+    except (RateLimitExceeded, BudgetExceeded) as e:
+        raise rate_limited(e)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
 
+async def run_batch_item(
+    index: int, item: BatchGenerateItem, http_request: Request, slots: asyncio.Semaphore
+) -> dict:
+    """Result line for one batch item; failures become an error line instead of raising"""
+    started = time.perf_counter()
+    line = {'index': index, 'id': item.id}
+    response = Response()
+    try:
+        async with slots:
+            payload = await generate_cached(item, http_request, response, "generate_batch")
+    except (RateLimitExceeded, BudgetExceeded) as e:
+        return {'type': 'error', **line, 'status': 429, 'message': str(e), 'retryAfter': e.retry_after}
+    except HTTPException as e:
+        return {'type': 'error', **line, 'status': e.status_code, 'message': e.detail}
+    except Exception as e:
+        return {'type': 'error', **line, 'status': 500, 'message': f"Generation failed: {str(e)}"}
+    return {
+        'type': 'result', **line, **payload,
+        'cache': response.headers.get(CACHE_STATUS_HEADER), 'elapsed_ms': elapsed_ms(started),
+    }
+
+
+def save_batch_diagram(db: Session, item: BatchGenerateItem, code: str) -> str:
+    """Store a generated batch item as a diagram and return its id"""
+    db_diagram = Diagram(
+        id=str(uuid.uuid4()),
+        title=item.title or item.description[:100],
+        type=item.diagramType,
+        format=item.format,
+        code=code,
+        ai_provider=item.aiProvider,
+        ai_prompt=item.description,
+    )
+    db.add(db_diagram)
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return db_diagram.id
+
+
+@router.post("/ai/generate/batch")
+async def generate_batch(request: BatchGenerateRequest, http_request: Request):
+    """Generate many diagrams concurrently, streamed as NDJSON
+
+    At most ``concurrency`` items (capped by AI_BATCH_MAX_CONCURRENCY) are in
+    flight at once. Each one goes through the same cache, coalescing, rate
+    limits and usage accounting as /ai/generate. A ``result`` or ``error``
+    line is written for each item as soon as it finishes, in completion order
+    and carrying the item's ``index`` and ``id``. Error lines hold the status
+    /ai/generate would have returned. A ``summary`` line ends the stream. With
+    ``save`` every generated diagram is stored and its ``diagramId`` returned.
+    """
+    if len(request.items) > settings.AI_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400, detail=f"A batch holds at most {settings.AI_BATCH_MAX_ITEMS} items"
+        )
+    for provider in {item.aiProvider for item in request.items}:
+        get_ai_service(provider)  # Reject disabled providers before the stream starts
+    concurrency = min(request.concurrency or settings.AI_BATCH_MAX_CONCURRENCY, settings.AI_BATCH_MAX_CONCURRENCY)
+
+    async def generate():
+        started = time.perf_counter()
+        slots = asyncio.Semaphore(concurrency)
+        tasks = [
+            asyncio.create_task(run_batch_item(index, item, http_request, slots))
+            for index, item in enumerate(request.items)
+        ]
+        counts = {'result': 0, 'error': 0}
+        # The request's get_db session is closed before the body streams, so the saves get their own
+        db = SessionLocal() if request.save else None
+        with observe_stream("generate_batch") as stream:
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    line = await finished
+                    if line['type'] == 'result' and request.save:
+                        item = request.items[line['index']]
+                        try:
+                            line['diagramId'] = await run_in_threadpool(save_batch_diagram, db, item, line['code'])
+                        except SQLAlchemyError as e:
+                            logger.warning("Batch item %d not saved: %s", line['index'], e)
+                            line = {
+                                'type': 'error', 'index': line['index'], 'id': item.id,
+                                'status': 500, 'message': 'Generated diagram could not be saved', 'code': line['code'],
+                            }
+                    counts[line['type']] += 1
+                    yield json.dumps(line) + "\n"
+                yield json.dumps({
+                    'type': 'summary', 'total': len(tasks), 'succeeded': counts['result'],
+                    'failed': counts['error'], 'total_ms': elapsed_ms(started),
+                }) + "\n"
+                stream.outcome = "done"
+            finally:
+                # Client went away: stop the items still waiting or running
+                for task in tasks:
+                    task.cancel()
+                if db is not None:
+                    db.close()
+
+    return StreamingResponse(
+        generate(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"}
+    )
+
+
+# Headers a background job needs to act for its caller: credentials and cache control
+JOB_HEADERS = (
+    "X-Anthropic-Key", "X-Anthropic-Base-Url",
+    "X-OpenAI-Key", "X-OpenAI-Base-Url",
+    "X-DeepSeek-Key", "X-DeepSeek-Base-Url",
+    "Cache-Control",
+)
+
+
+def job_request(headers: dict) -> Request:
+    """Stand-in request carrying a job's stored headers, for the credential and cache helpers"""
+    return Request({
+        "type": "http",
+        "method": "POST",
+        "path": "/api/ai/jobs",
+        "query_string": b"",
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()],
+    })
+
+
+async def run_generate_job(payload: dict, context: JobContext) -> dict:
+    request = GenerateDiagramRequest(**payload)
+    response = Response()
+    await context.progress(stage="generating")
+    try:
+        payload = await generate_cached(request, job_request(context.headers), response, "generate_job")
+    except RateLimitExceeded as e:
+        raise JobRetry(str(e), delay=e.retry_after)
+    return {**payload, "cache": response.headers.get(CACHE_STATUS_HEADER)}
+
+
+job_queue.register("generate", run_generate_job)
+
+
+@router.post("/ai/jobs/generate", status_code=202)
+async def submit_generate_job(request: GenerateDiagramRequest, http_request: Request, response: Response):
+    """Queue a generation and return its job at once
+
+    The job runs on a worker whatever happens to this connection. Poll
+    ``GET /ai/jobs/{id}`` or follow ``GET /ai/jobs/{id}/events`` for progress
+    and the result (``code`` and ``usage``, as /ai/generate returns them).
+    """
+    get_ai_service(request.aiProvider)  # Reject a disabled provider now rather than in the worker
+    headers = {name: value for name in JOB_HEADERS if (value := http_request.headers.get(name))}
+    try:
+        job = await job_queue.submit("generate", request.model_dump(mode="json"), headers)
+    except RedisError as e:
+        logger.warning("Job submit failed: %s", e)
+        raise HTTPException(status_code=503, detail="Job queue unavailable")
+    response.headers["Location"] = f"/api/ai/jobs/{job['id']}"
+    return job
+
+
+@router.get("/ai/jobs/stats")
+async def ai_job_stats():
+    """Jobs waiting and running across all workers"""
+    return await job_queue.stats()
+
+
+@router.get("/ai/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, progress and result of a background job"""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+
+@router.get("/ai/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent ``job`` events with the job's state now and after every change
+
+    The stream ends once the job is done or failed. Disconnecting does not
+    affect the job.
+    """
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    async def events():
+        with observe_stream("job_events") as stream:
+            async for job in job_queue.watch(job_id):
+                if job is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event({'type': 'job', 'job': job})
+            stream.outcome = "done"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.post("/ai/generate-stream")
+async def generate_diagram_stream(request: GenerateDiagramRequest, http_request: Request):
+    """Stream diagram generation as server-sent events
+
+    Markdown fences and leading prose are stripped incrementally, so diagram
+    code is forwarded as soon as the model starts producing it. For Draw.io a
+    ``cell`` event follows as soon as each ``<mxCell>`` closes. The final
+    ``done`` event reports ``ttft_ms`` (first upstream token), ``ttfb_ms``
+    (first code chunk sent) and ``total_ms``.
+    """
+    started = time.perf_counter()
+    cache_key, _ = generate_cache_identity(request, get_ai_service(request.aiProvider))
+    read, write = response_cache.policy("generate", http_request.headers.get("Cache-Control"))
+    cached = await response_cache.get(cache_key) if read else None
+    if cached is not None:
+        cache_status = "HIT"
+    else:
+        cache_status = "MISS" if read else "BYPASS"
+
+    lease = None
+    if cached is None:
+        try:
+            lease = await acquire_ai_lease(request.aiProvider, http_request)
+        except (RateLimitExceeded, BudgetExceeded) as e:
+            raise rate_limited(e)
+
+    async def generate():
+        timings = {}
+        cells = DrawioCellParser() if request.format == DiagramFormat.DRAWIO else None
+        with observe_stream("generate_stream") as stream:
+            try:
+                if cached is not None:
+                    timings["ttfb_ms"] = elapsed_ms(started)
+                    yield sse_event({'type': 'chunk', 'content': cached['code']})
+                    if cells is not None:
+                        for event in cell_events(cells.feed(cached['code']) + cells.close()):
+                            yield event
+                    yield sse_event({'type': 'done', 'cached': True, **timings, 'total_ms': elapsed_ms(started)})
+                    stream.outcome = "cached"
+                    return
+
+                extractor = IncrementalCodeExtractor(request.format)
+                async with account_ai_call("generate_stream", request.aiProvider, http_request, request) as usage:
+                    async with borrow_ai_client(request.aiProvider, http_request, limit=False) as (service, client):
+                        with observe_ai_call(
+                            request.aiProvider.value, service.model, "generate_stream", usage
+                        ) as call:
+                            async for chunk in traced_stream(
+                                "llm.stream",
+                                service.generate_stream(
+                                    request.description, request.diagramType, request.format, client=client
+                                ),
+                                provider=request.aiProvider.value, model=service.model, operation="generate_stream",
+                            ):
+                                call.first_token()
+                                if isinstance(chunk, dict):
+                                    if chunk.get('type') == 'reasoning':
+                                        timings.setdefault('ttft_ms', elapsed_ms(started))
+                                        yield sse_event(chunk)
+                                        continue
+                                    chunk = chunk.get('content') or ''
+                                timings.setdefault('ttft_ms', elapsed_ms(started))
+                                code = extractor.feed(chunk)
+                                if code:
+                                    timings.setdefault('ttfb_ms', elapsed_ms(started))
+                                    yield sse_event({'type': 'chunk', 'content': code})
+                                    if cells is not None:
+                                        for event in cell_events(cells.feed(code)):
+                                            yield event
+
+                tail = extractor.finish()
+                if tail:
+                    timings.setdefault('ttfb_ms', elapsed_ms(started))
+                    yield sse_event({'type': 'chunk', 'content': tail})
+                if cells is not None:
+                    for event in cell_events(cells.feed(tail) + cells.close()):
+                        yield event
+                if write and extractor.code:
+                    await response_cache.set(cache_key, {"code": extractor.code})
+                done = {'type': 'done', 'cached': False, **timings, 'total_ms': elapsed_ms(started)}
+                if usage.calls:
+                    done['usage'] = usage.as_dict()
+                yield sse_event(done)
+                stream.outcome = "done"
+            except Exception as e:
+                stream.outcome = "error"
+                yield sse_event({'type': 'error', 'message': str(e)})
+            finally:
+                if lease is not None:
+                    await lease.release()
+
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={**SSE_HEADERS, CACHE_STATUS_HEADER: cache_status},
+        # Also release when the client disconnects before the stream starts
+        background=BackgroundTask(lease.release) if lease is not None else None,
+    )
+
+
 @router.post("/ai/refine", response_model=GenerateDiagramResponse)
-async def refine_diagram(request: RefineDiagramRequest, http_request: Request):
-    """Refine existing diagram with instruction"""
-    api_keys = get_api_keys_from_request(http_request)
-    base_urls = get_api_base_urls_from_request(http_request)
+async def refine_diagram(request: RefineDiagramRequest, http_request: Request, response: Response):
+    """Refine existing diagram with instruction
+
+    With ``diagramId``, the saved diagram's code is refined, not the copy the
+    client sent, so edits are applied to (and cached against) what is stored.
+    """
+    if request.diagramId:
+        stored = await run_in_threadpool(stored_diagram_code, request.diagramId)
+        request = request.model_copy(update={"code": stored})
+    service = get_ai_service(request.aiProvider)
+    cache_key = response_cache.build_key(
+        "refine", request.aiProvider.value, service.model, None, request.format.value,
+        request.mode.value, normalize_code(request.code), normalize_prompt(request.instruction),
+    )
+
+    async def call():
+        async with account_ai_call("refine", request.aiProvider, http_request, request) as usage:
+            async with borrow_ai_client(request.aiProvider, http_request) as (service, client):
+                code, mode = None, RefineMode.FULL
+                if request.mode == RefineMode.PATCH:
+                    # Output scales with the change; fall back to a full rewrite if the edits don't apply
+                    code = await refine_with_patch(service, client, request, usage)
+                    mode = RefineMode.PATCH if code is not None else RefineMode.FULL
+                if code is None:
+                    with observe_ai_call(request.aiProvider.value, service.model, "refine", usage):
+                        code = await service.refine_diagram(
+                            request.code, request.instruction, request.format, client=client
+                        )
+        return {"code": code, "refineMode": mode.value, "usage": usage.summary()}
 
     try:
-        if request.aiProvider == AIProvider.CLAUDE:
-            set_service_base_url(claude_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(claude_service, request.aiProvider, api_keys, base_urls)
-            code = await claude_service.refine_diagram(request.code, request.instruction, request.format)
-            if original_key is not None:
-                os.environ['ANTHROPIC_API_KEY'] = original_key
-                settings.ANTHROPIC_API_KEY = original_key
-                claude_service._client = None
-        elif request.aiProvider == AIProvider.DEEPSEEK:
-            set_service_base_url(deepseek_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(deepseek_service, request.aiProvider, api_keys, base_urls)
-            code = await deepseek_service.refine_diagram(request.code, request.instruction, request.format)
-            if original_key is not None:
-                os.environ['DEEPSEEK_API_KEY'] = original_key
-                settings.DEEPSEEK_API_KEY = original_key
-                deepseek_service._client = None
-        else:
-            set_service_base_url(openai_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(openai_service, request.aiProvider, api_keys, base_urls)
-            code = await openai_service.refine_diagram(request.code, request.instruction, request.format)
-            if original_key is not None:
-                os.environ['OPENAI_API_KEY'] = original_key
-                settings.OPENAI_API_KEY = original_key
-                openai_service._client = None
-
-        return GenerateDiagramResponse(code=code)
+        payload = await run_cached_ai_call("refine", request.aiProvider, cache_key, http_request, response, call)
+        return GenerateDiagramResponse(**payload)
+    except (RateLimitExceeded, BudgetExceeded) as e:
+        raise rate_limited(e)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Refinement failed: {str(e)}")
 
 
 @router.post("/ai/explain", response_model=ExplainDiagramResponse)
-async def explain_diagram(request: ExplainDiagramRequest, http_request: Request):
+async def explain_diagram(request: ExplainDiagramRequest, http_request: Request, response: Response):
     """Explain diagram in natural language"""
-    api_keys = get_api_keys_from_request(http_request)
-    base_urls = get_api_base_urls_from_request(http_request)
+    service = get_ai_service(request.aiProvider)
+    cache_key = response_cache.build_key(
+        "explain", request.aiProvider.value, service.model, None, request.format.value,
+        normalize_code(request.code),
+    )
+
+    async def call():
+        async with account_ai_call("explain", request.aiProvider, http_request, request) as usage:
+            async with borrow_ai_client(request.aiProvider, http_request) as (service, client):
+                with observe_ai_call(request.aiProvider.value, service.model, "explain", usage):
+                    explanation = await service.explain_diagram(request.code, request.format, client=client)
+        return {"explanation": explanation, "usage": usage.summary()}
 
     try:
-        if request.aiProvider == AIProvider.CLAUDE:
-            set_service_base_url(claude_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(claude_service, request.aiProvider, api_keys, base_urls)
-            explanation = await claude_service.explain_diagram(request.code, request.format)
-            if original_key is not None:
-                os.environ['ANTHROPIC_API_KEY'] = original_key
-                settings.ANTHROPIC_API_KEY = original_key
-                claude_service._client = None
-        elif request.aiProvider == AIProvider.DEEPSEEK:
-            set_service_base_url(deepseek_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(deepseek_service, request.aiProvider, api_keys, base_urls)
-            explanation = await deepseek_service.explain_diagram(request.code, request.format)
-            if original_key is not None:
-                os.environ['DEEPSEEK_API_KEY'] = original_key
-                settings.DEEPSEEK_API_KEY = original_key
-                deepseek_service._client = None
-        else:
-            set_service_base_url(openai_service, request.aiProvider, base_urls)
-            original_key = set_service_api_key(openai_service, request.aiProvider, api_keys, base_urls)
-            explanation = await openai_service.explain_diagram(request.code, request.format)
-            if original_key is not None:
-                os.environ['OPENAI_API_KEY'] = original_key
-                settings.OPENAI_API_KEY = original_key
-                openai_service._client = None
-
-        return ExplainDiagramResponse(explanation=explanation)
+        payload = await run_cached_ai_call("explain", request.aiProvider, cache_key, http_request, response, call)
+        return ExplainDiagramResponse(**payload)
+    except (RateLimitExceeded, BudgetExceeded) as e:
+        raise rate_limited(e)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Explanation failed: {str(e)}")
 
 
+@router.get("/ai/cache/stats")
+def ai_cache_stats():
+    """Hit-rate statistics for the prompt caches and request coalescing"""
+    return {
+        "semantic": semantic_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "clients": client_pool.stats(),
+        "chat_history": chat_history_compactor.stats(),
+        "renders": render_cache.stats(),
+    }
+
+
+@router.get("/ai/limits")
+async def ai_rate_limit_stats():
+    """Upstream queue depth, wait times and rejections per provider"""
+    return await rate_limiter.stats()
+
+
+@router.get("/ai/usage")
+def ai_usage(
+    group_by: List[str] = Query(default=["provider", "model"]),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    key_hash: Optional[str] = None,
+    diagram_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """Token usage and latency totals, grouped by any of the ledger columns
+
+    ``group_by`` may repeat: provider, model, endpoint, diagram_type,
+    diagram_format, diagram_id, key_hash, status. Rows come most expensive first.
+    """
+    unknown = [name for name in group_by if name not in GROUP_BY_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown group_by {', '.join(unknown)}; choose from {', '.join(GROUP_BY_COLUMNS)}",
+        )
+    return {
+        "group_by": group_by,
+        "rows": summarize_usage(db, group_by, since, until, key_hash, diagram_id),
+    }
+
+
+@router.get("/ai/usage/budget")
+async def ai_usage_budget(provider: AIProvider, http_request: Request):
+    """Today's token budget for the caller's key with the given provider"""
+    _, api_key, _ = resolve_ai_credentials(provider, http_request)
+    key_hash = key_fingerprint(api_key)
+    budget = usage_ledger.budget_for(key_hash)
+    used = await usage_ledger.used_today(key_hash)
+    return {
+        "key_hash": key_hash,
+        "budget": budget or None,
+        "used_today": used,
+        "remaining": max(0, budget - (used or 0)) if budget else None,
+    }
+
+
 @router.post("/ai/chat/stream")
 async def chat_stream(request: ChatRequest, http_request: Request):
     """Stream AI chat responses with context"""
-    api_keys = get_api_keys_from_request(http_request)
-    base_urls = get_api_base_urls_from_request(http_request)
     raw_messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
     messages = sanitize_chat_messages(raw_messages)
     if not messages:
         raise HTTPException(status_code=400, detail="No valid chat messages provided")
     if messages[-1]['role'] != 'user':
         raise HTTPException(status_code=400, detail="Latest message must come from the user")
-    
-    async def generate():
-        try:
-            if request.aiProvider == AIProvider.CLAUDE:
-                set_service_base_url(claude_service, request.aiProvider, base_urls)
-                original_key = set_service_api_key(claude_service, request.aiProvider, api_keys, base_urls)
-                async for chunk in claude_service.chat_stream(messages, request.diagramType, request.format):
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
-                if original_key is not None:
-                    os.environ['ANTHROPIC_API_KEY'] = original_key
-                    settings.ANTHROPIC_API_KEY = original_key
-                    claude_service._client = None
-            elif request.aiProvider == AIProvider.DEEPSEEK:
-                set_service_base_url(deepseek_service, request.aiProvider, base_urls)
-                original_key = set_service_api_key(deepseek_service, request.aiProvider, api_keys, base_urls)
-                async for chunk in deepseek_service.chat_stream(messages, request.diagramType, request.format):
-                    # DeepSeek returns dict with type and content
-                    if isinstance(chunk, dict):
-                        yield f"data: {json.dumps(chunk)}\n\n"
-                    else:
-                        # Fallback for string chunks
-                        yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
-                if original_key is not None:
-                    os.environ['DEEPSEEK_API_KEY'] = original_key
-                    settings.DEEPSEEK_API_KEY = original_key
-                    deepseek_service._client = None
-            else:
-                set_service_base_url(openai_service, request.aiProvider, base_urls)
-                original_key = set_service_api_key(openai_service, request.aiProvider, api_keys, base_urls)
-                async for chunk in openai_service.chat_stream(messages, request.diagramType, request.format):
-                    yield f"data: {json.dumps({'type': 'chunk', 'content': chunk})}\n\n"
-                if original_key is not None:
-                    os.environ['OPENAI_API_KEY'] = original_key
-                    settings.OPENAI_API_KEY = original_key
-                    openai_service._client = None
-            
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-    
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    compaction = None
+    if settings.CHAT_HISTORY_COMPACTION_ENABLED:
+        # Keep long sessions under the token budget so time-to-first-token stays flat
+        system_prompt = get_ai_service(request.aiProvider).prompts.get(request.diagramType, request.format)
+        with span("chat.compact_history", messages=len(messages)) as compact_span:
+            compaction = chat_history_compactor.compact(
+                messages, request.format, reserved_tokens=prompt_tokens(system_prompt.text)
+            )
+            compact_span.set(
+                tokens_before=compaction.tokens_before,
+                tokens_after=compaction.tokens_after,
+                summarized_messages=compaction.summarized_messages,
+            )
+        messages = compaction.messages
+    try:
+        lease = await acquire_ai_lease(request.aiProvider, http_request)
+    except (RateLimitExceeded, BudgetExceeded) as e:
+        raise rate_limited(e)
+
+    turn = chat_streams.open()
+
+    async def produce():
+        # Draw.io answers additionally report each <mxCell> as soon as it closes
+        cells = DrawioStreamTracker() if request.format == DiagramFormat.DRAWIO else None
+        with observe_stream("chat_stream") as stream:
+            try:
+                if compaction is not None and compaction.compacted:
+                    await turn.emit({
+                        'type': 'context',
+                        'summarized_messages': compaction.summarized_messages,
+                        'tokens_before': compaction.tokens_before,
+                        'tokens_after': compaction.tokens_after,
+                    })
+                async with account_ai_call("chat", request.aiProvider, http_request, request) as usage:
+                    async with borrow_ai_client(request.aiProvider, http_request, limit=False) as (service, client):
+                        with observe_ai_call(request.aiProvider.value, service.model, "chat_stream", usage) as call:
+                            async for chunk in traced_stream(
+                                "llm.stream",
+                                service.chat_stream(messages, request.diagramType, request.format, client=client),
+                                provider=request.aiProvider.value, model=service.model, operation="chat_stream",
+                            ):
+                                call.first_token()
+                                # DeepSeek returns dicts with type and content (reasoning/content)
+                                if isinstance(chunk, dict):
+                                    await turn.emit(chunk)
+                                    text = chunk.get('content') if chunk.get('type') == 'content' else None
+                                else:
+                                    await turn.emit({'type': 'chunk', 'content': chunk})
+                                    text = chunk
+                                if cells is not None and text:
+                                    for cell in cells.feed(text):
+                                        await turn.emit({'type': 'cell', 'cell': cell})
+
+                if cells is not None:
+                    for cell in cells.finish():
+                        await turn.emit({'type': 'cell', 'cell': cell})
+                done = {'type': 'done'}
+                if usage.calls:
+                    done['usage'] = usage.as_dict()
+                await turn.emit(done)
+                stream.outcome = "done"
+            except Exception as e:
+                stream.outcome = "error"
+                await turn.emit({'type': 'error', 'message': str(e)})
+            finally:
+                await lease.release()
+                await turn.close()
+
+    # The upstream call runs detached, so a dropped connection can resume instead of re-running the turn
+    chat_streams.start(turn, produce())
+    return StreamingResponse(
+        resumable_sse(turn.id, turn.tail()),
+        media_type="text/event-stream",
+        headers={**SSE_HEADERS, STREAM_ID_HEADER: turn.id},
+    )
+
+
+@router.get("/ai/chat/stream/{stream_id}")
+async def resume_chat_stream(
+    stream_id: str,
+    http_request: Request,
+    last_event_id: Optional[int] = Query(default=None, ge=0),
+):
+    """Reconnect to a chat turn: replay the events after ``Last-Event-ID``, then follow it live
+
+    The id comes from the ``Last-Event-ID`` header (or the ``last_event_id``
+    query parameter); without one the turn is replayed from the start.
+    """
+    header = http_request.headers.get("Last-Event-ID")
+    if last_event_id is None and header:
+        if not header.isdigit():
+            raise HTTPException(status_code=400, detail="Last-Event-ID must be an event id")
+        last_event_id = int(header)
+    events = await chat_streams.resume(stream_id, last_event_id or 0)
+    if events is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    return StreamingResponse(
+        resumable_sse(stream_id, events),
+        media_type="text/event-stream",
+        headers={**SSE_HEADERS, STREAM_ID_HEADER: stream_id},
+    )
+
+
+@router.delete("/ai/chat/stream/{stream_id}")
+async def cancel_chat_stream(stream_id: str):
+    """Stop a chat turn and its upstream call
+
+    The turn runs detached from the connection, so aborting the request does
+    not stop it. Clients call this when the user stops or discards a reply.
+    Readers get an error event that ends the stream.
+    """
+    try:
+        stopped = await chat_streams.stop(stream_id)
+    except RedisError as e:
+        logger.warning("Stream %s could not be stopped: %s", stream_id, e)
+        raise HTTPException(status_code=503, detail="Stream could not be stopped")
+    if not stopped:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    return {"message": "Stream stopped"}
 
 
 # CRUD endpoints for diagrams
@@ -343,40 +1022,177 @@ def delete_diagram(diagram_id: str, db: Session = Depends(get_db)):
 
 
 # Export endpoints
+EXPORT_MEDIA_TYPES = {
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "pdf": "application/pdf",
+}
+
+
+def attachment_disposition(filename: str) -> str:
+    """Content-Disposition for a download, with an RFC 5987 UTF-8 name and an ASCII fallback"""
+    fallback = filename.encode("ascii", "replace").decode("ascii").replace("?", "_")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+async def cached_export(code: str, format: str, diagram_format: str) -> tuple[bytes, str]:
+    """Export bytes from the render cache, rendering and storing them on a miss, and HIT or MISS"""
+    key = export_service.cache_key(code, format, diagram_format)
+    data = await render_cache.get(key)
+    if data is not None:
+        return data, "HIT"
+    with observe_export(format), span("export.render", format=format):
+        data = await export_service.export(code, format, diagram_format)
+    await render_cache.set(key, data)
+    return data, "MISS"
+
+
 @router.get("/diagrams/{diagram_id}/export")
 async def export_diagram(
     diagram_id: str,
+    http_request: Request,
     format: str = "svg",
     db: Session = Depends(get_db)
 ):
-    """Export diagram to various formats"""
+    """Export diagram to various formats
+
+    Exports are cached by content: the ETag is a hash of the code, format and
+    renderer version, so a client holding the current file gets a 304 and an
+    unchanged diagram is never rendered twice.
+    """
     # Get diagram
     diagram = db.query(Diagram).filter(Diagram.id == diagram_id).first()
     if not diagram:
         raise HTTPException(status_code=404, detail="Diagram not found")
 
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unsupported format")
+
+    key = export_service.cache_key(diagram.code, format, diagram.format)
+    headers = {
+        "ETag": f'"{key}"',
+        # The diagram can change under the same URL; revalidate before reusing a stored copy
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": attachment_disposition(member_name(diagram.title, format, set())),
+    }
+    if etag_matches(http_request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers={name: headers[name] for name in ("ETag", "Cache-Control")})
+
     try:
-        if format == "svg":
-            data = await export_service.export_svg(diagram.code)
-            media_type = "image/svg+xml"
-            filename = f"{diagram.title}.svg"
-        elif format == "png":
-            data = await export_service.export_png(diagram.code)
-            media_type = "image/png"
-            filename = f"{diagram.title}.png"
-        elif format == "pdf":
-            data = await export_service.export_pdf(diagram.code)
-            media_type = "application/pdf"
-            filename = f"{diagram.title}.pdf"
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported format")
-
-        return Response(
-            content=data,
-            media_type=media_type,
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"'
-            }
-        )
+        data, headers[CACHE_STATUS_HEADER] = await cached_export(diagram.code, format, diagram.format)
+        return Response(content=data, media_type=EXPORT_MEDIA_TYPES[format], headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
+
+
+async def export_archive_member(diagram: Diagram, format: str) -> tuple[dict, Optional[bytes]]:
+    """Manifest entry for one diagram of a bulk export, and its file unless the export failed"""
+    entry = {'id': diagram.id, 'title': diagram.title}
+    try:
+        data, cache_status = await cached_export(diagram.code, format, diagram.format)
+    except HTTPException as e:
+        return {**entry, 'status': e.status_code, 'error': e.detail}, None
+    except Exception as e:
+        return {**entry, 'status': 500, 'error': f"Export failed: {str(e)}"}, None
+    return {**entry, 'status': 200, 'cache': cache_status}, data
+
+
+@router.post("/diagrams/export")
+async def bulk_export_diagrams(request: BulkExportRequest, db: Session = Depends(get_db)):
+    """Export many diagrams as one ZIP archive, streamed as it is written
+
+    Selects the diagrams in ``ids`` (in that order), or every diagram matching
+    the filters, at most EXPORT_BULK_MAX_DIAGRAMS. Up to ``concurrency``
+    renders (capped by EXPORT_BULK_MAX_CONCURRENCY) run at once, each through
+    the render cache like /diagrams/{id}/export. Each file is sent as soon as
+    it is rendered, so archive members come in completion order. Finished
+    renders wait in a queue of ``concurrency`` entries, so a slow client holds
+    back the renders instead of piling them up in memory. ``manifest.json``
+    ends the archive. It lists every requested diagram with its file name or
+    the status and error it failed with. Unknown ids are listed as 404.
+    """
+    query = db.query(Diagram)
+    if request.ids:
+        ids = list(dict.fromkeys(request.ids))
+        if len(ids) > settings.EXPORT_BULK_MAX_DIAGRAMS:
+            raise HTTPException(
+                status_code=400, detail=f"An archive holds at most {settings.EXPORT_BULK_MAX_DIAGRAMS} diagrams"
+            )
+        query = query.filter(Diagram.id.in_(ids))
+    if request.type:
+        query = query.filter(Diagram.type == request.type)
+    if request.diagramFormat:
+        query = query.filter(Diagram.format == request.diagramFormat)
+    if request.search:
+        query = query.filter(Diagram.title.ilike(f"%{request.search}%"))
+    if request.ids:
+        found = {diagram.id: diagram for diagram in query.all()}
+        diagrams = [found[diagram_id] for diagram_id in ids if diagram_id in found]
+        missing = [diagram_id for diagram_id in ids if diagram_id not in found]
+    else:
+        diagrams = query.order_by(Diagram.created_at, Diagram.id).limit(settings.EXPORT_BULK_MAX_DIAGRAMS + 1).all()
+        missing = []
+        if len(diagrams) > settings.EXPORT_BULK_MAX_DIAGRAMS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"More than {settings.EXPORT_BULK_MAX_DIAGRAMS} diagrams match; narrow the filters",
+            )
+    if not diagrams and not missing:
+        raise HTTPException(status_code=404, detail="No diagrams match")
+
+    format = request.format.value
+    concurrency = min(request.concurrency or settings.EXPORT_BULK_MAX_CONCURRENCY, settings.EXPORT_BULK_MAX_CONCURRENCY)
+
+    async def generate():
+        started = time.perf_counter()
+        archive = ZipStream()
+        finished: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+        pending = iter(diagrams)
+
+        async def worker():
+            for diagram in pending:  # Shared by the workers; each diagram is taken once
+                await finished.put((diagram, *await export_archive_member(diagram, format)))
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(diagrams)))]
+        entries = {}
+        taken = {"manifest.json"}
+        with observe_stream("export_bulk") as stream:
+            try:
+                for _ in diagrams:
+                    diagram, entry, data = await finished.get()
+                    if data is not None:
+                        entry.update(file=member_name(diagram.title, format, taken), bytes=len(data))
+                        # Deflate is CPU-bound; PNG and PDF are already compressed and stored as they are
+                        yield await run_in_threadpool(
+                            archive.add, entry['file'], data, format == "svg", diagram.updated_at
+                        )
+                    entries[diagram.id] = entry
+                manifest = {
+                    'format': format,
+                    'created_at': datetime.utcnow().isoformat() + "Z",
+                    'total': len(diagrams) + len(missing),
+                    'succeeded': sum(1 for entry in entries.values() if entry['status'] == 200),
+                    'failed': sum(1 for entry in entries.values() if entry['status'] != 200) + len(missing),
+                    'total_ms': elapsed_ms(started),
+                    'diagrams': [entries[diagram.id] for diagram in diagrams] + [
+                        {'id': diagram_id, 'status': 404, 'error': "Diagram not found"} for diagram_id in missing
+                    ],
+                }
+                yield archive.add("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+                yield archive.close()
+                stream.outcome = "done"
+            finally:
+                # Client went away: stop the renders still running
+                for task in workers:
+                    task.cancel()
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="diagrams-{format}.zip"',
+            "X-Accel-Buffering": "no",
+        },
+    )
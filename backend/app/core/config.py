@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, List
 from pathlib import Path
 import os
 
@@ -55,6 +55,110 @@ class Settings(BaseSettings):
     DEEPSEEK_API_KEY: str = ""
     DEEPSEEK_BASE_URL: str = "https://api.deepseek.com"
 
+    # AI provider clients
+    AI_CLIENT_POOL_SIZE: int = 32  # Warm SDK clients kept per worker (LRU)
+
+    # AI response cache (Redis)
+    AI_CACHE_ENABLED: bool = True
+    AI_CACHE_TTL_SECONDS: int = 60 * 60 * 24  # 1 day
+    AI_CACHE_DISABLED_ENDPOINTS: List[str] = []  # e.g. ["refine"]; values: generate, refine, explain
+
+    # Near-duplicate prompt cache for /ai/generate (local NumPy index)
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_THRESHOLD: float = 0.9  # Cosine similarity needed to reuse a diagram
+    SEMANTIC_CACHE_DIMENSIONS: int = 1024
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 5000
+    SEMANTIC_CACHE_TTL_SECONDS: int = 60 * 60 * 24  # Same as AI_CACHE_TTL_SECONDS by default; 0 = never expire
+    SEMANTIC_CACHE_DIR: str = str(BASE_DIR / "data" / "semantic_cache")  # Empty disables persistence
+    SEMANTIC_CACHE_SYNONYMS_PATH: str = ""  # Optional JSON {"canonical": ["variant", ...]}
+
+    # Coalescing of identical in-flight AI requests (in-process + Redis lock)
+    AI_SINGLE_FLIGHT_ENABLED: bool = True
+    AI_SINGLE_FLIGHT_LOCK_TTL_SECONDS: int = 300  # Should exceed the slowest provider call
+    AI_SINGLE_FLIGHT_WAIT_TIMEOUT_SECONDS: int = 300
+
+    # Upstream concurrency / rate limits per provider and API key (Redis, all workers)
+    AI_RATE_LIMIT_ENABLED: bool = True
+    AI_RATE_LIMIT_MAX_CONCURRENCY: Dict[str, int] = {"claude": 8, "openai": 8, "deepseek": 4}
+    AI_RATE_LIMIT_REQUESTS_PER_MINUTE: Dict[str, int] = {"claude": 50, "openai": 60, "deepseek": 60}
+    AI_RATE_LIMIT_BURST: int = 10  # Token bucket capacity
+    AI_RATE_LIMIT_MAX_QUEUE: int = 50  # Callers allowed to wait per provider/key
+    AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS: float = 30.0
+    AI_RATE_LIMIT_LEASE_TTL_SECONDS: int = 600  # Frees slots held by crashed workers
+
+    # Token usage accounting (ai_usage table) and per-key daily budgets
+    AI_USAGE_TRACKING_ENABLED: bool = True
+    AI_USAGE_DAILY_TOKEN_BUDGET: int = 0  # Input + output tokens per key per UTC day; 0 = unlimited
+    AI_USAGE_KEY_BUDGETS: Dict[str, int] = {}  # Per key fingerprint (see /ai/usage), overrides the default
+
+    # Bulk generation (/ai/generate/batch)
+    AI_BATCH_MAX_ITEMS: int = 100
+    AI_BATCH_MAX_CONCURRENCY: int = 4  # Items in flight per batch; rate limits still apply per call
+
+    # Background AI jobs (/ai/jobs, Redis); workers run in-process and/or via `python -m app.worker`
+    AI_JOBS_INPROCESS_WORKERS: int = 2  # Jobs run concurrently per API process; 0 = external workers only
+    AI_JOBS_RESULT_TTL_SECONDS: int = 60 * 60 * 24  # Counted from the job's last update
+    AI_JOBS_MAX_ATTEMPTS: int = 3  # Runs per job, counting retries after rate limits and lost workers
+    AI_JOBS_LEASE_SECONDS: int = 30  # A running job whose lease is not renewed for this long is requeued
+
+    # Chat history compaction (/ai/chat/stream)
+    CHAT_HISTORY_COMPACTION_ENABLED: bool = True
+    CHAT_HISTORY_TOKEN_BUDGET: int = 12000  # Estimated input tokens, system prompt included
+    CHAT_HISTORY_KEEP_TURNS: int = 4  # Most recent user turns sent verbatim
+    CHAT_HISTORY_SUMMARY_TOKENS: int = 800  # Budget for the summary of older turns
+    # Replay window for reconnects to /ai/chat/stream; 0 = a disconnect cancels the turn
+    CHAT_STREAM_RESUME_TTL_SECONDS: int = 300
+
+    # Local fake LLM provider ("fake") for offline load testing; never enable in production
+    FAKE_PROVIDER_ENABLED: bool = False
+    FAKE_PROVIDER_LATENCY_MS: int = 50  # Connection/queueing overhead per call
+    FAKE_PROVIDER_TTFT_MS: int = 300  # Time to first output token
+    FAKE_PROVIDER_TOKENS_PER_SECOND: float = 80.0  # Output rate; 0 = instant
+    FAKE_PROVIDER_REASONING_CHUNKS: int = 0  # DeepSeek-style reasoning chunks before the answer
+    FAKE_PROVIDER_ERROR_RATE: float = 0.0  # Fraction of requests that fail, chosen by a hash of the input
+    FAKE_PROVIDER_SEED: int = 0
+
+    # Export rendering (per API process)
+    EXPORT_MAX_CONCURRENT_RENDERS: int = 4
+    EXPORT_QUEUE_TIMEOUT_SECONDS: float = 15.0  # Wait for a render slot before answering 503
+    EXPORT_RENDER_TIMEOUT_SECONDS: float = 30.0  # Per mmdc run (fallback path)
+    EXPORT_PDF_MODE: str = "vector"  # vector (selectable text, small files) or raster (PNG at 3x wrapped in a PDF)
+    EXPORT_BULK_MAX_DIAGRAMS: int = 500  # Per /diagrams/export archive
+    EXPORT_BULK_MAX_CONCURRENCY: int = 4  # Renders in flight per archive; EXPORT_MAX_CONCURRENT_RENDERS still applies
+
+    # Mermaid export renderer workers (renderer/mermaid-worker.mjs; run `npm install` there)
+    RENDER_POOL_ENABLED: bool = True  # Falls back to one mmdc process per export when workers cannot start
+    RENDER_POOL_COMMAND: str = ""  # Worker command line; default: node renderer/mermaid-worker.mjs
+    RENDER_POOL_SIZE: int = 2  # Warm browsers per API process
+    RENDER_POOL_MAX_JOBS: int = 500  # Renders before a worker is replaced
+    RENDER_POOL_MAX_RSS_MB: int = 1024  # Node + Chromium memory before a worker is replaced; 0 = no limit
+    RENDER_POOL_MAX_QUEUE: int = 50  # Exports allowed to wait for a worker
+    RENDER_POOL_QUEUE_TIMEOUT_SECONDS: float = 15.0
+    RENDER_POOL_JOB_TIMEOUT_SECONDS: float = 30.0
+
+    # Draw.io exports are drawn in-process (app/services/drawio_renderer.py); no browser needed
+    DRAWIO_FONT_PATH: str = ""  # TrueType/OpenType font for PNG/PDF labels; set a CJK font for Chinese text
+    DRAWIO_FONT_BOLD_PATH: str = ""
+
+    # Rendered export cache (app/services/render_cache.py), keyed by code, format and renderer version
+    RENDER_CACHE_DIR: str = str(BASE_DIR / "data" / "render_cache")  # Empty disables the disk tier
+    RENDER_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    RENDER_CACHE_REDIS_ENABLED: bool = False  # Share artifacts between API processes/hosts
+    RENDER_CACHE_REDIS_TTL_SECONDS: int = 60 * 60 * 24 * 7
+    RENDER_CACHE_REDIS_MAX_BYTES: int = 2 * 1024 * 1024  # Larger artifacts stay on local disk only
+    RENDER_CACHE_VERSION: str = "1"  # Bump to invalidate every cached export (e.g. after a renderer upgrade)
+
+    # Prometheus metrics (/metrics); set PROMETHEUS_MULTIPROC_DIR when running several workers
+    METRICS_ENABLED: bool = True
+
+    # Request tracing (app/core/tracing.py)
+    TRACING_ENABLED: bool = True
+    TRACING_EXPORTER: str = "jsonl"  # jsonl, none, or "package.module:factory"
+    TRACING_FILE: str = str(BASE_DIR / "data" / "traces.jsonl")
+    TRACING_SLOW_MS: int = 2000  # Traces at least this slow are always exported in full
+    TRACING_SAMPLE_RATE: float = 0.01  # Fraction of other traces exported (errors always are)
+    TRACING_MAX_SPANS: int = 500  # Per trace; further spans are counted, not kept
+
     # Security
     SECRET_KEY: str = "your-secret-key-change-in-production"
     ALGORITHM: str = "HS256"
@@ -0,0 +1,288 @@
+"""Prometheus metrics
+
+Everything is labelled with bounded values only: provider and model names
+from the service singletons, route templates (never raw paths), operation
+names, export formats and a fixed set of error types. Per-diagram, per-key and
+per-user values never become labels.
+
+With several workers, set ``PROMETHEUS_MULTIPROC_DIR`` to an empty,
+writable directory before starting the server. Each worker then writes its
+samples there and ``/metrics`` aggregates all of them. Under gunicorn, call
+``mark_process_dead`` from the ``child_exit`` hook.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    REGISTRY,
+)
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+UPSTREAM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+STREAM_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKEN_KINDS = ("input", "output", "cached_input", "cache_write", "reasoning")
+UNMATCHED_ROUTE = "unmatched"
+HTTP_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route template and status class",
+    ["method", "route", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request duration, streaming bodies included",
+    ["method", "route"], buckets=LATENCY_BUCKETS,
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being served",
+    ["method", "route"], multiprocess_mode="livesum",
+)
+
+AI_UPSTREAM_SECONDS = Histogram(
+    "ai_upstream_request_seconds", "Upstream AI call duration",
+    ["provider", "model", "operation", "outcome"], buckets=UPSTREAM_BUCKETS,
+)
+AI_TTFT_SECONDS = Histogram(
+    "ai_time_to_first_token_seconds", "Time from upstream call start to the first streamed token",
+    ["provider", "model", "operation"], buckets=LATENCY_BUCKETS,
+)
+AI_TOKENS = Counter(
+    "ai_tokens_total", "Tokens reported by upstream providers",
+    ["provider", "model", "kind"],
+)
+AI_ERRORS = Counter(
+    "ai_errors_total", "Failed upstream AI calls by error type",
+    ["provider", "operation", "error_type"],
+)
+AI_RATE_LIMIT_WAIT_SECONDS = Histogram(
+    "ai_rate_limit_wait_seconds", "Time spent waiting for an upstream slot",
+    ["provider"], buckets=LATENCY_BUCKETS,
+)
+AI_RATE_LIMIT_QUEUE_DEPTH = Gauge(
+    "ai_rate_limit_queue_depth", "Requests waiting for an upstream slot",
+    ["provider"], multiprocess_mode="livesum",
+)
+AI_RATE_LIMIT_REJECTIONS = Counter(
+    "ai_rate_limit_rejections_total", "Requests rejected by the upstream rate limiter",
+    ["provider", "reason"],
+)
+
+SSE_STREAM_SECONDS = Histogram(
+    "sse_stream_duration_seconds", "Server-sent event stream duration",
+    ["route", "outcome"], buckets=STREAM_BUCKETS,
+)
+
+EXPORT_RENDER_SECONDS = Histogram(
+    "export_render_seconds", "Diagram export render time",
+    ["format", "outcome"], buckets=LATENCY_BUCKETS,
+)
+MMDC_FAILURES = Counter(
+    "export_mmdc_failures_total", "mermaid-cli invocations that failed",
+    ["format", "reason"],
+)
+
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds", "Database statement execution time by route",
+    ["route", "statement"], buckets=DB_BUCKETS,
+)
+
+# Route template of the request being served, for labelling DB time
+_current_route: ContextVar[str] = ContextVar("metrics_route", default="background")
+
+_ERROR_TYPES = (
+    ("RateLimit", "rate_limited"),
+    ("Timeout", "timeout"),
+    ("Authentication", "auth"),
+    ("PermissionDenied", "auth"),
+    ("Connection", "connection"),
+    ("BadRequest", "bad_request"),
+    ("NotFound", "not_found"),
+    ("InternalServer", "server"),
+    ("ServiceUnavailable", "server"),
+    ("Patch", "invalid_output"),
+    ("JSONDecode", "invalid_output"),
+)
+
+
+def error_type(exc: BaseException) -> str:
+    """Bounded error label from an exception's class hierarchy
+
+    Matching on class names covers the Anthropic and OpenAI SDK exceptions
+    without importing either SDK here.
+    """
+    for cls in type(exc).__mro__:
+        for fragment, label in _ERROR_TYPES:
+            if fragment in cls.__name__:
+                return label
+    if isinstance(exc, TimeoutError):
+        return "timeout"
+    return "other"
+
+
+class AICallObservation:
+    def __init__(self, provider: str, model: str, operation: str, started: float):
+        self.provider = provider
+        self.model = model
+        self.operation = operation
+        self.started = started
+        self.first_token_at: Optional[float] = None
+
+    def first_token(self) -> None:
+        """Mark the first streamed token; later calls are ignored"""
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            AI_TTFT_SECONDS.labels(self.provider, self.model, self.operation).observe(
+                self.first_token_at - self.started
+            )
+
+
+def _token_counts(usage) -> tuple[int, ...]:
+    if usage is None:
+        return (0,) * len(TOKEN_KINDS)
+    return (
+        usage.input_tokens, usage.output_tokens, usage.cached_input_tokens,
+        usage.cache_write_tokens, usage.reasoning_tokens,
+    )
+
+
+@contextmanager
+def observe_ai_call(provider: str, model: str, operation: str, usage=None):
+    """Time an upstream call and count its tokens and errors
+
+    ``usage`` is the ``UsageCounter`` the call records into; what the call
+    adds to it is added to the token counters.
+    """
+    before = _token_counts(usage)
+    call = AICallObservation(provider, model, operation, time.perf_counter())
+    outcome = "error"
+    try:
+        yield call
+        outcome = "ok"
+    except Exception as e:
+        AI_ERRORS.labels(provider, operation, error_type(e)).inc()
+        raise
+    finally:
+        AI_UPSTREAM_SECONDS.labels(provider, model, operation, outcome).observe(
+            time.perf_counter() - call.started
+        )
+        for kind, count, previous in zip(TOKEN_KINDS, _token_counts(usage), before):
+            if count > previous:
+                AI_TOKENS.labels(provider, model, kind).inc(count - previous)
+
+
+class StreamObservation:
+    def __init__(self):
+        self.outcome = "disconnected"
+
+
+@contextmanager
+def observe_stream(route: str):
+    """Time an SSE generator; set ``.outcome`` before it finishes normally"""
+    stream = StreamObservation()
+    started = time.perf_counter()
+    try:
+        yield stream
+    finally:
+        SSE_STREAM_SECONDS.labels(route, stream.outcome).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def observe_export(diagram_format: str):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        EXPORT_RENDER_SECONDS.labels(diagram_format, outcome).observe(time.perf_counter() - started)
+
+
+def route_template(app, scope) -> str:
+    """Path template of the route matching ``scope``, e.g. /api/diagrams/{diagram_id}"""
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", UNMATCHED_ROUTE)
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """ASGI middleware for request counts, durations and in-flight gauges"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"] if scope["method"] in HTTP_METHODS else "OTHER"
+        route = route_template(scope["app"], scope)
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        token = _current_route.set(route)
+        in_flight = HTTP_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_SECONDS.labels(method, route).observe(time.perf_counter() - started)
+            HTTP_REQUESTS.labels(method, route, f"{status['code'] // 100}xx").inc()
+            in_flight.dec()
+            _current_route.reset(token)
+
+
+def instrument_engine(engine) -> None:
+    """Time every statement on ``engine``, labelled with the current route"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_query_start"].pop()
+        verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        if verb not in ("select", "insert", "update", "delete"):
+            verb = "other"
+        DB_QUERY_SECONDS.labels(_current_route.get(), verb).observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("metrics_query_start")
+            if starts:
+                starts.pop()
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Exposition body and content type, aggregated across workers when multiprocess"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop a dead worker's live gauges (gunicorn ``child_exit`` hook)"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -1,9 +1,18 @@
 import redis
+import redis.asyncio as aioredis
 from app.core.config import settings
 
 redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
 
+# Async client for use inside request handlers so Redis round trips never block the event loop
+async_redis_client = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+
 
 def get_redis():
     """Redis dependency"""
-    return redis_client
\ No newline at end of file
+    return redis_client
+
+
+def get_async_redis():
+    """Async Redis dependency"""
+    return async_redis_client
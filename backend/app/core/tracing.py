@@ -0,0 +1,335 @@
+"""Lightweight request tracing
+
+Each HTTP request gets a root span from ``TracingMiddleware``. Code on the
+request path opens nested spans with ``span(name, **attributes)``. These
+come from the routes, the AI services, code cleanup, the DB engine and the
+export renderer. Outside a traced request ``span`` does nothing, so library
+code can use it unconditionally.
+
+A finished trace goes to the configured exporter if it is slow
+(``TRACING_SLOW_MS``), contains an error, or is picked at random
+(``TRACING_SAMPLE_RATE``). An exported trace always includes every span. The
+default exporter appends one JSON object per trace to ``TRACING_FILE``.
+Set ``TRACING_EXPORTER`` to ``"none"`` to disable export, or to
+``"package.module:factory"`` to plug in another exporter.
+"""
+import importlib
+import json
+import logging
+import queue
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional, Protocol
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class SpanExporter(Protocol):
+    def export(self, trace: dict) -> None:
+        ...
+
+
+class Trace:
+    def __init__(self, max_spans: int):
+        self.trace_id = secrets.token_hex(16)
+        self.max_spans = max_spans
+        self.spans: list["Span"] = []
+        self.dropped_spans = 0
+        self.error = False
+
+    def add(self, span: "Span") -> bool:
+        if len(self.spans) >= self.max_spans:
+            self.dropped_spans += 1
+            return False
+        self.spans.append(span)  # list.append is atomic, so threadpool spans are safe
+        return True
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "started", "start_wall", "ended", "status")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.start_wall = time.time()
+        self.ended: Optional[float] = None
+        self.status = "ok"
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, exc: BaseException) -> None:
+        self.status = "error"
+        self.attributes["error.type"] = type(exc).__name__
+        self.attributes["error.message"] = str(exc)[:200]
+        self.trace.error = True
+
+    def end(self) -> None:
+        if self.ended is None:
+            self.ended = time.perf_counter()
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.ended or time.perf_counter()) - self.started) * 1000
+
+    def as_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(self.start_wall, timezone.utc).isoformat(timespec="microseconds"),
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    duration_ms = 0.0
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def record_error(self, exc: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def start_span(name: str, **attributes):
+    """Start a child of the current span without making it current
+
+    For work that outlives the calling frame, such as a streamed response
+    consumed across many ``yield``\\ s. The caller must call ``end()``.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    child = Span(parent.trace, name, parent.span_id, attributes)
+    return child if parent.trace.add(child) else NOOP_SPAN
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator:
+    """Nested span around a block; a no-op outside a traced request"""
+    child = start_span(name, **attributes)
+    if child is NOOP_SPAN:
+        yield child
+        return
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        child.end()
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            # Closed from another context (an abandoned async generator)
+            pass
+
+
+async def traced_stream(name: str, stream, **attributes):
+    """Re-yield an async iterator inside a span that records time to first chunk"""
+    child = start_span(name, **attributes)
+    chunks = 0
+    try:
+        async for chunk in stream:
+            if chunks == 0:
+                child.set(ttft_ms=round(child.duration_ms, 3))
+            chunks += 1
+            yield chunk
+    except Exception as e:
+        child.record_error(e)
+        raise
+    finally:
+        child.set(chunks=chunks)
+        child.end()
+
+
+@contextmanager
+def start_trace(name: str, **attributes) -> Iterator:
+    """Root span of a new trace; exported on exit if the sampler keeps it"""
+    if not settings.TRACING_ENABLED or _current_span.get() is not None:
+        with span(name, **attributes) as child:
+            yield child
+        return
+    trace = Trace(settings.TRACING_MAX_SPANS)
+    root = Span(trace, name, None, attributes)
+    trace.add(root)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.record_error(e)
+        raise
+    finally:
+        root.end()
+        _current_span.reset(token)
+        _finish(trace, root)
+
+
+def _should_export(trace: Trace, root: Span) -> bool:
+    if root.duration_ms >= settings.TRACING_SLOW_MS or trace.error:
+        return True
+    return random.random() < settings.TRACING_SAMPLE_RATE
+
+
+def _finish(trace: Trace, root: Span) -> None:
+    exporter = get_exporter()
+    if exporter is None or not _should_export(trace, root):
+        return
+    # Spans still open (an unfinished stream) are reported with their duration so far
+    payload = {
+        "trace_id": trace.trace_id,
+        "name": root.name,
+        "duration_ms": round(root.duration_ms, 3),
+        "slow": root.duration_ms >= settings.TRACING_SLOW_MS,
+        "error": trace.error,
+        "dropped_spans": trace.dropped_spans,
+        "spans": [s.as_dict() for s in trace.spans],
+    }
+    try:
+        exporter.export(payload)
+    except Exception as e:
+        logger.warning("Trace export failed: %s", e)
+
+
+class JsonLinesExporter:
+    """Append traces to a file, one JSON object per line, from a writer thread"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def export(self, trace: dict) -> None:
+        self._queue.put(json.dumps(trace, ensure_ascii=False, default=str))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get())
+            try:
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+            except OSError as e:
+                logger.warning("Could not write traces to %s: %s", self.path, e)
+
+
+class InMemoryExporter:
+    """Keeps exported traces in a list (tests, debugging)"""
+
+    def __init__(self):
+        self.traces: list[dict] = []
+
+    def export(self, trace: dict) -> None:
+        self.traces.append(trace)
+
+
+_exporter: Optional[SpanExporter] = None
+_exporter_loaded = False
+
+
+def _load_exporter() -> Optional[SpanExporter]:
+    name = settings.TRACING_EXPORTER
+    if name == "none":
+        return None
+    if name == "jsonl":
+        return JsonLinesExporter(settings.TRACING_FILE)
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+
+def get_exporter() -> Optional[SpanExporter]:
+    global _exporter, _exporter_loaded
+    if not _exporter_loaded:
+        _exporter = _load_exporter()
+        _exporter_loaded = True
+    return _exporter
+
+
+def set_exporter(exporter: Optional[SpanExporter]) -> None:
+    global _exporter, _exporter_loaded
+    _exporter, _exporter_loaded = exporter, True
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a root span per HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.TRACING_ENABLED:
+            return await self.app(scope, receive, send)
+        from app.core.metrics import route_template
+
+        route = route_template(scope["app"], scope)
+        with start_trace(f"{scope['method']} {route}", **{"http.method": scope["method"], "http.route": route}) as root:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    root.set(**{"http.status_code": message["status"]})
+                    if message["status"] >= 500:
+                        root.status = "error"
+                        root.trace.error = True
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+def instrument_engine(engine) -> None:
+    """Open a ``db.query`` span for every statement executed on ``engine``"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+        # Statement text only; parameters may hold user data
+        child = start_span("db.query", **{"db.operation": verb, "db.statement": statement[:300]})
+        conn.info.setdefault("trace_spans", []).append(child)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["trace_spans"].pop().end()
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            spans = context.connection.info.get("trace_spans")
+            if spans:
+                child = spans.pop()
+                child.record_error(context.original_exception)
+                child.end()
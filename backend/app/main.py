@@ -1,7 +1,15 @@
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
+from app.core.database import engine
+from app.core import metrics, tracing
 from app.api.routes import router as api_router
+from app.services.ai.client_pool import client_pool
+from app.services.jobs import JobWorker, job_queue
+from app.services.renderer_pool import renderer_pool
+from app.services.semantic_cache import semantic_cache
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -16,12 +24,46 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],  # Lets the chat panel stop a turn (DELETE /ai/chat/stream/{id})
 )
 
+if settings.TRACING_ENABLED:
+    app.add_middleware(tracing.TracingMiddleware)
+    tracing.instrument_engine(engine)
+
+if settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine)
+
 # Include API router
 app.include_router(api_router, prefix="/api")
 
 
+job_worker = JobWorker(job_queue, settings.AI_JOBS_INPROCESS_WORKERS)
+job_worker_task = None
+
+
+@app.on_event("startup")
+async def startup():
+    global job_worker_task
+    await semantic_cache.load()
+    if settings.AI_JOBS_INPROCESS_WORKERS > 0:
+        job_worker_task = asyncio.create_task(job_worker.run())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if job_worker_task is not None:
+        job_worker.stop()
+        try:
+            await asyncio.wait_for(job_worker_task, timeout=settings.AI_JOBS_LEASE_SECONDS)
+        except asyncio.TimeoutError:
+            pass  # wait_for cancelled the running jobs, which put them back on the queue
+    await client_pool.aclose()
+    await renderer_pool.aclose()
+    await semantic_cache.flush()
+
+
 @app.get("/")
 async def root():
     return {
@@ -33,4 +75,12 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+
+if settings.METRICS_ENABLED:
+    @app.get("/metrics", include_in_schema=False)
+    def prometheus_metrics():
+        """Prometheus exposition, aggregated across workers in multiprocess mode"""
+        body, content_type = metrics.render_latest()
+        return Response(content=body, media_type=content_type)
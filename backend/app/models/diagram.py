@@ -25,6 +25,8 @@ class DiagramFormatEnum(str, enum.Enum):
 class AIProviderEnum(str, enum.Enum):
     CLAUDE = "claude"
     OPENAI = "openai"
+    DEEPSEEK = "deepseek"
+    FAKE = "fake"
 
 
 class Diagram(Base):
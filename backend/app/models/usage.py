@@ -0,0 +1,30 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from datetime import datetime
+from app.core.database import Base
+
+
+class AIUsageRecord(Base):
+    """Token usage and latency of one AI request, by caller key and diagram"""
+    __tablename__ = "ai_usage"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    key_hash = Column(String(16), nullable=False)  # key_fingerprint() of the caller's API key
+    provider = Column(String(20), nullable=False)
+    model = Column(String(100), nullable=False)
+    endpoint = Column(String(30), nullable=False)  # generate, generate_stream, refine, explain, chat
+    diagram_type = Column(String(20), nullable=True)
+    diagram_format = Column(String(10), nullable=True)
+    diagram_id = Column(String, ForeignKey("diagrams.id", ondelete="SET NULL"), nullable=True, index=True)
+    status = Column(String(10), nullable=False, default="ok")  # ok, error
+    input_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    reasoning_tokens = Column(Integer, nullable=False, default=0)
+    cached_input_tokens = Column(Integer, nullable=False, default=0)
+    cache_write_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_ai_usage_created_at", "created_at"),
+        Index("ix_ai_usage_key_hash_created_at", "key_hash", "created_at"),
+    )
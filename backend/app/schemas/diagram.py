@@ -22,10 +22,22 @@ class DiagramFormat(str, Enum):
     DRAWIO = "drawio"
 
 
+class ExportFormat(str, Enum):
+    SVG = "svg"
+    PNG = "png"
+    PDF = "pdf"
+
+
 class AIProvider(str, Enum):
     CLAUDE = "claude"
     OPENAI = "openai"
     DEEPSEEK = "deepseek"
+    FAKE = "fake"  # Local canned responses, only when FAKE_PROVIDER_ENABLED
+
+
+class RefineMode(str, Enum):
+    FULL = "full"  # Model returns the complete modified diagram
+    PATCH = "patch"  # Model returns edit operations, applied server-side
 
 
 class DiagramBase(BaseModel):
@@ -62,11 +74,44 @@ class GenerateDiagramRequest(BaseModel):
     format: DiagramFormat = DiagramFormat.DRAWIO  # Default to Draw.io format
     aiProvider: AIProvider
     style: Optional[str] = None
+    diagramId: Optional[str] = None  # Diagram the request is for, for usage accounting
+
+
+class BatchGenerateItem(GenerateDiagramRequest):
+    id: Optional[str] = None  # Client correlation id, echoed on the item's result line
+    title: Optional[str] = None  # Title of the saved diagram; defaults to the description
+
+
+class BatchGenerateRequest(BaseModel):
+    items: list[BatchGenerateItem] = Field(..., min_length=1)
+    concurrency: Optional[int] = Field(None, ge=1)  # Items in flight; capped by AI_BATCH_MAX_CONCURRENCY
+    save: bool = False  # Store each generated diagram and return its id
+
+
+class BulkExportRequest(BaseModel):
+    # Diagrams to export; without ids, every diagram matching the filters
+    ids: Optional[list[str]] = Field(None, min_length=1)
+    type: Optional[DiagramType] = None
+    diagramFormat: Optional[DiagramFormat] = None
+    search: Optional[str] = Field(None, min_length=1)  # Case-insensitive part of the title
+    format: ExportFormat = ExportFormat.SVG
+    concurrency: Optional[int] = Field(None, ge=1)  # Renders in flight; capped by EXPORT_BULK_MAX_CONCURRENCY
+
+
+class TokenUsage(BaseModel):
+    """Provider token counts for the upstream call that produced a response"""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0  # Prompt tokens served from the provider's prompt cache
+    cache_write_tokens: int = 0
+    reasoning_tokens: int = 0  # Part of output_tokens spent on reasoning
 
 
 class GenerateDiagramResponse(BaseModel):
     code: str
     explanation: Optional[str] = None
+    usage: Optional[TokenUsage] = None  # Absent when served from a cache or a shared call
+    refineMode: Optional[RefineMode] = None  # How a refinement was produced (patch may fall back to full)
 
 
 class RefineDiagramRequest(BaseModel):
@@ -74,16 +119,20 @@ class RefineDiagramRequest(BaseModel):
     format: DiagramFormat  # 新增: 图表格式
     instruction: str = Field(..., min_length=1, max_length=500)
     aiProvider: AIProvider
+    mode: RefineMode = RefineMode.FULL
+    diagramId: Optional[str] = None
 
 
 class ExplainDiagramRequest(BaseModel):
     code: str
     format: DiagramFormat  # 新增: 图表格式
     aiProvider: AIProvider
+    diagramId: Optional[str] = None
 
 
 class ExplainDiagramResponse(BaseModel):
     explanation: str
+    usage: Optional[TokenUsage] = None
 
 
 class ChatMessage(BaseModel):
@@ -96,4 +145,5 @@ class ChatRequest(BaseModel):
     diagramType: DiagramType
     format: DiagramFormat = DiagramFormat.DRAWIO
     aiProvider: AIProvider
-    style: Optional[str] = None
\ No newline at end of file
+    style: Optional[str] = None
+    diagramId: Optional[str] = None
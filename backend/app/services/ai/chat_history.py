@@ -0,0 +1,229 @@
+"""Token-budgeted compaction of chat history
+
+Every chat turn resends the whole conversation, and conversations about
+diagrams fill up with pasted Draw.io XML. ``ChatHistoryCompactor`` keeps the
+request under a token budget: the last turns are sent verbatim, the latest
+diagram code is always kept, and older turns are replaced by a short
+extractive summary. Token counts are estimated locally, and per-message
+summaries are memoized, so compaction adds no upstream calls and its cost per
+turn does not grow with the session.
+"""
+import hashlib
+import math
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from app.core.config import settings
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.code_extraction import FENCE
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[㐀-鿿豈-﫿]|[^\sA-Za-z\d]")
+_FENCED_RE = re.compile(r"```[A-Za-z0-9_+-]*\n?(.*?)```", re.DOTALL)
+_MXFILE_RE = re.compile(r"(?:<\?xml[^>]*>\s*)?<mxfile\b.*?</mxfile>", re.DOTALL)
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?.])\s*")
+
+# Per-message overhead of the chat format (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_LINE_TOKENS = 60
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate BPE token count without a tokenizer
+
+    CJK characters and punctuation count as one token each, latin words as one
+    token per four letters and numbers as one per three digits. This tracks
+    the providers' tokenizers closely enough for budgeting.
+    """
+    total = 0
+    for piece in _TOKEN_RE.findall(text):
+        if piece[0].isascii() and piece[0].isalpha():
+            total += math.ceil(len(piece) / 4)
+        elif piece[0].isdigit():
+            total += math.ceil(len(piece) / 3)
+        else:
+            total += 1
+    return total
+
+
+# System prompts come from a fixed table, so their counts are memoized
+prompt_tokens = lru_cache(maxsize=128)(estimate_tokens)
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def find_diagram_code(text: str, diagram_format: DiagramFormat) -> Optional[str]:
+    """Last diagram in a message: a fenced block or, for Draw.io, a bare <mxfile>"""
+    if diagram_format == DiagramFormat.DRAWIO:
+        documents = _MXFILE_RE.findall(text)
+        if documents:
+            return documents[-1].strip()
+    blocks = [block.strip() for block in _FENCED_RE.findall(text) if block.strip()]
+    return blocks[-1] if blocks else None
+
+
+def _strip_code(text: str) -> str:
+    text = _FENCED_RE.sub(" [图表代码] ", text)
+    return _MXFILE_RE.sub(" [图表代码] ", text)
+
+
+@dataclass
+class CompactionResult:
+    messages: list[dict]
+    tokens_before: int
+    tokens_after: int
+    summarized_messages: int = 0
+
+    @property
+    def compacted(self) -> bool:
+        return self.summarized_messages > 0
+
+
+class ChatHistoryCompactor:
+    def __init__(
+        self,
+        budget_tokens: int,
+        keep_turns: int,
+        summary_tokens: int,
+        cache_size: int = 2048,
+    ):
+        self.budget_tokens = budget_tokens
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self.cache_size = cache_size
+        self._summaries: OrderedDict[str, str] = OrderedDict()
+        self.summary_hits = 0
+        self.summary_misses = 0
+
+    def compact(
+        self,
+        messages: list[dict],
+        diagram_format: DiagramFormat,
+        reserved_tokens: int = 0,
+    ) -> CompactionResult:
+        """Fit ``messages`` (alternating, starting and ending with a user turn) into the budget
+
+        ``reserved_tokens`` accounts for the system prompt and other fixed input.
+        """
+        costs = [message_tokens(m) for m in messages]
+        before = sum(costs) + reserved_tokens
+        budget = self.budget_tokens
+        if before <= budget:
+            return CompactionResult(messages, before, before)
+
+        # Keep the last N turns; a turn starts at a user message
+        user_starts = [i for i, m in enumerate(messages) if m["role"] == "user"]
+        keep = max(1, min(self.keep_turns, len(user_starts)))
+        while True:
+            split = user_starts[-keep]
+            kept_cost = sum(costs[split:]) + reserved_tokens
+            if keep == 1 or kept_cost + self.summary_tokens <= budget:
+                break
+            keep -= 1
+        older, recent = messages[:split], messages[split:]
+        if not older:
+            # A single turn over budget cannot be shortened without losing the request
+            return CompactionResult(messages, before, before)
+
+        context = []
+        summary = self._summarize(older)
+        if summary:
+            context.append("以下是之前对话的摘要：\n" + summary)
+        latest_code = None if self._has_code(recent, diagram_format) else self._latest_code(older, diagram_format)
+        if latest_code:
+            context.append(f"当前图表代码（最新版本）：\n{FENCE}\n{latest_code}\n{FENCE}")
+
+        first = recent[0]
+        merged = {"role": first["role"], "content": "\n\n".join(context + [first["content"]])}
+        compacted = [merged] + recent[1:]
+        after = sum(message_tokens(m) for m in compacted) + reserved_tokens
+        return CompactionResult(compacted, before, after, summarized_messages=len(older))
+
+    def _has_code(self, messages: list[dict], diagram_format: DiagramFormat) -> bool:
+        return any(find_diagram_code(m["content"], diagram_format) for m in messages)
+
+    def _latest_code(self, messages: list[dict], diagram_format: DiagramFormat) -> Optional[str]:
+        for message in reversed(messages):
+            code = find_diagram_code(message["content"], diagram_format)
+            if code:
+                return code
+        return None
+
+    def _summarize(self, messages: list[dict]) -> str:
+        """One line per message, newest kept first when over the summary budget"""
+        lines = [self._summary_line(m) for m in messages]
+        kept, used = [], 0
+        for line in reversed(lines):
+            cost = estimate_tokens(line) + 1
+            if used + cost > self.summary_tokens:
+                break
+            kept.append(line)
+            used += cost
+        kept.reverse()
+        omitted = len(lines) - len(kept)
+        if omitted:
+            kept.insert(0, f"（更早的 {omitted} 条消息已省略）")
+        return "\n".join(kept)
+
+    def _summary_line(self, message: dict) -> str:
+        key = hashlib.sha256(f"{message['role']}\x00{message['content']}".encode("utf-8")).hexdigest()
+        line = self._summaries.get(key)
+        if line is not None:
+            self.summary_hits += 1
+            self._summaries.move_to_end(key)
+            return line
+        self.summary_misses += 1
+        line = self._build_summary_line(message)
+        self._summaries[key] = line
+        if len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+        return line
+
+    def _build_summary_line(self, message: dict) -> str:
+        label = "用户" if message["role"] == "user" else "助手"
+        text = " ".join(_strip_code(message["content"]).split())
+        # Leading sentences up to the per-line budget
+        excerpt, used = [], 0
+        for sentence in _SENTENCE_END_RE.split(text):
+            if not sentence:
+                continue
+            cost = estimate_tokens(sentence)
+            if excerpt and used + cost > SUMMARY_LINE_TOKENS:
+                break
+            excerpt.append(sentence)
+            used += cost
+            if used >= SUMMARY_LINE_TOKENS:
+                break
+        summary = " ".join(excerpt)
+        if estimate_tokens(summary) > SUMMARY_LINE_TOKENS:
+            summary = self._truncate(summary, SUMMARY_LINE_TOKENS) + "…"
+        return f"- {label}：{summary or '[图表代码]'}"
+
+    @staticmethod
+    def _truncate(text: str, max_tokens: int) -> str:
+        used = 0
+        for match in _TOKEN_RE.finditer(text):
+            used += estimate_tokens(match.group(0))
+            if used > max_tokens:
+                return text[:match.start()].rstrip()
+        return text
+
+    def stats(self) -> dict:
+        return {
+            "budget_tokens": self.budget_tokens,
+            "keep_turns": self.keep_turns,
+            "cached_summaries": len(self._summaries),
+            "summary_hits": self.summary_hits,
+            "summary_misses": self.summary_misses,
+        }
+
+
+chat_history_compactor = ChatHistoryCompactor(
+    budget_tokens=settings.CHAT_HISTORY_TOKEN_BUDGET,
+    keep_turns=settings.CHAT_HISTORY_KEEP_TURNS,
+    summary_tokens=settings.CHAT_HISTORY_SUMMARY_TOKENS,
+)
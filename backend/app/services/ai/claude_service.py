@@ -1,6 +1,15 @@
-from anthropic import Anthropic
+from typing import Optional
+from anthropic import AsyncAnthropic
 from app.core.config import settings
+from app.core.tracing import span
 from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.code_extraction import clean_diagram_code
+from app.services.ai.diagram_patch import build_patch_prompt
+from app.services.ai.prompts import PromptTable
+from app.services.ai.usage import record_anthropic_usage
+
+# Beta header enabling cache_control on system blocks
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
 
 
 class ClaudeService:
@@ -8,23 +17,40 @@ class ClaudeService:
         self._client = None
         self.model = "claude-3-5-sonnet-20241022"
         self.base_url = None  # Can be overridden for custom endpoints
+        self.prompts = PromptTable(self._build_system_prompt)
+
+    def create_client(self, api_key: str, base_url: Optional[str] = None) -> AsyncAnthropic:
+        """Build an async Anthropic client for the given credentials"""
+        if not api_key:
+            raise ValueError("ANTHROPIC_API_KEY is not set")
+
+        client_kwargs = {"api_key": api_key}
+        if base_url:
+            client_kwargs["base_url"] = base_url
+
+        return AsyncAnthropic(**client_kwargs)
 
     @property
     def client(self):
-        """Lazy initialization of Anthropic client"""
+        """Lazy initialization of the default async Anthropic client"""
         if self._client is None:
-            if not settings.ANTHROPIC_API_KEY:
-                raise ValueError("ANTHROPIC_API_KEY is not set")
-            
-            client_kwargs = {"api_key": settings.ANTHROPIC_API_KEY}
-            if self.base_url:
-                client_kwargs["base_url"] = self.base_url
-                
-            self._client = Anthropic(**client_kwargs)
+            self._client = self.create_client(settings.ANTHROPIC_API_KEY, self.base_url)
         return self._client
 
     def _get_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
-        """Get system prompt based on diagram type and format"""
+        """Get the precompiled system prompt for a diagram type and format"""
+        return self.prompts.get(diagram_type, diagram_format).text
+
+    def _cached_system(self, diagram_type: DiagramType, diagram_format: DiagramFormat) -> list[dict]:
+        """System prompt as a content block marked for Anthropic prompt caching"""
+        return [{
+            "type": "text",
+            "text": self._get_system_prompt(diagram_type, diagram_format),
+            "cache_control": {"type": "ephemeral"},
+        }]
+
+    def _build_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat) -> str:
+        """Build the system prompt for a diagram type and format"""
         if diagram_format == DiagramFormat.DRAWIO:
             return self._get_drawio_prompt(diagram_type)
         else:
@@ -206,46 +232,24 @@ ER图要求：
 
         return base_prompt + type_specific.get(diagram_type, "请根据用户描述生成合适的Draw.io XML代码。") + "\n\n只返回完整的XML代码，不要有markdown代码块标记，不要有其他解释。直接以<?xml开头。"
 
-    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO) -> str:
+    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
         """Generate diagram code using Claude"""
-        system_prompt = self._get_system_prompt(diagram_type, diagram_format)
-
-        message = self.client.messages.create(
-            model=self.model,
-            max_tokens=4000,  # Increased for Draw.io XML
-            system=system_prompt,
-            messages=[{"role": "user", "content": description}],
-        )
-
-        code = message.content[0].text
-
-        # Clean up code blocks if present
-        if "```" in code:
-            parts = code.split("```")
-            if len(parts) >= 3:
-                code = parts[1]
-                # Remove language identifier
-                if code.startswith("mermaid\n"):
-                    code = code[8:]
-                elif code.startswith("xml\n"):
-                    code = code[4:]
-                elif code.startswith("mermaid"):
-                    code = code[7:]
-                elif code.startswith("xml"):
-                    code = code[3:]
-
-        # For Draw.io XML, ensure it starts with <?xml
-        code = code.strip()
-        if diagram_format == DiagramFormat.DRAWIO and not code.startswith("<?xml"):
-            # Try to find the XML declaration
-            xml_start = code.find("<?xml")
-            if xml_start > 0:
-                code = code[xml_start:]
-
-        return code
-
-    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO) -> str:
+        client = client or self.client
+        with span("llm.request", provider="claude", model=self.model, operation="generate_diagram"):
+            message = await client.messages.create(
+                model=self.model,
+                max_tokens=4000,  # Increased for Draw.io XML
+                system=self._cached_system(diagram_type, diagram_format),
+                messages=[{"role": "user", "content": description}],
+                extra_headers=PROMPT_CACHING_HEADERS,
+            )
+        record_anthropic_usage(message.usage)
+
+        return clean_diagram_code(message.content[0].text, diagram_format)
+
+    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
         """Refine existing diagram with instruction"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 现有的{format_name}代码：
@@ -258,11 +262,13 @@ ER图要求：
 请修改上面的{format_name}代码以满足要求。只返回修改后的完整代码，不要有其他解释。
 """
 
-        message = self.client.messages.create(
-            model=self.model,
-            max_tokens=4000,
-            messages=[{"role": "user", "content": prompt}],
-        )
+        with span("llm.request", provider="claude", model=self.model, operation="refine_diagram"):
+            message = await client.messages.create(
+                model=self.model,
+                max_tokens=4000,
+                messages=[{"role": "user", "content": prompt}],
+            )
+        record_anthropic_usage(message.usage)
 
         code = message.content[0].text
         if "```" in code:
@@ -273,8 +279,22 @@ ER图要求：
                     code = code.split("\n", 1)[1] if "\n" in code else code
         return code.strip()
 
-    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO) -> str:
+    async def refine_patch(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
+        """Ask for the edits that implement an instruction, as JSON operations"""
+        client = client or self.client
+        with span("llm.request", provider="claude", model=self.model, operation="refine_patch"):
+            message = await client.messages.create(
+                model=self.model,
+                max_tokens=2000,  # Edits only; scales with the change, not the diagram
+                messages=[{"role": "user", "content": build_patch_prompt(code, instruction, diagram_format)}],
+            )
+        record_anthropic_usage(message.usage)
+
+        return message.content[0].text
+
+    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
         """Explain diagram in natural language"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 请用中文解释这个{format_name}图表的内容和结构：
@@ -286,26 +306,36 @@ ER图要求：
 用简洁清晰的语言描述图表表达的信息。
 """
 
-        message = self.client.messages.create(
-            model=self.model,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-        )
+        with span("llm.request", provider="claude", model=self.model, operation="explain_diagram"):
+            message = await client.messages.create(
+                model=self.model,
+                max_tokens=1000,
+                messages=[{"role": "user", "content": prompt}],
+            )
+        record_anthropic_usage(message.usage)
 
         return message.content[0].text
 
-    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO):
+    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
         """Stream chat responses with context"""
-        system_prompt = self._get_system_prompt(diagram_type, diagram_format)
-        
-        with self.client.messages.stream(
+        client = client or self.client
+
+        async with client.messages.stream(
             model=self.model,
             max_tokens=4000,
-            system=system_prompt,
+            system=self._cached_system(diagram_type, diagram_format),
             messages=messages,
+            extra_headers=PROMPT_CACHING_HEADERS,
         ) as stream:
-            for text in stream.text_stream:
+            async for text in stream.text_stream:
                 yield text
+            record_anthropic_usage((await stream.get_final_message()).usage)
+
+    async def generate_stream(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
+        """Stream raw generation output as it is produced"""
+        messages = [{"role": "user", "content": description}]
+        async for chunk in self.chat_stream(messages, diagram_type, diagram_format, client=client):
+            yield chunk
 
 
 claude_service = ClaudeService()
\ No newline at end of file
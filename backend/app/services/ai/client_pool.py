@@ -0,0 +1,116 @@
+"""Pooled provider SDK clients
+
+Requests that bring their own API key (``X-*-Key`` headers) or base URL need a
+client configured for those credentials. Building a fresh SDK client per request
+throws away its HTTP connection pool (keep-alive, TLS sessions), so clients are
+kept warm here, keyed by (provider, key fingerprint, base_url), and lent out to
+requests without touching ``os.environ`` or the global settings.
+"""
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Optional
+
+from app.core.config import settings
+
+
+ClientFactory = Callable[[str, Optional[str]], Any]
+
+
+def key_fingerprint(api_key: str) -> str:
+    """Stable, non-reversible identifier for an API key"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class _PooledClient:
+    __slots__ = ("client", "borrowers", "evicted")
+
+    def __init__(self, client: Any):
+        self.client = client
+        self.borrowers = 0
+        self.evicted = False
+
+
+async def _close_client(client: Any) -> None:
+    close = getattr(client, "close", None)
+    if close is None:
+        return
+    result = close()
+    if hasattr(result, "__await__"):
+        await result
+
+
+class ProviderClientPool:
+    """Bounded LRU cache of provider SDK clients
+
+    Clients are evicted least-recently-used first once ``max_size`` is exceeded.
+    An evicted client that is still lent out is closed when its last borrower
+    returns it.
+    """
+
+    def __init__(self, max_size: int = 32):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple[str, str, str], _PooledClient]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _acquire(
+        self, provider: str, api_key: str, base_url: Optional[str], factory: ClientFactory
+    ) -> tuple[_PooledClient, list[Any]]:
+        key = (provider, key_fingerprint(api_key), base_url or "")
+        entry = self._entries.get(key)
+        to_close: list[Any] = []
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            entry = _PooledClient(factory(api_key, base_url))
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                _, old = self._entries.popitem(last=False)
+                old.evicted = True
+                if old.borrowers == 0:
+                    to_close.append(old.client)
+        entry.borrowers += 1
+        return entry, to_close
+
+    @asynccontextmanager
+    async def borrow(
+        self, provider: str, api_key: str, base_url: Optional[str], factory: ClientFactory
+    ):
+        """Lend a warm client for the given credentials, creating it on first use"""
+        entry, to_close = self._acquire(provider, api_key, base_url, factory)
+        for client in to_close:
+            await _close_client(client)
+        try:
+            yield entry.client
+        finally:
+            entry.borrowers -= 1
+            if entry.evicted and entry.borrowers == 0:
+                await _close_client(entry.client)
+
+    async def aclose(self) -> None:
+        """Close every pooled client (application shutdown)"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for entry in entries:
+            entry.evicted = True
+            if entry.borrowers == 0:
+                await _close_client(entry.client)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+client_pool = ProviderClientPool(max_size=settings.AI_CLIENT_POOL_SIZE)
@@ -0,0 +1,198 @@
+"""Extraction of diagram code from raw model output
+
+Models wrap their answer in markdown fences or prefix it with prose. The batch
+helper cleans a complete answer; ``IncrementalCodeExtractor`` applies the same
+rules to a token stream so code can be forwarded as soon as it starts.
+"""
+import re
+
+from app.core.tracing import span
+from app.schemas.diagram import DiagramFormat
+
+FENCE = "```"
+XML_START_MARKERS = ("<?xml", "<mxfile")
+
+# First words of a Mermaid diagram; unfenced output starting with one of these is code
+MERMAID_KEYWORDS = frozenset({
+    "graph", "flowchart", "sequenceDiagram", "classDiagram", "stateDiagram", "stateDiagram-v2",
+    "erDiagram", "gantt", "pie", "journey", "mindmap", "timeline", "gitGraph", "quadrantChart",
+    "requirementDiagram", "C4Context", "block-beta", "sankey-beta", "xychart-beta",
+})
+
+_FENCE_INFO_RE = re.compile(r"[A-Za-z0-9_+-]*")
+_FIRST_WORD_RE = re.compile(r"\s*(\S+)")
+# Overlap kept when re-scanning the search buffer so markers split across chunks are found
+_SCAN_OVERLAP = max(len(FENCE), *(len(m) for m in XML_START_MARKERS)) - 1
+
+
+def _find_xml_start(text: str, start: int = 0) -> int:
+    positions = [text.find(marker, start) for marker in XML_START_MARKERS]
+    positions = [p for p in positions if p >= 0]
+    return min(positions) if positions else -1
+
+
+def clean_diagram_code(text: str, diagram_format: DiagramFormat) -> str:
+    """Strip markdown fences and surrounding prose from a complete model answer"""
+    with span("code.clean", chars=len(text)):
+        return _clean_diagram_code(text, diagram_format)
+
+
+def _clean_diagram_code(text: str, diagram_format: DiagramFormat) -> str:
+    code = text
+    if FENCE in code:
+        parts = code.split(FENCE)
+        if len(parts) >= 3:
+            code = parts[1]
+            # Remove language identifier
+            if code.startswith("mermaid\n"):
+                code = code[8:]
+            elif code.startswith("xml\n"):
+                code = code[4:]
+            elif code.startswith("mermaid"):
+                code = code[7:]
+            elif code.startswith("xml"):
+                code = code[3:]
+
+    # For Draw.io XML, ensure it starts with the XML declaration (or <mxfile>)
+    code = code.strip()
+    if diagram_format == DiagramFormat.DRAWIO and not code.startswith(XML_START_MARKERS):
+        xml_start = _find_xml_start(code)
+        if xml_start > 0:
+            code = code[xml_start:]
+
+    return code
+
+
+class IncrementalCodeExtractor:
+    """Streaming counterpart of ``clean_diagram_code``
+
+    ``feed`` returns the part of the diagram code that can be emitted now;
+    ``finish`` returns whatever was held back. Once code has started only a
+    bounded tail (a possible partial fence, trailing whitespace) is held back,
+    so the work per chunk is proportional to the chunk size.
+    """
+
+    _SEARCHING, _FENCE_INFO, _FENCED_XML, _CODE, _DONE = range(5)
+
+    def __init__(self, diagram_format: DiagramFormat):
+        self.diagram_format = diagram_format
+        self._state = self._SEARCHING
+        self._buffer = ""  # text seen before the code start was found
+        self._pending = ""  # held-back tail once in code
+        self._scanned = 0  # buffer prefix already searched for markers
+        self._keyword_checked = False
+        self._code_started = False
+        self.code = ""  # everything emitted so far
+
+    @property
+    def started(self) -> bool:
+        return self._code_started
+
+    def feed(self, text: str) -> str:
+        if not text or self._state == self._DONE:
+            return ""
+        if self._state == self._CODE:
+            return self._emit_code(text)
+        self._buffer += text
+        return self._search()
+
+    def finish(self) -> str:
+        """Flush held-back text at the end of the stream"""
+        if self._state == self._CODE:
+            out = self._pending.rstrip()
+        elif self._state == self._DONE:
+            out = ""
+        else:
+            out = clean_diagram_code(self._buffer, self.diagram_format)
+        self._buffer = ""
+        self._pending = ""
+        self._state = self._DONE
+        if not self._code_started:
+            out = out.lstrip()
+        if out:
+            self._code_started = True
+            self.code += out
+        return out
+
+    def _start_code(self, rest: str) -> str:
+        self._buffer = ""
+        self._state = self._CODE
+        return self._emit_code(rest)
+
+    def _search(self) -> str:
+        scan_from = max(0, self._scanned - _SCAN_OVERLAP)
+        self._scanned = len(self._buffer)
+
+        if self._state == self._SEARCHING:
+            fence_at = self._buffer.find(FENCE, scan_from)
+            if self.diagram_format == DiagramFormat.DRAWIO:
+                xml_at = _find_xml_start(self._buffer, scan_from)
+                if xml_at >= 0 and (fence_at < 0 or xml_at < fence_at):
+                    return self._start_code(self._buffer[xml_at:])
+            if fence_at >= 0:
+                self._buffer = self._buffer[fence_at + len(FENCE):]
+                self._state = self._FENCE_INFO
+                self._scanned = 0
+            elif self.diagram_format == DiagramFormat.MERMAID and not self._keyword_checked:
+                starts = self._starts_with_keyword()
+                if starts:
+                    return self._start_code(self._buffer)
+                if starts is not None:
+                    self._keyword_checked = True
+                return ""
+            else:
+                return ""
+
+        if self._state == self._FENCE_INFO:
+            # Skip the fence's language identifier ("mermaid", "xml", ...) and its newline
+            end = _FENCE_INFO_RE.match(self._buffer).end()
+            if end == len(self._buffer):
+                return ""  # the identifier may continue in the next chunk
+            if self._buffer[end] == "\n":
+                end += 1
+            self._buffer = self._buffer[end:]
+            if self.diagram_format != DiagramFormat.DRAWIO:
+                return self._start_code(self._buffer)
+            self._state = self._FENCED_XML
+            scan_from = 0
+            self._scanned = len(self._buffer)
+
+        # Inside a fence, Draw.io code starts at the XML declaration when there is one
+        xml_at = _find_xml_start(self._buffer, scan_from)
+        closing = self._buffer.find(FENCE, scan_from)
+        if xml_at >= 0 and (closing < 0 or xml_at < closing):
+            return self._start_code(self._buffer[xml_at:])
+        if closing >= 0 or self._buffer.lstrip().startswith("<"):
+            return self._start_code(self._buffer)
+        return ""
+
+    def _starts_with_keyword(self):
+        """True/False once the first word is complete, None while it may still grow"""
+        match = _FIRST_WORD_RE.match(self._buffer)
+        if match is None or match.end() == len(self._buffer):
+            return None
+        first = match.group(1)
+        return first in MERMAID_KEYWORDS or first.startswith("%%")
+
+    def _emit_code(self, text: str) -> str:
+        data = self._pending + text
+        fence_at = data.find(FENCE)
+        if fence_at >= 0:
+            out = data[:fence_at].rstrip()
+            self._pending = ""
+            self._state = self._DONE
+        else:
+            # Hold back a possible partial closing fence and trailing whitespace
+            keep = 0
+            while keep < 2 and keep < len(data) and data[-1 - keep] == "`":
+                keep += 1
+            body = data[:len(data) - keep]
+            out = body.rstrip()
+            self._pending = data[len(out):]
+        if not self._code_started:
+            out = out.lstrip()
+            if not out:
+                return ""
+            self._code_started = True
+        self.code += out
+        return out
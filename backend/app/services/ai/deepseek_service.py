@@ -1,7 +1,13 @@
 import os
+from typing import Optional
 from openai import AsyncOpenAI
 from app.core.config import settings
+from app.core.tracing import span
 from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.code_extraction import clean_diagram_code
+from app.services.ai.diagram_patch import build_patch_prompt
+from app.services.ai.prompts import PromptTable
+from app.services.ai.usage import record_openai_usage
 
 
 class DeepSeekService:
@@ -9,22 +15,31 @@ class DeepSeekService:
         self._client = None
         self.model = "deepseek-reasoner"  # DeepSeek R1 model
         self.base_url = settings.DEEPSEEK_BASE_URL  # Base URL from config, can be overridden
+        self.prompts = PromptTable(self._build_system_prompt)
+
+    def create_client(self, api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+        """Build an async DeepSeek (OpenAI-compatible) client for the given credentials"""
+        if not api_key:
+            raise ValueError("DEEPSEEK_API_KEY is not set")
+        return AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url or self.base_url
+        )
 
     @property
     def client(self):
-        """Lazy initialization of DeepSeek client"""
+        """Lazy initialization of the default DeepSeek client"""
         if self._client is None:
             api_key = settings.DEEPSEEK_API_KEY or os.environ.get("DEEPSEEK_API_KEY")
-            if not api_key:
-                raise ValueError("DEEPSEEK_API_KEY is not set")
-            self._client = AsyncOpenAI(
-                api_key=api_key,
-                base_url=self.base_url
-            )
+            self._client = self.create_client(api_key, self.base_url)
         return self._client
 
     def _get_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
-        """Get system prompt based on diagram type and format"""
+        """Get the precompiled system prompt for a diagram type and format"""
+        return self.prompts.get(diagram_type, diagram_format).text
+
+    def _build_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat) -> str:
+        """Build the system prompt for a diagram type and format"""
         if diagram_format == DiagramFormat.DRAWIO:
             return self._get_drawio_prompt(diagram_type)
         else:
@@ -201,48 +216,27 @@ ER图要求：
 
         return base_prompt + type_specific.get(diagram_type, "请根据用户描述生成合适的Draw.io XML代码。") + "\n\n只返回完整的XML代码，不要有markdown代码块标记，不要有其他解释。直接以<?xml开头。"
 
-    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Generate diagram code using DeepSeek R1"""
+        client = client or self.client
         system_prompt = self._get_system_prompt(diagram_type, diagram_format)
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": description},
-            ],
-            max_tokens=4000,
-        )
+        with span("llm.request", provider="deepseek", model=self.model, operation="generate_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": description},
+                ],
+                max_tokens=4000,
+            )
+        record_openai_usage(response.usage)
 
-        code = response.choices[0].message.content
+        return clean_diagram_code(response.choices[0].message.content, diagram_format)
 
-        # Clean up code blocks if present
-        if "```" in code:
-            parts = code.split("```")
-            if len(parts) >= 3:
-                code = parts[1]
-                # Remove language identifier
-                if code.startswith("mermaid\n"):
-                    code = code[8:]
-                elif code.startswith("xml\n"):
-                    code = code[4:]
-                elif code.startswith("mermaid"):
-                    code = code[7:]
-                elif code.startswith("xml"):
-                    code = code[3:]
-
-        # For Draw.io XML, ensure it starts with <?xml
-        code = code.strip()
-        if diagram_format == DiagramFormat.DRAWIO and not code.startswith("<?xml"):
-            # Try to find the XML declaration
-            xml_start = code.find("<?xml")
-            if xml_start > 0:
-                code = code[xml_start:]
-
-        return code
-
-    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Refine existing diagram with instruction"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 现有的{format_name}代码：
@@ -255,11 +249,13 @@ ER图要求：
 请修改上面的{format_name}代码以满足要求。只返回修改后的完整代码，不要有其他解释。
 """
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=4000,
-        )
+        with span("llm.request", provider="deepseek", model=self.model, operation="refine_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=4000,
+            )
+        record_openai_usage(response.usage)
 
         code = response.choices[0].message.content
         if "```" in code:
@@ -270,8 +266,22 @@ ER图要求：
                     code = code.split("\n", 1)[1] if "\n" in code else code
         return code.strip()
 
-    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def refine_patch(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
+        """Ask for the edits that implement an instruction, as JSON operations"""
+        client = client or self.client
+        with span("llm.request", provider="deepseek", model=self.model, operation="refine_patch"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": build_patch_prompt(code, instruction, diagram_format)}],
+                max_tokens=2000,  # Edits only; scales with the change, not the diagram
+            )
+        record_openai_usage(response.usage)
+
+        return response.choices[0].message.content
+
+    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Explain diagram in natural language"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 请用中文解释这个{format_name}图表的内容和结构：
@@ -283,28 +293,34 @@ ER图要求：
 用简洁清晰的语言描述图表表达的信息。
 """
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000,
-        )
+        with span("llm.request", provider="deepseek", model=self.model, operation="explain_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=1000,
+            )
+        record_openai_usage(response.usage)
 
         return response.choices[0].message.content
 
-    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO):
+    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
         """Stream chat responses with context, handling DeepSeek R1 reasoning"""
+        client = client or self.client
         system_prompt = self._get_system_prompt(diagram_type, diagram_format)
         
         full_messages = [{"role": "system", "content": system_prompt}] + messages
         
-        stream = await self.client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model=self.model,
             messages=full_messages,
             max_tokens=4000,
             stream=True,
+            stream_options={"include_usage": True},
         )
         
         async for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                record_openai_usage(chunk.usage)
             if not chunk.choices:
                 continue
             delta = chunk.choices[0].delta
@@ -341,5 +357,11 @@ ER图要求：
                     'content': content_text
                 }
 
+    async def generate_stream(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
+        """Stream raw generation output as it is produced"""
+        messages = [{"role": "user", "content": description}]
+        async for chunk in self.chat_stream(messages, diagram_type, diagram_format, client=client):
+            yield chunk
+
 
 deepseek_service = DeepSeekService()
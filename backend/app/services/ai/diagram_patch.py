@@ -0,0 +1,298 @@
+"""Patch-based diagram refinement
+
+Regenerating a whole diagram for a small change costs output tokens, and so
+latency, proportional to the diagram size, and large Draw.io diagrams get cut
+off at ``max_tokens``. In patch mode the model returns a short JSON list of
+edits instead. They are validated and applied here:
+
+Draw.io (cells addressed by id)::
+
+    {"op": "add", "cell": {"id": "9", "value": "审核", "style": "...", "vertex": true,
+                           "parent": "1", "geometry": {"x": 40, "y": 300, "width": 120, "height": 60}}}
+    {"op": "update", "id": "3", "value": "新标签", "style": "...", "geometry": {"y": 220}}
+    {"op": "remove", "id": "5"}
+
+Mermaid (1-based line numbers of the original code)::
+
+    {"op": "replace", "line": 3, "text": "    B --> C"}
+    {"op": "insert", "after": 4, "text": "    C --> D"}
+    {"op": "delete", "line": 6}
+
+Any problem raises ``PatchError`` so the caller can fall back to a full
+refine.
+"""
+import json
+import re
+import xml.etree.ElementTree as ET
+from typing import Optional
+
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.code_extraction import FENCE
+
+_WRAPPER_TAGS = ("object", "UserObject")
+_GEOMETRY_FIELDS = ("x", "y", "width", "height")
+_PROTECTED_IDS = ("0", "1")
+_FENCED_JSON_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+
+class PatchError(ValueError):
+    """The model's edits could not be parsed or applied"""
+
+
+def parse_patch(text: str) -> list[dict]:
+    """Operations from a model answer: a JSON list, or an object with an "ops" list"""
+    match = _FENCED_JSON_RE.search(text)
+    body = (match.group(1) if match else text).strip()
+    if not body.startswith(("[", "{")):
+        start = min((i for i in (body.find("["), body.find("{")) if i >= 0), default=-1)
+        if start < 0:
+            raise PatchError("No JSON operations in the response")
+        body = body[start:]
+    try:
+        data, _ = json.JSONDecoder().raw_decode(body)
+    except json.JSONDecodeError as e:
+        raise PatchError(f"Invalid operations JSON: {e}") from e
+    if isinstance(data, dict):
+        data = data.get("ops")
+    if not isinstance(data, list) or not all(isinstance(op, dict) for op in data):
+        raise PatchError("Operations must be a list of objects")
+    return data
+
+
+# Draw.io
+
+def _format_number(value) -> str:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise PatchError(f"Geometry values must be numbers, got {value!r}")
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def _set_geometry(cell: ET.Element, geometry: dict) -> None:
+    if not isinstance(geometry, dict):
+        raise PatchError("geometry must be an object")
+    element = cell.find("mxGeometry")
+    if element is None:
+        element = ET.SubElement(cell, "mxGeometry", {"as": "geometry"})
+    for field in _GEOMETRY_FIELDS:
+        if field in geometry:
+            element.set(field, _format_number(geometry[field]))
+    if geometry.get("relative"):
+        element.set("relative", "1")
+
+
+class _DrawioDocument:
+    def __init__(self, xml: str):
+        self.declaration = xml.lstrip().startswith("<?xml")
+        try:
+            self.tree = ET.fromstring(xml)
+        except ET.ParseError as e:
+            raise PatchError(f"Existing diagram is not valid XML: {e}") from e
+        if self.tree.tag == "root":
+            self.root = self.tree
+        elif self.tree.tag == "mxGraphModel":
+            self.root = self.tree.find("root")
+        else:
+            self.root = self.tree.find(".//mxGraphModel/root")
+        if self.root is None:
+            # Compressed <diagram> content or a non-mxGraph document
+            raise PatchError("Existing diagram has no uncompressed mxGraphModel")
+        # id -> (node in <root>, mxCell)
+        self.cells: dict[str, tuple[ET.Element, ET.Element]] = {}
+        for node in list(self.root):
+            if node.tag == "mxCell":
+                self.cells[node.get("id")] = (node, node)
+            elif node.tag in _WRAPPER_TAGS:
+                cell = node.find("mxCell")
+                if cell is not None:
+                    self.cells[node.get("id")] = (node, cell)
+
+    def _require(self, cell_id) -> tuple[ET.Element, ET.Element]:
+        if cell_id not in self.cells:
+            raise PatchError(f"Unknown cell id {cell_id!r}")
+        return self.cells[cell_id]
+
+    def _check_links(self, cell: ET.Element) -> None:
+        for attribute in ("parent", "source", "target"):
+            ref = cell.get(attribute)
+            if ref is not None and ref not in self.cells:
+                raise PatchError(f"Cell {attribute} {ref!r} does not exist")
+
+    def add(self, spec) -> None:
+        if not isinstance(spec, dict) or not spec.get("id"):
+            raise PatchError("add needs a cell with an id")
+        cell_id = str(spec["id"])
+        if cell_id in self.cells:
+            raise PatchError(f"Cell id {cell_id!r} already exists")
+        cell = ET.Element("mxCell", {"id": cell_id})
+        cell.set("value", str(spec.get("value", "")))
+        if spec.get("style"):
+            cell.set("style", str(spec["style"]))
+        if spec.get("edge"):
+            cell.set("edge", "1")
+            for attribute in ("source", "target"):
+                if spec.get(attribute) is not None:
+                    cell.set(attribute, str(spec[attribute]))
+        else:
+            cell.set("vertex", "1")
+        cell.set("parent", str(spec.get("parent") or "1"))
+        self.cells[cell_id] = (cell, cell)
+        try:
+            self._check_links(cell)
+        except PatchError:
+            del self.cells[cell_id]
+            raise
+        geometry = spec.get("geometry")
+        if geometry is not None:
+            _set_geometry(cell, geometry)
+        elif spec.get("edge"):
+            _set_geometry(cell, {"relative": True})
+        else:
+            raise PatchError(f"Vertex {cell_id!r} needs a geometry")
+        self.root.append(cell)
+
+    def update(self, op: dict) -> None:
+        cell_id = str(op.get("id"))
+        if cell_id in _PROTECTED_IDS:
+            raise PatchError(f"Cell {cell_id!r} is a layer root and cannot be edited")
+        node, cell = self._require(cell_id)
+        if "value" in op:
+            if node is cell:
+                cell.set("value", str(op["value"]))
+            else:
+                node.set("label", str(op["value"]))
+        if "style" in op:
+            cell.set("style", str(op["style"]))
+        for attribute in ("parent", "source", "target"):
+            if attribute in op:
+                cell.set(attribute, str(op[attribute]))
+        self._check_links(cell)
+        if "geometry" in op:
+            _set_geometry(cell, op["geometry"])
+
+    def remove(self, op: dict) -> None:
+        cell_id = str(op.get("id"))
+        if cell_id in _PROTECTED_IDS:
+            raise PatchError(f"Cell {cell_id!r} is a layer root and cannot be removed")
+        self._require(cell_id)
+        # Children and connected edges go with the cell
+        doomed = {cell_id}
+        changed = True
+        while changed:
+            changed = False
+            for other_id, (_, cell) in self.cells.items():
+                if other_id in doomed:
+                    continue
+                if cell.get("parent") in doomed or cell.get("source") in doomed or cell.get("target") in doomed:
+                    doomed.add(other_id)
+                    changed = True
+        for doomed_id in doomed:
+            node, _ = self.cells.pop(doomed_id)
+            self.root.remove(node)
+
+    def serialize(self) -> str:
+        xml = ET.tostring(self.tree, encoding="unicode")
+        if self.declaration:
+            xml = '<?xml version="1.0" encoding="UTF-8"?>\n' + xml
+        return xml
+
+
+def apply_drawio_patch(xml: str, ops: list[dict]) -> str:
+    document = _DrawioDocument(xml)
+    for op in ops:
+        kind = op.get("op")
+        if kind == "add":
+            document.add(op.get("cell"))
+        elif kind == "update":
+            document.update(op)
+        elif kind == "remove":
+            document.remove(op)
+        else:
+            raise PatchError(f"Unsupported Draw.io operation {kind!r}")
+    return document.serialize()
+
+
+# Mermaid
+
+def apply_mermaid_patch(code: str, ops: list[dict]) -> str:
+    """Apply line edits; all line numbers refer to the original code"""
+    lines = code.split("\n")
+    replaced: dict[int, Optional[list[str]]] = {}  # line -> new lines (None = deleted)
+    inserted: dict[int, list[str]] = {}  # after line -> lines
+    for op in ops:
+        kind = op.get("op")
+        if kind in ("replace", "delete"):
+            line = op.get("line")
+            if not isinstance(line, int) or not 1 <= line <= len(lines):
+                raise PatchError(f"Line {line!r} is out of range")
+            if line in replaced:
+                raise PatchError(f"Line {line} is edited more than once")
+            if kind == "delete":
+                replaced[line] = None
+            else:
+                if not isinstance(op.get("text"), str):
+                    raise PatchError("replace needs text")
+                replaced[line] = op["text"].split("\n")
+        elif kind == "insert":
+            after = op.get("after")
+            if not isinstance(after, int) or not 0 <= after <= len(lines):
+                raise PatchError(f"Insert position {after!r} is out of range")
+            if not isinstance(op.get("text"), str):
+                raise PatchError("insert needs text")
+            inserted.setdefault(after, []).extend(op["text"].split("\n"))
+        else:
+            raise PatchError(f"Unsupported Mermaid operation {kind!r}")
+
+    result = list(inserted.get(0, []))
+    for number, line in enumerate(lines, start=1):
+        if number in replaced:
+            result.extend(replaced[number] or [])
+        else:
+            result.append(line)
+        result.extend(inserted.get(number, []))
+    patched = "\n".join(result).strip()
+    if not patched:
+        raise PatchError("Patch removed the whole diagram")
+    return patched
+
+
+def apply_patch(code: str, diagram_format: DiagramFormat, ops: list[dict]) -> str:
+    if not ops:
+        raise PatchError("No operations")
+    if diagram_format == DiagramFormat.DRAWIO:
+        return apply_drawio_patch(code, ops)
+    return apply_mermaid_patch(code, ops)
+
+
+def build_patch_prompt(code: str, instruction: str, diagram_format: DiagramFormat) -> str:
+    """User prompt asking for edits instead of the complete diagram"""
+    if diagram_format == DiagramFormat.DRAWIO:
+        return f"""
+现有的Draw.io XML代码：
+{FENCE}xml
+{code}
+{FENCE}
+
+修改要求：{instruction}
+
+不要返回完整的XML。只返回一个JSON数组，列出需要的最少修改操作，支持：
+- {{"op": "add", "cell": {{"id": "新ID", "value": "标签", "style": "样式", "vertex": true, "parent": "1", "geometry": {{"x": 0, "y": 0, "width": 120, "height": 60}}}}}}
+- {{"op": "add", "cell": {{"id": "新ID", "value": "", "style": "样式", "edge": true, "parent": "1", "source": "起点ID", "target": "终点ID"}}}}
+- {{"op": "update", "id": "单元ID", "value": "新标签", "style": "新样式", "geometry": {{"x": 0, "y": 0}}}}（只写需要修改的字段）
+- {{"op": "remove", "id": "单元ID"}}（相连的连线会一并删除）
+新ID不能与现有ID重复。只返回JSON，不要有其他解释。
+"""
+    numbered = "\n".join(f"{number:>4} | {line}" for number, line in enumerate(code.split("\n"), start=1))
+    return f"""
+现有的Mermaid代码（每行前是行号）：
+{FENCE}
+{numbered}
+{FENCE}
+
+修改要求：{instruction}
+
+不要返回完整代码。只返回一个JSON数组，列出需要的最少修改操作，行号均指上面的原始行号：
+- {{"op": "replace", "line": 行号, "text": "新的整行内容"}}
+- {{"op": "insert", "after": 行号, "text": "插入的内容"}}（after为0表示插入到开头）
+- {{"op": "delete", "line": 行号}}
+text中不要包含行号前缀。只返回JSON，不要有其他解释。
+"""
@@ -0,0 +1,128 @@
+"""Progressive parsing of streamed Draw.io XML
+
+Draw.io XML is only renderable once complete, but each ``<mxCell>`` is usable
+as soon as its closing tag arrives. ``DrawioCellParser`` feeds streamed code
+into an expat-backed pull parser and reports every finished cell, so the
+editor can draw nodes while the model is still writing. Finished cells are
+detached from the tree, keeping memory flat and total work linear in the
+stream length.
+"""
+from typing import Optional
+from xml.etree.ElementTree import Element, ParseError, XMLPullParser
+
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.code_extraction import IncrementalCodeExtractor
+
+_GEOMETRY_FIELDS = ("x", "y", "width", "height")
+
+
+def _number(value: Optional[str]):
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+
+_WRAPPER_TAGS = ("object", "UserObject")
+
+
+def cell_to_dict(cell: Element, wrapper: Optional[Element] = None) -> dict:
+    """JSON-friendly view of an ``mxCell`` element
+
+    ``wrapper`` is an enclosing ``<object>``/``<UserObject>``, which carries the
+    id and label of cells that have custom properties.
+    """
+    data = {
+        "id": wrapper.get("id") if wrapper is not None else cell.get("id"),
+        "parent": cell.get("parent"),
+        "value": wrapper.get("label", "") if wrapper is not None else cell.get("value", ""),
+        "style": cell.get("style", ""),
+        "vertex": cell.get("vertex") == "1",
+        "edge": cell.get("edge") == "1",
+    }
+    if data["edge"]:
+        data["source"] = cell.get("source")
+        data["target"] = cell.get("target")
+    geometry = cell.find("mxGeometry")
+    if geometry is not None:
+        data["geometry"] = {
+            field: _number(geometry.get(field))
+            for field in _GEOMETRY_FIELDS
+            if geometry.get(field) is not None
+        }
+        if geometry.get("relative") == "1":
+            data["geometry"]["relative"] = True
+    return data
+
+
+class DrawioCellParser:
+    """Incremental ``mxCell`` extractor for Draw.io XML text
+
+    Malformed XML stops cell extraction (``failed`` becomes True) without
+    raising, so the raw text stream is never interrupted.
+    """
+
+    def __init__(self):
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._stack: list[Element] = []
+        self.failed = False
+        self.cell_count = 0
+
+    def feed(self, text: str) -> list[dict]:
+        if self.failed or not text:
+            return []
+        try:
+            self._parser.feed(text)
+            return self._drain()
+        except ParseError:
+            self.failed = True
+            return []
+
+    def close(self) -> list[dict]:
+        if self.failed:
+            return []
+        try:
+            self._parser.close()
+        except ParseError:
+            # Truncated output; cells already reported stay valid
+            return []
+        return self._drain()
+
+    def _drain(self) -> list[dict]:
+        cells = []
+        for event, element in self._parser.read_events():
+            if event == "start":
+                self._stack.append(element)
+                continue
+            self._stack.pop()
+            if element.tag in _WRAPPER_TAGS and self._stack:
+                self._stack[-1].remove(element)
+            elif element.tag == "mxCell":
+                wrapper = self._stack[-1] if self._stack and self._stack[-1].tag in _WRAPPER_TAGS else None
+                cells.append(cell_to_dict(element, wrapper))
+                self.cell_count += 1
+                if self._stack:
+                    self._stack[-1].remove(element)
+        return cells
+
+
+class DrawioStreamTracker:
+    """Turns a raw model text stream into code plus finished Draw.io cells
+
+    For chat answers that mix prose and XML, the XML is located with the same
+    incremental extraction used for generation before it reaches the parser.
+    """
+
+    def __init__(self):
+        self.extractor = IncrementalCodeExtractor(DiagramFormat.DRAWIO)
+        self.parser = DrawioCellParser()
+
+    def feed(self, text: str) -> list[dict]:
+        return self.parser.feed(self.extractor.feed(text))
+
+    def finish(self) -> list[dict]:
+        cells = self.parser.feed(self.extractor.finish())
+        return cells + self.parser.close()
@@ -0,0 +1,248 @@
+"""Deterministic local LLM provider for offline load testing
+
+``FakeLLMService`` implements the same interface as the real provider
+services but answers from templates derived from the input, with timing
+modelled on a real API: a fixed per-call latency, a time to first token and
+a steady output token rate. Reasoning chunks and error injection are
+configurable. The same input always gives the same output, and the same
+decision about whether to fail, so load tests are repeatable and measure the
+server's own overhead without any network.
+"""
+import asyncio
+import hashlib
+import json
+import re
+from typing import Optional
+from xml.sax.saxutils import quoteattr
+
+from app.core.config import settings
+from app.core.tracing import span
+from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.chat_history import estimate_tokens
+from app.services.ai.claude_service import claude_service
+from app.services.ai.code_extraction import FENCE, clean_diagram_code
+from app.services.ai.usage import record_usage
+
+_CLAUSE_RE = re.compile(r"[,，。.;；:：、!！?？\n]+|\s+(?:then|and)\s+|然后|接着")
+_CHUNK_RE = re.compile(r"[A-Za-z]{1,4}|\d{1,3}|\s+|.", re.DOTALL)
+
+MAX_NODES = 8
+
+
+class FakeProviderError(RuntimeError):
+    """Error injected by the fake provider"""
+
+
+class FakeClient:
+    """Stands in for an SDK client in the client pool"""
+
+    async def close(self) -> None:
+        pass
+
+
+def _digest(*parts: str) -> int:
+    data = "\x00".join([str(settings.FAKE_PROVIDER_SEED), *parts]).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def _labels(text: str) -> list[str]:
+    labels = [clause.strip()[:16] for clause in _CLAUSE_RE.split(text) if clause and clause.strip()]
+    labels = labels[:MAX_NODES]
+    while len(labels) < 3:
+        labels.append(f"步骤{len(labels) + 1}")
+    return labels
+
+
+def _mermaid(diagram_type: DiagramType, labels: list[str]) -> str:
+    quoted = [label.replace('"', "'") for label in labels]
+    if diagram_type == DiagramType.SEQUENCE:
+        lines = ["sequenceDiagram", "    participant U as 用户", "    participant S as 系统"]
+        lines += [f"    U->>S: {label}" if i % 2 == 0 else f"    S-->>U: {label}" for i, label in enumerate(quoted)]
+    elif diagram_type == DiagramType.STATE:
+        lines = ["stateDiagram-v2", "    [*] --> S0"]
+        lines += [f"    S{i} --> S{i + 1}: {label}" for i, label in enumerate(quoted[:-1])]
+        lines.append(f"    S{len(quoted) - 1} --> [*]")
+    elif diagram_type == DiagramType.CLASS:
+        lines = ["classDiagram"]
+        lines += [f"    class C{i} {{\n        +{label}()\n    }}" for i, label in enumerate(quoted)]
+        lines += [f"    C{i} --> C{i + 1}" for i in range(len(quoted) - 1)]
+    else:
+        lines = ["flowchart TD"]
+        lines += [f'    N{i}["{label}"]' for i, label in enumerate(quoted)]
+        lines += [f"    N{i} --> N{i + 1}" for i in range(len(quoted) - 1)]
+    return "\n".join(lines)
+
+
+def _drawio(labels: list[str]) -> str:
+    cells = ['        <mxCell id="0" />', '        <mxCell id="1" parent="0" />']
+    for i, label in enumerate(labels):
+        cells.append(
+            f'        <mxCell id="n{i}" value={quoteattr(label)} '
+            f'style="rounded=1;whiteSpace=wrap;html=1;fillColor=#dae8fc;strokeColor=#6c8ebf;" vertex="1" parent="1">\n'
+            f'          <mxGeometry x="300" y="{50 + i * 120}" width="160" height="60" as="geometry" />\n'
+            f'        </mxCell>'
+        )
+    for i in range(len(labels) - 1):
+        cells.append(
+            f'        <mxCell id="e{i}" style="edgeStyle=orthogonalEdgeStyle;html=1;strokeWidth=2;endArrow=classic;" '
+            f'edge="1" parent="1" source="n{i}" target="n{i + 1}">\n'
+            f'          <mxGeometry relative="1" as="geometry" />\n'
+            f'        </mxCell>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<mxfile host="embed.diagrams.net" agent="FakeLLM">\n'
+        '  <diagram name="Diagram" id="fake">\n'
+        '    <mxGraphModel dx="800" dy="600" grid="1" gridSize="10">\n'
+        '      <root>\n' + "\n".join(cells) + '\n'
+        '      </root>\n'
+        '    </mxGraphModel>\n'
+        '  </diagram>\n'
+        '</mxfile>'
+    )
+
+
+def _chunks(text: str) -> list[str]:
+    """Split text into token-sized pieces, roughly as a BPE stream would"""
+    return _CHUNK_RE.findall(text)
+
+
+class FakeLLMService:
+    def __init__(self):
+        self._client = None
+        self.model = "fake-llm-1"
+        self.base_url = None
+        # Real system prompts keep prompt hashing and history budgets realistic
+        self.prompts = claude_service.prompts
+
+    def create_client(self, api_key: str, base_url: Optional[str] = None) -> FakeClient:
+        if not settings.FAKE_PROVIDER_ENABLED:
+            raise ValueError("The fake provider is disabled (FAKE_PROVIDER_ENABLED)")
+        return FakeClient()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.create_client("")
+        return self._client
+
+    def _get_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+        return self.prompts.get(diagram_type, diagram_format).text
+
+    def _should_fail(self, *inputs: str) -> bool:
+        rate = settings.FAKE_PROVIDER_ERROR_RATE
+        return rate > 0 and (_digest("error", *inputs) % 10_000) < rate * 10_000
+
+    async def _wait_first_token(self) -> None:
+        delay = settings.FAKE_PROVIDER_LATENCY_MS + settings.FAKE_PROVIDER_TTFT_MS
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+    async def _wait_tokens(self, tokens: int) -> None:
+        rate = settings.FAKE_PROVIDER_TOKENS_PER_SECOND
+        if rate > 0 and tokens > 0:
+            await asyncio.sleep(tokens / rate)
+
+    async def _complete(self, prompt: str, answer: str, *inputs: str) -> str:
+        """Non-streaming call: the full answer after first-token latency plus generation time"""
+        if self._should_fail(*inputs):
+            await asyncio.sleep(settings.FAKE_PROVIDER_LATENCY_MS / 1000)
+            raise FakeProviderError("Injected fake provider error")
+        output_tokens = estimate_tokens(answer)
+        with span("llm.request", provider="fake", model=self.model, operation=inputs[0]):
+            await self._wait_first_token()
+            await self._wait_tokens(output_tokens)
+        record_usage(input_tokens=estimate_tokens(prompt), output_tokens=output_tokens)
+        return answer
+
+    def _diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat) -> str:
+        labels = _labels(description)
+        if diagram_format == DiagramFormat.DRAWIO:
+            return _drawio(labels)
+        return _mermaid(diagram_type, labels)
+
+    def _answer(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat) -> str:
+        """Model-style answer: a sentence of prose, then the diagram in a fence"""
+        lang = "xml" if diagram_format == DiagramFormat.DRAWIO else "mermaid"
+        code = self._diagram(description, diagram_type, diagram_format)
+        return f"好的，下面是根据描述生成的图表：\n{FENCE}{lang}\n{code}\n{FENCE}"
+
+    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
+        """Generate a canned diagram from the description"""
+        prompt = self._get_system_prompt(diagram_type, diagram_format) + description
+        answer = self._answer(description, diagram_type, diagram_format)
+        text = await self._complete(prompt, answer, "generate", description)
+        return clean_diagram_code(text, diagram_format)
+
+    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
+        """Return the diagram with one node added for the instruction"""
+        if diagram_format == DiagramFormat.DRAWIO:
+            cell = (
+                f'<mxCell id="r{_digest(instruction) % 10_000}" value={quoteattr(instruction[:16])} '
+                'style="rounded=1;whiteSpace=wrap;html=1;" vertex="1" parent="1">'
+                '<mxGeometry x="520" y="50" width="160" height="60" as="geometry" /></mxCell>'
+            )
+            refined = code.replace("</root>", f"{cell}\n</root>", 1) if "</root>" in code else code
+        else:
+            refined = f"{code.rstrip()}\n    %% {instruction}"
+        return await self._complete(code + instruction, refined, "refine", code, instruction)
+
+    async def refine_patch(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
+        """Return a one-operation patch adding a node for the instruction"""
+        if diagram_format == DiagramFormat.DRAWIO:
+            ops = [{"op": "add", "cell": {
+                "id": f"r{_digest(instruction) % 10_000}", "value": instruction[:16], "vertex": True,
+                "style": "rounded=1;whiteSpace=wrap;html=1;",
+                "geometry": {"x": 520, "y": 50, "width": 160, "height": 60},
+            }}]
+        else:
+            ops = [{"op": "insert", "after": len(code.split("\n")), "text": f"    %% {instruction}"}]
+        answer = json.dumps(ops, ensure_ascii=False)
+        return await self._complete(code + instruction, answer, "refine_patch", code, instruction)
+
+    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None) -> str:
+        """Describe the diagram by its size"""
+        lines = [line for line in code.split("\n") if line.strip()]
+        answer = f"这个图表共有 {len(lines)} 行定义，{code.count('mxCell') // 2 or len(lines)} 个元素，描述了一个按顺序执行的流程。"
+        return await self._complete(code, answer, "explain", code)
+
+    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
+        """Stream a canned answer at the configured token rate
+
+        With reasoning chunks configured, output follows the DeepSeek shape
+        (dicts with type reasoning/content); otherwise plain text chunks.
+        """
+        last = messages[-1]["content"] if messages else ""
+        prompt = self._get_system_prompt(diagram_type, diagram_format) + "".join(m["content"] for m in messages)
+        fail = self._should_fail("chat", last)
+        reasoning_chunks = settings.FAKE_PROVIDER_REASONING_CHUNKS
+        chunks = _chunks(self._answer(last, diagram_type, diagram_format))
+
+        await self._wait_first_token()
+        output_tokens = reasoning_tokens = 0
+        for i in range(reasoning_chunks):
+            text = f"思考步骤{i + 1}：分析需求中的元素与关系。"
+            await self._wait_tokens(estimate_tokens(text))
+            reasoning_tokens += estimate_tokens(text)
+            yield {'type': 'reasoning', 'content': text}
+        for i, chunk in enumerate(chunks):
+            if fail and i == len(chunks) // 2:
+                # Fail mid-stream, after the client has already received output
+                raise FakeProviderError("Injected fake provider error")
+            await self._wait_tokens(1)
+            output_tokens += 1
+            yield {'type': 'content', 'content': chunk} if reasoning_chunks else chunk
+        record_usage(
+            input_tokens=estimate_tokens(prompt),
+            output_tokens=output_tokens + reasoning_tokens,
+            reasoning_tokens=reasoning_tokens,
+        )
+
+    async def generate_stream(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
+        """Stream raw generation output as it is produced"""
+        messages = [{"role": "user", "content": description}]
+        async for chunk in self.chat_stream(messages, diagram_type, diagram_format, client=client):
+            yield chunk
+
+
+fake_service = FakeLLMService()
@@ -1,6 +1,12 @@
+from typing import Optional
 from openai import AsyncOpenAI
 from app.core.config import settings
+from app.core.tracing import span
 from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.code_extraction import clean_diagram_code
+from app.services.ai.diagram_patch import build_patch_prompt
+from app.services.ai.prompts import PromptTable
+from app.services.ai.usage import record_openai_usage
 
 
 class OpenAIService:
@@ -8,23 +14,32 @@ class OpenAIService:
         self._client = None
         self.model = "gpt-4-turbo-preview"
         self.base_url = None  # Can be overridden for custom endpoints
+        self.prompts = PromptTable(self._build_system_prompt)
     
+    def create_client(self, api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+        """Build an async OpenAI client for the given credentials"""
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY is not set")
+
+        client_kwargs = {"api_key": api_key}
+        if base_url:
+            client_kwargs["base_url"] = base_url
+
+        return AsyncOpenAI(**client_kwargs)
+
     @property
     def client(self):
-        """Lazy initialization of OpenAI client"""
+        """Lazy initialization of the default OpenAI client"""
         if self._client is None:
-            if not settings.OPENAI_API_KEY:
-                raise ValueError("OPENAI_API_KEY is not set")
-            
-            client_kwargs = {"api_key": settings.OPENAI_API_KEY}
-            if self.base_url:
-                client_kwargs["base_url"] = self.base_url
-                
-            self._client = AsyncOpenAI(**client_kwargs)
+            self._client = self.create_client(settings.OPENAI_API_KEY, self.base_url)
         return self._client
 
-    def _get_system_prompt(self, diagram_type: DiagramType) -> str:
-        """Get system prompt based on diagram type"""
+    def _get_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+        """Get the precompiled system prompt for a diagram type"""
+        return self.prompts.get(diagram_type, diagram_format).text
+
+    def _build_system_prompt(self, diagram_type: DiagramType, diagram_format: DiagramFormat) -> str:
+        """Build the system prompt for a diagram type (Mermaid only for now)"""
         # Reuse the same prompts as Claude service
         prompts = {
             DiagramType.FLOWCHART: """
@@ -59,35 +74,33 @@ class OpenAIService:
             "你是Mermaid图表专家，根据用户描述生成相应的Mermaid代码。只返回代码，不要有其他解释。",
         )
 
-    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def generate_diagram(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Generate diagram code using OpenAI"""
+        client = client or self.client
         # OpenAI currently only supports Mermaid format well
         if diagram_format == DiagramFormat.DRAWIO:
             # For now, we'll still generate Mermaid and let the caller know
             # In future, this could be enhanced to support Draw.io
             pass
 
-        system_prompt = self._get_system_prompt(diagram_type)
+        system_prompt = self._get_system_prompt(diagram_type, diagram_format)
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": description},
-            ],
-            max_tokens=2000,
-        )
+        with span("llm.request", provider="openai", model=self.model, operation="generate_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": description},
+                ],
+                max_tokens=2000,
+            )
+        record_openai_usage(response.usage)
 
-        code = response.choices[0].message.content
-        # Clean up code blocks if present
-        if "```" in code:
-            code = code.split("```")[1]
-            if code.startswith("mermaid"):
-                code = code[7:]
-        return code.strip()
+        return clean_diagram_code(response.choices[0].message.content, diagram_format)
 
-    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def refine_diagram(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Refine existing diagram with instruction"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 现有的{format_name}代码：
@@ -100,11 +113,13 @@ class OpenAIService:
 请修改上面的{format_name}代码以满足要求。只返回修改后的完整代码，不要有其他解释。
 """
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=2000,
-        )
+        with span("llm.request", provider="openai", model=self.model, operation="refine_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=2000,
+            )
+        record_openai_usage(response.usage)
 
         code = response.choices[0].message.content
         if "```" in code:
@@ -113,8 +128,22 @@ class OpenAIService:
                 code = code[7:]
         return code.strip()
 
-    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID) -> str:
+    async def refine_patch(self, code: str, instruction: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
+        """Ask for the edits that implement an instruction, as JSON operations"""
+        client = client or self.client
+        with span("llm.request", provider="openai", model=self.model, operation="refine_patch"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": build_patch_prompt(code, instruction, diagram_format)}],
+                max_tokens=2000,  # Edits only; scales with the change, not the diagram
+            )
+        record_openai_usage(response.usage)
+
+        return response.choices[0].message.content
+
+    async def explain_diagram(self, code: str, diagram_format: DiagramFormat = DiagramFormat.MERMAID, client=None) -> str:
         """Explain diagram in natural language"""
+        client = client or self.client
         format_name = "Mermaid" if diagram_format == DiagramFormat.MERMAID else "Draw.io XML"
         prompt = f"""
 请用中文解释这个{format_name}图表的内容和结构：
@@ -126,30 +155,43 @@ class OpenAIService:
 用简洁清晰的语言描述图表表达的信息。
 """
 
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000,
-        )
+        with span("llm.request", provider="openai", model=self.model, operation="explain_diagram"):
+            response = await client.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=1000,
+            )
+        record_openai_usage(response.usage)
 
         return response.choices[0].message.content
 
-    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO):
+    async def chat_stream(self, messages: list[dict], diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
         """Stream chat responses with context"""
-        system_prompt = self._get_system_prompt(diagram_type)
+        client = client or self.client
+        system_prompt = self._get_system_prompt(diagram_type, diagram_format)
         
         full_messages = [{"role": "system", "content": system_prompt}] + messages
         
-        stream = await self.client.chat.completions.create(
+        stream = await client.chat.completions.create(
             model=self.model,
             messages=full_messages,
             max_tokens=4000,
             stream=True,
+            stream_options={"include_usage": True},
         )
         
         async for chunk in stream:
-            if chunk.choices[0].delta.content:
+            if chunk.usage is not None:
+                # Final chunk requested by include_usage carries no choices
+                record_openai_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
                 yield chunk.choices[0].delta.content
 
+    async def generate_stream(self, description: str, diagram_type: DiagramType, diagram_format: DiagramFormat = DiagramFormat.DRAWIO, client=None):
+        """Stream raw generation output as it is produced"""
+        messages = [{"role": "user", "content": description}]
+        async for chunk in self.chat_stream(messages, diagram_type, diagram_format, client=client):
+            yield chunk
+
 
 openai_service = OpenAIService()
\ No newline at end of file
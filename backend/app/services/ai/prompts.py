@@ -0,0 +1,47 @@
+"""Precompiled system prompt tables
+
+Each provider's system prompts depend only on (diagram type, format), so they
+are built once when the service is created instead of on every request. Every
+entry carries a content hash: it identifies the exact prompt a response was
+generated with (cache keys change when a prompt is edited) and keeps the
+prompt prefix byte-identical between calls, which upstream prompt caching
+relies on.
+"""
+import hashlib
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable
+
+from app.schemas.diagram import DiagramType, DiagramFormat
+
+
+@dataclass(frozen=True)
+class SystemPrompt:
+    text: str
+    hash: str
+
+
+def prompt_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptTable:
+    """Immutable (diagram type, format) -> ``SystemPrompt`` mapping"""
+
+    def __init__(self, build: Callable[[DiagramType, DiagramFormat], str]):
+        self._prompts = MappingProxyType({
+            (diagram_type, diagram_format): SystemPrompt(text, prompt_hash(text))
+            for diagram_type in DiagramType
+            for diagram_format in DiagramFormat
+            for text in (build(diagram_type, diagram_format),)
+        })
+        digest = hashlib.sha256()
+        for key in sorted(self._prompts, key=lambda k: (k[0].value, k[1].value)):
+            digest.update(self._prompts[key].hash.encode("ascii"))
+        self.hash = digest.hexdigest()[:16]
+
+    def get(self, diagram_type: DiagramType, diagram_format: DiagramFormat) -> SystemPrompt:
+        return self._prompts[(diagram_type, diagram_format)]
+
+    def __len__(self) -> int:
+        return len(self._prompts)
@@ -0,0 +1,101 @@
+"""Token usage reported by the providers
+
+Services call ``record_usage`` after each upstream response; callers that want
+the counts wrap the call in ``track_usage()``. The counter lives in a context
+variable, so concurrent requests sharing the service singletons never see each
+other's numbers.
+
+Counts are normalised across providers: ``input_tokens`` is the full prompt
+size and ``cached_input_tokens`` the part of it served from the provider's
+prompt cache (Anthropic ``cache_read_input_tokens``, OpenAI
+``prompt_tokens_details.cached_tokens``, DeepSeek ``prompt_cache_hit_tokens``).
+``reasoning_tokens`` is the part of ``output_tokens`` spent on reasoning
+(``completion_tokens_details.reasoning_tokens``).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Iterator, Optional
+
+
+@dataclass
+class UsageCounter:
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+    cache_write_tokens: int = 0
+    reasoning_tokens: int = 0
+    calls: int = 0
+
+    def as_dict(self) -> dict:
+        data = asdict(self)
+        del data["calls"]
+        return data
+
+    def summary(self) -> Optional[dict]:
+        """Counts as a dict, or None when no upstream call reported usage"""
+        return self.as_dict() if self.calls else None
+
+
+_current: ContextVar[Optional[UsageCounter]] = ContextVar("ai_usage", default=None)
+
+
+@contextmanager
+def track_usage() -> Iterator[UsageCounter]:
+    counter = UsageCounter()
+    token = _current.set(counter)
+    try:
+        yield counter
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # A streaming generator finalised from another context; nothing to restore
+            pass
+
+
+def record_usage(
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    cached_input_tokens: int = 0,
+    cache_write_tokens: int = 0,
+    reasoning_tokens: int = 0,
+) -> None:
+    counter = _current.get()
+    if counter is None:
+        return
+    counter.input_tokens += input_tokens
+    counter.output_tokens += output_tokens
+    counter.cached_input_tokens += cached_input_tokens
+    counter.cache_write_tokens += cache_write_tokens
+    counter.reasoning_tokens += reasoning_tokens
+    counter.calls += 1
+
+
+def record_anthropic_usage(usage) -> None:
+    """Record an Anthropic ``Usage``; its input_tokens exclude cache reads and writes"""
+    if usage is None:
+        return
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    record_usage(
+        input_tokens=(usage.input_tokens or 0) + cache_read + cache_write,
+        output_tokens=usage.output_tokens or 0,
+        cached_input_tokens=cache_read,
+        cache_write_tokens=cache_write,
+    )
+
+
+def record_openai_usage(usage) -> None:
+    """Record an OpenAI-compatible ``CompletionUsage`` (OpenAI or DeepSeek)"""
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or getattr(usage, "prompt_cache_hit_tokens", None) or 0
+    completion_details = getattr(usage, "completion_tokens_details", None)
+    record_usage(
+        input_tokens=usage.prompt_tokens or 0,
+        output_tokens=usage.completion_tokens or 0,
+        cached_input_tokens=cached,
+        reasoning_tokens=getattr(completion_details, "reasoning_tokens", None) or 0,
+    )
@@ -0,0 +1,821 @@
+"""Browser-free renderer for Draw.io diagrams
+
+Mermaid exports need mermaid-cli and a headless browser, but a Draw.io
+diagram already says where everything goes: every vertex has an
+``mxGeometry`` and every edge names its endpoints. This module reads the
+mxGraphModel, whether plain or deflate-compressed inside an ``<mxfile>``. It
+resolves the cells into absolute coordinates once (a ``DrawioScene``) and
+draws that scene as SVG text, as vector PDF (via ``svg_pdf``) or, through
+Pillow, as PNG and raster PDF.
+
+Supported: rectangles (square or rounded), rhombus, ellipse, cylinder3,
+hexagon, parallelogram, triangle, umlActor, swimlane and text cells; fill,
+stroke, dash, opacity and font styles; straight and orthogonal edges with
+waypoints, fixed exit/entry points and classic/open arrowheads. Other shapes
+are drawn as their bounding rectangle. Rendering is a linear pass over the
+cells, so diagrams with thousands of cells take milliseconds.
+"""
+import base64
+import html
+import io
+import math
+import re
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Union
+from urllib.parse import unquote
+from xml.etree.ElementTree import Element, ParseError, fromstring
+from xml.sax.saxutils import escape
+
+from app.core.config import settings
+from app.services.ai.drawio_stream import cell_to_dict
+from app.services.svg_pdf import svg_to_pdf
+
+# Part of the export cache key; bump when the output of this module changes
+DRAWIO_RENDERER_VERSION = "1"
+
+MARGIN = 10
+DEFAULT_FONT_SIZE = 12
+LINE_HEIGHT = 1.2
+FONT_FAMILY = "Helvetica, Arial, sans-serif"
+
+ORTHOGONAL_EDGE_STYLES = ("orthogonalEdgeStyle", "elbowEdgeStyle", "entityRelationEdgeStyle")
+POLYGON_SHAPES = ("rhombus", "hexagon", "parallelogram", "triangle")
+
+_BREAK_RE = re.compile(r"<br\s*/?>|</(?:div|p|li)>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_WIDE_CHAR_RE = re.compile(r"[ᄀ-ᅟ⺀-꓏가-힣豈-﫿︰-﹏＀-｠￠-￦]")
+
+Point = tuple[float, float]
+
+
+class DrawioRenderError(ValueError):
+    """The code is not a Draw.io diagram this renderer can read"""
+
+
+@dataclass
+class Vertex:
+    id: str
+    x: float
+    y: float
+    width: float
+    height: float
+    shape: str
+    style: dict
+    label: str
+
+    @property
+    def center(self) -> Point:
+        return self.x + self.width / 2, self.y + self.height / 2
+
+
+@dataclass
+class Arrowhead:
+    points: list[Point]
+    closed: bool  # Filled triangle/notched head, or an open "V"
+
+
+@dataclass
+class Edge:
+    id: str
+    points: list[Point]
+    style: dict
+    label: str
+    end_arrow: Optional[Arrowhead] = None
+    start_arrow: Optional[Arrowhead] = None
+
+
+@dataclass
+class DrawioScene:
+    cells: list[Union[Vertex, Edge]]  # In document (z) order
+    left: float
+    top: float
+    width: float
+    height: float
+
+
+@lru_cache(maxsize=1024)
+def parse_style(style: str) -> dict:
+    """``"ellipse;fillColor=#fff;"`` -> ``{"shape": "ellipse", "fillColor": "#fff"}``
+
+    Cached, since diagrams repeat a handful of styles; treat the result as read-only.
+    """
+    parsed = {}
+    for token in style.split(";"):
+        token = token.strip()
+        if not token:
+            continue
+        key, sep, value = token.partition("=")
+        if sep:
+            parsed[key] = value
+        else:
+            parsed.setdefault("shape", key)  # Named base style, e.g. "ellipse" or "text"
+    return parsed
+
+
+def _graph_model(code: str) -> Element:
+    try:
+        root = fromstring(code.strip())
+    except ParseError as e:
+        raise DrawioRenderError(f"Invalid XML: {e}")
+    if root.tag == "mxGraphModel":
+        return root
+    diagram = root if root.tag == "diagram" else root.find("diagram")
+    if diagram is None:
+        raise DrawioRenderError(f"Expected <mxfile> or <mxGraphModel>, got <{root.tag}>")
+    model = diagram.find("mxGraphModel")
+    if model is not None:
+        return model
+    # Compressed page: base64(raw deflate(urlencoded XML)), as saved by draw.io
+    try:
+        inflated = zlib.decompress(base64.b64decode((diagram.text or "").strip()), -15)
+        return fromstring(unquote(inflated.decode("utf-8")))
+    except (ValueError, zlib.error, ParseError) as e:
+        raise DrawioRenderError(f"Cannot read compressed diagram: {e}")
+
+
+def _cells(model: Element):
+    """(cell dict, mxGeometry element) for each cell, unwrapping <object>/<UserObject>"""
+    root = model.find("root")
+    if root is None:
+        return
+    for element in root:
+        if element.tag == "mxCell":
+            yield cell_to_dict(element), element.find("mxGeometry")
+        else:
+            cell = element.find("mxCell")
+            if cell is not None:
+                yield cell_to_dict(cell, element), cell.find("mxGeometry")
+
+
+def _number(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _label(value: str, style: dict) -> str:
+    if not value:
+        return ""
+    if style.get("html") == "1":
+        value = _BREAK_RE.sub("\n", value)
+        value = html.unescape(_TAG_RE.sub("", value))
+    return value.replace("\xa0", " ").strip()
+
+
+def _point(element: Optional[Element], offset: Point) -> Optional[Point]:
+    if element is None:
+        return None
+    return _number(element.get("x")) + offset[0], _number(element.get("y")) + offset[1]
+
+
+def perimeter_point(vertex: Vertex, toward: Point) -> Point:
+    """Where the line from the vertex center to ``toward`` crosses its outline"""
+    cx, cy = vertex.center
+    dx, dy = toward[0] - cx, toward[1] - cy
+    hw, hh = vertex.width / 2, vertex.height / 2
+    if (dx == 0 and dy == 0) or hw == 0 or hh == 0:
+        return cx, cy
+    if vertex.shape == "ellipse":
+        t = 1 / math.hypot(dx / hw, dy / hh)
+    elif vertex.shape == "rhombus":
+        t = 1 / (abs(dx) / hw + abs(dy) / hh)
+    else:
+        t = min(hw / abs(dx) if dx else math.inf, hh / abs(dy) if dy else math.inf)
+    t = min(t, 1.0)  # ``toward`` inside the shape
+    return cx + dx * t, cy + dy * t
+
+
+def _fixed_point(vertex: Optional[Vertex], style: dict, prefix: str) -> Optional[Point]:
+    """Anchor from exitX/exitY (or entryX/entryY), given as fractions of the vertex bounds"""
+    if vertex is None or f"{prefix}X" not in style or f"{prefix}Y" not in style:
+        return None
+    return (
+        vertex.x + _number(style[f"{prefix}X"]) * vertex.width,
+        vertex.y + _number(style[f"{prefix}Y"]) * vertex.height,
+    )
+
+
+def _orthogonal(points: list[Point]) -> list[Point]:
+    """Insert elbows so that every segment is horizontal or vertical"""
+    routed = [points[0]]
+    single = len(points) == 2
+    for x, y in points[1:]:
+        px, py = routed[-1]
+        if px != x and py != y:
+            if single:
+                # Free-standing connector: bend twice, halfway along the longer axis
+                if abs(x - px) >= abs(y - py):
+                    mid = (px + x) / 2
+                    routed.extend([(mid, py), (mid, y)])
+                else:
+                    mid = (py + y) / 2
+                    routed.extend([(px, mid), (x, mid)])
+            else:
+                routed.append((x, py))
+        routed.append((x, y))
+    return routed
+
+
+def _arrowhead(tip: Point, before: Point, kind: str, size: float) -> Optional[Arrowhead]:
+    """Polygon of an arrowhead pointing at ``tip``, coming from ``before``"""
+    if kind == "none":
+        return None
+    dx, dy = tip[0] - before[0], tip[1] - before[1]
+    length = math.hypot(dx, dy)
+    if length == 0:
+        return None
+    ux, uy = dx / length, dy / length
+    depth, half = size * 1.5, size * 0.6
+    bx, by = tip[0] - ux * depth, tip[1] - uy * depth
+    left = (bx - uy * half, by + ux * half)
+    right = (bx + uy * half, by - ux * half)
+    if kind == "classic":
+        notch = (tip[0] - ux * depth * 0.7, tip[1] - uy * depth * 0.7)
+        return Arrowhead([tip, left, notch, right], closed=True)
+    if kind == "open":
+        return Arrowhead([left, tip, right], closed=False)
+    return Arrowhead([tip, left, right], closed=True)  # block and anything else
+
+
+def _edge_route(edge: dict, style: dict, geometry: Optional[Element], vertices: dict, offset: Point):
+    source = vertices.get(edge.get("source"))
+    target = vertices.get(edge.get("target"))
+    waypoints = []
+    source_point = target_point = None
+    if geometry is not None:
+        for point in geometry.findall("mxPoint"):
+            if point.get("as") == "sourcePoint":
+                source_point = _point(point, offset)
+            elif point.get("as") == "targetPoint":
+                target_point = _point(point, offset)
+        array = geometry.find("Array")
+        if array is not None:
+            waypoints = [_point(point, offset) for point in array.findall("mxPoint")]
+
+    start = _fixed_point(source, style, "exit") or (source.center if source else source_point)
+    end = _fixed_point(target, style, "entry") or (target.center if target else target_point)
+    if start is None or end is None:
+        return None
+    points = [start, *waypoints, end]
+    if style.get("edgeStyle") in ORTHOGONAL_EDGE_STYLES:
+        points = _orthogonal(points)
+    # Endpoints at a center are moved out to the shape outline
+    if source is not None and start == source.center and len(points) > 1:
+        points[0] = perimeter_point(source, points[1])
+    if target is not None and end == target.center and len(points) > 1:
+        points[-1] = perimeter_point(target, points[-2])
+    return points
+
+
+def build_scene(code: str) -> DrawioScene:
+    """Resolve a Draw.io document into absolutely positioned vertices and routed edges"""
+    parsed = list(_cells(_graph_model(code)))
+    by_id = {cell["id"]: cell for cell, _ in parsed}
+    origins: dict[str, Point] = {}
+
+    def origin(cell_id: Optional[str], depth: int = 0) -> Point:
+        """Absolute top-left of a container vertex; its children are positioned relative to it"""
+        cell = by_id.get(cell_id)
+        if cell is None or not cell["vertex"] or depth > 100:
+            return 0.0, 0.0  # Layers and the root cell
+        if cell_id not in origins:
+            geometry = cell.get("geometry") or {}
+            px, py = origin(cell.get("parent"), depth + 1)
+            origins[cell_id] = (px + geometry.get("x", 0), py + geometry.get("y", 0))
+        return origins[cell_id]
+
+    vertices: dict[str, Vertex] = {}
+    for cell, _ in parsed:
+        style = parse_style(cell["style"])
+        parent = by_id.get(cell.get("parent"))
+        # Children of edges are edge labels placed along the edge; not supported
+        if not cell["vertex"] or style.get("visible") == "0" or (parent is not None and parent["edge"]):
+            continue
+        x, y = origin(cell["id"])
+        size = cell.get("geometry") or {}
+        shape = style.get("shape", "rect")
+        if shape in ("rect", "rectangle", "label") and style.get("rounded") == "1":
+            shape = "rounded"
+        if shape == "cylinder":
+            shape = "cylinder3"
+        vertices[cell["id"]] = Vertex(
+            cell["id"], x, y, size.get("width", 0), size.get("height", 0),
+            shape, style, _label(cell["value"], style),
+        )
+
+    # Second pass in document order, so edges keep their z-order among the vertices
+    cells: list[Union[Vertex, Edge]] = []
+    for cell, geometry in parsed:
+        if cell["id"] in vertices:
+            cells.append(vertices[cell["id"]])
+            continue
+        if not cell["edge"]:
+            continue
+        style = parse_style(cell["style"])
+        points = _edge_route(cell, style, geometry, vertices, origin(cell.get("parent")))
+        if points is None:
+            continue
+        end_kind = style.get("endArrow", "classic")
+        if style.get("endFill") == "0" and end_kind != "none":
+            end_kind = "open"
+        cells.append(Edge(
+            cell["id"], points, style, _label(cell["value"], style),
+            end_arrow=_arrowhead(points[-1], points[-2], end_kind, _number(style.get("endSize"), 6)),
+            start_arrow=_arrowhead(
+                points[0], points[1], style.get("startArrow", "none"), _number(style.get("startSize"), 6)
+            ),
+        ))
+
+    return _with_bounds(cells)
+
+
+def _with_bounds(cells: list) -> DrawioScene:
+    xs, ys = [], []
+    for cell in cells:
+        if isinstance(cell, Vertex):
+            xs += [cell.x, cell.x + cell.width]
+            ys += [cell.y, cell.y + cell.height]
+            if cell.label and (cell.style.get("verticalLabelPosition") == "bottom" or cell.shape == "umlActor"):
+                ys.append(cell.y + cell.height + _font_size(cell.style) * LINE_HEIGHT * (cell.label.count("\n") + 1))
+        else:
+            xs += [x for x, _ in cell.points]
+            ys += [y for _, y in cell.points]
+    if not xs:
+        return DrawioScene(cells, 0.0, 0.0, 2 * MARGIN, 2 * MARGIN)
+    left, top = min(xs) - MARGIN, min(ys) - MARGIN
+    return DrawioScene(cells, left, top, max(xs) + MARGIN - left, max(ys) + MARGIN - top)
+
+
+# -- shared geometry -----------------------------------------------------------
+
+def polygon_points(vertex: Vertex) -> list[Point]:
+    x, y, w, h = vertex.x, vertex.y, vertex.width, vertex.height
+    cx, cy = vertex.center
+    if vertex.shape == "rhombus":
+        return [(cx, y), (x + w, cy), (cx, y + h), (x, cy)]
+    if vertex.shape == "triangle":
+        return [(x, y), (x + w, cy), (x, y + h)]
+    fixed = vertex.style.get("fixedSize") == "1"
+    if vertex.shape == "hexagon":
+        inset = _number(vertex.style.get("size"), 20) if fixed else w * 0.25
+        return [(x + inset, y), (x + w - inset, y), (x + w, cy), (x + w - inset, y + h), (x + inset, y + h), (x, cy)]
+    inset = _number(vertex.style.get("size"), 20) if fixed else w * 0.2  # parallelogram
+    return [(x + inset, y), (x + w, y), (x + w - inset, y + h), (x, y + h)]
+
+
+def _rounded(vertex: Vertex) -> bool:
+    return vertex.shape == "rounded" or (vertex.shape == "swimlane" and vertex.style.get("rounded") == "1")
+
+
+def _corner_radius(vertex: Vertex) -> float:
+    """arcSize is a percentage of the shorter side, or a diameter in px with absoluteArcSize"""
+    if vertex.style.get("absoluteArcSize") == "1":
+        return _number(vertex.style.get("arcSize"), 20) / 2
+    return min(vertex.width, vertex.height) * _number(vertex.style.get("arcSize"), 15) / 100
+
+
+def _cylinder_cap(vertex: Vertex) -> float:
+    return min(_number(vertex.style.get("size"), 15), vertex.height / 2)
+
+
+def _swimlane_header(vertex: Vertex) -> float:
+    return min(_number(vertex.style.get("startSize"), 23), vertex.height)
+
+
+def _font_size(style: dict) -> float:
+    return _number(style.get("fontSize"), DEFAULT_FONT_SIZE)
+
+
+def _text_width(text: str, font_size: float) -> float:
+    """Approximate advance width; CJK and fullwidth characters count as one em"""
+    wide = len(_WIDE_CHAR_RE.findall(text))
+    return (len(text) - wide) * font_size * 0.55 + wide * font_size
+
+
+def wrap_lines(text: str, width: float, font_size: float) -> list[str]:
+    """Greedy line wrapping at spaces (or anywhere, for CJK) to fit ``width``"""
+    lines = []
+    for paragraph in text.split("\n"):
+        if width <= 0 or _text_width(paragraph, font_size) <= width:
+            lines.append(paragraph)
+            continue
+        current = ""
+        for token in re.findall(r"\S+\s*|\s+", paragraph):
+            pieces = list(token) if _WIDE_CHAR_RE.search(token) else [token]
+            for piece in pieces:
+                if current and _text_width(current + piece.rstrip(), font_size) > width:
+                    lines.append(current.rstrip())
+                    current = piece.lstrip()
+                else:
+                    current += piece
+        lines.append(current.rstrip())
+    return lines
+
+
+@dataclass
+class TextBlock:
+    lines: list[str]
+    x: float  # Center of the block
+    y: float  # Top of the first line
+    font_size: float
+    color: str
+    bold: bool
+    italic: bool
+
+
+def text_block(cell: Union[Vertex, Edge]) -> Optional[TextBlock]:
+    if not cell.label:
+        return None
+    style = cell.style
+    size = _font_size(style)
+    font_style = int(_number(style.get("fontStyle"), 0))
+    color = style.get("fontColor", "#000000")
+    if isinstance(cell, Edge):
+        lines = cell.label.split("\n")
+        x, y = _midpoint(cell.points)
+        top = y - len(lines) * size * LINE_HEIGHT / 2
+        return TextBlock(lines, x, top, size, color, bool(font_style & 1), bool(font_style & 2))
+
+    below = style.get("verticalLabelPosition") == "bottom" or cell.shape == "umlActor"
+    wrap = style.get("whiteSpace") == "wrap" and not below
+    lines = wrap_lines(cell.label, cell.width - 4, size) if wrap else cell.label.split("\n")
+    block_height = len(lines) * size * LINE_HEIGHT
+    cx, cy = cell.center
+    if below:
+        top = cell.y + cell.height + 2
+    elif cell.shape == "swimlane":
+        top = cell.y + (_swimlane_header(cell) - block_height) / 2
+    elif style.get("verticalAlign") == "top":
+        top = cell.y + 2
+    elif style.get("verticalAlign") == "bottom":
+        top = cell.y + cell.height - block_height - 2
+    else:
+        top = cy - block_height / 2
+    return TextBlock(lines, cx, top, size, color, bool(font_style & 1), bool(font_style & 2))
+
+
+def _midpoint(points: list[Point]) -> Point:
+    lengths = [math.dist(a, b) for a, b in zip(points, points[1:])]
+    remaining = sum(lengths) / 2
+    for (a, b), length in zip(zip(points, points[1:]), lengths):
+        if remaining <= length and length > 0:
+            t = remaining / length
+            return a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t
+        remaining -= length
+    return points[-1]
+
+
+def _paint(value: Optional[str], default: Optional[str]) -> Optional[str]:
+    """Style color, or None for "none"; draw.io's "default" means the theme color"""
+    if value is None or value == "default":
+        return default
+    if value == "none" or not value:
+        return None
+    return value
+
+
+def _fill(style: dict, shape: str) -> Optional[str]:
+    if shape in ("text", "umlActor") and "fillColor" not in style:
+        return None
+    return _paint(style.get("fillColor"), "#ffffff")
+
+
+def _stroke(style: dict, shape: str) -> Optional[str]:
+    if shape == "text" and "strokeColor" not in style:
+        return None
+    return _paint(style.get("strokeColor"), "#000000")
+
+
+# -- SVG -----------------------------------------------------------------------
+
+def _fmt(value: float) -> str:
+    return f"{value:g}"
+
+
+def _points_attr(points: list[Point]) -> str:
+    return " ".join(f"{_fmt(x)},{_fmt(y)}" for x, y in points)
+
+
+def _svg_paint(style: dict, fill: Optional[str], stroke: Optional[str]) -> str:
+    attrs = [
+        f'fill="{escape(fill)}"' if fill else 'fill="none"',
+        f'stroke="{escape(stroke)}"' if stroke else 'stroke="none"',
+    ]
+    if stroke:
+        attrs.append(f'stroke-width="{_fmt(_number(style.get("strokeWidth"), 1))}"')
+        if style.get("dashed") == "1":
+            attrs.append('stroke-dasharray="3 3"')
+    opacity = _number(style.get("opacity"), 100)
+    if opacity < 100:
+        attrs.append(f'opacity="{_fmt(opacity / 100)}"')
+    return " ".join(attrs)
+
+
+def _svg_vertex(vertex: Vertex, out: list[str]) -> None:
+    x, y, w, h = vertex.x, vertex.y, vertex.width, vertex.height
+    shape, style = vertex.shape, vertex.style
+    paint = _svg_paint(style, _fill(style, shape), _stroke(style, shape))
+    if shape in POLYGON_SHAPES:
+        out.append(f'<polygon points="{_points_attr(polygon_points(vertex))}" {paint}/>')
+    elif shape in ("ellipse", "doubleEllipse"):
+        cx, cy = vertex.center
+        out.append(f'<ellipse cx="{_fmt(cx)}" cy="{_fmt(cy)}" rx="{_fmt(w / 2)}" ry="{_fmt(h / 2)}" {paint}/>')
+    elif shape == "cylinder3":
+        cap = _cylinder_cap(vertex)
+        rx = _fmt(w / 2)
+        out.append(
+            f'<path d="M{_fmt(x)},{_fmt(y + cap)} A{rx},{_fmt(cap)} 0 0 1 {_fmt(x + w)},{_fmt(y + cap)} '
+            f'L{_fmt(x + w)},{_fmt(y + h - cap)} A{rx},{_fmt(cap)} 0 0 1 {_fmt(x)},{_fmt(y + h - cap)} Z" {paint}/>'
+        )
+        out.append(
+            f'<path d="M{_fmt(x)},{_fmt(y + cap)} A{rx},{_fmt(cap)} 0 0 0 {_fmt(x + w)},{_fmt(y + cap)}" '
+            f'{_svg_paint(style, None, _stroke(style, shape))}/>'
+        )
+    elif shape == "umlActor":
+        stroke_paint = _svg_paint(style, None, _stroke(style, shape))
+        cx = x + w / 2
+        out.append(
+            f'<ellipse cx="{_fmt(cx)}" cy="{_fmt(y + h / 8)}" rx="{_fmt(w / 4)}" ry="{_fmt(h / 8)}" {paint}/>'
+        )
+        out.append(f'<path d="{_actor_path(vertex)}" {stroke_paint}/>')
+    elif shape == "text":
+        if _fill(style, shape) or _stroke(style, shape):
+            out.append(f'<rect x="{_fmt(x)}" y="{_fmt(y)}" width="{_fmt(w)}" height="{_fmt(h)}" {paint}/>')
+    else:
+        corner = f' rx="{_fmt(_corner_radius(vertex))}"' if _rounded(vertex) else ""
+        out.append(f'<rect x="{_fmt(x)}" y="{_fmt(y)}" width="{_fmt(w)}" height="{_fmt(h)}"{corner} {paint}/>')
+        if shape == "swimlane":
+            header = _swimlane_header(vertex)
+            out.append(
+                f'<path d="M{_fmt(x)},{_fmt(y + header)} H{_fmt(x + w)}" '
+                f'{_svg_paint(style, None, _stroke(style, shape))}/>'
+            )
+
+
+def _actor_lines(vertex: Vertex) -> list[tuple[Point, Point]]:
+    x, y, w, h = vertex.x, vertex.y, vertex.width, vertex.height
+    cx = x + w / 2
+    hip = y + h * 2 / 3
+    return [
+        ((cx, y + h / 4), (cx, hip)),
+        ((x, y + h / 3), (x + w, y + h / 3)),
+        ((cx, hip), (x, y + h)),
+        ((cx, hip), (x + w, y + h)),
+    ]
+
+
+def _actor_path(vertex: Vertex) -> str:
+    return " ".join(f"M{_fmt(a[0])},{_fmt(a[1])} L{_fmt(b[0])},{_fmt(b[1])}" for a, b in _actor_lines(vertex))
+
+
+def _svg_edge(edge: Edge, out: list[str]) -> None:
+    stroke = _paint(edge.style.get("strokeColor"), "#000000")
+    if stroke is None:
+        return
+    out.append(f'<polyline points="{_points_attr(edge.points)}" {_svg_paint(edge.style, None, stroke)}/>')
+    for head in (edge.end_arrow, edge.start_arrow):
+        if head is None:
+            continue
+        if head.closed:
+            out.append(f'<polygon points="{_points_attr(head.points)}" fill="{escape(stroke)}" stroke="{escape(stroke)}"/>')
+        else:
+            out.append(f'<polyline points="{_points_attr(head.points)}" fill="none" stroke="{escape(stroke)}"/>')
+
+
+def _svg_text(block: TextBlock, out: list[str], background: Optional[str] = None) -> None:
+    attrs = [
+        f'x="{_fmt(block.x)}"',
+        f'font-size="{_fmt(block.font_size)}"',
+        f'fill="{escape(block.color)}"',
+        'text-anchor="middle"',
+        'dominant-baseline="central"',
+    ]
+    if block.bold:
+        attrs.append('font-weight="bold"')
+    if block.italic:
+        attrs.append('font-style="italic"')
+    step = block.font_size * LINE_HEIGHT
+    if background:
+        width = max(_text_width(line, block.font_size) for line in block.lines) + 4
+        out.append(
+            f'<rect x="{_fmt(block.x - width / 2)}" y="{_fmt(block.y)}" width="{_fmt(width)}" '
+            f'height="{_fmt(step * len(block.lines))}" fill="{escape(background)}"/>'
+        )
+    spans = "".join(
+        f'<tspan x="{_fmt(block.x)}" y="{_fmt(block.y + step * (i + 0.5))}">{escape(line)}</tspan>'
+        for i, line in enumerate(block.lines)
+    )
+    out.append(f'<text {" ".join(attrs)}>{spans}</text>')
+
+
+def render_svg(scene: DrawioScene, background: str = "transparent") -> bytes:
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{_fmt(scene.width)}" height="{_fmt(scene.height)}" '
+        f'viewBox="{_fmt(scene.left)} {_fmt(scene.top)} {_fmt(scene.width)} {_fmt(scene.height)}" '
+        f'font-family="{FONT_FAMILY}">'
+    ]
+    if background != "transparent":
+        out.append(
+            f'<rect x="{_fmt(scene.left)}" y="{_fmt(scene.top)}" width="{_fmt(scene.width)}" '
+            f'height="{_fmt(scene.height)}" fill="{escape(background)}"/>'
+        )
+    for cell in scene.cells:
+        if isinstance(cell, Vertex):
+            _svg_vertex(cell, out)
+        else:
+            _svg_edge(cell, out)
+        block = text_block(cell)
+        if block is not None:
+            label_background = None
+            if isinstance(cell, Edge):
+                label_background = _paint(cell.style.get("labelBackgroundColor"), "#ffffff")
+            _svg_text(block, out, label_background)
+    out.append("</svg>")
+    return "".join(out).encode("utf-8")
+
+
+# -- Raster (Pillow) -----------------------------------------------------------
+
+@lru_cache(maxsize=64)
+def _font(size: int, bold: bool):
+    from PIL import ImageFont
+
+    path = settings.DRAWIO_FONT_BOLD_PATH if bold and settings.DRAWIO_FONT_BOLD_PATH else settings.DRAWIO_FONT_PATH
+    if path:
+        return ImageFont.truetype(path, size)
+    return ImageFont.load_default(size=size)
+
+
+def _rgba(color: Optional[str], style: dict):
+    from PIL import ImageColor
+
+    if color is None:
+        return None
+    try:
+        rgb = ImageColor.getrgb(color)[:3]
+    except ValueError:
+        rgb = (0, 0, 0)
+    return (*rgb, round(255 * _number(style.get("opacity"), 100) / 100))
+
+
+def _dashed(draw, points: list[Point], fill, width: int, dash: float) -> None:
+    for a, b in zip(points, points[1:]):
+        length = math.dist(a, b)
+        steps = max(int(length // dash), 1)
+        for i in range(0, steps, 2):
+            t0, t1 = i / steps, min((i + 1) / steps, 1.0)
+            draw.line(
+                [(a[0] + (b[0] - a[0]) * t0, a[1] + (b[1] - a[1]) * t0),
+                 (a[0] + (b[0] - a[0]) * t1, a[1] + (b[1] - a[1]) * t1)],
+                fill=fill, width=width,
+            )
+
+
+class _Raster:
+    def __init__(self, scene: DrawioScene, scale: float, background: str):
+        from PIL import Image, ImageDraw
+
+        self.scene = scene
+        self.scale = scale
+        size = (max(1, math.ceil(scene.width * scale)), max(1, math.ceil(scene.height * scale)))
+        if background == "transparent":
+            self.image = Image.new("RGBA", size, (255, 255, 255, 0))
+        else:
+            self.image = Image.new("RGBA", size, _rgba(background, {}))
+        self.draw = ImageDraw.Draw(self.image)
+
+    def xy(self, point: Point) -> Point:
+        return (point[0] - self.scene.left) * self.scale, (point[1] - self.scene.top) * self.scale
+
+    def box(self, x: float, y: float, w: float, h: float) -> list[float]:
+        x0, y0 = self.xy((x, y))
+        return [x0, y0, x0 + max(w * self.scale, 1), y0 + max(h * self.scale, 1)]
+
+    def width(self, style: dict) -> int:
+        return max(1, round(_number(style.get("strokeWidth"), 1) * self.scale))
+
+    def vertex(self, vertex: Vertex) -> None:
+        style, shape = vertex.style, vertex.shape
+        fill = _rgba(_fill(style, shape), style)
+        stroke = _rgba(_stroke(style, shape), style)
+        width = self.width(style)
+        box = self.box(vertex.x, vertex.y, vertex.width, vertex.height)
+        draw = self.draw
+        if shape in POLYGON_SHAPES:
+            draw.polygon([self.xy(p) for p in polygon_points(vertex)], fill=fill, outline=stroke, width=width)
+        elif shape in ("ellipse", "doubleEllipse"):
+            draw.ellipse(box, fill=fill, outline=stroke, width=width)
+        elif shape == "cylinder3":
+            cap = _cylinder_cap(vertex) * self.scale
+            x0, y0, x1, y1 = box
+            draw.rectangle([x0, y0 + cap, x1, y1 - cap], fill=fill)
+            draw.ellipse([x0, y1 - 2 * cap, x1, y1], fill=fill, outline=stroke, width=width)
+            draw.rectangle([x0 + width, y1 - 2 * cap, x1 - width, y1 - cap], fill=fill)
+            draw.ellipse([x0, y0, x1, y0 + 2 * cap], fill=fill, outline=stroke, width=width)
+            if stroke:
+                draw.line([(x0, y0 + cap), (x0, y1 - cap)], fill=stroke, width=width)
+                draw.line([(x1, y0 + cap), (x1, y1 - cap)], fill=stroke, width=width)
+        elif shape == "umlActor":
+            x, y = vertex.x, vertex.y
+            draw.ellipse(
+                self.box(x + vertex.width / 4, y, vertex.width / 2, vertex.height / 4),
+                fill=fill, outline=stroke, width=width,
+            )
+            if stroke:
+                for a, b in _actor_lines(vertex):
+                    draw.line([self.xy(a), self.xy(b)], fill=stroke, width=width)
+        elif shape == "text":
+            if fill or stroke:
+                draw.rectangle(box, fill=fill, outline=stroke, width=width)
+        else:
+            if _rounded(vertex):
+                draw.rounded_rectangle(box, _corner_radius(vertex) * self.scale, fill=fill, outline=stroke, width=width)
+            else:
+                draw.rectangle(box, fill=fill, outline=stroke, width=width)
+            if shape == "swimlane" and stroke:
+                y = self.xy((0, vertex.y + _swimlane_header(vertex)))[1]
+                draw.line([(box[0], y), (box[2], y)], fill=stroke, width=width)
+
+    def edge(self, edge: Edge) -> None:
+        stroke = _rgba(_paint(edge.style.get("strokeColor"), "#000000"), edge.style)
+        if stroke is None:
+            return
+        width = self.width(edge.style)
+        points = [self.xy(p) for p in edge.points]
+        if edge.style.get("dashed") == "1":
+            _dashed(self.draw, points, stroke, width, 3 * self.scale)
+        else:
+            self.draw.line(points, fill=stroke, width=width, joint="curve")
+        for head in (edge.end_arrow, edge.start_arrow):
+            if head is None:
+                continue
+            scaled = [self.xy(p) for p in head.points]
+            if head.closed:
+                self.draw.polygon(scaled, fill=stroke, outline=stroke)
+            else:
+                self.draw.line(scaled, fill=stroke, width=width)
+
+    def text(self, block: TextBlock, background: Optional[str]) -> None:
+        font = _font(max(1, round(block.font_size * self.scale)), block.bold)
+        color = _rgba(block.color, {})
+        step = block.font_size * LINE_HEIGHT
+        for i, line in enumerate(block.lines):
+            if not line:
+                continue
+            x, y = self.xy((block.x, block.y + step * (i + 0.5)))
+            if background:
+                left, top, right, bottom = self.draw.textbbox((x, y), line, font=font, anchor="mm")
+                self.draw.rectangle([left - 2, top - 1, right + 2, bottom + 1], fill=_rgba(background, {}))
+            self.draw.text((x, y), line, fill=color, font=font, anchor="mm")
+
+    def render(self):
+        for cell in self.scene.cells:
+            if isinstance(cell, Vertex):
+                self.vertex(cell)
+            else:
+                self.edge(cell)
+            block = text_block(cell)
+            if block is not None:
+                background = None
+                if isinstance(cell, Edge):
+                    background = _paint(cell.style.get("labelBackgroundColor"), "#ffffff")
+                self.text(block, background)
+        return self.image
+
+
+def render_png(scene: DrawioScene, scale: float = 2, background: str = "white") -> bytes:
+    image = _Raster(scene, scale, background).render()
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=False)
+    return buffer.getvalue()
+
+
+def render_raster_pdf(scene: DrawioScene, scale: float = 3, background: str = "white") -> bytes:
+    """One-page PDF holding the PNG rendering, sized to the diagram in points"""
+    image = _Raster(scene, scale, background).render().convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "PDF", resolution=72 * scale)
+    return buffer.getvalue()
+
+
+def render_drawio(
+    code: str, fmt: str, background: str = "white", scale: float = 1, pdf_mode: str = "vector"
+) -> bytes:
+    """Render Draw.io XML to "svg", "png" or "pdf" bytes
+
+    PDFs are vector (the SVG converted to PDF operators) unless ``pdf_mode`` is
+    "raster"; ``scale`` only affects PNG and raster PDF output.
+    """
+    scene = build_scene(code)
+    if fmt == "svg":
+        return render_svg(scene, background)
+    if fmt == "png":
+        return render_png(scene, scale, background)
+    if fmt == "pdf" and pdf_mode == "raster":
+        return render_raster_pdf(scene, scale, background)
+    if fmt == "pdf":
+        return svg_to_pdf(render_svg(scene, background))
+    raise ValueError(f"Unsupported format: {fmt}")
@@ -1,115 +1,214 @@
 from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
+import asyncio
 import base64
 import io
-import subprocess
-import tempfile
+import logging
 import os
 from pathlib import Path
+from typing import Optional
+
+import aiofiles
+import aiofiles.tempfile
+
+from app.core.config import settings
+from app.core.metrics import MMDC_FAILURES
+from app.core.tracing import span
+from app.services.drawio_renderer import DRAWIO_RENDERER_VERSION, DrawioRenderError, render_drawio
+from app.services.render_cache import render_cache
+from app.services.renderer_pool import (
+    RenderError,
+    RenderQueueFull,
+    RendererUnavailable,
+    RenderTimeout,
+    renderer_pool,
+)
+
+logger = logging.getLogger(__name__)
+
+# Background and scale each export format is rendered with; part of the render cache key
+RENDER_OPTIONS = {
+    'svg': ('transparent', 1),
+    'png': ('white', 2),
+    'pdf': ('white', 3),  # Scale only applies to raster PDFs (EXPORT_PDF_MODE=raster)
+}
 
 
 class ExportService:
-    """Service for exporting diagrams to various formats"""
+    """Service for exporting diagrams to various formats
 
-    async def export_svg(self, mermaid_code: str) -> bytes:
-        """
-        Export Mermaid diagram to SVG
-        Uses mermaid-cli (mmdc) to render
-        """
-        try:
-            # Create temporary files
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False) as input_file:
-                input_file.write(mermaid_code)
-                input_path = input_file.name
+    Nothing here blocks the event loop: renders run on pooled workers or in
+    async subprocesses, and file I/O is async. At most
+    EXPORT_MAX_CONCURRENT_RENDERS renders run per process. Further exports
+    wait up to EXPORT_QUEUE_TIMEOUT_SECONDS and then get a 503.
+    """
 
-            output_path = input_path.replace('.mmd', '.svg')
+    def __init__(self):
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = None
 
-            # Run mermaid-cli
-            result = subprocess.run(
-                ['mmdc', '-i', input_path, '-o', output_path, '-b', 'transparent'],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
+    def _render_slots(self) -> asyncio.Semaphore:
+        # A semaphore belongs to one event loop; rebuild it if the loop changed (tests)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(settings.EXPORT_MAX_CONCURRENT_RENDERS)
+        return self._slots
 
-            if result.returncode != 0:
-                raise Exception(f"Mermaid rendering failed: {result.stderr}")
+    async def _render(self, mermaid_code: str, suffix: str, *options: str) -> bytes:
+        """Run mermaid-cli (mmdc) on the code and return the rendered file"""
+        fmt = suffix.lstrip('.')
+        # Removed on the way out whatever happens, including timeouts and mmdc failures
+        async with aiofiles.tempfile.TemporaryDirectory(prefix='mmdc-') as workdir:
+            input_path = os.path.join(workdir, 'diagram.mmd')
+            output_path = os.path.join(workdir, f'diagram{suffix}')
+            async with aiofiles.open(input_path, 'w', encoding='utf-8') as input_file:
+                await input_file.write(mermaid_code)
 
-            # Read SVG output
-            with open(output_path, 'rb') as f:
-                svg_data = f.read()
+            with span("mmdc", format=fmt) as mmdc_span:
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        'mmdc', '-i', input_path, '-o', output_path, *options,
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+                except FileNotFoundError:
+                    MMDC_FAILURES.labels(fmt, "not_installed").inc()
+                    raise Exception("mermaid-cli (mmdc) is not installed")
+                try:
+                    _, stderr = await asyncio.wait_for(
+                        process.communicate(), settings.EXPORT_RENDER_TIMEOUT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    MMDC_FAILURES.labels(fmt, "timeout").inc()
+                    raise RenderTimeout(f"mmdc took longer than {settings.EXPORT_RENDER_TIMEOUT_SECONDS:g}s")
+                finally:
+                    # Timed out, or the request was cancelled: don't leave the browser running
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                mmdc_span.set(returncode=process.returncode)
 
-            # Cleanup
-            os.unlink(input_path)
-            os.unlink(output_path)
+            if process.returncode != 0:
+                MMDC_FAILURES.labels(fmt, "exit_code").inc()
+                raise Exception(f"Mermaid rendering failed: {stderr.decode(errors='replace')}")
+            async with aiofiles.open(output_path, 'rb') as output_file:
+                return await output_file.read()
 
-            return svg_data
+    async def _render_mermaid(self, mermaid_code: str, fmt: str, background: str, scale: int = 1) -> bytes:
+        """Render on a warm pooled worker, or with a one-off mmdc process if the pool is unavailable"""
+        if settings.RENDER_POOL_ENABLED:
+            try:
+                with span("renderer.render", format=fmt):
+                    return await renderer_pool.render(mermaid_code, fmt, background, scale)
+            except RendererUnavailable as e:
+                MMDC_FAILURES.labels(fmt, "worker_unavailable").inc()
+                logger.warning("Renderer pool unavailable, using mmdc: %s", e)
+            except RenderTimeout:
+                MMDC_FAILURES.labels(fmt, "timeout").inc()
+                raise
+            except RenderQueueFull:
+                MMDC_FAILURES.labels(fmt, "queue_full").inc()
+                raise
+            except RenderError:
+                MMDC_FAILURES.labels(fmt, "render_error").inc()
+                raise
+        options = ['-b', background]
+        if fmt == 'png':
+            options += ['-s', str(scale)]
+        elif fmt == 'pdf':
+            options.append('--pdfFit')  # Page sized to the diagram instead of A4
+        return await self._render(mermaid_code, f'.{fmt}', *options)
 
-        except subprocess.TimeoutExpired:
+    async def _export(self, mermaid_code: str, fmt: str, background: str, scale: int = 1) -> bytes:
+        slots = self._render_slots()
+        try:
+            with span("export.queue", format=fmt):
+                await asyncio.wait_for(slots.acquire(), settings.EXPORT_QUEUE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            MMDC_FAILURES.labels(fmt, "queue_full").inc()
+            raise HTTPException(status_code=503, detail="Too many exports in progress", headers={"Retry-After": "5"})
+        try:
+            return await self._render_mermaid(mermaid_code, fmt, background, scale)
+        except RenderTimeout:
             raise HTTPException(status_code=500, detail="Export timeout")
+        except RenderQueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
+        finally:
+            slots.release()
+
+    def cache_key(self, code: str, fmt: str, diagram_format: str = 'mermaid') -> str:
+        """Render cache key (and ETag) of the export ``export(code, fmt, diagram_format)`` would produce"""
+        background, scale = RENDER_OPTIONS[fmt]
+        renderer = f'drawio:{DRAWIO_RENDERER_VERSION}' if diagram_format == 'drawio' else 'mermaid'
+        if fmt == 'pdf':
+            renderer += f':{settings.EXPORT_PDF_MODE}'
+        return render_cache.key(code, fmt, scale, background, renderer)
 
-    async def export_png(self, mermaid_code: str, scale: int = 2) -> bytes:
+    async def export(self, code: str, fmt: str, diagram_format: str = 'mermaid') -> bytes:
+        """Export in ``fmt`` ("svg", "png" or "pdf") with that format's default options"""
+        if diagram_format == 'drawio':
+            return await self.export_drawio(code, fmt)
+        if fmt == 'svg':
+            return await self.export_svg(code)
+        if fmt == 'png':
+            return await self.export_png(code)
+        return await self.export_pdf(code)
+
+    async def export_drawio(self, drawio_xml: str, fmt: str) -> bytes:
         """
-        Export Mermaid diagram to PNG
-        Uses mermaid-cli (mmdc) to render
+        Export a Draw.io diagram
+        Drawn in-process from its mxGraphModel; no browser or render slot needed
         """
+        background, scale = RENDER_OPTIONS[fmt]
         try:
-            # Create temporary files
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.mmd', delete=False) as input_file:
-                input_file.write(mermaid_code)
-                input_path = input_file.name
-
-            output_path = input_path.replace('.mmd', '.png')
-
-            # Run mermaid-cli
-            result = subprocess.run(
-                [
-                    'mmdc',
-                    '-i', input_path,
-                    '-o', output_path,
-                    '-b', 'white',
-                    '-s', str(scale)
-                ],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-
-            if result.returncode != 0:
-                raise Exception(f"Mermaid rendering failed: {result.stderr}")
-
-            # Read PNG output
-            with open(output_path, 'rb') as f:
-                png_data = f.read()
-
-            # Cleanup
-            os.unlink(input_path)
-            os.unlink(output_path)
-
-            return png_data
-
-        except subprocess.TimeoutExpired:
-            raise HTTPException(status_code=500, detail="Export timeout")
+            with span("drawio.render", format=fmt):
+                return await run_in_threadpool(
+                    render_drawio, drawio_xml, fmt, background, scale, settings.EXPORT_PDF_MODE
+                )
+        except DrawioRenderError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid Draw.io diagram: {str(e)}")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Export failed: {str(e)}")
 
+    async def export_svg(self, mermaid_code: str) -> bytes:
+        """
+        Export Mermaid diagram to SVG
+        Uses a pooled renderer worker (mmdc as fallback)
+        """
+        return await self._export(mermaid_code, 'svg', *RENDER_OPTIONS['svg'])
+
+    async def export_png(self, mermaid_code: str, scale: int = RENDER_OPTIONS['png'][1]) -> bytes:
+        """
+        Export Mermaid diagram to PNG
+        Uses a pooled renderer worker (mmdc as fallback)
+        """
+        return await self._export(mermaid_code, 'png', 'white', scale)
+
     async def export_pdf(self, mermaid_code: str) -> bytes:
         """
         Export Mermaid diagram to PDF
-        First converts to PNG, then to PDF
+        Vector by default: Chromium prints the rendered page to PDF (pdfFit in the
+        renderer workers, --pdfFit for mmdc), so text stays selectable. This does
+        not go through svg_to_pdf as Draw.io does: Mermaid labels are HTML in
+        foreignObject, which svg_to_pdf skips.
+        With EXPORT_PDF_MODE=raster, renders a PNG and wraps it instead.
         """
+        if settings.EXPORT_PDF_MODE == 'vector':
+            return await self._export(mermaid_code, 'pdf', RENDER_OPTIONS['pdf'][0])
         try:
             # First get PNG
-            png_data = await self.export_png(mermaid_code, scale=3)
+            png_data = await self.export_png(mermaid_code, scale=RENDER_OPTIONS['pdf'][1])
 
             # Create temporary PDF using Pillow
             from PIL import Image
             import img2pdf
 
-            # Convert PNG bytes to PDF
-            pdf_bytes = img2pdf.convert(png_data)
+            # Convert PNG bytes to PDF (CPU-bound, so off the event loop)
+            pdf_bytes = await run_in_threadpool(img2pdf.convert, png_data)
             return pdf_bytes
 
         except ImportError:
@@ -141,7 +240,7 @@ class ExportService:
 
                 # Convert to PDF
                 pdf_buffer = BytesIO()
-                HTML(string=html_content).write_pdf(pdf_buffer)
+                await run_in_threadpool(HTML(string=html_content).write_pdf, pdf_buffer)
                 return pdf_buffer.getvalue()
 
             except ImportError:
@@ -149,6 +248,8 @@ class ExportService:
                     status_code=501,
                     detail="PDF export requires img2pdf or weasyprint to be installed"
                 )
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"PDF export failed: {str(e)}")
 
@@ -0,0 +1,361 @@
+"""Background AI jobs in Redis
+
+Slow provider calls (``deepseek-reasoner`` can outlast proxy timeouts) can
+run as jobs. A submit stores the job under ``{prefix}:job:{id}`` and pushes
+its id on the queue list, and the caller gets the id right away. Workers take
+ids from the queue, run the handler registered for the job's kind, and write
+progress and the result back to the job. The workers are either tasks inside
+the API process (``AI_JOBS_INPROCESS_WORKERS``) or separate
+``python -m app.worker`` processes. Every change to a job is also published
+on ``{prefix}:events:{id}`` for subscribers. Jobs expire
+``AI_JOBS_RESULT_TTL_SECONDS`` after their last update. Nothing ties a job to
+the HTTP request that submitted it.
+
+Claimed ids move to a processing list, and the worker running a job keeps a
+lease key alive for it. A job that asks to be retried later (``JobRetry``)
+leaves the processing list for a scheduled sorted set, scored by when it may
+run again; workers move due ids back onto the queue between claims, so no
+worker sits idle waiting for it. When a worker dies, its job's lease expires. Any
+worker then puts the job back on the queue, up to ``AI_JOBS_MAX_ATTEMPTS``
+runs.
+
+Client-supplied credentials (request headers) are kept in a separate key that
+is deleted as soon as the job finishes. They are never returned by ``get``.
+"""
+import asyncio
+import json
+import logging
+import socket
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.redis import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+ERROR = "error"
+TERMINAL_STATES = frozenset({DONE, ERROR})
+
+
+class JobRetry(Exception):
+    """Raised by a handler to run the job again after ``delay`` seconds"""
+
+    def __init__(self, message: str, delay: float = 1.0):
+        super().__init__(message)
+        self.delay = delay
+
+
+class JobContext:
+    """What a handler gets besides its payload: credentials and progress reporting"""
+
+    def __init__(self, queue: "JobQueue", job: dict, headers: dict):
+        self.queue = queue
+        self.job = job
+        self.headers = headers
+
+    async def progress(self, **fields) -> None:
+        self.job["progress"] = fields
+        await self.queue.save(self.job)
+
+
+JobHandler = Callable[[dict, JobContext], Awaitable[dict]]
+
+
+# KEYS: scheduled zset, queue list; ARGV: now (Unix seconds)
+# Moves ids that are due from the schedule to the front of the queue; returns how many
+_PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('RPUSH', KEYS[2], job_id)
+end
+return #due
+"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+class JobQueue:
+    def __init__(self, redis_client, prefix: str = "aijobs:v1"):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.handlers: dict[str, JobHandler] = {}
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        self.handlers[kind] = handler
+
+    @property
+    def queue_key(self) -> str:
+        return f"{self.prefix}:queue"
+
+    @property
+    def processing_key(self) -> str:
+        return f"{self.prefix}:processing"
+
+    @property
+    def scheduled_key(self) -> str:
+        return f"{self.prefix}:scheduled"
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.prefix}:job:{job_id}"
+
+    def _headers_key(self, job_id: str) -> str:
+        return f"{self.prefix}:headers:{job_id}"
+
+    def _lease_key(self, job_id: str) -> str:
+        return f"{self.prefix}:lease:{job_id}"
+
+    def events_channel(self, job_id: str) -> str:
+        return f"{self.prefix}:events:{job_id}"
+
+    async def submit(self, kind: str, payload: dict, headers: Optional[dict] = None) -> dict:
+        """Store a new job and queue it; ``headers`` are the caller's credentials"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": QUEUED,
+            "attempts": 0,
+            "progress": None,
+            "request": payload,
+            "result": None,
+            "error": None,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        ttl = settings.AI_JOBS_RESULT_TTL_SECONDS
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._job_key(job["id"]), json.dumps(job, ensure_ascii=False), ex=ttl)
+            if headers:
+                pipe.set(self._headers_key(job["id"]), json.dumps(headers), ex=ttl)
+            pipe.lpush(self.queue_key, job["id"])
+            await pipe.execute()
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        raw = await self.redis.get(self._job_key(job_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def save(self, job: dict) -> None:
+        """Write the job back, refresh its TTL and notify subscribers"""
+        data = json.dumps(job, ensure_ascii=False)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(self._job_key(job["id"]), data, ex=settings.AI_JOBS_RESULT_TTL_SECONDS)
+            pipe.publish(self.events_channel(job["id"]), data)
+            await pipe.execute()
+
+    async def watch(self, job_id: str, keepalive: float = 15.0) -> AsyncIterator[Optional[dict]]:
+        """Yield the job now and after every change until it finishes
+
+        ``None`` is yielded after ``keepalive`` seconds without a change, so
+        the caller can keep its connection open.
+        """
+        pubsub = self.redis.pubsub()
+        try:
+            # Subscribe before reading the job so a change in between is not missed
+            await pubsub.subscribe(self.events_channel(job_id))
+            job = await self.get(job_id)
+            if job is None:
+                return
+            yield job
+            while job["status"] not in TERMINAL_STATES:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive)
+                if message is None:
+                    # Re-read in case the job expired or a publish was lost
+                    job = await self.get(job_id)
+                    if job is None:
+                        return
+                    if job["status"] not in TERMINAL_STATES:
+                        yield None
+                        continue
+                    # It finished meanwhile; pass on the changes published before the end
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+                        if message is None:
+                            break
+                        update = json.loads(message["data"])
+                        if update["status"] not in TERMINAL_STATES:
+                            yield update
+                    yield job
+                    return
+                job = json.loads(message["data"])
+                yield job
+        finally:
+            try:
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    async def claim(self, timeout: float) -> Optional[str]:
+        """Move the oldest queued id to the processing list; None after ``timeout`` seconds"""
+        return await self.redis.blmove(self.queue_key, self.processing_key, timeout, "RIGHT", "LEFT")
+
+    async def promote_due(self) -> int:
+        """Queue the scheduled retries whose delay has passed; returns how many"""
+        return int(await self.redis.eval(_PROMOTE_SCRIPT, 2, self.scheduled_key, self.queue_key, time.time()))
+
+    async def run(self, job_id: str, worker_id: str) -> None:
+        """Run a claimed job to completion (or back onto the queue)"""
+        job = await self.get(job_id)
+        if job is None:
+            # Expired while queued
+            await self.redis.lrem(self.processing_key, 0, job_id)
+            return
+        lease = asyncio.create_task(self._hold_lease(job_id, worker_id))
+        requeue_after = None
+        try:
+            raw_headers = await self.redis.get(self._headers_key(job_id))
+            context = JobContext(self, job, json.loads(raw_headers) if raw_headers else {})
+            job.update(status=RUNNING, attempts=job["attempts"] + 1, started_at=_now(), error=None)
+            await self.save(job)
+            try:
+                handler = self.handlers[job["kind"]]
+                job["result"] = await handler(job["request"], context)
+                job["status"] = DONE
+            except JobRetry as e:
+                if job["attempts"] < settings.AI_JOBS_MAX_ATTEMPTS:
+                    job.update(status=QUEUED, progress={"stage": "retrying", "reason": str(e)})
+                    requeue_after = e.delay
+                else:
+                    job.update(status=ERROR, error=str(e))
+            except asyncio.CancelledError:
+                # Worker shutting down: hand the job to another worker
+                job.update(status=QUEUED, progress={"stage": "requeued"}, attempts=job["attempts"] - 1)
+                requeue_after = 0
+                await self.save(job)
+                raise
+            except Exception as e:
+                logger.warning("Job %s failed: %s", job_id, e)
+                job.update(status=ERROR, error=str(e))
+            if job["status"] in TERMINAL_STATES:
+                job["finished_at"] = _now()
+            await self.save(job)
+        finally:
+            lease.cancel()
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.lrem(self.processing_key, 0, job_id)
+                if requeue_after:
+                    # Waits in the schedule, not in this worker's slot
+                    pipe.zadd(self.scheduled_key, {job_id: time.time() + requeue_after})
+                elif requeue_after is not None:
+                    pipe.rpush(self.queue_key, job_id)
+                else:
+                    pipe.delete(self._headers_key(job_id))
+                pipe.delete(self._lease_key(job_id))
+                await pipe.execute()
+
+    async def _hold_lease(self, job_id: str, worker_id: str) -> None:
+        ttl = settings.AI_JOBS_LEASE_SECONDS
+        while True:
+            try:
+                await self.redis.set(self._lease_key(job_id), worker_id, ex=ttl)
+            except RedisError as e:
+                logger.warning("Job lease refresh failed: %s", e)
+            await asyncio.sleep(ttl / 3)
+
+    async def requeue_stalled(self, suspects: set[str]) -> set[str]:
+        """Requeue processing jobs whose lease was missing on this and the previous sweep
+
+        ``suspects`` is what the previous call returned. Requiring two sweeps
+        covers the moment between a claim and the first lease write.
+        """
+        missing = set()
+        for job_id in await self.redis.lrange(self.processing_key, 0, -1):
+            if await self.redis.exists(self._lease_key(job_id)):
+                continue
+            if job_id not in suspects:
+                missing.add(job_id)
+                continue
+            if not await self.redis.lrem(self.processing_key, 1, job_id):
+                continue  # Another worker got to it first
+            job = await self.get(job_id)
+            if job is None:
+                continue
+            if job["attempts"] >= settings.AI_JOBS_MAX_ATTEMPTS:
+                job.update(status=ERROR, error="Worker lost while running the job", finished_at=_now())
+                await self.save(job)
+                await self.redis.delete(self._headers_key(job_id))
+            else:
+                logger.info("Requeueing job %s from a lost worker", job_id)
+                job.update(status=QUEUED, progress={"stage": "requeued"})
+                await self.save(job)
+                await self.redis.rpush(self.queue_key, job_id)
+        return missing
+
+    async def stats(self) -> dict:
+        return {
+            "queued": await self.redis.llen(self.queue_key),
+            "scheduled": await self.redis.zcard(self.scheduled_key),
+            "running": await self.redis.llen(self.processing_key),
+        }
+
+
+class JobWorker:
+    """Pulls jobs off the queue and runs up to ``concurrency`` at a time"""
+
+    def __init__(self, queue: JobQueue, concurrency: int, worker_id: Optional[str] = None):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.worker_id = worker_id or f"{socket.gethostname()}:{uuid.uuid4().hex[:8]}"
+        self._stopping = asyncio.Event()
+
+    def stop(self) -> None:
+        """Stop taking new jobs; running ones finish"""
+        self._stopping.set()
+
+    async def stopped(self) -> None:
+        """Wait until ``stop`` is called"""
+        await self._stopping.wait()
+
+    async def run(self, poll_seconds: float = 1.0) -> None:
+        await asyncio.gather(
+            self._sweep(),
+            *(self._loop(poll_seconds) for _ in range(self.concurrency)),
+        )
+
+    async def _loop(self, poll_seconds: float) -> None:
+        while not self._stopping.is_set():
+            try:
+                await self.queue.promote_due()
+                job_id = await self.queue.claim(poll_seconds)
+            except RedisError as e:
+                logger.warning("Job queue unavailable: %s", e)
+                await asyncio.sleep(poll_seconds)
+                continue
+            if job_id is not None:
+                try:
+                    await self.queue.run(job_id, self.worker_id)
+                except RedisError as e:
+                    logger.warning("Job %s interrupted by a Redis error: %s", job_id, e)
+
+    async def _sweep(self) -> None:
+        suspects: set[str] = set()
+        interval = settings.AI_JOBS_LEASE_SECONDS
+        deadline = time.monotonic() + interval
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), max(0.0, deadline - time.monotonic()))
+                return
+            except asyncio.TimeoutError:
+                pass
+            deadline = time.monotonic() + interval
+            try:
+                suspects = await self.queue.requeue_stalled(suspects)
+            except RedisError as e:
+                logger.warning("Stalled job sweep failed: %s", e)
+
+
+job_queue = JobQueue(async_redis_client)
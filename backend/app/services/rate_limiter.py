@@ -0,0 +1,289 @@
+"""Per-provider, per-key concurrency limits and token-bucket rate limiting
+
+Upstream calls to Anthropic, OpenAI and DeepSeek go through a limiter keyed
+by (provider, API key fingerprint). State lives in Redis so limits hold across
+workers: concurrent calls are leases in a sorted set (expiring, so a crashed
+worker cannot leak capacity) and the request rate is a token bucket. Callers
+that cannot start immediately wait in a bounded queue until their deadline.
+The queue is FIFO: a newcomer cannot take capacity an earlier waiter still
+needs. A full queue or an expired deadline raises ``RateLimitExceeded``, which
+the routes turn into a 429 with ``Retry-After``. If Redis is unreachable the
+limiter fails open.
+"""
+import asyncio
+import logging
+import math
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.metrics import (
+    AI_RATE_LIMIT_QUEUE_DEPTH,
+    AI_RATE_LIMIT_REJECTIONS,
+    AI_RATE_LIMIT_WAIT_SECONDS,
+)
+from app.core.redis import async_redis_client
+from app.services.ai.client_pool import key_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# KEYS: leases zset, bucket hash, waiters zset
+# ARGV: now_ms, lease_ttl_ms, max_concurrency, tokens_per_ms, burst, lease_id
+# Returns {1, 0} when a lease was granted, otherwise {0, retry_after_ms} (-1 = unknown).
+# Waiters are admitted in queue order: capacity that the waiters ahead of the
+# caller still need is not handed to it. A caller not in the queue yet counts
+# everyone in it as ahead.
+_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease_ttl = tonumber(ARGV[2])
+local max_concurrency = tonumber(ARGV[3])
+local rate = tonumber(ARGV[4])
+local burst = tonumber(ARGV[5])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+local ahead = redis.call('ZRANK', KEYS[3], ARGV[6]) or redis.call('ZCARD', KEYS[3])
+if max_concurrency > 0 and redis.call('ZCARD', KEYS[1]) + ahead >= max_concurrency then
+    return {0, -1}
+end
+
+if rate > 0 then
+    local state = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens - ahead < 1 then
+        redis.call('HSET', KEYS[2], 'tokens', tostring(tokens), 'ts', tostring(now))
+        return {0, math.ceil((1 + ahead - tokens) / rate)}
+    end
+    redis.call('HSET', KEYS[2], 'tokens', tostring(tokens - 1), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[2], math.ceil(burst / rate) + 1000)
+end
+
+redis.call('ZREM', KEYS[3], ARGV[6])
+redis.call('ZADD', KEYS[1], now + lease_ttl, ARGV[6])
+redis.call('PEXPIRE', KEYS[1], lease_ttl)
+return {1, 0}
+"""
+
+# KEYS: waiters zset; ARGV: now_ms, deadline_ms, max_queue, waiter_id
+# Waiters are scored by deadline; with one queue timeout that is arrival order.
+# Returns the queue depth after joining, or -1 when the queue is full
+_ENQUEUE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]))
+local depth = redis.call('ZCARD', KEYS[1])
+if depth >= tonumber(ARGV[3]) then
+    return -1
+end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[2]), ARGV[4])
+redis.call('PEXPIRE', KEYS[1], math.max(1, tonumber(ARGV[2]) - tonumber(ARGV[1])))
+return depth + 1
+"""
+
+_POLL_INTERVAL_SECONDS = 0.1
+
+# Upper bounds (seconds) of the queue wait histogram
+WAIT_BUCKETS = (0.0, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class RateLimitExceeded(Exception):
+    """No upstream capacity became available in time"""
+
+    status_code = 429
+
+    def __init__(self, provider: str, reason: str, retry_after: int):
+        super().__init__(f"{provider} rate limit: {reason}")
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _ProviderStats:
+    def __init__(self):
+        self.waiting = 0
+        self.acquired = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.wait_histogram = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def observe_wait(self, seconds: float) -> None:
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if seconds <= bound:
+                self.wait_histogram[i] += 1
+                return
+        self.wait_histogram[-1] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "wait_histogram": {
+                **{f"le_{bound:g}": count for bound, count in zip(WAIT_BUCKETS, self.wait_histogram)},
+                "le_inf": self.wait_histogram[-1],
+            },
+        }
+
+
+class Lease:
+    """A granted upstream slot; release it exactly once when the call ends"""
+
+    def __init__(self, limiter: "ProviderRateLimiter", leases_key: Optional[str], lease_id: str):
+        self._limiter = limiter
+        self._leases_key = leases_key
+        self._lease_id = lease_id
+        self._released = False
+
+    async def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self._leases_key is not None:
+            await self._limiter._release(self._leases_key, self._lease_id)
+
+
+class ProviderRateLimiter:
+    def __init__(self, redis_client, prefix: str = "airate:v1"):
+        self.redis = redis_client
+        self.prefix = prefix
+        self._stats: dict[str, _ProviderStats] = {}
+
+    def _limits(self, provider: str) -> tuple[int, float, int]:
+        """(max concurrency, requests per minute, burst) for a provider; 0 = unlimited"""
+        return (
+            settings.AI_RATE_LIMIT_MAX_CONCURRENCY.get(provider, 0),
+            settings.AI_RATE_LIMIT_REQUESTS_PER_MINUTE.get(provider, 0),
+            max(1, settings.AI_RATE_LIMIT_BURST),
+        )
+
+    def _stats_for(self, provider: str) -> _ProviderStats:
+        return self._stats.setdefault(provider, _ProviderStats())
+
+    def _keys(self, provider: str, api_key: str) -> tuple[str, str, str]:
+        base = f"{self.prefix}:{provider}:{key_fingerprint(api_key or '')}"
+        return f"{base}:leases", f"{base}:bucket", f"{base}:waiters"
+
+    async def acquire(self, provider: str, api_key: str) -> Lease:
+        """Wait for an upstream slot for (provider, api_key)
+
+        Waiters poll Redis, but are admitted in the order they joined the
+        queue. Raises ``RateLimitExceeded`` when the wait queue is full or the
+        slot does not free up within ``AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS``.
+        """
+        lease_id = uuid.uuid4().hex
+        if not settings.AI_RATE_LIMIT_ENABLED:
+            return Lease(self, None, lease_id)
+        max_concurrency, per_minute, burst = self._limits(provider)
+        if max_concurrency <= 0 and per_minute <= 0:
+            return Lease(self, None, lease_id)
+
+        stats = self._stats_for(provider)
+        leases_key, bucket_key, waiters_key = self._keys(provider, api_key)
+        lease_ttl_ms = settings.AI_RATE_LIMIT_LEASE_TTL_SECONDS * 1000
+        tokens_per_ms = per_minute / 60000.0
+        started = time.monotonic()
+        deadline = started + settings.AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS
+        queued = False
+        try:
+            while True:
+                now_ms = int(time.time() * 1000)
+                granted, retry_ms = await self.redis.eval(
+                    _ACQUIRE_SCRIPT, 3, leases_key, bucket_key, waiters_key,
+                    now_ms, lease_ttl_ms, max_concurrency, repr(tokens_per_ms), burst, lease_id,
+                )
+                if int(granted):
+                    waited = time.monotonic() - started
+                    stats.acquired += 1
+                    stats.observe_wait(waited)
+                    AI_RATE_LIMIT_WAIT_SECONDS.labels(provider).observe(waited)
+                    return Lease(self, leases_key, lease_id)
+
+                retry_after = (int(retry_ms) / 1000.0) if int(retry_ms) >= 0 else _POLL_INTERVAL_SECONDS
+                if not queued:
+                    deadline_ms = now_ms + int(settings.AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS * 1000)
+                    depth = await self.redis.eval(
+                        _ENQUEUE_SCRIPT, 1, waiters_key,
+                        now_ms, deadline_ms, settings.AI_RATE_LIMIT_MAX_QUEUE, lease_id,
+                    )
+                    if int(depth) < 0:
+                        stats.rejected_queue_full += 1
+                        AI_RATE_LIMIT_REJECTIONS.labels(provider, "queue_full").inc()
+                        raise RateLimitExceeded(provider, "wait queue is full", _retry_after(retry_after))
+                    queued = True
+                    stats.waiting += 1
+                    AI_RATE_LIMIT_QUEUE_DEPTH.labels(provider).inc()
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    stats.rejected_timeout += 1
+                    AI_RATE_LIMIT_REJECTIONS.labels(provider, "timeout").inc()
+                    raise RateLimitExceeded(provider, "timed out waiting for capacity", _retry_after(retry_after))
+                await asyncio.sleep(min(max(retry_after, 0.01), _POLL_INTERVAL_SECONDS * 5, remaining))
+        except RedisError as e:
+            logger.warning("Rate limiter unavailable, allowing %s call: %s", provider, e)
+            return Lease(self, None, lease_id)
+        finally:
+            if queued:
+                stats.waiting -= 1
+                AI_RATE_LIMIT_QUEUE_DEPTH.labels(provider).dec()
+                try:
+                    await self.redis.zrem(waiters_key, lease_id)
+                except RedisError:
+                    pass
+
+    async def _release(self, leases_key: str, lease_id: str) -> None:
+        try:
+            await self.redis.zrem(leases_key, lease_id)
+        except RedisError as e:
+            logger.warning("Rate limiter lease release failed: %s", e)
+
+    @asynccontextmanager
+    async def limit(self, provider: str, api_key: str):
+        lease = await self.acquire(provider, api_key)
+        try:
+            yield lease
+        finally:
+            await lease.release()
+
+    async def stats(self) -> dict:
+        """Per-provider queue/wait statistics, plus live cluster-wide queue depth"""
+        result = {}
+        for provider, stats in self._stats.items():
+            data = stats.as_dict()
+            max_concurrency, per_minute, burst = self._limits(provider)
+            data["limits"] = {
+                "max_concurrency": max_concurrency,
+                "requests_per_minute": per_minute,
+                "burst": burst,
+            }
+            data["queue_depth"] = 0
+            result[provider] = data
+        try:
+            now_ms = int(time.time() * 1000)
+            depths: dict[str, int] = {}
+            async for key in self.redis.scan_iter(match=f"{self.prefix}:*:waiters"):
+                provider = key[len(self.prefix) + 1:].split(":", 1)[0]
+                depths[provider] = depths.get(provider, 0) + await self.redis.zcount(key, now_ms, "+inf")
+            for provider, depth in depths.items():
+                result.setdefault(provider, {})["queue_depth"] = depth
+        except RedisError:
+            pass
+        return result
+
+
+def _retry_after(seconds: float) -> int:
+    return max(1, math.ceil(seconds))
+
+
+rate_limiter = ProviderRateLimiter(async_redis_client)
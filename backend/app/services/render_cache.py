@@ -0,0 +1,213 @@
+"""Content-addressed cache for rendered diagram exports
+
+An export is identified by a hash of everything that decides its bytes: the
+diagram code, format, scale, background and the renderer version. That hash
+is the cache key and also the strong ETag sent to clients. Re-downloading an
+unchanged diagram costs one hash lookup instead of a Chromium render.
+
+Artifacts live on local disk under RENDER_CACHE_DIR. An in-memory LRU index
+is rebuilt from file mtimes on first use, and the oldest entries are evicted
+once the total size passes RENDER_CACHE_MAX_BYTES. With RENDER_CACHE_REDIS_ENABLED,
+small artifacts are also shared through Redis, so the other API processes can
+serve them. Redis errors count as a miss, the same as in the AI response cache.
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.redis import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+RENDERER_DIR = Path(__file__).resolve().parents[2] / "renderer"
+
+
+def renderer_version() -> str:
+    """Changes when the renderer's dependencies or RENDER_CACHE_VERSION change"""
+    digest = hashlib.sha256(settings.RENDER_CACHE_VERSION.encode("utf-8"))
+    for name in ("package.json", "package-lock.json"):
+        path = RENDERER_DIR / name
+        if path.is_file():
+            digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True if an If-None-Match header value matches ``etag`` (weak comparison, as RFC 9110 asks)"""
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    if "*" in candidates:
+        return True
+    return etag in {tag[2:] if tag.startswith("W/") else tag for tag in candidates}
+
+
+class RenderCache:
+    def __init__(
+        self,
+        directory: Optional[Path],
+        max_bytes: int,
+        redis_client=None,
+        redis_ttl_seconds: int = 0,
+        redis_max_bytes: int = 0,
+        version: str = "",
+        prefix: str = "render:v1",
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.redis = redis_client
+        self.redis_ttl_seconds = redis_ttl_seconds
+        self.redis_max_bytes = redis_max_bytes
+        self.version = version
+        self.prefix = prefix
+        self._lock = threading.Lock()  # Disk access runs on worker threads
+        self._index: Optional[OrderedDict] = None  # key -> size, least recently used first
+        self._size = 0
+        self.lookups = 0
+        self.disk_hits = 0
+        self.redis_hits = 0
+        self.evictions = 0
+
+    def key(self, code: str, fmt: str, scale: int, background: str, renderer: str = "mermaid") -> str:
+        digest = hashlib.sha256()
+        for part in (self.version, renderer, fmt, str(scale), background, code):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def _load_index(self) -> None:
+        if self._index is not None:
+            return
+        entries = []
+        if self.directory.is_dir():
+            for path in self.directory.glob("??/*"):
+                if path.name.endswith(".tmp"):
+                    path.unlink(missing_ok=True)  # Left over from an interrupted write
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path.name, stat.st_size))
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._index.values())
+
+    def _read(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._read_locked(key)
+
+    def _write(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._write_locked(key, data)
+
+    def _read_locked(self, key: str) -> Optional[bytes]:
+        self._load_index()
+        if key not in self._index:
+            return None
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # Keep the LRU order across restarts
+        except OSError:
+            self._forget(key)
+            return None
+        self._index.move_to_end(key)
+        return data
+
+    def _write_locked(self, key: str, data: bytes) -> None:
+        self._load_index()
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so a crash never leaves a truncated artifact behind a valid key
+        partial = path.with_name(f"{key}.{os.getpid()}.tmp")
+        partial.write_bytes(data)
+        os.replace(partial, path)
+        self._forget(key)
+        self._index[key] = len(data)
+        self._size += len(data)
+        while self._size > self.max_bytes:
+            oldest, _ = next(iter(self._index.items()))
+            self._forget(oldest)
+            self._path(oldest).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def _forget(self, key: str) -> None:
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    async def get(self, key: str) -> Optional[bytes]:
+        self.lookups += 1
+        if self.directory is not None:
+            data = await asyncio.to_thread(self._read, key)
+            if data is not None:
+                self.disk_hits += 1
+                return data
+        if self.redis is None:
+            return None
+        try:
+            raw = await self.redis.get(f"{self.prefix}:{key}")
+        except RedisError as e:
+            logger.warning("Render cache read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        self.redis_hits += 1
+        data = base64.b64decode(raw)
+        await self._store_on_disk(key, data)
+        return data
+
+    async def _store_on_disk(self, key: str, data: bytes) -> None:
+        if self.directory is None:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, data)
+        except OSError as e:
+            logger.warning("Render cache write failed: %s", e)
+
+    async def set(self, key: str, data: bytes) -> None:
+        await self._store_on_disk(key, data)
+        if self.redis is None or len(data) > self.redis_max_bytes:
+            return
+        try:
+            # The Redis client decodes responses as text, so artifacts are stored base64-encoded
+            await self.redis.set(f"{self.prefix}:{key}", base64.b64encode(data), ex=self.redis_ttl_seconds)
+        except RedisError as e:
+            logger.warning("Render cache write failed: %s", e)
+
+    def stats(self) -> dict:
+        hits = self.disk_hits + self.redis_hits
+        return {
+            "entries": len(self._index) if self._index is not None else None,
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "lookups": self.lookups,
+            "disk_hits": self.disk_hits,
+            "redis_hits": self.redis_hits,
+            "hit_rate": hits / self.lookups if self.lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+render_cache = RenderCache(
+    Path(settings.RENDER_CACHE_DIR) if settings.RENDER_CACHE_DIR else None,
+    max_bytes=settings.RENDER_CACHE_MAX_BYTES,
+    redis_client=async_redis_client if settings.RENDER_CACHE_REDIS_ENABLED else None,
+    redis_ttl_seconds=settings.RENDER_CACHE_REDIS_TTL_SECONDS,
+    redis_max_bytes=settings.RENDER_CACHE_REDIS_MAX_BYTES,
+    version=renderer_version(),
+)
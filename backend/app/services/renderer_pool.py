@@ -0,0 +1,327 @@
+"""Pool of long-lived Mermaid renderer processes
+
+Starting ``mmdc`` for each export boots Node and headless Chromium every
+time, which takes 1-2 s and hundreds of MB. Instead, each worker here runs
+``renderer/mermaid-worker.mjs``. The worker keeps one browser open and renders
+jobs sent over its stdin/stdout as newline-delimited JSON. A worker handles
+one job at a time. Callers wait in a bounded queue for a free worker.
+
+A worker is replaced after ``max_jobs`` renders, or when its process tree
+(Node plus Chromium) grows past ``max_rss_mb``; memory is read in a thread,
+at most every few seconds per worker. It is also replaced when a
+job times out or the process dies. Workers start lazily, up to ``size``. If a
+worker cannot be started, e.g. because the renderer's npm dependencies are
+not installed, the pool reports ``RendererUnavailable`` without retrying for
+a minute. Callers then fall back to ``mmdc``.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import shlex
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = Path(__file__).resolve().parents[2] / "renderer" / "mermaid-worker.mjs"
+_STREAM_LIMIT = 64 * 1024 * 1024  # One reply line holds a whole base64 PNG
+_START_RETRY_SECONDS = 60.0
+_RSS_CHECK_SECONDS = 5.0  # Memory is sampled at most this often per worker
+
+
+class RenderError(Exception):
+    """The diagram could not be rendered (bad Mermaid code)"""
+
+
+class RendererUnavailable(Exception):
+    """No renderer worker could be started, or one died mid-job"""
+
+
+class RenderQueueFull(Exception):
+    """Too many exports waiting, or none got a worker within the queue timeout"""
+
+
+class RenderTimeout(Exception):
+    """A render took longer than the job timeout; its worker was killed"""
+
+
+def _child_pids(pid: int) -> Optional[list[int]]:
+    """Children of ``pid`` from ``/proc/<pid>/task/*/children``, or None if the kernel lacks it"""
+    tasks = Path(f"/proc/{pid}/task")
+    found, pids = False, []
+    try:
+        for task in tasks.iterdir():
+            try:
+                pids.extend(int(child) for child in (task / "children").read_text().split())
+                found = True
+            except FileNotFoundError:
+                continue  # Thread exited, or CONFIG_PROC_CHILDREN is off
+    except OSError:
+        return []  # The process itself is gone
+    return pids if found else None
+
+
+def _scan_children() -> dict[int, list[int]]:
+    """Parent to children map built from every ``/proc/<pid>/stat``"""
+    children: dict[int, list[int]] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue  # Exited while scanning
+        # The command name may contain spaces; fields after it are fixed
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    return children
+
+
+def process_tree_rss(pid: int) -> Optional[int]:
+    """Resident memory in bytes of ``pid`` and its descendants (Linux), else None
+
+    Descendants are found through ``/proc/<pid>/task/*/children``, which
+    only touches the worker's own tree. Kernels built without it fall back to
+    reading every process's parent from ``/proc``.
+    """
+    if not Path("/proc").is_dir():
+        return None
+    scanned: Optional[dict[int, list[int]]] = None
+    total, found, pending = 0, False, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            total += int(Path(f"/proc/{current}/statm").read_text().split()[1])
+        except OSError:
+            continue  # Exited meanwhile
+        found = True
+        children = _child_pids(current)
+        if children is None:
+            if scanned is None:
+                scanned = _scan_children()
+            children = scanned.get(current, [])
+        pending.extend(children)
+    return total * os.sysconf("SC_PAGE_SIZE") if found else None
+
+
+class RendererWorker:
+    def __init__(self, command: list[str]):
+        self.command = command
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.jobs = 0
+        self.rss_checked = float("-inf")
+        self._next_id = 0
+
+    @property
+    def pid(self) -> Optional[int]:
+        return self.process.pid if self.process else None
+
+    async def start(self, timeout: float) -> None:
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=_STREAM_LIMIT,
+            )
+        except OSError as e:
+            raise RendererUnavailable(f"Cannot start renderer worker: {e}")
+        try:
+            ready = await asyncio.wait_for(self._read(), timeout)
+        except asyncio.TimeoutError:
+            await self.kill()
+            raise RendererUnavailable("Renderer worker did not become ready in time")
+        if ready.get("type") != "ready":
+            await self.kill()
+            raise RendererUnavailable(f"Unexpected renderer greeting: {ready}")
+
+    async def _read(self) -> dict:
+        line = await self.process.stdout.readline()
+        if not line:
+            raise RendererUnavailable(f"Renderer worker exited (code {await self.process.wait()})")
+        return json.loads(line)
+
+    async def render(self, code: str, fmt: str, background: str, scale: int, timeout: float) -> bytes:
+        self._next_id += 1
+        job = {"id": self._next_id, "code": code, "format": fmt, "backgroundColor": background, "scale": scale}
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps(job).encode() + b"\n")
+            await self.process.stdin.drain()
+            reply = await asyncio.wait_for(self._read(), timeout)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise RendererUnavailable(f"Renderer worker went away: {e}")
+        except asyncio.TimeoutError:
+            raise RenderTimeout(f"Render took longer than {timeout:g}s")
+        if reply.get("id") != job["id"]:
+            raise RendererUnavailable("Renderer worker replied out of order")
+        if not reply.get("ok"):
+            raise RenderError(reply.get("error") or "Rendering failed")
+        return base64.b64decode(reply["data"])
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def kill(self) -> None:
+        if self.alive():
+            self.process.kill()
+        if self.process is not None:
+            await self.process.wait()
+
+    async def close(self, timeout: float = 5.0) -> None:
+        """Let the worker close its browser, then make sure it is gone"""
+        if not self.alive():
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.kill()
+
+
+class RendererPool:
+    def __init__(
+        self,
+        command: list[str],
+        size: int,
+        max_jobs: int,
+        max_rss_mb: int,
+        max_queue: int,
+        queue_timeout: float,
+        job_timeout: float,
+        start_timeout: float = 30.0,
+    ):
+        self.command = command
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.job_timeout = job_timeout
+        self.start_timeout = start_timeout
+        self._idle: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop = None
+        self._unavailable_until = 0.0
+        self.waiting = 0
+        self.renders = 0
+        self.recycled = 0
+        self.failures = 0
+
+    def _bind(self) -> None:
+        # Queues belong to the running loop; rebuild them if the loop changed (tests)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._idle = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.size)
+
+    async def _acquire(self) -> RendererWorker:
+        if self.waiting >= self.max_queue:
+            raise RenderQueueFull("Too many exports waiting for a renderer")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise RenderQueueFull(f"No renderer free within {self.queue_timeout:g}s")
+        finally:
+            self.waiting -= 1
+        try:
+            while not self._idle.empty():
+                worker = self._idle.get_nowait()
+                if worker.alive():
+                    return worker
+                await worker.kill()  # Died while idle
+            if time.monotonic() < self._unavailable_until:
+                raise RendererUnavailable("Renderer workers failed to start recently")
+            worker = RendererWorker(self.command)
+            try:
+                await worker.start(self.start_timeout)
+            except RendererUnavailable:
+                self._unavailable_until = time.monotonic() + _START_RETRY_SECONDS
+                raise
+            return worker
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _release(self, worker: RendererWorker, healthy: bool) -> None:
+        try:
+            if not healthy or not worker.alive():
+                await worker.kill()
+            elif await self._worn_out(worker):
+                self.recycled += 1
+                await worker.close()
+            else:
+                self._idle.put_nowait(worker)
+        finally:
+            self._slots.release()
+
+    async def _worn_out(self, worker: RendererWorker) -> bool:
+        if worker.jobs >= self.max_jobs:
+            return True
+        if self.max_rss_mb > 0 and time.monotonic() >= worker.rss_checked + _RSS_CHECK_SECONDS:
+            worker.rss_checked = time.monotonic()
+            # Reading /proc blocks; keep it off the event loop
+            rss = await asyncio.to_thread(process_tree_rss, worker.pid)
+            if rss is not None and rss > self.max_rss_mb * 1024 * 1024:
+                logger.info("Recycling renderer %s at %d MB", worker.pid, rss // (1024 * 1024))
+                return True
+        return False
+
+    async def render(self, code: str, fmt: str, background: str = "white", scale: int = 1) -> bytes:
+        """Render Mermaid ``code`` to ``fmt`` ("svg", "png" or "pdf") on a pooled worker"""
+        self._bind()
+        worker = await self._acquire()
+        healthy = False
+        try:
+            data = await worker.render(code, fmt, background, scale, self.job_timeout)
+            healthy = True
+            self.renders += 1
+            return data
+        except RenderError:
+            healthy = True  # The worker is fine; the diagram was not
+            raise
+        except BaseException:
+            self.failures += 1
+            raise
+        finally:
+            await self._release(worker, healthy)
+
+    async def aclose(self) -> None:
+        if self._idle is None or self._loop is not asyncio.get_running_loop():
+            return
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize() if self._idle is not None else 0,
+            "waiting": self.waiting,
+            "renders": self.renders,
+            "recycled": self.recycled,
+            "failures": self.failures,
+        }
+
+
+def default_command() -> list[str]:
+    if settings.RENDER_POOL_COMMAND:
+        return shlex.split(settings.RENDER_POOL_COMMAND)
+    return ["node", str(WORKER_SCRIPT)]
+
+
+renderer_pool = RendererPool(
+    default_command(),
+    size=settings.RENDER_POOL_SIZE,
+    max_jobs=settings.RENDER_POOL_MAX_JOBS,
+    max_rss_mb=settings.RENDER_POOL_MAX_RSS_MB,
+    max_queue=settings.RENDER_POOL_MAX_QUEUE,
+    queue_timeout=settings.RENDER_POOL_QUEUE_TIMEOUT_SECONDS,
+    job_timeout=settings.RENDER_POOL_JOB_TIMEOUT_SECONDS,
+)
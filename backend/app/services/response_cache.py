@@ -0,0 +1,106 @@
+"""Redis-backed cache for AI responses
+
+Identical generate/refine/explain requests (same provider, model, diagram type,
+format and normalized input) are answered from Redis instead of paying for
+another LLM round trip. Redis being unavailable is treated as a cache miss.
+"""
+import hashlib
+import json
+import logging
+import re
+import unicodedata
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.redis import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+CACHE_STATUS_HEADER = "X-Cache"
+CACHEABLE_ENDPOINTS = ("generate", "refine", "explain")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Normalize free text so trivially different prompts share a cache entry"""
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().casefold()
+
+
+def normalize_code(code: str) -> str:
+    """Normalize diagram code without changing its meaning"""
+    lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+class ResponseCache:
+    """Exact-match AI response cache with a TTL and per-endpoint opt-out"""
+
+    def __init__(self, redis_client, ttl_seconds: int, prefix: str = "aicache:v1"):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def build_key(
+        self,
+        endpoint: str,
+        provider: str,
+        model: str,
+        diagram_type: Optional[str],
+        diagram_format: Optional[str],
+        *inputs: str,
+    ) -> str:
+        """Cache key from the request identity and a hash of its normalized input"""
+        digest = hashlib.sha256()
+        for part in inputs:
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")
+        return ":".join([
+            self.prefix,
+            endpoint,
+            provider,
+            model,
+            diagram_type or "-",
+            diagram_format or "-",
+            digest.hexdigest(),
+        ])
+
+    def policy(self, endpoint: str, cache_control: Optional[str] = None) -> tuple[bool, bool]:
+        """Return (read, write) for an endpoint and the request's Cache-Control header
+
+        ``no-cache`` skips the lookup but refreshes the entry, ``no-store``
+        bypasses the cache entirely.
+        """
+        if not settings.AI_CACHE_ENABLED or endpoint in settings.AI_CACHE_DISABLED_ENDPOINTS:
+            return False, False
+        directives = {d.strip().lower() for d in (cache_control or "").split(",")}
+        if "no-store" in directives:
+            return False, False
+        if "no-cache" in directives:
+            return False, True
+        return True, True
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            raw = await self.redis.get(key)
+        except RedisError as e:
+            logger.warning("AI response cache read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    async def set(self, key: str, payload: dict) -> None:
+        try:
+            await self.redis.set(key, json.dumps(payload, ensure_ascii=False), ex=self.ttl_seconds)
+        except RedisError as e:
+            logger.warning("AI response cache write failed: %s", e)
+
+
+response_cache = ResponseCache(async_redis_client, ttl_seconds=settings.AI_CACHE_TTL_SECONDS)
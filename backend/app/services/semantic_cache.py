@@ -0,0 +1,337 @@
+"""Near-duplicate prompt cache for /ai/generate
+
+Exact-match caching misses descriptions that differ only by clause order,
+spacing or wording ("登录" vs "登陆", "log in" vs "sign in"). Prompts are turned
+into hashed bag-of-n-gram vectors and kept in a local NumPy index; a new prompt
+whose cosine similarity to a stored one passes the configured threshold is
+served the stored diagram. Everything runs in-process and is persisted to disk,
+no embedding service is involved. Entries expire after SEMANTIC_CACHE_TTL_SECONDS,
+like the exact-match Redis cache next to them.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Canonical term -> variants that should be treated as the same word
+DEFAULT_SYNONYMS = {
+    "登录": ["登陆", "登入"],
+    "注册": ["註冊"],
+    "用户": ["使用者", "用戶"],
+    "数据库": ["資料庫", "database", "db"],
+    "服务器": ["伺服器", "server"],
+    "login": ["log in", "sign in", "signin", "logon"],
+    "signup": ["sign up", "register", "registration"],
+    "user": ["users", "customer", "customers"],
+    "microservice": ["microservices", "micro service", "micro-service"],
+}
+
+_CLAUSE_SPLIT_RE = re.compile(r"[,，。.;；:：、!！?？\n]+")
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+_CJK_RE = re.compile(r"[㐀-鿿豈-﫿]+")
+
+
+class PromptVectorizer:
+    """Hashed bag-of-features embedding for short prompts
+
+    Features are latin words plus CJK character unigrams and bigrams taken per
+    clause, so reordering clauses does not change the vector.
+    """
+
+    def __init__(self, dimensions: int = 1024, synonyms: Optional[dict] = None):
+        self.dimensions = dimensions
+        self._canonical = {}
+        for canonical, variants in (synonyms or {}).items():
+            for variant in variants:
+                self._canonical[variant.casefold()] = canonical.casefold()
+        patterns = []
+        # Longest variants first so "sign in" wins over shorter overlaps
+        for variant in sorted(self._canonical, key=len, reverse=True):
+            escaped = re.escape(variant)
+            if variant.isascii():
+                # Latin variants only match whole words ("db" must not hit "feedback")
+                escaped = rf"(?<![a-z0-9]){escaped}(?![a-z0-9])"
+            patterns.append(escaped)
+        self._synonym_re = re.compile("|".join(patterns)) if patterns else None
+
+    def normalize(self, text: str) -> str:
+        text = unicodedata.normalize("NFKC", text).casefold()
+        if self._synonym_re is not None:
+            text = self._synonym_re.sub(lambda m: self._canonical[m.group(0)], text)
+        return text
+
+    def features(self, text: str) -> Counter:
+        counts: Counter = Counter()
+        for clause in _CLAUSE_SPLIT_RE.split(self.normalize(text)):
+            for word in _WORD_RE.findall(clause):
+                counts["w:" + word] += 1
+            for run in _CJK_RE.findall(clause):
+                for i, char in enumerate(run):
+                    counts["c:" + char] += 1
+                    if i + 1 < len(run):
+                        counts["b:" + run[i:i + 2]] += 1
+        return counts
+
+    def _bucket(self, feature: str) -> tuple[int, float]:
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        sign = 1.0 if value & 1 else -1.0
+        return (value >> 1) % self.dimensions, sign
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature, count in self.features(text).items():
+            index, sign = self._bucket(feature)
+            vector[index] += sign * (1.0 + math.log(count))
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class VectorIndex:
+    """Fixed-capacity cosine index over unit vectors, oldest entries evicted first
+
+    Each entry records when it was added (Unix time), so searches can skip
+    entries past an age limit. Expired entries are the oldest ones and are
+    the next to be overwritten.
+    """
+
+    def __init__(self, dimensions: int, capacity: int):
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self._vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._added_at = np.zeros(capacity, dtype=np.float64)
+        self._namespaces: list[Optional[str]] = [None] * capacity
+        self._payloads: list[Optional[dict]] = [None] * capacity
+        self._size = 0
+        self._next = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, vector: np.ndarray, namespace: str, payload: dict, added_at: Optional[float] = None) -> None:
+        slot = self._next
+        self._vectors[slot] = vector
+        self._added_at[slot] = time.time() if added_at is None else added_at
+        self._namespaces[slot] = namespace
+        self._payloads[slot] = payload
+        self._next = (slot + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def live(self, added_after: float = 0.0) -> int:
+        """Number of entries added after ``added_after``"""
+        return int(np.count_nonzero(self._added_at[:self._size] > added_after))
+
+    def search(
+        self, vector: np.ndarray, namespace: str, k: int = 1, added_after: float = 0.0
+    ) -> list[tuple[float, dict]]:
+        """Top-k (score, payload) pairs within a namespace and added after ``added_after``, best first"""
+        if self._size == 0:
+            return []
+        scores = self._vectors[:self._size] @ vector
+        mask = np.fromiter(
+            (ns == namespace for ns in self._namespaces[:self._size]), dtype=bool, count=self._size
+        )
+        mask &= self._added_at[:self._size] > added_after
+        scores = np.where(mask, scores, -1.0)
+        k = min(k, self._size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self._payloads[i]) for i in top if mask[i]]
+
+    def merged(self, other: "VectorIndex") -> "VectorIndex":
+        """Entries of both indexes, the newest ``capacity`` of them; one in both is kept once"""
+        # An entry is identified by its namespace and the time it was added
+        entries = {}
+        for index in (other, self):
+            for i in range(index._size):
+                entries[(index._namespaces[i], float(index._added_at[i]))] = (index, i)
+        result = VectorIndex(self.dimensions, self.capacity)
+        for key in sorted(entries, key=lambda key: key[1])[-self.capacity:]:
+            index, i = entries[key]
+            result.add(index._vectors[i], index._namespaces[i], index._payloads[i], index._added_at[i])
+        return result
+
+    def save(self, directory: Path) -> None:
+        """Merge the index into the one saved in ``directory`` and write the result atomically
+
+        Every worker saves to the same directory, so entries other workers
+        saved are kept rather than overwritten. If two saves race, one
+        worker's new entries are missing until its next save.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        on_disk = VectorIndex(self.dimensions, self.capacity)
+        on_disk.load(directory)
+        index = self.merged(on_disk)
+        vectors_tmp = directory / f"vectors.{os.getpid()}.tmp.npy"
+        meta_tmp = directory / f"meta.{os.getpid()}.tmp.json"
+        np.save(vectors_tmp, index._vectors[:index._size])
+        meta = {
+            "dimensions": index.dimensions,
+            "next": index._next,
+            "added_at": index._added_at[:index._size].tolist(),
+            "namespaces": index._namespaces[:index._size],
+            "payloads": index._payloads[:index._size],
+        }
+        meta_tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        os.replace(vectors_tmp, directory / "vectors.npy")
+        os.replace(meta_tmp, directory / "meta.json")
+
+    def load(self, directory: Path) -> bool:
+        """Load a saved index; returns False when nothing usable is on disk
+
+        A damaged index is logged and ignored, leaving this one as it was.
+        """
+        vectors_path = directory / "vectors.npy"
+        meta_path = directory / "meta.json"
+        if not vectors_path.exists() or not meta_path.exists():
+            return False
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            vectors = np.load(vectors_path)
+            if meta.get("dimensions") != self.dimensions or vectors.ndim != 2 or vectors.shape[1] != self.dimensions:
+                return False
+            size = min(len(vectors), self.capacity)
+            namespaces = meta["namespaces"][:size]
+            payloads = meta["payloads"][:size]
+            # Indexes saved before entries had an age are treated as expired
+            added_at = np.asarray(meta.get("added_at", [0.0] * size)[:size], dtype=np.float64)
+            if len(namespaces) != size or len(payloads) != size or len(added_at) != size:
+                raise ValueError("entry count does not match the vectors")
+            next_slot = int(meta.get("next", size)) % self.capacity
+        except (OSError, ValueError, KeyError, EOFError) as e:
+            logger.warning("Ignoring unreadable semantic cache index in %s: %s", directory, e)
+            return False
+        self._vectors[:size] = vectors[:size]
+        self._namespaces[:size] = namespaces
+        self._payloads[:size] = payloads
+        self._added_at[:size] = added_at
+        self._size = size
+        self._next = next_slot
+        return True
+
+    def snapshot(self) -> "VectorIndex":
+        """Copy of the index that can be saved from another thread"""
+        copy = VectorIndex(self.dimensions, self.capacity)
+        copy._vectors = self._vectors[:self._size].copy()
+        copy._added_at = self._added_at[:self._size].copy()
+        copy._namespaces = list(self._namespaces)
+        copy._payloads = list(self._payloads)
+        copy._size = self._size
+        copy._next = self._next
+        return copy
+
+
+class SemanticCache:
+    """Similarity-thresholded prompt cache with hit-rate statistics"""
+
+    SCORE_BUCKETS = 20  # histogram of best scores in 0.05 steps
+
+    def __init__(
+        self,
+        threshold: float,
+        dimensions: int,
+        capacity: int,
+        directory: Optional[Path] = None,
+        save_every: int = 25,
+        synonyms: Optional[dict] = None,
+        ttl_seconds: int = 0,
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self.save_every = save_every
+        self.vectorizer = PromptVectorizer(dimensions, synonyms)
+        self.index = VectorIndex(dimensions, capacity)
+        self._loaded = directory is None
+        self._load_lock = asyncio.Lock()
+        self._unsaved = 0
+        self.lookups = 0
+        self.hits = 0
+        self._score_histogram = [0] * self.SCORE_BUCKETS
+
+    async def load(self) -> None:
+        """Read the saved index off the event loop; runs at startup, or on first use"""
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                await asyncio.to_thread(self.index.load, self.directory)
+                self._loaded = True
+
+    def _added_after(self) -> float:
+        return time.time() - self.ttl_seconds if self.ttl_seconds > 0 else 0.0
+
+    async def lookup(self, namespace: str, text: str) -> Optional[tuple[dict, float]]:
+        """Return (payload, similarity) of the closest unexpired stored prompt above the threshold"""
+        await self.load()
+        self.lookups += 1
+        matches = self.index.search(self.vectorizer.embed(text), namespace, k=1, added_after=self._added_after())
+        if not matches:
+            return None
+        score, payload = matches[0]
+        bucket = min(int(max(score, 0.0) * self.SCORE_BUCKETS), self.SCORE_BUCKETS - 1)
+        self._score_histogram[bucket] += 1
+        if score < self.threshold:
+            return None
+        self.hits += 1
+        return payload, score
+
+    async def add(self, namespace: str, text: str, payload: dict) -> None:
+        await self.load()
+        self.index.add(self.vectorizer.embed(text), namespace, payload)
+        self._unsaved += 1
+        if self.directory is not None and self._unsaved >= self.save_every:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Persist the index to disk without blocking the event loop"""
+        if self.directory is None or not self._loaded or self._unsaved == 0:
+            return
+        self._unsaved = 0
+        await asyncio.to_thread(self.index.snapshot().save, self.directory)
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "entries": self.index.live(self._added_after()),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            # best_score_histogram[i] counts lookups whose closest match scored in
+            # [i / 20, (i + 1) / 20); use it to see what a different threshold would hit
+            "best_score_histogram": list(self._score_histogram),
+        }
+
+
+def _load_synonyms() -> dict:
+    synonyms = dict(DEFAULT_SYNONYMS)
+    if settings.SEMANTIC_CACHE_SYNONYMS_PATH:
+        path = Path(settings.SEMANTIC_CACHE_SYNONYMS_PATH)
+        synonyms.update(json.loads(path.read_text(encoding="utf-8")))
+    return synonyms
+
+
+semantic_cache = SemanticCache(
+    threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+    dimensions=settings.SEMANTIC_CACHE_DIMENSIONS,
+    capacity=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+    directory=Path(settings.SEMANTIC_CACHE_DIR) if settings.SEMANTIC_CACHE_DIR else None,
+    synonyms=_load_synonyms(),
+    ttl_seconds=settings.SEMANTIC_CACHE_TTL_SECONDS,
+)
@@ -0,0 +1,199 @@
+"""Single-flight coalescing of identical AI requests
+
+Concurrent requests that share a cache key await one upstream call instead of
+each paying for their own. Within a worker the call runs as a shared task;
+across workers a Redis lock elects a leader, which stores the result under a
+short-lived key and publishes a notification that the other workers wait for.
+If Redis is unreachable, coalescing degrades to in-process only.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.redis import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Compare-and-delete so a leader never releases a lock that expired and was re-acquired
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_POLL_INTERVAL_SECONDS = 1.0
+
+
+class SingleFlightError(Exception):
+    """The shared call failed in another worker
+
+    ``status_code`` and ``retry_after`` are the failure's own, when it had
+    them, so a follower can answer with the status the leader got.
+    """
+
+    def __init__(self, message: str, status_code: int = 500, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SingleFlight:
+    def __init__(
+        self,
+        redis_client,
+        lock_ttl_seconds: int,
+        wait_timeout_seconds: int,
+        result_ttl_seconds: int = 30,
+        prefix: str = "aiflight:v1",
+    ):
+        self.redis = redis_client
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.result_ttl_seconds = result_ttl_seconds
+        self.prefix = prefix
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced_local = 0
+        self.coalesced_remote = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable[dict]]) -> tuple[dict, bool]:
+        """Run ``call`` once for all concurrent callers of ``key``
+
+        Returns (result, shared) where ``shared`` is True when the result came
+        from a call started by another request. The shared call runs in its own
+        task, so a caller disconnecting does not cancel it for the others.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced_local += 1
+            result, _ = await asyncio.shield(task)
+            return result, True
+
+        task = asyncio.ensure_future(self._run_distributed(key, call))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every caller went away
+            task.exception()
+
+    def _keys(self, key: str) -> tuple[str, str, str]:
+        return (
+            f"{self.prefix}:lock:{key}",
+            f"{self.prefix}:result:{key}",
+            f"{self.prefix}:done:{key}",
+        )
+
+    async def _run_distributed(self, key: str, call) -> tuple[dict, bool]:
+        lock_key, result_key, channel = self._keys(key)
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis.set(lock_key, token, nx=True, ex=self.lock_ttl_seconds)
+        except RedisError as e:
+            logger.warning("Single-flight lock unavailable, running locally: %s", e)
+            self.leaders += 1
+            return await call(), False
+
+        if not acquired:
+            envelope = await self._wait_for_leader(lock_key, result_key, channel)
+            if envelope is not None:
+                self.coalesced_remote += 1
+                if not envelope.get("ok"):
+                    raise SingleFlightError(
+                        envelope.get("error") or "Shared request failed",
+                        envelope.get("status") or 500,
+                        envelope.get("retry_after"),
+                    )
+                return envelope["value"], True
+            # The leader vanished without publishing; do the work ourselves
+            self.leaders += 1
+            return await call(), False
+
+        self.leaders += 1
+        try:
+            result = await call()
+        except Exception as e:
+            await self._publish(lock_key, result_key, channel, token, {
+                "ok": False,
+                "error": str(getattr(e, "detail", None) or e),
+                "status": getattr(e, "status_code", 500),
+                "retry_after": getattr(e, "retry_after", None),
+            })
+            raise
+        except BaseException:
+            await self._release(lock_key, token)
+            raise
+        await self._publish(lock_key, result_key, channel, token, {"ok": True, "value": result})
+        return result, False
+
+    async def _publish(self, lock_key, result_key, channel, token, envelope: dict) -> None:
+        try:
+            await self.redis.set(
+                result_key, json.dumps(envelope, ensure_ascii=False), ex=self.result_ttl_seconds
+            )
+            await self.redis.publish(channel, "1")
+        except RedisError as e:
+            logger.warning("Single-flight result publish failed: %s", e)
+        await self._release(lock_key, token)
+
+    async def _release(self, lock_key: str, token: str) -> None:
+        try:
+            await self.redis.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except RedisError as e:
+            logger.warning("Single-flight lock release failed: %s", e)
+
+    async def _wait_for_leader(self, lock_key, result_key, channel) -> Optional[dict]:
+        """Wait for another worker's result; None if the leader went away"""
+        deadline = time.monotonic() + self.wait_timeout_seconds
+        pubsub = self.redis.pubsub()
+        try:
+            # Subscribe before the first check so a publish in between is not missed
+            await pubsub.subscribe(channel)
+            while True:
+                raw = await self.redis.get(result_key)
+                if raw is not None:
+                    return json.loads(raw)
+                if not await self.redis.exists(lock_key):
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                await pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=min(_POLL_INTERVAL_SECONDS, remaining),
+                )
+        except RedisError as e:
+            logger.warning("Single-flight wait failed, running locally: %s", e)
+            return None
+        finally:
+            try:
+                await pubsub.unsubscribe(channel)
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced_local": self.coalesced_local,
+            "coalesced_remote": self.coalesced_remote,
+        }
+
+
+single_flight = SingleFlight(
+    async_redis_client,
+    lock_ttl_seconds=settings.AI_SINGLE_FLIGHT_LOCK_TTL_SECONDS,
+    wait_timeout_seconds=settings.AI_SINGLE_FLIGHT_WAIT_TIMEOUT_SECONDS,
+)
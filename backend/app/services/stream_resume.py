@@ -0,0 +1,243 @@
+"""Resumable server-sent event streams
+
+A streamed AI turn runs in a producer task that is detached from the HTTP
+connection. The producer appends every event to a ``ResumableStream``. The
+event's id is its 1-based position. Events are kept in memory for readers on
+the same worker and are mirrored to a Redis list (``{prefix}:{id}``) by a
+task of their own, so producing never waits on Redis: events that arrive
+while a write is in flight go out together in the next one. A notification
+goes out on ``{prefix}:{id}:events`` after each write. A client
+that loses its connection reconnects with ``Last-Event-ID``. It gets the
+events it missed, then the rest live, from memory if the producer runs on
+its worker and from Redis if it does not. Either way the upstream call is
+made only once.
+
+The Redis copy expires ``CHAT_STREAM_RESUME_TTL_SECONDS`` after the last event. If Redis fails,
+the turn carries on for readers on the producing worker only.
+
+Since the producer outlives the connection, closing the connection does not
+stop the upstream call; ``stop`` does. A worker with producers listens on
+``{prefix}:cancel`` for the ids that other workers were asked to stop.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from typing import AsyncIterator, Coroutine, Optional
+
+from redis.exceptions import RedisError
+
+from app.core.config import settings
+from app.core.redis import async_redis_client
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_EVENT_TYPES = frozenset({"done", "error"})
+
+# (event id, payload); None is a keepalive tick while waiting on Redis
+StreamItem = Optional[tuple[int, dict]]
+
+
+class ResumableStream:
+    def __init__(self, registry: "StreamRegistry", stream_id: str, mirror: bool):
+        self.registry = registry
+        self.id = stream_id
+        self.events: list[dict] = []
+        self.finished = False
+        self.mirror = mirror
+        self._changed = asyncio.Event()
+        self._mirrored = 0  # Events already written to Redis
+        self._unmirrored = asyncio.Event()
+        self._mirror_task: Optional[asyncio.Task] = None
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def emit(self, payload: dict) -> int:
+        """Append an event; local readers see it at once, Redis shortly after"""
+        self.events.append(payload)
+        event_id = len(self.events)
+        self._wake()
+        if self.mirror:
+            if self._mirror_task is None:
+                self._mirror_task = asyncio.create_task(self._mirror_events())
+            self._unmirrored.set()
+        return event_id
+
+    async def _mirror_events(self) -> None:
+        """Write new events to Redis in batches until the turn is finished and fully written"""
+        while self.mirror:
+            await self._unmirrored.wait()
+            self._unmirrored.clear()
+            batch = self.events[self._mirrored:]
+            if batch:
+                try:
+                    await self.registry.mirror(self.id, batch)
+                except RedisError as e:
+                    # A partial copy would stall remote readers; stop mirroring and let it expire
+                    logger.warning("Stream %s no longer resumable from other workers: %s", self.id, e)
+                    self.mirror = False
+                    return
+                self._mirrored += len(batch)
+            if self.finished and self._mirrored == len(self.events):
+                return
+
+    async def close(self) -> None:
+        """Mark the turn finished, ending it with an error event if it stopped early
+
+        Waits until every event is in Redis, so a reader on another worker
+        that finds the stream there also finds its end.
+        """
+        if not self.events or self.events[-1].get("type") not in TERMINAL_EVENT_TYPES:
+            await self.emit({"type": "error", "message": "Stream interrupted"})
+        self.finished = True
+        self._wake()
+        if self._mirror_task is not None:
+            self._unmirrored.set()
+            await asyncio.shield(self._mirror_task)
+
+    async def tail(self, after: int = 0) -> AsyncIterator[StreamItem]:
+        """Events after id ``after``, then live ones until the turn ends"""
+        cursor = after
+        while True:
+            while cursor < len(self.events):
+                cursor += 1
+                yield cursor, self.events[cursor - 1]
+            if self.finished:
+                return
+            await self._changed.wait()
+
+
+class StreamRegistry:
+    def __init__(self, redis_client, prefix: str = "aistream:v1"):
+        self.redis = redis_client
+        self.prefix = prefix
+        self._local: dict[str, ResumableStream] = {}
+        self._producers: dict[str, asyncio.Task] = {}
+        self._cancel_listener: Optional[asyncio.Task] = None
+
+    def _key(self, stream_id: str) -> str:
+        return f"{self.prefix}:{stream_id}"
+
+    def _channel(self, stream_id: str) -> str:
+        return f"{self.prefix}:{stream_id}:events"
+
+    @property
+    def _cancel_channel(self) -> str:
+        return f"{self.prefix}:cancel"
+
+    @property
+    def resumable(self) -> bool:
+        return settings.CHAT_STREAM_RESUME_TTL_SECONDS > 0
+
+    def open(self) -> ResumableStream:
+        return ResumableStream(self, uuid.uuid4().hex, mirror=self.resumable)
+
+    def start(self, stream: ResumableStream, producer: Coroutine) -> asyncio.Task:
+        """Run ``producer`` detached from the request; it must close ``stream``"""
+        task = asyncio.create_task(producer)
+        self._local[stream.id] = stream
+        self._producers[stream.id] = task
+        if self.resumable and (self._cancel_listener is None or self._cancel_listener.done()):
+            self._cancel_listener = asyncio.create_task(self._listen_for_cancels())
+
+        def forget(_: asyncio.Task) -> None:
+            self._producers.pop(stream.id, None)
+            self._local.pop(stream.id, None)
+            if not self._producers and self._cancel_listener is not None:
+                # Nothing left here to cancel
+                self._cancel_listener.cancel()
+                self._cancel_listener = None
+
+        task.add_done_callback(forget)
+        return task
+
+    def cancel(self, stream_id: str) -> bool:
+        """Stop a producer running on this worker"""
+        task = self._producers.get(stream_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def stop(self, stream_id: str) -> bool:
+        """Stop a turn's producer, here or on the worker running it; False if the stream is unknown
+
+        Raises RedisError if the request cannot be passed on to other workers.
+        """
+        if self.cancel(stream_id):
+            return True
+        if not self.resumable or not await self.redis.exists(self._key(stream_id)):
+            return False
+        await self.redis.publish(self._cancel_channel, stream_id)
+        return True
+
+    async def _listen_for_cancels(self) -> None:
+        pubsub = self.redis.pubsub()
+        try:
+            await pubsub.subscribe(self._cancel_channel)
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    self.cancel(message["data"])
+        except RedisError as e:
+            logger.warning("Chat streams can no longer be stopped from other workers: %s", e)
+        finally:
+            try:
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    async def mirror(self, stream_id: str, payloads: list[dict]) -> None:
+        key = self._key(stream_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *(json.dumps(payload, ensure_ascii=False) for payload in payloads))
+            pipe.expire(key, settings.CHAT_STREAM_RESUME_TTL_SECONDS)
+            pipe.publish(self._channel(stream_id), "1")
+            await pipe.execute()
+
+    async def resume(self, stream_id: str, after: int) -> Optional[AsyncIterator[StreamItem]]:
+        """Events after id ``after`` and live ones; None if the stream is unknown or expired"""
+        stream = self._local.get(stream_id)
+        if stream is not None:
+            return stream.tail(after)
+        if not self.resumable or not await self.redis.exists(self._key(stream_id)):
+            return None
+        return self._tail_remote(stream_id, after)
+
+    async def _tail_remote(self, stream_id: str, after: int, keepalive: float = 15.0) -> AsyncIterator[StreamItem]:
+        key = self._key(stream_id)
+        cursor = after
+        pubsub = self.redis.pubsub()
+        try:
+            # Subscribe before reading so an append in between is not missed
+            await pubsub.subscribe(self._channel(stream_id))
+            if cursor:
+                last_seen = await self.redis.lindex(key, cursor - 1)
+                if last_seen is not None and json.loads(last_seen).get("type") in TERMINAL_EVENT_TYPES:
+                    return
+            while True:
+                for raw in await self.redis.lrange(key, cursor, -1):
+                    cursor += 1
+                    payload = json.loads(raw)
+                    yield cursor, payload
+                    if payload.get("type") in TERMINAL_EVENT_TYPES:
+                        return
+                if not await self.redis.exists(key):
+                    return
+                if await pubsub.get_message(ignore_subscribe_messages=True, timeout=keepalive) is None:
+                    yield None
+        finally:
+            try:
+                await pubsub.unsubscribe()
+                await pubsub.aclose()
+            except RedisError:
+                pass
+
+    def stats(self) -> dict:
+        return {"producing": len(self._producers)}
+
+
+chat_streams = StreamRegistry(async_redis_client, prefix="aichat:v1")
@@ -0,0 +1,678 @@
+"""SVG to vector PDF, without a browser or native libraries
+
+Turns the SVG subset that ``drawio_renderer`` writes, plus common hand-written
+SVG, into PDF drawing operators on a single page. Supported: ``rect``,
+``circle``, ``ellipse``, ``line``, ``polyline``, ``polygon``, ``path`` (all
+commands, arcs included), ``text``/``tspan`` and ``g``. Also: transforms,
+inherited presentation attributes, ``style="..."`` declarations, opacity and
+dashes. Stylesheets, markers, gradients, images and ``foreignObject`` are
+skipped.
+
+Text stays text. Latin labels use the standard Helvetica fonts, and anything
+else uses the Adobe CJK font STSong-Light (UniGB-UCS2-H). Neither is embedded:
+PDF viewers supply them, which keeps files small. The output size depends on
+the drawing, not on a resolution.
+"""
+import math
+import re
+import zlib
+from typing import Iterator, Optional, Union
+from xml.etree.ElementTree import Element, ParseError, fromstring
+
+from PIL import ImageColor
+
+SVG_NS = "{http://www.w3.org/2000/svg}"
+KAPPA = 0.5522847498  # Bezier handle length for a quarter circle
+
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+_NUMBER_RE = re.compile(_NUMBER)
+_PATH_TOKEN_RE = re.compile(rf"([MmLlHhVvCcSsQqTtAaZz])|({_NUMBER})")
+_TRANSFORM_RE = re.compile(r"(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)")
+_UNIT_RE = re.compile(rf"^\s*({_NUMBER})\s*(px|pt)?\s*$")
+
+INHERITED = (
+    "fill", "stroke", "stroke-width", "stroke-dasharray", "stroke-linecap", "stroke-linejoin",
+    "fill-opacity", "stroke-opacity", "fill-rule", "font-size", "font-weight", "font-style",
+    "text-anchor", "dominant-baseline", "visibility",
+)
+DEFAULT_STATE = {
+    "fill": "black", "stroke": "none", "stroke-width": "1", "font-size": "16",
+    "fill-opacity": "1", "stroke-opacity": "1", "opacity": 1.0, "text-anchor": "start",
+}
+
+# Glyph widths (1/1000 em) of the standard Helvetica fonts for ASCII 32..126
+_HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611,
+    975, 722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 333, 278, 333, 584, 556,
+    333, 556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611,
+    611, 611, 389, 556, 333, 611, 556, 778, 556, 556, 500, 389, 280, 389, 584,
+]
+
+# Resource name -> font dictionary; STSong-Light also needs its CIDFont and descriptor
+_LATIN_FONTS = {
+    "F1": "Helvetica",
+    "F2": "Helvetica-Bold",
+    "F3": "Helvetica-Oblique",
+    "F4": "Helvetica-BoldOblique",
+}
+CJK_FONT = "STSong-Light"
+
+Matrix = tuple[float, float, float, float, float, float]
+
+
+class SvgPdfError(ValueError):
+    """The input is not an SVG document"""
+
+
+def _n(value: float) -> str:
+    text = f"{value:.3f}".rstrip("0").rstrip(".")
+    return "0" if text in ("-0", "") else text
+
+
+def _length(value: Optional[str], default: float = 0.0) -> float:
+    if value is None:
+        return default
+    match = _UNIT_RE.match(value)
+    if not match:
+        return default
+    number = float(match.group(1))
+    return number * 4 / 3 if match.group(2) == "pt" else number
+
+
+def _numbers(text: str) -> list[float]:
+    return [float(value) for value in _NUMBER_RE.findall(text)]
+
+
+def _multiply(a: Matrix, b: Matrix) -> Matrix:
+    """``a`` applied after ``b``, in PDF ``cm`` order"""
+    return (
+        a[0] * b[0] + a[1] * b[2], a[0] * b[1] + a[1] * b[3],
+        a[2] * b[0] + a[3] * b[2], a[2] * b[1] + a[3] * b[3],
+        a[4] * b[0] + a[5] * b[2] + b[4], a[4] * b[1] + a[5] * b[3] + b[5],
+    )
+
+
+def parse_transform(text: str) -> Optional[Matrix]:
+    """SVG ``transform`` attribute as one PDF matrix, or None for the identity"""
+    result: Matrix = (1, 0, 0, 1, 0, 0)
+    found = False
+    for name, args in _TRANSFORM_RE.findall(text or ""):
+        values = _numbers(args)
+        if name == "matrix" and len(values) == 6:
+            step = tuple(values)
+        elif name == "translate" and values:
+            step = (1, 0, 0, 1, values[0], values[1] if len(values) > 1 else 0)
+        elif name == "scale" and values:
+            step = (values[0], 0, 0, values[1] if len(values) > 1 else values[0], 0, 0)
+        elif name == "rotate" and values:
+            angle = math.radians(values[0])
+            cos, sin = math.cos(angle), math.sin(angle)
+            step = (cos, sin, -sin, cos, 0, 0)
+            if len(values) == 3:
+                cx, cy = values[1], values[2]
+                step = _multiply(_multiply((1, 0, 0, 1, -cx, -cy), step), (1, 0, 0, 1, cx, cy))
+        elif name == "skewX" and values:
+            step = (1, 0, math.tan(math.radians(values[0])), 1, 0, 0)
+        elif name == "skewY" and values:
+            step = (1, math.tan(math.radians(values[0])), 0, 1, 0, 0)
+        else:
+            continue
+        # Listed transforms apply right to left
+        result = _multiply(step, result)
+        found = True
+    return result if found else None
+
+
+def _color(value: Optional[str]) -> Optional[tuple[float, float, float]]:
+    if value is None or value in ("none", "transparent") or value.startswith("url("):
+        return None
+    try:
+        rgb = ImageColor.getrgb(value.strip())
+    except ValueError:
+        return None
+    if len(rgb) == 4 and rgb[3] == 0:
+        return None
+    return rgb[0] / 255, rgb[1] / 255, rgb[2] / 255
+
+
+# -- path geometry -------------------------------------------------------------
+
+def _arc_to_beziers(x1, y1, rx, ry, angle, large, sweep, x2, y2) -> Iterator[tuple[float, ...]]:
+    """Endpoint arc (SVG ``A``) as cubic Bezier segments (SVG spec, appendix B.2.4)"""
+    if rx == 0 or ry == 0:
+        yield (x1, y1, x2, y2, x2, y2)
+        return
+    rx, ry = abs(rx), abs(ry)
+    phi = math.radians(angle)
+    cos_phi, sin_phi = math.cos(phi), math.sin(phi)
+    dx, dy = (x1 - x2) / 2, (y1 - y2) / 2
+    x1p = cos_phi * dx + sin_phi * dy
+    y1p = -sin_phi * dx + cos_phi * dy
+    scale = (x1p / rx) ** 2 + (y1p / ry) ** 2
+    if scale > 1:
+        rx, ry = rx * math.sqrt(scale), ry * math.sqrt(scale)
+    numerator = rx * rx * ry * ry - rx * rx * y1p * y1p - ry * ry * x1p * x1p
+    denominator = rx * rx * y1p * y1p + ry * ry * x1p * x1p
+    factor = math.sqrt(max(numerator, 0) / denominator) if denominator else 0
+    if large == sweep:
+        factor = -factor
+    cxp, cyp = factor * rx * y1p / ry, -factor * ry * x1p / rx
+    cx = cos_phi * cxp - sin_phi * cyp + (x1 + x2) / 2
+    cy = sin_phi * cxp + cos_phi * cyp + (y1 + y2) / 2
+
+    def angle_of(ux, uy, vx, vy):
+        return math.atan2(ux * vy - uy * vx, ux * vx + uy * vy)
+
+    theta = angle_of(1, 0, (x1p - cxp) / rx, (y1p - cyp) / ry)
+    delta = angle_of((x1p - cxp) / rx, (y1p - cyp) / ry, (-x1p - cxp) / rx, (-y1p - cyp) / ry)
+    if not sweep and delta > 0:
+        delta -= 2 * math.pi
+    elif sweep and delta < 0:
+        delta += 2 * math.pi
+
+    segments = max(1, math.ceil(abs(delta) / (math.pi / 2)))
+    step = delta / segments
+    handle = 4 / 3 * math.tan(step / 4)
+
+    def point(t):
+        x, y = rx * math.cos(t), ry * math.sin(t)
+        return cx + cos_phi * x - sin_phi * y, cy + sin_phi * x + cos_phi * y
+
+    def derivative(t):
+        x, y = -rx * math.sin(t), ry * math.cos(t)
+        return cos_phi * x - sin_phi * y, sin_phi * x + cos_phi * y
+
+    for i in range(segments):
+        t1, t2 = theta + i * step, theta + (i + 1) * step
+        p1, p2 = point(t1), point(t2)
+        d1, d2 = derivative(t1), derivative(t2)
+        end = (x2, y2) if i == segments - 1 else p2
+        yield (
+            p1[0] + handle * d1[0], p1[1] + handle * d1[1],
+            p2[0] - handle * d2[0], p2[1] - handle * d2[1],
+            end[0], end[1],
+        )
+
+
+def path_operators(d: str) -> list[str]:
+    """SVG path data as PDF path construction operators (m, l, c, h)"""
+    ops: list[str] = []
+    tokens = _PATH_TOKEN_RE.findall(d or "")
+    index = 0
+    command = ""
+    x = y = start_x = start_y = 0.0
+    last_control: Optional[tuple[float, float]] = None
+    last_command = ""
+
+    def take(count: int) -> Optional[list[float]]:
+        nonlocal index
+        if index + count > len(tokens) or any(tokens[index + i][0] for i in range(count)):
+            return None
+        values = [float(tokens[index + i][1]) for i in range(count)]
+        index += count
+        return values
+
+    def curve(c1x, c1y, c2x, c2y, ex, ey):
+        ops.append(f"{_n(c1x)} {_n(c1y)} {_n(c2x)} {_n(c2y)} {_n(ex)} {_n(ey)} c")
+
+    while index < len(tokens):
+        if tokens[index][0]:
+            command = tokens[index][0]
+            index += 1
+            if command in "Zz":
+                ops.append("h")
+                x, y = start_x, start_y
+                last_command, last_control = command, None
+                continue
+        elif not command:
+            break  # Numbers before any command
+        relative = command.islower()
+        upper = command.upper()
+        ox, oy = (x, y) if relative else (0.0, 0.0)
+        control = None
+        if upper == "M":
+            values = take(2)
+            if values is None:
+                break
+            x, y = values[0] + ox, values[1] + oy
+            start_x, start_y = x, y
+            ops.append(f"{_n(x)} {_n(y)} m")
+            command = "l" if relative else "L"  # Further pairs are implicit lineto
+        elif upper == "L":
+            values = take(2)
+            if values is None:
+                break
+            x, y = values[0] + ox, values[1] + oy
+            ops.append(f"{_n(x)} {_n(y)} l")
+        elif upper == "H":
+            values = take(1)
+            if values is None:
+                break
+            x = values[0] + ox
+            ops.append(f"{_n(x)} {_n(y)} l")
+        elif upper == "V":
+            values = take(1)
+            if values is None:
+                break
+            y = values[0] + oy
+            ops.append(f"{_n(x)} {_n(y)} l")
+        elif upper in "CS":
+            if upper == "C":
+                values = take(6)
+                if values is None:
+                    break
+                c1 = (values[0] + ox, values[1] + oy)
+                c2, end = (values[2] + ox, values[3] + oy), (values[4] + ox, values[5] + oy)
+            else:
+                values = take(4)
+                if values is None:
+                    break
+                reflect = last_control if last_command.upper() in "CS" and last_control else (x, y)
+                c1 = (2 * x - reflect[0], 2 * y - reflect[1])
+                c2, end = (values[0] + ox, values[1] + oy), (values[2] + ox, values[3] + oy)
+            curve(*c1, *c2, *end)
+            control = c2
+            x, y = end
+        elif upper in "QT":
+            if upper == "Q":
+                values = take(4)
+                if values is None:
+                    break
+                q = (values[0] + ox, values[1] + oy)
+                end = (values[2] + ox, values[3] + oy)
+            else:
+                values = take(2)
+                if values is None:
+                    break
+                reflect = last_control if last_command.upper() in "QT" and last_control else (x, y)
+                q = (2 * x - reflect[0], 2 * y - reflect[1])
+                end = (values[0] + ox, values[1] + oy)
+            # Quadratic to cubic: control points 2/3 of the way to the quadratic one
+            curve(
+                x + 2 / 3 * (q[0] - x), y + 2 / 3 * (q[1] - y),
+                end[0] + 2 / 3 * (q[0] - end[0]), end[1] + 2 / 3 * (q[1] - end[1]),
+                *end,
+            )
+            control = q
+            x, y = end
+        elif upper == "A":
+            values = take(7)
+            if values is None:
+                break
+            rx, ry, angle, large, sweep, ex, ey = values
+            ex, ey = ex + ox, ey + oy
+            for segment in _arc_to_beziers(x, y, rx, ry, angle, bool(large), bool(sweep), ex, ey):
+                curve(*segment)
+            x, y = ex, ey
+        else:
+            break
+        last_command, last_control = command, control
+    return ops
+
+
+def _ellipse_ops(cx: float, cy: float, rx: float, ry: float) -> list[str]:
+    kx, ky = rx * KAPPA, ry * KAPPA
+    return [
+        f"{_n(cx + rx)} {_n(cy)} m",
+        f"{_n(cx + rx)} {_n(cy + ky)} {_n(cx + kx)} {_n(cy + ry)} {_n(cx)} {_n(cy + ry)} c",
+        f"{_n(cx - kx)} {_n(cy + ry)} {_n(cx - rx)} {_n(cy + ky)} {_n(cx - rx)} {_n(cy)} c",
+        f"{_n(cx - rx)} {_n(cy - ky)} {_n(cx - kx)} {_n(cy - ry)} {_n(cx)} {_n(cy - ry)} c",
+        f"{_n(cx + kx)} {_n(cy - ry)} {_n(cx + rx)} {_n(cy - ky)} {_n(cx + rx)} {_n(cy)} c",
+        "h",
+    ]
+
+
+def _rect_ops(x: float, y: float, w: float, h: float, rx: float, ry: float) -> list[str]:
+    if rx <= 0 and ry <= 0:
+        return [f"{_n(x)} {_n(y)} {_n(w)} {_n(h)} re"]
+    rx, ry = min(rx or ry, w / 2), min(ry or rx, h / 2)
+    kx, ky = rx * KAPPA, ry * KAPPA
+    return [
+        f"{_n(x + rx)} {_n(y)} m",
+        f"{_n(x + w - rx)} {_n(y)} l",
+        f"{_n(x + w - rx + kx)} {_n(y)} {_n(x + w)} {_n(y + ry - ky)} {_n(x + w)} {_n(y + ry)} c",
+        f"{_n(x + w)} {_n(y + h - ry)} l",
+        f"{_n(x + w)} {_n(y + h - ry + ky)} {_n(x + w - rx + kx)} {_n(y + h)} {_n(x + w - rx)} {_n(y + h)} c",
+        f"{_n(x + rx)} {_n(y + h)} l",
+        f"{_n(x + rx - kx)} {_n(y + h)} {_n(x)} {_n(y + h - ry + ky)} {_n(x)} {_n(y + h - ry)} c",
+        f"{_n(x)} {_n(y + ry)} l",
+        f"{_n(x)} {_n(y + ry - ky)} {_n(x + rx - kx)} {_n(y)} {_n(x + rx)} {_n(y)} c",
+        "h",
+    ]
+
+
+def _poly_ops(points: str, close: bool) -> list[str]:
+    values = _numbers(points or "")
+    pairs = list(zip(values[0::2], values[1::2]))
+    if not pairs:
+        return []
+    ops = [f"{_n(pairs[0][0])} {_n(pairs[0][1])} m"]
+    ops += [f"{_n(px)} {_n(py)} l" for px, py in pairs[1:]]
+    if close:
+        ops.append("h")
+    return ops
+
+
+# -- text ----------------------------------------------------------------------
+
+def _is_latin(text: str) -> bool:
+    try:
+        text.encode("cp1252")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def text_width(text: str, font_size: float, bold: bool = False, latin: bool = True) -> float:
+    """Advance width of ``text`` in the font ``_text_ops`` picks for it"""
+    if not latin:
+        return sum(500 if ord(char) < 127 else 1000 for char in text) * font_size / 1000
+    widths = _HELVETICA_BOLD_WIDTHS if bold else _HELVETICA_WIDTHS
+    total = 0
+    for char in text:
+        code = ord(char)
+        total += widths[code - 32] if 32 <= code <= 126 else 556
+    return total * font_size / 1000
+
+
+def _latin_string(text: str) -> str:
+    out = []
+    for byte in text.encode("cp1252"):
+        char = chr(byte)
+        if char in "\\()":
+            out.append("\\" + char)
+        elif 32 <= byte < 127:
+            out.append(char)
+        else:
+            out.append(f"\\{byte:03o}")
+    return "(" + "".join(out) + ")"
+
+
+def _cjk_string(text: str) -> str:
+    # UniGB-UCS2-H takes big-endian UCS-2; astral characters have no code point there
+    return "<" + "".join(f"{ord(char) if ord(char) <= 0xFFFF else 0x3F:04X}" for char in text) + ">"
+
+
+# -- document ------------------------------------------------------------------
+
+class _Page:
+    def __init__(self):
+        self.ops: list[str] = []
+        self.fonts: dict[str, str] = {}  # Resource name -> base font
+        self.alphas: dict[tuple[float, float], str] = {}
+
+    def alpha(self, fill: float, stroke: float) -> Optional[str]:
+        if fill >= 1 and stroke >= 1:
+            return None
+        key = (round(fill, 3), round(stroke, 3))
+        if key not in self.alphas:
+            self.alphas[key] = f"GS{len(self.alphas) + 1}"
+        return self.alphas[key]
+
+    def font(self, bold: bool, italic: bool, latin: bool) -> str:
+        if not latin:
+            name = "F5"
+            self.fonts[name] = CJK_FONT
+            return name
+        name = f"F{1 + bold + 2 * italic}"
+        self.fonts[name] = _LATIN_FONTS[name]
+        return name
+
+
+def _style_of(element: Element, parent: dict) -> dict:
+    state = {key: value for key, value in parent.items() if key in INHERITED or key in DEFAULT_STATE}
+    own = dict(element.attrib)
+    for declaration in (own.pop("style", "") or "").split(";"):
+        key, sep, value = declaration.partition(":")
+        if sep:
+            own[key.strip()] = value.strip()
+    for key, value in own.items():
+        if key in INHERITED:
+            state[key] = value
+    # Group opacity is approximated by multiplying it into the children's fill/stroke alpha
+    state["opacity"] = parent.get("opacity", 1.0) * _length(own.get("opacity"), 1.0)
+    return state
+
+
+def _paint_ops(page: _Page, state: dict, geometry: list[str]) -> None:
+    fill = _color(state.get("fill"))
+    stroke = _color(state.get("stroke"))
+    width = _length(state.get("stroke-width"), 1.0)
+    if stroke is not None and width <= 0:
+        stroke = None
+    if fill is None and stroke is None:
+        return
+    ops = page.ops
+    ops.append("q")
+    opacity = state["opacity"]
+    gs = page.alpha(
+        opacity * _length(state.get("fill-opacity"), 1.0),
+        opacity * _length(state.get("stroke-opacity"), 1.0),
+    )
+    if gs:
+        ops.append(f"/{gs} gs")
+    if fill is not None:
+        ops.append(f"{_n(fill[0])} {_n(fill[1])} {_n(fill[2])} rg")
+    if stroke is not None:
+        ops.append(f"{_n(stroke[0])} {_n(stroke[1])} {_n(stroke[2])} RG")
+        ops.append(f"{_n(width)} w")
+        dashes = _numbers(state.get("stroke-dasharray") or "")
+        if dashes and any(dashes):
+            ops.append(f"[{' '.join(_n(d) for d in dashes)}] 0 d")
+        cap = {"round": 1, "square": 2}.get(state.get("stroke-linecap", ""))
+        if cap:
+            ops.append(f"{cap} J")
+        join = {"round": 1, "bevel": 2}.get(state.get("stroke-linejoin", ""))
+        if join:
+            ops.append(f"{join} j")
+    ops.extend(geometry)
+    even_odd = state.get("fill-rule") == "evenodd"
+    if fill is not None and stroke is not None:
+        ops.append("B*" if even_odd else "B")
+    elif fill is not None:
+        ops.append("f*" if even_odd else "f")
+    else:
+        ops.append("S")
+    ops.append("Q")
+
+
+def _text_ops(page: _Page, element: Element, state: dict) -> None:
+    """``text`` and its ``tspan`` children, as (selectable) PDF text"""
+    x, y = _length(element.get("x")), _length(element.get("y"))
+    runs = []
+    if element.text and element.text.strip():
+        runs.append((element.text, x, y, state))
+    for child in element:
+        if child.tag.replace(SVG_NS, "") != "tspan":
+            continue
+        child_state = _style_of(child, state)
+        if child.get("x") is not None:
+            x = _length(child.get("x"))
+        if child.get("y") is not None:
+            y = _length(child.get("y"))
+        if child.text:
+            runs.append((child.text, x, y, child_state))
+    for text, run_x, run_y, run_state in runs:
+        fill = _color(run_state.get("fill"))
+        if fill is None or run_state.get("visibility") == "hidden":
+            continue
+        text = " ".join(text.split()) if "\n" in text else text
+        size = _length(run_state.get("font-size"), 16)
+        bold = run_state.get("font-weight") in ("bold", "bolder", "600", "700", "800", "900")
+        italic = run_state.get("font-style") in ("italic", "oblique")
+        latin = _is_latin(text)
+        width = text_width(text, size, bold, latin)
+        anchor = run_state.get("text-anchor", "start")
+        if anchor == "middle":
+            run_x -= width / 2
+        elif anchor == "end":
+            run_x -= width
+        baseline = run_state.get("dominant-baseline")
+        if baseline in ("central", "middle"):
+            run_y += size * 0.35
+        elif baseline in ("hanging", "text-before-edge"):
+            run_y += size * 0.8
+        font = page.font(bold, italic, latin)
+        string = _latin_string(text) if latin else _cjk_string(text)
+        page.ops.append("q")
+        gs = page.alpha(run_state["opacity"] * _length(run_state.get("fill-opacity"), 1.0), 1.0)
+        if gs:
+            page.ops.append(f"/{gs} gs")
+        # The page is flipped to SVG's y-down space; flip glyphs back upright
+        page.ops.append(
+            f"BT /{font} {_n(size)} Tf {_n(fill[0])} {_n(fill[1])} {_n(fill[2])} rg "
+            f"1 0 0 -1 {_n(run_x)} {_n(run_y)} Tm {string} Tj ET"
+        )
+        page.ops.append("Q")
+
+
+def _draw(page: _Page, element: Element, parent_state: dict) -> None:
+    tag = element.tag.replace(SVG_NS, "")
+    if tag in ("defs", "style", "title", "desc", "metadata", "marker", "clipPath", "mask",
+               "linearGradient", "radialGradient", "pattern", "symbol", "foreignObject", "image", "script"):
+        return
+    if element.get("display") == "none":
+        return
+    state = _style_of(element, parent_state)
+    transform = parse_transform(element.get("transform", ""))
+    if transform:
+        page.ops.append("q")
+        page.ops.append(" ".join(_n(v) for v in transform) + " cm")
+
+    if tag in ("g", "svg", "a", "switch"):
+        for child in element:
+            _draw(page, child, state)
+    elif state.get("visibility") != "hidden":
+        if tag == "rect":
+            w, h = _length(element.get("width")), _length(element.get("height"))
+            if w > 0 and h > 0:
+                _paint_ops(page, state, _rect_ops(
+                    _length(element.get("x")), _length(element.get("y")), w, h,
+                    _length(element.get("rx")), _length(element.get("ry")),
+                ))
+        elif tag in ("circle", "ellipse"):
+            r = _length(element.get("r"))
+            rx = _length(element.get("rx"), r) if tag == "ellipse" else r
+            ry = _length(element.get("ry"), r) if tag == "ellipse" else r
+            if rx > 0 and ry > 0:
+                _paint_ops(page, state, _ellipse_ops(_length(element.get("cx")), _length(element.get("cy")), rx, ry))
+        elif tag == "line":
+            _paint_ops(page, {**state, "fill": "none"}, [
+                f"{_n(_length(element.get('x1')))} {_n(_length(element.get('y1')))} m",
+                f"{_n(_length(element.get('x2')))} {_n(_length(element.get('y2')))} l",
+            ])
+        elif tag in ("polyline", "polygon"):
+            _paint_ops(page, state, _poly_ops(element.get("points"), tag == "polygon"))
+        elif tag == "path":
+            geometry = path_operators(element.get("d", ""))
+            if geometry:
+                _paint_ops(page, state, geometry)
+        elif tag == "text":
+            _text_ops(page, element, state)
+
+    if transform:
+        page.ops.append("Q")
+
+
+def _page_box(root: Element) -> tuple[float, float, float, float, float, float]:
+    """(viewBox x, y, width, height, page width, page height) in SVG user units"""
+    view_box = _numbers(root.get("viewBox", ""))
+    width = _length(root.get("width")) if not (root.get("width") or "").endswith("%") else 0
+    height = _length(root.get("height")) if not (root.get("height") or "").endswith("%") else 0
+    if len(view_box) == 4 and view_box[2] > 0 and view_box[3] > 0:
+        vx, vy, vw, vh = view_box
+        return vx, vy, vw, vh, width or vw, height or vh
+    if width <= 0 or height <= 0:
+        raise SvgPdfError("SVG needs a viewBox or an absolute width and height")
+    return 0.0, 0.0, width, height, width, height
+
+
+def _font_objects(base_font: str, first_id: int) -> list[bytes]:
+    if base_font != CJK_FONT:
+        return [
+            f"<< /Type /Font /Subtype /Type1 /BaseFont /{base_font} /Encoding /WinAnsiEncoding >>".encode()
+        ]
+    # Type0 font over the Adobe-GB1 CIDFont; viewers supply the glyphs
+    return [
+        f"<< /Type /Font /Subtype /Type0 /BaseFont /{CJK_FONT} /Encoding /UniGB-UCS2-H "
+        f"/DescendantFonts [{first_id + 1} 0 R] >>".encode(),
+        f"<< /Type /Font /Subtype /CIDFontType0 /BaseFont /{CJK_FONT} "
+        f"/CIDSystemInfo << /Registry (Adobe) /Ordering (GB1) /Supplement 2 >> "
+        f"/FontDescriptor {first_id + 2} 0 R /DW 1000 /W [1 95 500] >>".encode(),
+        f"<< /Type /FontDescriptor /FontName /{CJK_FONT} /Flags 6 /FontBBox [-25 -254 1000 880] "
+        f"/ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 880 /StemV 93 >>".encode(),
+    ]
+
+
+def _escape_literal(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def svg_to_pdf(svg: Union[bytes, str], title: Optional[str] = None) -> bytes:
+    """One-page vector PDF of ``svg``, one SVG user unit per PDF point"""
+    try:
+        root = fromstring(svg)
+    except ParseError as e:
+        raise SvgPdfError(f"Invalid SVG: {e}")
+    if root.tag.replace(SVG_NS, "") != "svg":
+        raise SvgPdfError(f"Expected <svg>, got <{root.tag}>")
+    vx, vy, vw, vh, page_width, page_height = _page_box(root)
+
+    page = _Page()
+    # Map the viewBox onto the page and flip to SVG's y-down coordinates
+    sx, sy = page_width / vw, page_height / vh
+    page.ops.append(f"{_n(sx)} 0 0 {_n(-sy)} {_n(-vx * sx)} {_n(page_height + vy * sy)} cm")
+    state = _style_of(root, DEFAULT_STATE)
+    for child in root:
+        _draw(page, child, state)
+
+    objects: list[bytes] = [b"", b"", b""]  # Catalog, Pages, Page; filled in below
+    content = zlib.compress("\n".join(page.ops).encode("latin-1"))
+    objects.append(f"<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n".encode() + content + b"\nendstream")
+    content_id = len(objects)
+
+    font_refs = []
+    for name, base_font in sorted(page.fonts.items()):
+        first_id = len(objects) + 1
+        objects.extend(_font_objects(base_font, first_id))
+        font_refs.append(f"/{name} {first_id} 0 R")
+    states = " ".join(
+        f"/{name} << /Type /ExtGState /ca {_n(fill)} /CA {_n(stroke)} >>"
+        for (fill, stroke), name in page.alphas.items()
+    )
+    resources = f"/Font << {' '.join(font_refs)} >>" + (f" /ExtGState << {states} >>" if states else "")
+
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>"
+    objects[2] = (
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {_n(page_width)} {_n(page_height)}] "
+        f"/Resources << {resources} >> /Contents {content_id} 0 R >>"
+    ).encode()
+    info = "/Producer (ai-diagram-generator)"
+    if title and _is_latin(title):
+        info += f" /Title ({_escape_literal(title)})"
+    objects.append(f"<< {info} >>".encode("cp1252"))
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R /Info {len(objects)} 0 R >>\n"
+        f"startxref\n{xref}\n%%EOF\n"
+    ).encode()
+    return bytes(out)
@@ -0,0 +1,192 @@
+"""Persistent token accounting and per-key budgets
+
+Every AI request that reached a provider is stored as an ``AIUsageRecord``
+row. The row holds the caller's key fingerprint, the diagram it was for (when
+the client sent ``diagramId``), token counts and latency. ``summarize``
+aggregates the rows for the ``/ai/usage`` endpoint.
+
+Budgets are daily token limits (input + output, UTC days) per key fingerprint.
+The running total for the current day lives in Redis, so every worker sees the
+same numbers and the check before a call needs no database query. If Redis is
+unavailable, calls are allowed and the database stays the record of truth.
+"""
+import logging
+import math
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from redis.exceptions import RedisError
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.redis import async_redis_client
+from app.models.usage import AIUsageRecord
+
+logger = logging.getLogger(__name__)
+
+GROUP_BY_COLUMNS = {
+    "provider": AIUsageRecord.provider,
+    "model": AIUsageRecord.model,
+    "endpoint": AIUsageRecord.endpoint,
+    "diagram_type": AIUsageRecord.diagram_type,
+    "diagram_format": AIUsageRecord.diagram_format,
+    "diagram_id": AIUsageRecord.diagram_id,
+    "key_hash": AIUsageRecord.key_hash,
+    "status": AIUsageRecord.status,
+}
+TOKEN_COLUMNS = ("input_tokens", "output_tokens", "reasoning_tokens", "cached_input_tokens", "cache_write_tokens")
+
+
+class BudgetExceeded(Exception):
+    status_code = 429
+
+    def __init__(self, key_hash: str, used: int, budget: int, retry_after: int):
+        super().__init__(f"Daily token budget exhausted for key {key_hash} ({used}/{budget} tokens)")
+        self.key_hash = key_hash
+        self.used = used
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+@dataclass
+class UsageEntry:
+    key_hash: str
+    provider: str
+    model: str
+    endpoint: str
+    latency_ms: int
+    status: str = "ok"
+    diagram_type: Optional[str] = None
+    diagram_format: Optional[str] = None
+    diagram_id: Optional[str] = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+    cached_input_tokens: int = 0
+    cache_write_tokens: int = 0
+
+    @property
+    def billable_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+
+def _today(now: Optional[datetime] = None) -> tuple[str, int]:
+    """(UTC day stamp, seconds until it ends)"""
+    now = now or datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return now.strftime("%Y%m%d"), max(1, math.ceil((tomorrow - now).total_seconds()))
+
+
+class UsageLedger:
+    def __init__(self, redis_client, session_factory=SessionLocal, prefix: str = "aiusage:v1"):
+        self.redis = redis_client
+        self.session_factory = session_factory
+        self.prefix = prefix
+
+    def budget_for(self, key_hash: str) -> int:
+        """Daily token budget for a key fingerprint; 0 = unlimited"""
+        return settings.AI_USAGE_KEY_BUDGETS.get(key_hash, settings.AI_USAGE_DAILY_TOKEN_BUDGET)
+
+    def _day_key(self, key_hash: str, day: str) -> str:
+        return f"{self.prefix}:{key_hash}:{day}"
+
+    async def used_today(self, key_hash: str) -> Optional[int]:
+        """Tokens counted against the key today, or None when Redis is unavailable"""
+        day, _ = _today()
+        try:
+            value = await self.redis.get(self._day_key(key_hash, day))
+        except RedisError as e:
+            logger.warning("Usage budget counter unavailable: %s", e)
+            return None
+        return int(value or 0)
+
+    async def check_budget(self, key_hash: str) -> None:
+        """Raise ``BudgetExceeded`` if the key has used up today's budget"""
+        budget = self.budget_for(key_hash)
+        if not settings.AI_USAGE_TRACKING_ENABLED or budget <= 0:
+            return
+        used = await self.used_today(key_hash)
+        if used is not None and used >= budget:
+            _, retry_after = _today()
+            raise BudgetExceeded(key_hash, used, budget, retry_after)
+
+    async def record(self, entry: UsageEntry) -> None:
+        """Store the entry and count it against the key's daily budget; failures are logged"""
+        if not settings.AI_USAGE_TRACKING_ENABLED:
+            return
+        if entry.billable_tokens:
+            day, ttl = _today()
+            try:
+                key = self._day_key(entry.key_hash, day)
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.incrby(key, entry.billable_tokens)
+                    pipe.expire(key, ttl + 3600)
+                    await pipe.execute()
+            except RedisError as e:
+                logger.warning("Usage budget counter update failed: %s", e)
+        try:
+            await run_in_threadpool(self._insert, entry)
+        except SQLAlchemyError as e:
+            logger.warning("Usage record not stored: %s", e)
+
+    def _insert(self, entry: UsageEntry) -> None:
+        with self.session_factory() as db:
+            db.add(AIUsageRecord(**entry.__dict__))
+            try:
+                db.commit()
+            except IntegrityError:
+                # diagramId did not name an existing diagram; keep the usage without the link
+                db.rollback()
+                db.add(AIUsageRecord(**{**entry.__dict__, "diagram_id": None}))
+                db.commit()
+
+
+def summarize(
+    db: Session,
+    group_by: list[str],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    key_hash: Optional[str] = None,
+    diagram_id: Optional[str] = None,
+) -> list[dict]:
+    """Usage totals grouped by the given columns, most tokens first"""
+    columns = [GROUP_BY_COLUMNS[name].label(name) for name in group_by]
+    total_tokens = func.sum(AIUsageRecord.input_tokens + AIUsageRecord.output_tokens)
+    query = db.query(
+        *columns,
+        func.count(AIUsageRecord.id).label("calls"),
+        func.count(AIUsageRecord.id).filter(AIUsageRecord.status == "error").label("errors"),
+        *(func.sum(getattr(AIUsageRecord, name)).label(name) for name in TOKEN_COLUMNS),
+        total_tokens.label("total_tokens"),
+        func.avg(AIUsageRecord.latency_ms).label("avg_latency_ms"),
+        func.max(AIUsageRecord.latency_ms).label("max_latency_ms"),
+    )
+    if since is not None:
+        query = query.filter(AIUsageRecord.created_at >= since)
+    if until is not None:
+        query = query.filter(AIUsageRecord.created_at < until)
+    if key_hash is not None:
+        query = query.filter(AIUsageRecord.key_hash == key_hash)
+    if diagram_id is not None:
+        query = query.filter(AIUsageRecord.diagram_id == diagram_id)
+    if columns:
+        query = query.group_by(*(GROUP_BY_COLUMNS[name] for name in group_by))
+    rows = query.order_by(total_tokens.desc()).all()
+    result = []
+    for row in rows:
+        data = dict(row._mapping)
+        if data["calls"] == 0:
+            continue
+        for name in (*TOKEN_COLUMNS, "total_tokens", "max_latency_ms", "errors"):
+            data[name] = int(data[name] or 0)
+        data["avg_latency_ms"] = round(float(data["avg_latency_ms"] or 0), 1)
+        result.append(data)
+    return result
+
+
+usage_ledger = UsageLedger(async_redis_client)
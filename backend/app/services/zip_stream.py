@@ -0,0 +1,77 @@
+"""ZIP archives written as a stream of chunks
+
+``zipfile`` can write to an unseekable file: each member then carries its
+sizes in a data descriptor after its data, so nothing before it has to be
+patched afterwards. ``ZipStream`` gives ``zipfile`` a sink that only
+collects what was written, and hands those bytes back after each member. The
+caller sends them straight on, so an archive never sits in memory whole; at
+most one member does.
+"""
+import re
+import zipfile
+from datetime import datetime
+from typing import Optional
+
+_UNSAFE_NAME_RE = re.compile(r'[\x00-\x1f\x7f/\\:*?"<>|]+')
+# Device names Windows will not extract a file as, whatever the extension
+_RESERVED_STEMS = {"con", "prn", "aux", "nul", *(f"{port}{n}" for port in ("com", "lpt") for n in range(1, 10))}
+
+
+class _Sink:
+    """Write-only file object that keeps what was written until drained"""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def member_name(title: str, extension: str, taken: set[str]) -> str:
+    """A file name for ``title`` that is safe in an archive and not in ``taken`` yet (which it joins)
+
+    Names keep non-ASCII characters; ``zipfile`` marks such names as UTF-8.
+    """
+    stem = _UNSAFE_NAME_RE.sub("_", title).strip(" ._")[:100].rstrip(" .") or "diagram"
+    if stem.lower() in _RESERVED_STEMS:
+        stem = f"_{stem}"
+    name = f"{stem}.{extension}"
+    copy = 1
+    while name.lower() in taken:
+        copy += 1
+        name = f"{stem} ({copy}).{extension}"
+    taken.add(name.lower())
+    return name
+
+
+class ZipStream:
+    def __init__(self):
+        self._sink = _Sink()
+        self._zip = zipfile.ZipFile(self._sink, "w")
+
+    def add(self, name: str, data: bytes, compress: bool = True, modified: Optional[datetime] = None) -> bytes:
+        """Archive ``data`` as ``name`` and return the bytes to send for it
+
+        Already-compressed formats (PNG, PDF) gain little from deflate; pass
+        ``compress=False`` to store them as they are.
+        """
+        modified = modified or datetime.now()
+        info = zipfile.ZipInfo(name, date_time=max(modified, datetime(1980, 1, 1)).timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.external_attr = 0o644 << 16
+        self._zip.writestr(info, data)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        """The central directory, which ends the archive"""
+        self._zip.close()
+        return self._sink.drain()
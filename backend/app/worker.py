@@ -0,0 +1,48 @@
+"""Standalone background job worker
+
+    python -m app.worker [--concurrency N]
+
+Runs jobs submitted through /api/ai/jobs, alongside or instead of the
+workers inside the API processes (``AI_JOBS_INPROCESS_WORKERS``). SIGINT or
+SIGTERM stops taking jobs; running ones finish first, up to
+``AI_JOBS_LEASE_SECONDS``, and are otherwise put back on the queue.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+import app.api.routes  # noqa: F401  (registers the job handlers)
+from app.core.config import settings
+from app.services.ai.client_pool import client_pool
+from app.services.jobs import JobWorker, job_queue
+
+logger = logging.getLogger("app.worker")
+
+
+async def serve(concurrency: int) -> None:
+    worker = JobWorker(job_queue, concurrency)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    logger.info("Worker %s running %d jobs at a time", worker.worker_id, concurrency)
+    task = asyncio.create_task(worker.run())
+    try:
+        await worker.stopped()
+        await asyncio.wait_for(task, timeout=settings.AI_JOBS_LEASE_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Running jobs did not finish in time and were requeued")
+    finally:
+        await client_pool.aclose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.worker", description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=max(1, settings.AI_JOBS_INPROCESS_WORKERS))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(serve(args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
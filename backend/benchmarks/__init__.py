@@ -0,0 +1,7 @@
+"""In-process benchmarks for the API hot paths
+
+Drives the FastAPI app through ``httpx.ASGITransport`` against a temporary
+SQLite database, the local fake LLM provider and in-memory Redis, so results
+reflect the server's own overhead and are repeatable on any machine. Run
+``python -m benchmarks --help`` from the backend directory.
+"""
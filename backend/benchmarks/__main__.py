@@ -0,0 +1,117 @@
+"""Benchmark the API hot paths in-process and optionally compare against a baseline"""
+import argparse
+import asyncio
+import json
+import platform
+import shutil
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.compare import compare, format_report
+from benchmarks.harness import configure_environment, measure, use_in_memory_redis, TimedASGIApp
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("scenarios", nargs="*", help="Scenarios to run (default: all)")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per scenario")
+    parser.add_argument("--rows", type=int, default=10_000, help="Diagrams seeded before the run")
+    parser.add_argument("-o", "--output", type=Path, help="Write results JSON here")
+    parser.add_argument("--baseline", type=Path, help="Compare against a saved results JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Allowed regression, as a fraction")
+    parser.add_argument("--redis-url", help="Use this Redis instead of an in-memory fakeredis")
+    parser.add_argument("--with-caches", action="store_true", help="Keep the AI response caches on")
+    parser.add_argument("--provider-latency-ms", type=int, default=0)
+    parser.add_argument("--provider-ttft-ms", type=int, default=0)
+    parser.add_argument("--provider-tokens-per-second", type=float, default=0, help="0 = instant")
+    parser.add_argument("--list", action="store_true", help="List scenarios and exit")
+    return parser.parse_args(argv)
+
+
+async def run(args) -> dict:
+    import httpx
+
+    from app.main import app
+    from benchmarks import scenarios
+
+    if not args.redis_url:
+        use_in_memory_redis()
+    selected = scenarios.find(args.scenarios)
+    diagram_ids = scenarios.seed_diagrams(args.rows)
+    scenarios.stub_renderer()
+
+    timed_app = TimedASGIApp(app)
+    results = {}
+    transport = httpx.ASGITransport(app=timed_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        ctx = scenarios.BenchContext(client, timed_app, diagram_ids)
+        for scenario in selected:
+            measurement = await measure(
+                lambda i, scenario=scenario: scenario.call(ctx, i),
+                args.requests, args.concurrency, args.warmup,
+            )
+            for metric in scenario.metrics:
+                name = scenarios.metric_name(scenario, metric)
+                results[name] = measurement.summarize(metric)
+                print(
+                    f"{name:<26} p50 {results[name]['p50_ms']:>8.2f} ms  p95 {results[name]['p95_ms']:>8.2f} ms  "
+                    f"p99 {results[name]['p99_ms']:>8.2f} ms  {results[name]['rps']:>8.1f} req/s  "
+                    f"errors {results[name]['errors']}",
+                    file=sys.stderr,
+                )
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "rows": args.rows,
+            "with_caches": args.with_caches,
+            "provider": {
+                "latency_ms": args.provider_latency_ms,
+                "ttft_ms": args.provider_ttft_ms,
+                "tokens_per_second": args.provider_tokens_per_second,
+            },
+        },
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.list:
+        from benchmarks.scenarios import SCENARIOS
+
+        for scenario in SCENARIOS.values():
+            print(f"{scenario.name:<18} {scenario.description}")
+        return 0
+
+    workdir = configure_environment(args)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        changes = compare(report, baseline, args.threshold)
+        print(format_report(changes), file=sys.stderr)
+        if any(change.regression for change in changes):
+            print(f"Regression beyond {args.threshold:.0%} against {args.baseline}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""Comparison of a benchmark run against a saved baseline"""
+from dataclasses import dataclass
+
+LATENCY_FIELDS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+@dataclass
+class Change:
+    metric: str
+    field: str
+    baseline: float
+    current: float
+    regression: bool
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline else float("inf")
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_ms: float = 0.5) -> list[Change]:
+    """Per-metric changes; latency up or throughput down by more than ``threshold`` is a regression
+
+    Latency changes smaller than ``min_delta_ms`` are never regressions, so
+    sub-millisecond routes do not flap on timer noise.
+    """
+    changes = []
+    for metric, result in current["results"].items():
+        base = baseline.get("results", {}).get(metric)
+        if base is None:
+            continue
+        for field in LATENCY_FIELDS:
+            regression = (
+                result[field] > base[field] * (1 + threshold)
+                and result[field] - base[field] >= min_delta_ms
+            )
+            changes.append(Change(metric, field, base[field], result[field], regression))
+        rps_regression = bool(base["rps"]) and result["rps"] < base["rps"] * (1 - threshold)
+        changes.append(Change(metric, "rps", base["rps"], result["rps"], rps_regression))
+        if result["errors"] > base["errors"]:
+            changes.append(Change(metric, "errors", base["errors"], result["errors"], True))
+    return changes
+
+
+def format_report(changes: list[Change]) -> str:
+    lines = [f"{'metric':<26} {'field':<7} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for change in changes:
+        delta = f"{(change.ratio - 1) * 100:+.1f}%" if change.baseline else "new"
+        flag = "  REGRESSION" if change.regression else ""
+        lines.append(
+            f"{change.metric:<26} {change.field:<7} {change.baseline:>10.2f} {change.current:>10.2f} {delta:>8}{flag}"
+        )
+    return "\n".join(lines)
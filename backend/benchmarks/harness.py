@@ -0,0 +1,146 @@
+"""Environment setup, request timing and latency statistics"""
+import asyncio
+import math
+import os
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+REQUEST_ID_HEADER = "X-Bench-Request"
+
+
+def configure_environment(args) -> Path:
+    """Point settings at a throwaway SQLite file and the fake provider
+
+    Must run before anything under ``app`` is imported, since settings and the
+    database engine are created at import time. Returns the temp directory.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="diagram-bench-"))
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{workdir / 'bench.db'}",
+        "FAKE_PROVIDER_ENABLED": "true",
+        "FAKE_PROVIDER_LATENCY_MS": str(args.provider_latency_ms),
+        "FAKE_PROVIDER_TTFT_MS": str(args.provider_ttft_ms),
+        "FAKE_PROVIDER_TOKENS_PER_SECOND": str(args.provider_tokens_per_second),
+        "FAKE_PROVIDER_ERROR_RATE": "0",
+        "SEMANTIC_CACHE_DIR": "",
+        "TRACING_FILE": str(workdir / "traces.jsonl"),
+        # Every request should take the full provider path unless caches are being measured
+        "AI_CACHE_ENABLED": str(args.with_caches).lower(),
+        "SEMANTIC_CACHE_ENABLED": str(args.with_caches).lower(),
+    })
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    return workdir
+
+
+def use_in_memory_redis() -> None:
+    """Swap the app's Redis consumers onto fakeredis, as the test suite does"""
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("fakeredis is not installed; pass --redis-url to use a real Redis") from None
+    from app.services.jobs import job_queue
+    from app.services.rate_limiter import rate_limiter
+    from app.services.response_cache import response_cache
+    from app.services.single_flight import single_flight
+    from app.services.stream_resume import chat_streams
+    from app.services.usage_ledger import usage_ledger
+
+    client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    for consumer in (response_cache, single_flight, rate_limiter, usage_ledger, job_queue, chat_streams):
+        consumer.redis = client
+
+
+class TimedASGIApp:
+    """ASGI wrapper recording when each request's first body byte is sent
+
+    ``httpx.ASGITransport`` buffers the whole response, so time to first byte
+    has to be observed on the server side. Requests are matched by the
+    ``X-Bench-Request`` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.first_byte: dict[str, float] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(REQUEST_ID_HEADER.lower().encode(), b"").decode()
+
+        async def timed_send(message):
+            if (
+                request_id
+                and message["type"] == "http.response.body"
+                and message.get("body")
+                and request_id not in self.first_byte
+            ):
+                self.first_byte[request_id] = time.perf_counter()
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class Sample:
+    ok: bool
+    total: float
+    ttfb: Optional[float] = None
+
+
+@dataclass
+class Measurement:
+    samples: list[Sample] = field(default_factory=list)
+    elapsed: float = 0.0
+
+    def summarize(self, metric: str = "total") -> dict:
+        values = sorted(
+            getattr(sample, metric) * 1000
+            for sample in self.samples
+            if sample.ok and getattr(sample, metric) is not None
+        )
+        errors = sum(not sample.ok for sample in self.samples)
+        return {
+            "requests": len(self.samples),
+            "errors": errors,
+            "p50_ms": round(percentile(values, 0.50), 3),
+            "p95_ms": round(percentile(values, 0.95), 3),
+            "p99_ms": round(percentile(values, 0.99), 3),
+            "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+            "max_ms": round(values[-1], 3) if values else 0.0,
+            "rps": round(len(self.samples) / self.elapsed, 2) if self.elapsed else 0.0,
+        }
+
+
+async def measure(
+    call: Callable[[int], Awaitable[Sample]],
+    requests: int,
+    concurrency: int,
+    warmup: int = 0,
+) -> Measurement:
+    """Run ``call(i)`` for i in range(requests) with at most ``concurrency`` in flight"""
+    for i in range(warmup):
+        await call(-1 - i)
+
+    measurement = Measurement()
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            measurement.samples.append(await call(i))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    measurement.elapsed = time.perf_counter() - started
+    return measurement
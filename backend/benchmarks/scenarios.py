@@ -0,0 +1,219 @@
+"""Benchmark scenarios: one per API hot path"""
+import asyncio
+import functools
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+from benchmarks.harness import REQUEST_ID_HEADER, Sample, TimedASGIApp
+
+SAMPLE_MERMAID = "flowchart TD\n    A[开始] --> B{校验}\n    B -->|通过| C[首页]\n    B -->|失败| D[错误提示]"
+STUB_RENDER = {
+    "svg": b'<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10"/>',
+    "png": b"\x89PNG\r\n\x1a\n" + b"\x00" * 64,
+    "pdf": b"%PDF-1.4\n%%EOF\n",
+}
+
+
+@dataclass
+class Scenario:
+    name: str
+    call: Callable[["BenchContext", int], Awaitable[Sample]]
+    # Latency metrics reported for the scenario ("ttfb" needs a streaming route)
+    metrics: tuple[str, ...] = ("total",)
+    description: str = ""
+
+
+class BenchContext:
+    def __init__(self, client: httpx.AsyncClient, timed_app: TimedASGIApp, diagram_ids: list[str]):
+        self.client = client
+        self.timed_app = timed_app
+        self.diagram_ids = diagram_ids
+        self.random = random.Random(0)
+
+    def pick_id(self) -> str:
+        return self.random.choice(self.diagram_ids)
+
+    async def timed(self, method: str, url: str, expect: int = 200, **kwargs) -> Sample:
+        request_id = uuid.uuid4().hex
+        headers = {REQUEST_ID_HEADER: request_id, **kwargs.pop("headers", {})}
+        started = time.perf_counter()
+        response = await self.client.request(method, url, headers=headers, **kwargs)
+        total = time.perf_counter() - started
+        first_byte = self.timed_app.first_byte.pop(request_id, None)
+        ok = response.status_code == expect and b'"type": "error"' not in response.content
+        ttfb = first_byte - started if first_byte is not None else None
+        return Sample(ok=ok, total=total, ttfb=ttfb)
+
+
+def seed_diagrams(rows: int) -> list[str]:
+    """Insert ``rows`` diagrams in one transaction and return their ids"""
+    from sqlalchemy import insert
+
+    from app.core.database import Base, SessionLocal, engine
+    from app.models.diagram import Diagram
+
+    Base.metadata.create_all(bind=engine)
+    now = datetime.utcnow()
+    ids = [str(uuid.UUID(int=random.Random(i).getrandbits(128))) for i in range(rows)]
+    with SessionLocal() as session:
+        session.execute(insert(Diagram), [
+            {
+                "id": diagram_id,
+                "title": f"Diagram {i}",
+                "type": "flowchart",
+                "format": "mermaid",
+                "code": SAMPLE_MERMAID,
+                "ai_provider": "claude",
+                "ai_prompt": f"用户登录流程 {i}",
+                "created_at": now,
+                "updated_at": now,
+            }
+            for i, diagram_id in enumerate(ids)
+        ])
+        session.commit()
+    return ids
+
+
+def stub_renderer() -> None:
+    """Replace mermaid-cli with canned output so export measures the route, not Node"""
+    from app.services.export_service import export_service
+
+    for fmt, data in STUB_RENDER.items():
+        async def render(code: str, *args, data=data, **kwargs) -> bytes:
+            return data
+        setattr(export_service, f"export_{fmt}", render)
+
+
+def _generate_body(i: int, fmt: str = "mermaid") -> dict:
+    return {
+        "description": f"用户注册，发送第{i}封验证邮件，激活账号，进入首页",
+        "diagramType": "flowchart",
+        "format": fmt,
+        "aiProvider": "fake",
+    }
+
+
+async def generate(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("POST", "/api/ai/generate", json=_generate_body(i))
+
+
+async def generate_stream(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("POST", "/api/ai/generate-stream", json=_generate_body(i, "drawio"))
+
+
+async def chat_stream(ctx: BenchContext, i: int) -> Sample:
+    messages = [
+        {"role": "user", "content": "画一个订单处理流程"},
+        {"role": "assistant", "content": f"好的：\n```mermaid\n{SAMPLE_MERMAID}\n```"},
+        {"role": "user", "content": f"在校验之后加一个第{i}号风控步骤"},
+    ]
+    return await ctx.timed("POST", "/api/ai/chat/stream", json={
+        "messages": messages, "diagramType": "flowchart", "format": "mermaid", "aiProvider": "fake",
+    })
+
+
+async def explain(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("POST", "/api/ai/explain", json={
+        "code": f"{SAMPLE_MERMAID}\n    C --> E[第{i}步]", "format": "mermaid", "aiProvider": "fake",
+    })
+
+
+async def diagram_create(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("POST", "/api/diagrams", json={
+        "title": f"Bench {i}", "type": "flowchart", "format": "mermaid",
+        "code": SAMPLE_MERMAID, "ai_provider": "claude", "ai_prompt": "bench",
+    })
+
+
+async def diagram_update(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("PUT", f"/api/diagrams/{ctx.pick_id()}", json={"title": f"Renamed {i}"})
+
+
+async def diagram_get(ctx: BenchContext, i: int) -> Sample:
+    return await ctx.timed("GET", f"/api/diagrams/{ctx.pick_id()}")
+
+
+async def diagram_list(ctx: BenchContext, i: int) -> Sample:
+    skip = ctx.random.randrange(0, max(1, len(ctx.diagram_ids) - 100))
+    return await ctx.timed("GET", "/api/diagrams", params={"skip": skip, "limit": 100})
+
+
+@functools.lru_cache(maxsize=None)
+def drawio_sample(nodes: int = 60) -> str:
+    """A grid of mixed shapes chained by labelled orthogonal edges"""
+    from app.services.ai.drawio_converter import DrawioXMLGenerator
+
+    shapes = ("rectangle", "rounded", "diamond", "ellipse", "hexagon", "cylinder")
+    return DrawioXMLGenerator().create_flowchart(
+        [
+            {"id": n, "label": f"步骤 {n} step", "shape": shapes[n % len(shapes)], "x": (n % 10) * 180, "y": (n // 10) * 110}
+            for n in range(nodes)
+        ],
+        [{"from": n, "to": n + 1, "label": "下一步" if n % 4 == 0 else ""} for n in range(nodes - 1)],
+    )
+
+
+_render_turn = asyncio.Lock()
+
+
+async def _timed_pdf(pdf_mode: str) -> Sample:
+    from app.services.drawio_renderer import render_drawio
+
+    code = drawio_sample()
+    # Renders hold the GIL, so with -c N each would take N times as long. Run
+    # one at a time and time only the render, not the wait for a turn.
+    async with _render_turn:
+        started = time.perf_counter()
+        # Off the loop, as in ExportService.export_drawio
+        data = await asyncio.to_thread(render_drawio, code, "pdf", "white", 3, pdf_mode)
+        return Sample(ok=data.startswith(b"%PDF"), total=time.perf_counter() - started)
+
+
+async def pdf_vector(ctx: BenchContext, i: int) -> Sample:
+    return await _timed_pdf("vector")
+
+
+async def pdf_raster(ctx: BenchContext, i: int) -> Sample:
+    return await _timed_pdf("raster")
+
+
+async def export(ctx: BenchContext, i: int) -> Sample:
+    fmt = ("svg", "png", "pdf")[i % 3]
+    return await ctx.timed("GET", f"/api/diagrams/{ctx.pick_id()}/export", params={"format": fmt})
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario("generate", generate, description="POST /ai/generate, cache miss"),
+        Scenario("generate_stream", generate_stream, ("ttfb", "total"), "POST /ai/generate-stream (Draw.io)"),
+        Scenario("chat_stream", chat_stream, ("ttfb", "total"), "POST /ai/chat/stream, three-message history"),
+        Scenario("explain", explain, description="POST /ai/explain"),
+        Scenario("diagram_create", diagram_create, description="POST /diagrams"),
+        Scenario("diagram_update", diagram_update, description="PUT /diagrams/{id}, random seeded row"),
+        Scenario("diagram_get", diagram_get, description="GET /diagrams/{id}, random seeded row"),
+        Scenario("diagram_list", diagram_list, description="GET /diagrams, 100-row page at a random offset"),
+        Scenario("export", export, description="GET /diagrams/{id}/export, stubbed renderer"),
+        Scenario("pdf_vector", pdf_vector, description="Draw.io PDF, 60 nodes, SVG to vector PDF (in-process)"),
+        Scenario("pdf_raster", pdf_raster, description="Draw.io PDF, 60 nodes, 3x PNG in a PDF (in-process)"),
+    )
+}
+
+
+def metric_name(scenario: Scenario, metric: str) -> str:
+    return scenario.name if metric == "total" and len(scenario.metrics) == 1 else f"{scenario.name}.{metric}"
+
+
+def find(names: Optional[list[str]]) -> list[Scenario]:
+    if not names:
+        return list(SCENARIOS.values())
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    return [SCENARIOS[name] for name in names]
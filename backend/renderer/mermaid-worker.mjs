@@ -0,0 +1,58 @@
+// Long-lived Mermaid renderer for app/services/renderer_pool.py
+//
+// Keeps one headless Chromium warm and renders jobs read from stdin, one JSON
+// object per line:
+//   {"id": 1, "code": "graph TD; A-->B", "format": "svg"|"png"|"pdf", "backgroundColor": "white", "scale": 2}
+// and answers on stdout, one line per job, in order:
+//   {"id": 1, "ok": true, "data": "<base64>"}
+//   {"id": 1, "ok": false, "error": "Parse error on line 1 ..."}
+// A {"type": "ready"} line is written once the browser is up. The process
+// exits when stdin closes or the browser goes away.
+//
+// Install next to this file: npm install (see package.json).
+import { createInterface } from "node:readline";
+import { readFileSync } from "node:fs";
+import puppeteer from "puppeteer";
+import { renderMermaid } from "@mermaid-js/mermaid-cli";
+
+const puppeteerConfig = process.env.MERMAID_PUPPETEER_CONFIG
+  ? JSON.parse(readFileSync(process.env.MERMAID_PUPPETEER_CONFIG, "utf8"))
+  : {};
+const mermaidConfig = process.env.MERMAID_CONFIG
+  ? JSON.parse(readFileSync(process.env.MERMAID_CONFIG, "utf8"))
+  : {};
+
+function reply(message) {
+  process.stdout.write(JSON.stringify(message) + "\n");
+}
+
+const browser = await puppeteer.launch({ headless: "new", ...puppeteerConfig });
+browser.on("disconnected", () => process.exit(1));
+
+async function render(job) {
+  const { data } = await renderMermaid(browser, job.code, job.format, {
+    backgroundColor: job.backgroundColor ?? "white",
+    mermaidConfig,
+    viewport: { width: 800, height: 600, deviceScaleFactor: job.scale ?? 1 },
+    // PDFs are printed by Chromium, so they stay vector; size the page to the diagram
+    pdfFit: job.format === "pdf",
+  });
+  return Buffer.from(data).toString("base64");
+}
+
+reply({ type: "ready", pid: process.pid });
+
+// Jobs are handled strictly one at a time; the pool never sends the next
+// before the previous answer, so replies stay in request order.
+const lines = createInterface({ input: process.stdin, crlfDelay: Infinity });
+for await (const line of lines) {
+  if (!line.trim()) continue;
+  let job;
+  try {
+    job = JSON.parse(line);
+    reply({ id: job.id, ok: true, data: await render(job) });
+  } catch (error) {
+    reply({ id: job?.id ?? null, ok: false, error: String(error?.message ?? error) });
+  }
+}
+await browser.close();
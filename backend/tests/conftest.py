@@ -1,43 +1,49 @@
 import os
 import sys
+import tempfile
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+import fakeredis
 
-# Mock AI services before importing to avoid initialization issues
-sys.modules['app.services.ai.claude_service'] = MagicMock()
-sys.modules['app.services.ai.openai_service'] = MagicMock()
+from app.core.database import Base, get_db
+from app.models.diagram import Diagram
 
-# Create mock service instances
-mock_claude_service = MagicMock()
-mock_openai_service = MagicMock()
-
-# Patch the service instances
-with patch.dict('sys.modules', {
-    'app.services.ai.claude_service': MagicMock(claude_service=mock_claude_service),
-    'app.services.ai.openai_service': MagicMock(openai_service=mock_openai_service),
-}):
-    from app.core.database import Base, get_db
-    from app.models.diagram import Diagram
-
-# Import app after mocking
+# Import app after the database module so dependency overrides target the same get_db
 from app.main import app
 
-# Patch the imported services in routes
+# Replace the AI service singletons used by the routes with mocks so tests
+# never reach a real provider
 import app.api.routes as routes_module
+
+mock_claude_service = MagicMock()
+mock_openai_service = MagicMock()
+mock_deepseek_service = MagicMock()
 routes_module.claude_service = mock_claude_service
 routes_module.openai_service = mock_openai_service
+routes_module.deepseek_service = mock_deepseek_service
 
-# Create test database (in-memory SQLite for testing)
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+from app.services.response_cache import response_cache
+from app.services.semantic_cache import DEFAULT_SYNONYMS, SemanticCache
+from app.services.render_cache import RenderCache
+from app.services.single_flight import single_flight
+from app.services.rate_limiter import rate_limiter
+from app.services.usage_ledger import usage_ledger
+from app.services.jobs import job_queue
+from app.services.stream_resume import chat_streams
+from app.services.ai.prompts import PromptTable
+from app.core import tracing
+
+# Create test database. A file rather than ":memory:", so that every session
+# gets its own connection, as in production: routes and the usage ledger write
+# from worker threads while the test's own session is open.
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='diagram-tests-'), 'test.db')}"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -80,3 +86,90 @@ def sample_diagram_data():
         "ai_prompt": "Create a simple flowchart",
     }
 
+
+
+def stream_of(*chunks):
+    """Side effect for a mocked streaming service method yielding ``chunks``"""
+    def start(*args, **kwargs):
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return stream()
+    return start
+
+
+@pytest.fixture
+def ai_services():
+    """Reset the mocked AI services and give them async entry points"""
+    services = {
+        "claude": mock_claude_service,
+        "openai": mock_openai_service,
+        "deepseek": mock_deepseek_service,
+    }
+    for name, service in services.items():
+        service.reset_mock()
+        service.base_url = None
+        service.model = f"{name}-test-model"
+        service.prompts = PromptTable(lambda t, f, name=name: f"{name} {t.value} {f.value} prompt")
+        service.create_client = MagicMock(side_effect=lambda api_key, base_url=None: MagicMock())
+        service.generate_diagram = AsyncMock(return_value="graph TD\n    A --> B")
+        service.refine_diagram = AsyncMock(return_value="graph TD\n    A --> C")
+        service.refine_patch = AsyncMock(return_value='[{"op": "replace", "line": 2, "text": "    A --> C"}]')
+        service.explain_diagram = AsyncMock(return_value="A flows to B")
+        service.generate_stream = MagicMock(side_effect=stream_of("graph TD\n", "    A --> B"))
+        service.chat_stream = MagicMock(side_effect=stream_of("Sure", ", here it is"))
+    return services
+
+
+@pytest.fixture(autouse=True)
+def fake_redis():
+    """Point every Redis consumer at an isolated in-memory server"""
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    consumers = [response_cache, single_flight, rate_limiter, usage_ledger, job_queue, chat_streams]
+    originals = [consumer.redis for consumer in consumers]
+    for consumer in consumers:
+        consumer.redis = client
+    yield client
+    for consumer, original in zip(consumers, originals):
+        consumer.redis = original
+
+
+@pytest.fixture(autouse=True)
+def semantic_cache(monkeypatch):
+    """Fresh, memory-only near-duplicate prompt cache for each test"""
+    cache = SemanticCache(
+        threshold=0.9, dimensions=256, capacity=64, directory=None, synonyms=DEFAULT_SYNONYMS
+    )
+    monkeypatch.setattr(routes_module, "semantic_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def render_cache(tmp_path, monkeypatch):
+    """Fresh export cache in the test's temporary directory"""
+    cache = RenderCache(tmp_path / "render_cache", max_bytes=1024 * 1024)
+    monkeypatch.setattr(routes_module, "render_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def trace_exporter():
+    """Collect exported traces in memory instead of writing the JSONL file"""
+    exporter = tracing.InMemoryExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+@pytest.fixture(autouse=True)
+def routes_db(monkeypatch):
+    """Sessions the routes open themselves use the test database"""
+    monkeypatch.setattr(routes_module, "SessionLocal", TestingSessionLocal)
+
+
+@pytest.fixture(autouse=True)
+def usage_ledger_db(monkeypatch):
+    """Store usage records in the test database"""
+    monkeypatch.setattr(usage_ledger, "session_factory", TestingSessionLocal)
+    return usage_ledger
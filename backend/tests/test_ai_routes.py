@@ -0,0 +1,611 @@
+import asyncio
+import json
+import os
+from unittest.mock import AsyncMock
+
+import pytest
+
+import app.api.routes as routes_module
+from app.core.config import settings
+from app.models.diagram import Diagram
+from app.services.ai.client_pool import ProviderClientPool
+from app.services.single_flight import SingleFlightError
+
+
+@pytest.fixture
+def fresh_client_pool(monkeypatch):
+    pool = ProviderClientPool(max_size=4)
+    monkeypatch.setattr(routes_module, "client_pool", pool)
+    return pool
+
+
+def generate_payload(**overrides):
+    payload = {
+        "description": "A simple login flow",
+        "diagramType": "flowchart",
+        "format": "mermaid",
+        "aiProvider": "claude",
+    }
+    payload.update(overrides)
+    return payload
+
+
+def test_generate_with_client_key_does_not_touch_global_state(client, ai_services, fresh_client_pool):
+    """Client-supplied keys are routed to a pooled client, not into os.environ/settings"""
+    before_env = os.environ.get("ANTHROPIC_API_KEY")
+    before_setting = settings.ANTHROPIC_API_KEY
+
+    response = client.post(
+        "/api/ai/generate",
+        json=generate_payload(),
+        headers={"X-Anthropic-Key": "sk-user", "X-Anthropic-Base-Url": "https://proxy.example"},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["code"] == "graph TD\n    A --> B"
+    assert os.environ.get("ANTHROPIC_API_KEY") == before_env
+    assert settings.ANTHROPIC_API_KEY == before_setting
+    ai_services["claude"].create_client.assert_called_once_with("sk-user", "https://proxy.example")
+    _, kwargs = ai_services["claude"].generate_diagram.call_args
+    assert kwargs["client"] is not None
+
+
+def test_repeated_requests_reuse_pooled_client(client, ai_services, fresh_client_pool):
+    headers = {"X-DeepSeek-Key": "sk-user"}
+    for _ in range(3):
+        response = client.post(
+            "/api/ai/explain",
+            json={"code": "graph TD\n A-->B", "format": "mermaid", "aiProvider": "deepseek"},
+            headers=headers,
+        )
+        assert response.status_code == 200
+
+    assert ai_services["deepseek"].create_client.call_count == 1
+    clients = {id(call.kwargs["client"]) for call in ai_services["deepseek"].explain_diagram.call_args_list}
+    assert len(clients) == 1
+
+
+def test_missing_key_reports_generation_failure(client, ai_services, fresh_client_pool, monkeypatch):
+    monkeypatch.setattr(settings, "OPENAI_API_KEY", "")
+    ai_services["openai"].create_client.side_effect = ValueError("OPENAI_API_KEY is not set")
+
+    response = client.post("/api/ai/generate", json=generate_payload(aiProvider="openai"))
+
+    assert response.status_code == 500
+    assert "OPENAI_API_KEY is not set" in response.json()["detail"]
+
+
+def test_generate_repeat_is_served_from_cache(client, ai_services, fresh_client_pool):
+    first = client.post("/api/ai/generate", json=generate_payload())
+    second = client.post(
+        "/api/ai/generate",
+        json=generate_payload(description="  a SIMPLE   login flow "),
+    )
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json()["code"] == first.json()["code"]
+    assert ai_services["claude"].generate_diagram.await_count == 1
+
+
+def test_cache_key_separates_provider_type_and_format(client, ai_services, fresh_client_pool):
+    client.post("/api/ai/generate", json=generate_payload())
+    other_format = client.post("/api/ai/generate", json=generate_payload(format="drawio"))
+    other_type = client.post("/api/ai/generate", json=generate_payload(diagramType="sequence"))
+    other_provider = client.post("/api/ai/generate", json=generate_payload(aiProvider="deepseek"))
+
+    for response in (other_format, other_type, other_provider):
+        assert response.headers["X-Cache"] == "MISS"
+
+
+def test_refine_and_explain_are_cached(client, ai_services, fresh_client_pool):
+    refine = {"code": "graph TD\n A-->B", "format": "mermaid", "instruction": "add C", "aiProvider": "openai"}
+    explain = {"code": "graph TD\n A-->B", "format": "mermaid", "aiProvider": "openai"}
+    for _ in range(2):
+        client.post("/api/ai/refine", json=refine)
+        client.post("/api/ai/explain", json=explain)
+
+    assert ai_services["openai"].refine_diagram.await_count == 1
+    assert ai_services["openai"].explain_diagram.await_count == 1
+    other_instruction = client.post("/api/ai/refine", json={**refine, "instruction": "add D"})
+    assert other_instruction.headers["X-Cache"] == "MISS"
+
+
+def test_cache_control_no_cache_refreshes_entry(client, ai_services, fresh_client_pool):
+    client.post("/api/ai/generate", json=generate_payload())
+    ai_services["claude"].generate_diagram.return_value = "graph LR\n    X --> Y"
+
+    refreshed = client.post("/api/ai/generate", json=generate_payload(), headers={"Cache-Control": "no-cache"})
+    again = client.post("/api/ai/generate", json=generate_payload())
+
+    assert refreshed.headers["X-Cache"] == "BYPASS"
+    assert again.headers["X-Cache"] == "HIT"
+    assert again.json()["code"] == "graph LR\n    X --> Y"
+
+
+def test_disabled_endpoint_skips_cache(client, ai_services, fresh_client_pool, monkeypatch):
+    monkeypatch.setattr(settings, "AI_CACHE_DISABLED_ENDPOINTS", ["explain"])
+    explain = {"code": "graph TD\n A-->B", "format": "mermaid", "aiProvider": "claude"}
+
+    responses = [client.post("/api/ai/explain", json=explain) for _ in range(2)]
+
+    assert [r.headers["X-Cache"] for r in responses] == ["BYPASS", "BYPASS"]
+    assert ai_services["claude"].explain_diagram.await_count == 2
+
+
+def test_cache_entries_expire(client, ai_services, fresh_client_pool, fake_redis):
+    import asyncio
+
+    client.post("/api/ai/generate", json=generate_payload())
+    keys = asyncio.run(fake_redis.keys("aicache:*"))
+    ttl = asyncio.run(fake_redis.ttl(keys[0]))
+
+    assert len(keys) == 1
+    assert 0 < ttl <= settings.AI_CACHE_TTL_SECONDS
+
+
+def test_near_duplicate_generate_uses_semantic_cache(client, ai_services, fresh_client_pool):
+    first = client.post(
+        "/api/ai/generate",
+        json=generate_payload(description="用户登录流程，输入用户名和密码，验证通过后进入首页"),
+    )
+    second = client.post(
+        "/api/ai/generate",
+        json=generate_payload(description="输入用户名和密码，验证通过后进入首页，用户登陆流程"),
+    )
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "SEMANTIC"
+    assert float(second.headers["X-Cache-Similarity"]) >= 0.9
+    assert second.json()["code"] == first.json()["code"]
+    assert ai_services["claude"].generate_diagram.await_count == 1
+
+    stats = client.get("/api/ai/cache/stats").json()["semantic"]
+    assert stats["hits"] == 1
+
+
+def test_semantic_cache_respects_diagram_type(client, ai_services, fresh_client_pool):
+    client.post("/api/ai/generate", json=generate_payload(description="用户登录流程"))
+    response = client.post(
+        "/api/ai/generate", json=generate_payload(description="用户登陆流程", diagramType="sequence")
+    )
+
+    assert response.headers["X-Cache"] == "MISS"
+
+
+def test_concurrent_identical_generates_share_one_provider_call(ai_services, fresh_client_pool):
+    import asyncio
+    import httpx
+    from app.main import app
+
+    async def slow_generate(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = slow_generate
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(
+                *(http.post("/api/ai/generate", json=generate_payload()) for _ in range(4))
+            )
+
+    responses = asyncio.run(burst())
+
+    assert all(r.status_code == 200 for r in responses)
+    assert sorted(r.headers["X-Cache"] for r in responses) == ["COALESCED"] * 3 + ["MISS"]
+    assert ai_services["claude"].generate_diagram.await_count == 1
+
+
+def test_identical_generates_on_different_keys_are_not_coalesced(ai_services, fresh_client_pool):
+    import asyncio
+    import httpx
+    from app.main import app
+
+    async def slow_generate(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = slow_generate
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await asyncio.gather(*(
+                http.post("/api/ai/generate", json=generate_payload(), headers={"X-Anthropic-Key": key})
+                for key in ("sk-one", "sk-two")
+            ))
+
+    responses = asyncio.run(burst())
+
+    # Each caller's own key, rate limits and budget are used
+    assert [r.headers["X-Cache"] for r in responses] == ["MISS", "MISS"]
+    assert ai_services["claude"].generate_diagram.await_count == 2
+
+
+@pytest.mark.parametrize("endpoint, payload", [
+    ("/api/ai/generate", generate_payload()),
+    ("/api/ai/explain", {"code": "graph TD\n    A --> B", "format": "mermaid", "aiProvider": "claude"}),
+])
+def test_remote_leader_failure_keeps_its_status(client, ai_services, monkeypatch, endpoint, payload):
+    monkeypatch.setattr(
+        routes_module.single_flight, "do",
+        AsyncMock(side_effect=SingleFlightError("claude rate limit: tokens", 429, retry_after=7)),
+    )
+
+    response = client.post(endpoint, json=payload)
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+    assert response.json()["detail"] == "claude rate limit: tokens"
+
+
+def parse_sse(body: str) -> list[dict]:
+    import json
+
+    return [json.loads(line[6:]) for line in body.splitlines() if line.startswith("data: ")]
+
+
+def test_generate_stream_emits_clean_code_incrementally(client, ai_services, fresh_client_pool):
+    from tests.conftest import stream_of
+
+    ai_services["claude"].generate_stream.side_effect = stream_of(
+        "好的：\n```mer", "maid\ngraph TD\n", "    A --> B\n``", "`\n说明"
+    )
+
+    response = client.post("/api/ai/generate-stream", json=generate_payload())
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    chunks = [e["content"] for e in events if e["type"] == "chunk"]
+    assert chunks[0] == "graph TD"
+    assert "".join(chunks) == "graph TD\n    A --> B"
+    done = events[-1]
+    assert done["type"] == "done"
+    assert done["ttfb_ms"] <= done["total_ms"]
+    assert "ttft_ms" in done
+
+
+def test_generate_stream_forwards_reasoning_and_caches_result(client, ai_services, fresh_client_pool):
+    from tests.conftest import stream_of
+
+    ai_services["deepseek"].generate_stream.side_effect = stream_of(
+        {"type": "reasoning", "content": "思考中"},
+        {"type": "content", "content": "graph TD\n  A-->B"},
+    )
+    payload = generate_payload(aiProvider="deepseek")
+
+    first = client.post("/api/ai/generate-stream", json=payload)
+    events = parse_sse(first.text)
+    assert events[0] == {"type": "reasoning", "content": "思考中"}
+    assert first.headers["X-Cache"] == "MISS"
+
+    second = client.post("/api/ai/generate-stream", json=payload)
+    assert second.headers["X-Cache"] == "HIT"
+    cached_events = parse_sse(second.text)
+    assert cached_events[0] == {"type": "chunk", "content": "graph TD\n  A-->B"}
+    assert cached_events[-1]["cached"] is True
+    assert ai_services["deepseek"].generate_stream.call_count == 1
+
+
+def test_generate_stream_reports_errors_as_events(client, ai_services, fresh_client_pool):
+    def broken(*args, **kwargs):
+        async def stream():
+            raise RuntimeError("upstream down")
+            yield  # pragma: no cover
+
+        return stream()
+
+    ai_services["openai"].generate_stream.side_effect = broken
+
+    response = client.post("/api/ai/generate-stream", json=generate_payload(aiProvider="openai"))
+
+    assert parse_sse(response.text)[-1] == {"type": "error", "message": "upstream down"}
+
+
+def test_generate_stream_emits_drawio_cells_progressively(client, ai_services, fresh_client_pool):
+    from tests.conftest import stream_of
+
+    ai_services["claude"].generate_stream.side_effect = stream_of(
+        '<?xml version="1.0"?><mxfile><diagram><mxGraphModel><root>',
+        '<mxCell id="2" value="A" vertex="1" parent="1"><mxGeometry x="0" y="0" width="80" height="40" as="geometry"/></mxCell>',
+        '<mxCell id="3" value="B" vertex="1" parent="1">',
+        '</mxCell></root></mxGraphModel></diagram></mxfile>',
+    )
+
+    response = client.post("/api/ai/generate-stream", json=generate_payload(format="drawio"))
+
+    types = [e["type"] for e in parse_sse(response.text)]
+    cells = [e["cell"]["id"] for e in parse_sse(response.text) if e["type"] == "cell"]
+    assert cells == ["2", "3"]
+    # The first cell is reported right after the chunk that closed it
+    assert types[:4] == ["chunk", "chunk", "cell", "chunk"]
+    assert types[-1] == "done"
+
+
+def test_chat_stream_emits_drawio_cells(client, ai_services, fresh_client_pool):
+    from tests.conftest import stream_of
+
+    ai_services["deepseek"].chat_stream.side_effect = stream_of(
+        {"type": "reasoning", "content": "<mxCell id='ignored'/>"},
+        {"type": "content", "content": "修改如下：\n```xml\n<mxfile><diagram><mxGraphModel><root>"},
+        {"type": "content", "content": '<mxCell id="7" value="新节点" vertex="1" parent="1"/>'},
+        {"type": "content", "content": "</root></mxGraphModel></diagram></mxfile>\n```"},
+    )
+    payload = {
+        "messages": [{"role": "user", "content": "加一个节点"}],
+        "diagramType": "flowchart",
+        "format": "drawio",
+        "aiProvider": "deepseek",
+    }
+
+    events = parse_sse(client.post("/api/ai/chat/stream", json=payload).text)
+
+    cells = [e["cell"] for e in events if e["type"] == "cell"]
+    assert [c["id"] for c in cells] == ["7"]
+    assert cells[0]["value"] == "新节点"
+    assert events[-1] == {"type": "done"}
+
+
+def test_rate_limited_requests_get_429_with_retry_after(client, ai_services, fresh_client_pool, monkeypatch):
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_MAX_CONCURRENCY", {"claude": 0})
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_REQUESTS_PER_MINUTE", {"claude": 60})
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_BURST", 1)
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS", 0)
+
+    assert client.post("/api/ai/generate", json=generate_payload()).status_code == 200
+    limited = client.post("/api/ai/generate", json=generate_payload(description="Another flow"))
+    stream = client.post("/api/ai/generate-stream", json=generate_payload(description="Third flow"))
+
+    for response in (limited, stream):
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+    # Cache hits never reach the provider, so they are not limited
+    assert client.post("/api/ai/generate", json=generate_payload()).headers["X-Cache"] == "HIT"
+    assert client.get("/api/ai/limits").json()["claude"]["rejected_timeout"] >= 2
+
+
+def test_stream_releases_its_slot_when_done(client, ai_services, fresh_client_pool, monkeypatch):
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_MAX_CONCURRENCY", {"deepseek": 1})
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS", 0.2)
+    payload = {
+        "messages": [{"role": "user", "content": "hi"}],
+        "diagramType": "flowchart",
+        "format": "mermaid",
+        "aiProvider": "deepseek",
+    }
+
+    for _ in range(3):
+        response = client.post("/api/ai/chat/stream", json=payload)
+        assert response.status_code == 200
+        assert parse_sse(response.text)[-1] == {"type": "done"}
+
+
+def test_token_usage_is_reported_only_for_the_request_that_paid_for_it(client, ai_services, fresh_client_pool):
+    from app.services.ai.usage import record_usage
+
+    async def generate(*args, **kwargs):
+        record_usage(input_tokens=1800, output_tokens=300, cached_input_tokens=1500)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = generate
+
+    first = client.post("/api/ai/generate", json=generate_payload())
+    second = client.post("/api/ai/generate", json=generate_payload())
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert first.json()["usage"] == {
+        "input_tokens": 1800, "output_tokens": 300, "cached_input_tokens": 1500, "cache_write_tokens": 0,
+        "reasoning_tokens": 0,
+    }
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json()["usage"] is None
+
+
+def test_editing_a_system_prompt_invalidates_cached_generations(client, ai_services, fresh_client_pool):
+    from app.services.ai.prompts import PromptTable
+
+    client.post("/api/ai/generate", json=generate_payload())
+    ai_services["claude"].prompts = PromptTable(lambda t, f: "a rewritten prompt")
+    response = client.post("/api/ai/generate", json=generate_payload())
+
+    assert response.headers["X-Cache"] == "MISS"
+    assert ai_services["claude"].generate_diagram.await_count == 2
+
+
+def test_chat_stream_compacts_long_history(client, ai_services, fresh_client_pool, monkeypatch):
+    from app.services.ai.chat_history import ChatHistoryCompactor
+
+    compactor = ChatHistoryCompactor(budget_tokens=300, keep_turns=1, summary_tokens=100)
+    monkeypatch.setattr(routes_module, "chat_history_compactor", compactor)
+    history = []
+    for turn in range(20):
+        history.append({"role": "user", "content": f"第{turn}轮修改"})
+        history.append({"role": "assistant", "content": f"```mermaid\ngraph TD\n    A{turn} --> B{turn}\n```"})
+    history.append({"role": "user", "content": "再加一个节点"})
+    payload = {"messages": history, "diagramType": "flowchart", "format": "mermaid", "aiProvider": "claude"}
+
+    events = parse_sse(client.post("/api/ai/chat/stream", json=payload).text)
+
+    assert events[0]["type"] == "context"
+    assert events[0]["summarized_messages"] == 40
+    sent = ai_services["claude"].chat_stream.call_args.args[0]
+    assert len(sent) == 1
+    assert "A19 --> B19" in sent[0]["content"]
+    assert sent[0]["content"].endswith("再加一个节点")
+    assert events[-1] == {"type": "done"}
+
+
+def refine_payload(**overrides):
+    payload = {
+        "code": "graph TD\n    A --> B",
+        "format": "mermaid",
+        "instruction": "Point A at C",
+        "aiProvider": "claude",
+        "mode": "patch",
+    }
+    payload.update(overrides)
+    return payload
+
+
+def test_patch_refine_applies_edits_without_full_rewrite(client, ai_services, fresh_client_pool):
+    response = client.post("/api/ai/refine", json=refine_payload())
+
+    assert response.status_code == 200
+    assert response.json()["code"] == "graph TD\n    A --> C"
+    assert response.json()["refineMode"] == "patch"
+    ai_services["claude"].refine_diagram.assert_not_awaited()
+
+
+def test_patch_refine_falls_back_to_full_refine(client, ai_services, fresh_client_pool):
+    ai_services["claude"].refine_patch.return_value = '[{"op": "delete", "line": 42}]'
+
+    response = client.post("/api/ai/refine", json=refine_payload())
+
+    assert response.json() == {
+        "code": "graph TD\n    A --> C", "explanation": None, "usage": None, "refineMode": "full",
+    }
+    ai_services["claude"].refine_diagram.assert_awaited_once()
+
+
+def test_patch_refine_edits_the_saved_diagram(client, db_session, sample_diagram_data, ai_services, fresh_client_pool):
+    db_session.add(Diagram(id="d1", **{**sample_diagram_data, "code": "graph TD\n    A --> B"}))
+    db_session.commit()
+
+    response = client.post("/api/ai/refine", json=refine_payload(code="graph TD\n    X --> Y", diagramId="d1"))
+
+    assert response.json()["code"] == "graph TD\n    A --> C"
+    assert ai_services["claude"].refine_patch.await_args.args[0] == "graph TD\n    A --> B"
+    assert client.post("/api/ai/refine", json=refine_payload(diagramId="nope")).status_code == 404
+
+
+def test_fake_provider_is_gated_by_setting(client, monkeypatch):
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_ENABLED", False)
+    response = client.post("/api/ai/generate", json=generate_payload(aiProvider="fake"))
+    assert response.status_code == 400
+
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_ENABLED", True)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TTFT_MS", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_LATENCY_MS", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TOKENS_PER_SECOND", 0)
+    generated = client.post("/api/ai/generate", json=generate_payload(aiProvider="fake", format="drawio"))
+    events = parse_sse(client.post(
+        "/api/ai/generate-stream", json=generate_payload(aiProvider="fake", format="drawio", description="x, y"),
+    ).text)
+
+    assert generated.status_code == 200
+    assert generated.json()["code"].startswith("<?xml")
+    assert generated.json()["usage"]["output_tokens"] > 0
+    assert any(e["type"] == "cell" for e in events)
+    assert events[-1]["type"] == "done"
+
+
+def parse_ndjson(body: str) -> list[dict]:
+    return [json.loads(line) for line in body.splitlines() if line]
+
+
+def test_batch_generate_streams_each_item_and_saves_results(
+    client, db_session, ai_services, fresh_client_pool, monkeypatch
+):
+    monkeypatch.setattr(settings, "AI_BATCH_MAX_CONCURRENCY", 2)
+    in_flight = {"now": 0, "max": 0}
+
+    async def generate(description, diagram_type, diagram_format, client=None):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        return f"graph TD\n    {description[0]} --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = generate
+    ai_services["openai"].generate_diagram.side_effect = RuntimeError("upstream down")
+    items = [
+        {**generate_payload(description=f"{name} service"), "id": name, "title": f"{name} architecture"}
+        for name in ("Auth", "Billing", "Catalog")
+    ]
+    items.append({**generate_payload(description="Search service", aiProvider="openai"), "id": "Search"})
+
+    response = client.post("/api/ai/generate/batch", json={"items": items, "concurrency": 10, "save": True})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = parse_ndjson(response.text)
+    results = {line["id"]: line for line in lines[:-1]}
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1, 2, 3]
+    assert results["Search"]["type"] == "error"
+    assert results["Search"]["status"] == 500
+    assert "upstream down" in results["Search"]["message"]
+    assert results["Billing"]["type"] == "result"
+    assert results["Billing"]["code"] == "graph TD\n    B --> B"
+    assert results["Billing"]["cache"] == "MISS"
+    assert lines[-1]["type"] == "summary"
+    assert (lines[-1]["total"], lines[-1]["succeeded"], lines[-1]["failed"]) == (4, 3, 1)
+    assert in_flight["max"] == 2  # The request asked for 10; the setting caps it
+
+    saved = db_session.query(Diagram).filter(Diagram.id == results["Auth"]["diagramId"]).one()
+    assert saved.title == "Auth architecture"
+    assert saved.ai_prompt == "Auth service"
+    assert db_session.query(Diagram).count() == 3
+
+
+def test_batch_generate_rejects_oversized_batches(client, ai_services, monkeypatch):
+    monkeypatch.setattr(settings, "AI_BATCH_MAX_ITEMS", 2)
+    response = client.post("/api/ai/generate/batch", json={"items": [generate_payload()] * 3})
+
+    assert response.status_code == 400
+    ai_services["claude"].generate_diagram.assert_not_called()
+
+
+def test_batch_generate_reports_rate_limited_items(client, ai_services, fresh_client_pool, monkeypatch):
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_MAX_CONCURRENCY", {"claude": 0})
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_REQUESTS_PER_MINUTE", {"claude": 60})
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_BURST", 1)
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS", 0)
+    items = [generate_payload(description="First flow"), generate_payload(description="Second flow")]
+
+    lines = parse_ndjson(client.post("/api/ai/generate/batch", json={"items": items}).text)
+
+    assert sorted(line["type"] for line in lines[:-1]) == ["error", "result"]
+    limited = next(line for line in lines if line["type"] == "error")
+    assert limited["status"] == 429
+    assert limited["retryAfter"] == 1
+
+
+def test_chat_stream_reconnect_replays_missed_events(client, ai_services, fresh_client_pool):
+    payload = {
+        "messages": [{"role": "user", "content": "hi"}],
+        "diagramType": "flowchart",
+        "format": "mermaid",
+        "aiProvider": "claude",
+    }
+    first = client.post("/api/ai/chat/stream", json=payload)
+    stream_id = first.headers["X-Stream-Id"]
+    ids = [int(line[4:]) for line in first.text.splitlines() if line.startswith("id: ")]
+    assert ids == [1, 2, 3]
+
+    resumed = client.get(f"/api/ai/chat/stream/{stream_id}", headers={"Last-Event-ID": "1"})
+
+    assert resumed.status_code == 200
+    assert parse_sse(resumed.text) == parse_sse(first.text)[1:]
+    assert "id: 2\n" in resumed.text
+    assert ai_services["claude"].chat_stream.call_count == 1
+    assert client.get(f"/api/ai/chat/stream/{stream_id}?last_event_id=3").text == ""
+    assert client.get("/api/ai/chat/stream/unknown").status_code == 404
+    bad = client.get(f"/api/ai/chat/stream/{stream_id}", headers={"Last-Event-ID": "abc"})
+    assert bad.status_code == 400
+
+
+def test_chat_stream_can_be_stopped(client, ai_services, fresh_client_pool, monkeypatch):
+    stopped = []
+
+    async def stop(stream_id):
+        stopped.append(stream_id)
+        return stream_id == "running"
+
+    monkeypatch.setattr(routes_module.chat_streams, "stop", stop)
+
+    assert client.delete("/api/ai/chat/stream/running").status_code == 200
+    assert client.delete("/api/ai/chat/stream/unknown").status_code == 404
+    assert stopped == ["running", "unknown"]
@@ -28,6 +28,14 @@ def test_create_diagram(client, sample_diagram_data):
     assert "created_at" in data
 
 
+@pytest.mark.parametrize("provider", ["deepseek", "fake"])
+def test_create_diagram_records_every_provider(client, sample_diagram_data, provider):
+    """Every provider the API accepts can be stored on a diagram"""
+    response = client.post("/api/diagrams", json={**sample_diagram_data, "ai_provider": provider})
+    assert response.status_code == 200
+    assert response.json()["ai_provider"] == provider
+
+
 def test_get_diagrams(client, db_session, sample_diagram_data):
     """Test getting all diagrams"""
     # Create a diagram directly in database
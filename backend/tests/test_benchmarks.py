@@ -0,0 +1,35 @@
+from benchmarks.compare import compare
+from benchmarks.harness import Measurement, Sample, percentile
+
+
+def result(p95, rps=100.0, errors=0):
+    return {"p50_ms": 10.0, "p95_ms": p95, "p99_ms": p95, "rps": rps, "errors": errors}
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) == 0.0
+
+
+def test_summary_excludes_failed_requests_from_latency():
+    measurement = Measurement([Sample(True, 0.010, 0.002), Sample(False, 5.0)], elapsed=1.0)
+
+    total = measurement.summarize()
+    ttfb = measurement.summarize("ttfb")
+
+    assert total["max_ms"] == 10.0 and total["errors"] == 1 and total["rps"] == 2.0
+    assert ttfb["p50_ms"] == 2.0
+
+
+def test_compare_flags_latency_and_throughput_regressions():
+    baseline = {"results": {"get": result(20.0), "list": result(20.0), "tiny": result(0.2)}}
+    current = {"results": {
+        "get": result(21.0), "list": result(30.0, rps=50.0), "tiny": result(0.4), "new": result(1.0),
+    }}
+
+    regressions = {(c.metric, c.field) for c in compare(current, baseline, threshold=0.1) if c.regression}
+
+    assert regressions == {("list", "p95_ms"), ("list", "p99_ms"), ("list", "rps")}
@@ -0,0 +1,129 @@
+import asyncio
+import io
+import json
+import zipfile
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.models.diagram import Diagram
+from app.services.export_service import export_service
+from app.services.zip_stream import ZipStream, member_name
+
+
+async def fake_export(code, fmt, diagram_format):
+    if "broken" in code:
+        raise HTTPException(status_code=400, detail="Parse error on line 1")
+    await asyncio.sleep(0.01 if "slow" in code else 0)
+    return f"{fmt}:{code}".encode()
+
+
+@pytest.fixture
+def export_renders(monkeypatch):
+    render = AsyncMock(side_effect=fake_export)
+    monkeypatch.setattr(export_service, "export", render)
+    return render
+
+
+@pytest.fixture
+def diagrams(db_session, sample_diagram_data):
+    rows = [
+        ("d1", "Login flow", "slow graph TD", "flowchart"),
+        ("d2", "Login flow", "graph LR", "flowchart"),
+        ("d3", "Schema: users/orders", "erDiagram", "er"),
+        ("d4", "Broken", "broken", "flowchart"),
+    ]
+    for diagram_id, title, code, diagram_type in rows:
+        db_session.add(Diagram(id=diagram_id, **{**sample_diagram_data, "title": title, "code": code, "type": diagram_type}))
+    db_session.commit()
+    return rows
+
+
+def read_archive(response) -> tuple[zipfile.ZipFile, dict]:
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    return archive, json.loads(archive.read("manifest.json"))
+
+
+def test_member_names_are_safe_and_unique():
+    taken = set()
+
+    assert member_name("Login flow", "svg", taken) == "Login flow.svg"
+    assert member_name("login FLOW", "svg", taken) == "login FLOW (2).svg"
+    assert member_name("../a/b:c", "png", taken) == "a_b_c.png"
+    assert member_name("...", "pdf", taken) == "diagram.pdf"
+    assert member_name("nul", "svg", taken) == "_nul.svg"
+    assert member_name("用户登录", "svg", taken) == "用户登录.svg"
+
+
+def test_non_ascii_member_names_are_marked_utf8():
+    archive = ZipStream()
+    packed = zipfile.ZipFile(io.BytesIO(archive.add("用户登录.svg", b"<svg/>") + archive.close()))
+
+    assert packed.namelist() == ["用户登录.svg"]
+    assert packed.getinfo("用户登录.svg").flag_bits & 0x800
+
+
+def test_zip_stream_hands_back_each_member_as_it_is_added():
+    archive = ZipStream()
+    chunks = [archive.add("a.svg", b"<svg/>" * 100), archive.add("b.png", b"\x89PNG", compress=False)]
+    chunks.append(archive.close())
+
+    assert all(chunks)
+    assert b"b.png" not in chunks[0]  # Nothing is held back for later members
+    packed = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert packed.read("a.svg") == b"<svg/>" * 100
+    assert packed.getinfo("a.svg").compress_type == zipfile.ZIP_DEFLATED
+    assert packed.getinfo("b.png").compress_type == zipfile.ZIP_STORED
+
+
+def test_bulk_export_streams_files_and_a_manifest(client, diagrams, export_renders):
+    response = client.post("/api/diagrams/export", json={"ids": ["d1", "d2", "d3", "d4", "nope", "d1"], "format": "png"})
+    archive, manifest = read_archive(response)
+
+    assert sorted(archive.namelist()) == [
+        "Login flow (2).png", "Login flow.png", "Schema_ users_orders.png", "manifest.json",
+    ]
+    assert archive.namelist()[-1] == "manifest.json"
+    assert export_renders.await_count == 4  # Duplicate ids are exported once
+    assert (manifest["total"], manifest["succeeded"], manifest["failed"]) == (5, 3, 2)
+    entries = {entry["id"]: entry for entry in manifest["diagrams"]}
+    assert [entry["id"] for entry in manifest["diagrams"]] == ["d1", "d2", "d3", "d4", "nope"]
+    assert archive.read(entries["d1"]["file"]) == b"png:slow graph TD"
+    assert entries["d1"]["bytes"] == len(b"png:slow graph TD")
+    assert entries["d4"] == {"id": "d4", "title": "Broken", "status": 400, "error": "Parse error on line 1"}
+    assert entries["nope"]["status"] == 404
+    # Finished renders are written first
+    assert archive.namelist().index(entries["d1"]["file"]) > archive.namelist().index(entries["d2"]["file"])
+
+
+def test_bulk_export_reuses_the_render_cache(client, diagrams, export_renders):
+    client.get("/api/diagrams/d2/export", params={"format": "svg"})
+
+    response = client.post("/api/diagrams/export", json={"ids": ["d2", "d3"]})
+    _, manifest = read_archive(response)
+
+    assert [entry["cache"] for entry in manifest["diagrams"]] == ["HIT", "MISS"]
+    assert export_renders.await_count == 2
+
+
+def test_bulk_export_selects_by_filter(client, diagrams, export_renders):
+    archive, manifest = read_archive(client.post("/api/diagrams/export", json={"type": "flowchart", "search": "login"}))
+
+    assert [entry["id"] for entry in manifest["diagrams"]] == ["d1", "d2"]
+    assert len(archive.namelist()) == 3
+
+    assert client.post("/api/diagrams/export", json={"search": "nothing like it"}).status_code == 404
+    assert client.post("/api/diagrams/export", json={"format": "gif"}).status_code == 422
+
+
+def test_bulk_export_is_capped(client, diagrams, export_renders, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_BULK_MAX_DIAGRAMS", 3)
+
+    assert client.post("/api/diagrams/export", json={}).status_code == 400
+    assert client.post("/api/diagrams/export", json={"ids": ["d1", "d2", "d3", "d4"]}).status_code == 400
+    assert client.post("/api/diagrams/export", json={"type": "flowchart"}).status_code == 200
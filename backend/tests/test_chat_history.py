@@ -0,0 +1,96 @@
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.chat_history import ChatHistoryCompactor, estimate_tokens, find_diagram_code
+
+DRAWIO = '<?xml version="1.0"?><mxfile><diagram><mxGraphModel><root>{cells}</root></mxGraphModel></diagram></mxfile>'
+
+
+def drawio(n: int) -> str:
+    cells = "".join(f'<mxCell id="{i}" value="节点{i}" vertex="1" parent="1"/>' for i in range(2, n + 2))
+    return DRAWIO.format(cells=cells)
+
+
+def conversation(turns: int, cells_per_answer: int = 40) -> list[dict]:
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"第{turn}轮：请添加一个审批节点。然后调整布局。"})
+        messages.append({
+            "role": "assistant",
+            "content": f"好的，这是第{turn}版。\n```xml\n{drawio(cells_per_answer + turn)}\n```",
+        })
+    messages.append({"role": "user", "content": "最后把颜色改成蓝色"})
+    return messages
+
+
+def test_estimate_tokens_counts_cjk_words_and_symbols():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("登录流程") == 4
+    assert estimate_tokens("hello world") == 4
+    assert estimate_tokens("<mxCell id=\"12\"/>") == 10
+
+
+def test_find_diagram_code_prefers_bare_or_fenced_xml():
+    xml = drawio(1)
+    assert find_diagram_code(f"看这里：{xml} 完成", DiagramFormat.DRAWIO) == xml
+    assert find_diagram_code("```mermaid\ngraph TD\nA-->B\n```", DiagramFormat.MERMAID) == "graph TD\nA-->B"
+    assert find_diagram_code("没有代码", DiagramFormat.MERMAID) is None
+
+
+def test_history_under_budget_is_untouched():
+    compactor = ChatHistoryCompactor(budget_tokens=100_000, keep_turns=2, summary_tokens=200)
+    messages = conversation(3)
+
+    result = compactor.compact(messages, DiagramFormat.DRAWIO)
+
+    assert result.messages is messages
+    assert not result.compacted
+
+
+def test_long_history_keeps_recent_turns_and_latest_code():
+    compactor = ChatHistoryCompactor(budget_tokens=3000, keep_turns=1, summary_tokens=300)
+    messages = conversation(12)
+
+    result = compactor.compact(messages, DiagramFormat.DRAWIO, reserved_tokens=500)
+
+    assert result.compacted
+    assert result.tokens_after <= 3000 < result.tokens_before
+    assert [m["role"] for m in result.messages] == ["user"]
+    content = result.messages[0]["content"]
+    # Latest version verbatim, older versions only mentioned in the summary
+    assert drawio(40 + 11) in content
+    assert drawio(40 + 10) not in content
+    assert "第0轮" in content or "已省略" in content
+    assert content.endswith("最后把颜色改成蓝色")
+
+
+def test_code_in_kept_turns_is_not_duplicated():
+    compactor = ChatHistoryCompactor(budget_tokens=4000, keep_turns=2, summary_tokens=300)
+
+    result = compactor.compact(conversation(12), DiagramFormat.DRAWIO)
+
+    assert [m["role"] for m in result.messages] == ["user", "assistant", "user"]
+    assert "当前图表代码" not in result.messages[0]["content"]
+    assert drawio(40 + 11) in result.messages[1]["content"]
+
+
+def test_compacted_size_stays_flat_as_the_session_grows():
+    compactor = ChatHistoryCompactor(budget_tokens=3000, keep_turns=1, summary_tokens=300)
+
+    sizes = []
+    for turns in (10, 20, 40):
+        result = compactor.compact(conversation(turns), DiagramFormat.DRAWIO)
+        # Diagrams grow by one cell per turn; everything else must stay flat
+        sizes.append(result.tokens_after - estimate_tokens(drawio(40 + turns - 1)))
+
+    assert max(sizes) - min(sizes) < 50
+
+
+def test_summaries_of_older_messages_are_cached():
+    compactor = ChatHistoryCompactor(budget_tokens=3000, keep_turns=1, summary_tokens=300)
+    compactor.compact(conversation(10), DiagramFormat.DRAWIO)
+    misses = compactor.summary_misses
+
+    compactor.compact(conversation(11), DiagramFormat.DRAWIO)
+
+    # Only the turn that just moved out of the verbatim window is summarized
+    assert compactor.summary_misses - misses == 2
+    assert compactor.summary_hits >= 20
@@ -0,0 +1,185 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from anthropic import AsyncAnthropic
+
+from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.claude_service import ClaudeService
+from app.services.ai.usage import track_usage
+
+UPSTREAM_DELAY = 0.3
+
+
+def _message_payload(text: str, **usage) -> dict:
+    return {
+        "id": "msg_test",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-3-5-sonnet-20241022",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 12, "output_tokens": 8, **usage},
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _stream_body(chunks: list[str]) -> str:
+    message = _message_payload("")
+    message["content"] = []
+    message["stop_reason"] = None
+    body = _sse("message_start", {"type": "message_start", "message": message})
+    body += _sse(
+        "content_block_start",
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+    )
+    for chunk in chunks:
+        body += _sse(
+            "content_block_delta",
+            {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}},
+        )
+    body += _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+    body += _sse(
+        "message_delta",
+        {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": 8}},
+    )
+    body += _sse("message_stop", {"type": "message_stop"})
+    return body
+
+
+def _make_service(handler) -> ClaudeService:
+    """Build a ClaudeService whose SDK client talks to an in-process fake Anthropic API"""
+    service = ClaudeService()
+    service._client = AsyncAnthropic(
+        api_key="test-key",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    return service
+
+
+async def _heartbeat(stop: asyncio.Event, interval: float = 0.01) -> int:
+    ticks = 0
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        ticks += 1
+    return ticks
+
+
+@pytest.mark.asyncio
+async def test_generate_diagram_does_not_block_event_loop():
+    """The event loop keeps serving other work while a Claude call is outstanding"""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(UPSTREAM_DELAY)
+        return httpx.Response(200, json=_message_payload("```mermaid\ngraph TD\n  A --> B\n```"))
+
+    service = _make_service(handler)
+    stop = asyncio.Event()
+    heartbeat = asyncio.create_task(_heartbeat(stop))
+
+    started = time.perf_counter()
+    code = await service.generate_diagram("two nodes", DiagramType.FLOWCHART, DiagramFormat.MERMAID)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    ticks = await heartbeat
+
+    assert code == "graph TD\n  A --> B"
+    assert elapsed >= UPSTREAM_DELAY
+    # A blocking client would starve the heartbeat for the whole round trip
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_concurrent_claude_calls_overlap():
+    """Independent Claude requests run concurrently instead of serially"""
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(UPSTREAM_DELAY)
+        return httpx.Response(200, json=_message_payload("解释"))
+
+    service = _make_service(handler)
+
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(service.explain_diagram("graph TD\n  A --> B", DiagramFormat.MERMAID) for _ in range(5))
+    )
+    elapsed = time.perf_counter() - started
+
+    assert results == ["解释"] * 5
+    assert elapsed < UPSTREAM_DELAY * 3
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_yields_text_asynchronously():
+    """chat_stream consumes the SDK's async text stream"""
+    chunks = ["graph TD\n", "  A --> B", "\n"]
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.05)
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=_stream_body(chunks).encode("utf-8"),
+        )
+
+    service = _make_service(handler)
+    messages = [{"role": "user", "content": "two nodes"}]
+
+    received = [
+        text async for text in service.chat_stream(messages, DiagramType.FLOWCHART, DiagramFormat.MERMAID)
+    ]
+
+    assert received == chunks
+
+
+@pytest.mark.asyncio
+async def test_generate_marks_system_prompt_for_caching_and_reports_cached_tokens():
+    seen = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request)
+        payload = _message_payload("<?xml version=\"1.0\"?><mxfile/>", cache_read_input_tokens=1500)
+        return httpx.Response(200, json=payload)
+
+    service = _make_service(handler)
+    with track_usage() as usage:
+        await service.generate_diagram("two nodes", DiagramType.FLOWCHART, DiagramFormat.DRAWIO)
+
+    request = seen[0]
+    body = json.loads(request.content)
+    assert request.headers["anthropic-beta"] == "prompt-caching-2024-07-31"
+    assert body["system"] == [{
+        "type": "text",
+        "text": service.prompts.get(DiagramType.FLOWCHART, DiagramFormat.DRAWIO).text,
+        "cache_control": {"type": "ephemeral"},
+    }]
+    assert usage.as_dict() == {
+        "input_tokens": 1512,
+        "output_tokens": 8,
+        "cached_input_tokens": 1500,
+        "cache_write_tokens": 0,
+        "reasoning_tokens": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_reports_usage_after_the_last_chunk():
+    async def handler(request: httpx.Request) -> httpx.Response:
+        assert json.loads(request.content)["system"][0]["cache_control"] == {"type": "ephemeral"}
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=_stream_body(["graph TD"]).encode("utf-8"),
+        )
+
+    service = _make_service(handler)
+    with track_usage() as usage:
+        async for _ in service.chat_stream([{"role": "user", "content": "x"}], DiagramType.FLOWCHART):
+            pass
+
+    assert usage.calls == 1
+    assert usage.output_tokens == 8
@@ -0,0 +1,99 @@
+import pytest
+
+from app.services.ai.client_pool import ProviderClientPool, key_fingerprint
+
+
+class FakeClient:
+    def __init__(self, api_key, base_url):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def factory(api_key, base_url=None):
+    return FakeClient(api_key, base_url)
+
+
+@pytest.mark.asyncio
+async def test_same_credentials_reuse_client():
+    pool = ProviderClientPool(max_size=4)
+    async with pool.borrow("claude", "key-a", None, factory) as first:
+        pass
+    async with pool.borrow("claude", "key-a", None, factory) as second:
+        pass
+
+    assert first is second
+    assert pool.stats()["hits"] == 1
+    assert pool.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_clients_are_keyed_by_provider_key_and_base_url():
+    pool = ProviderClientPool(max_size=8)
+    async with pool.borrow("claude", "key-a", None, factory) as a:
+        pass
+    async with pool.borrow("claude", "key-b", None, factory) as b:
+        pass
+    async with pool.borrow("claude", "key-a", "https://proxy.example", factory) as c:
+        pass
+    async with pool.borrow("openai", "key-a", None, factory) as d:
+        pass
+
+    assert len({id(a), id(b), id(c), id(d)}) == 4
+    assert c.base_url == "https://proxy.example"
+
+
+@pytest.mark.asyncio
+async def test_pool_never_stores_raw_keys():
+    pool = ProviderClientPool(max_size=2)
+    async with pool.borrow("deepseek", "sk-secret", None, factory):
+        pass
+
+    (key,) = pool._entries.keys()
+    assert "sk-secret" not in key
+    assert key[1] == key_fingerprint("sk-secret")
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_closes_idle_clients():
+    pool = ProviderClientPool(max_size=2)
+    async with pool.borrow("claude", "k1", None, factory) as c1:
+        pass
+    async with pool.borrow("claude", "k2", None, factory):
+        pass
+    # Touch k1 so k2 becomes the least recently used entry
+    async with pool.borrow("claude", "k1", None, factory):
+        pass
+    async with pool.borrow("claude", "k3", None, factory):
+        pass
+
+    assert len(pool) == 2
+    assert not c1.closed
+    async with pool.borrow("claude", "k2", None, factory) as c2_again:
+        pass
+    assert pool.stats()["misses"] == 4
+    assert not c2_again.closed
+
+
+@pytest.mark.asyncio
+async def test_evicted_client_in_use_is_closed_after_release():
+    pool = ProviderClientPool(max_size=1)
+    async with pool.borrow("claude", "k1", None, factory) as busy:
+        async with pool.borrow("claude", "k2", None, factory):
+            pass
+        assert not busy.closed
+    assert busy.closed
+
+
+@pytest.mark.asyncio
+async def test_aclose_closes_everything():
+    pool = ProviderClientPool(max_size=4)
+    async with pool.borrow("claude", "k1", None, factory) as c1:
+        pass
+    await pool.aclose()
+
+    assert c1.closed
+    assert len(pool) == 0
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.code_extraction import IncrementalCodeExtractor, clean_diagram_code
+
+XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<mxfile><diagram><mxGraphModel><root>'
+    '<mxCell id="0" /><mxCell id="1" parent="0" /></root></mxGraphModel></diagram></mxfile>'
+)
+
+CASES = [
+    ("graph TD\n  A-->B\n", DiagramFormat.MERMAID),
+    ("```mermaid\ngraph TD\n  A-->B\n```\n说明文字", DiagramFormat.MERMAID),
+    ("好的，这是流程图：\n```mermaid\nsequenceDiagram\n  A->>B: hi\n```", DiagramFormat.MERMAID),
+    ("graphics first\n```\ngraph LR\n  A-->B\n```", DiagramFormat.MERMAID),
+    ("no code at all", DiagramFormat.MERMAID),
+    ("graph TD\n  A[`tick`]-->B", DiagramFormat.MERMAID),
+    (XML, DiagramFormat.DRAWIO),
+    ("以下是XML：\n" + XML + "\n", DiagramFormat.DRAWIO),
+    ("```xml\n" + XML + "\n```", DiagramFormat.DRAWIO),
+    ("说明 ```xml\n" + XML + "\n``` 结束", DiagramFormat.DRAWIO),
+    ("```xml\nnote\n" + XML + "\n```", DiagramFormat.DRAWIO),
+]
+
+
+def stream(extractor, text, sizes):
+    out = []
+    i = 0
+    while i < len(text):
+        n = next(sizes)
+        out.append(extractor.feed(text[i:i + n]))
+        i += n
+    out.append(extractor.finish())
+    return out
+
+
+@pytest.mark.parametrize("text,diagram_format", CASES)
+def test_incremental_matches_batch_for_any_chunking(text, diagram_format):
+    expected = clean_diagram_code(text, diagram_format)
+    rng = random.Random(42)
+    for _ in range(50):
+        extractor = IncrementalCodeExtractor(diagram_format)
+        pieces = stream(extractor, text, iter(lambda: rng.randint(1, 8), None))
+        assert "".join(pieces) == expected
+        assert extractor.code == expected
+
+
+def test_code_flows_before_the_stream_ends():
+    extractor = IncrementalCodeExtractor(DiagramFormat.DRAWIO)
+    assert extractor.feed("好的，") == ""
+    assert extractor.feed("```xml\n<?xml version") == "<?xml version"
+    assert extractor.started
+    assert extractor.feed('="1.0"?>\n<mxfile>') == '="1.0"?>\n<mxfile>'
+
+
+def test_closing_fence_split_across_chunks_is_not_emitted():
+    extractor = IncrementalCodeExtractor(DiagramFormat.MERMAID)
+    emitted = extractor.feed("```mermaid\ngraph TD\n  A-->B\n`")
+    emitted += extractor.feed("`")
+    emitted += extractor.feed("`\n后面的说明")
+    emitted += extractor.finish()
+    assert emitted == "graph TD\n  A-->B"
+
+
+def test_generate_diagram_cleanup_uses_shared_helper():
+    assert clean_diagram_code("```xml\n" + XML + "\n```", DiagramFormat.DRAWIO) == XML
+    assert clean_diagram_code("```mermaid\ngraph TD\n```", DiagramFormat.MERMAID) == "graph TD"
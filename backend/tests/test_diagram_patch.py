@@ -0,0 +1,148 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from app.schemas.diagram import DiagramFormat
+from app.services.ai.diagram_patch import (
+    PatchError,
+    apply_drawio_patch,
+    apply_mermaid_patch,
+    apply_patch,
+    build_patch_prompt,
+    parse_patch,
+)
+
+XML = """<?xml version="1.0" encoding="UTF-8"?>
+<mxfile><diagram id="d"><mxGraphModel><root>
+  <mxCell id="0" />
+  <mxCell id="1" parent="0" />
+  <mxCell id="2" value="开始" style="ellipse;" vertex="1" parent="1">
+    <mxGeometry x="300" y="50" width="120" height="60" as="geometry" />
+  </mxCell>
+  <object id="3" label="处理" owner="ops">
+    <mxCell style="rounded=0;" vertex="1" parent="1">
+      <mxGeometry x="300" y="150" width="120" height="60" as="geometry" />
+    </mxCell>
+  </object>
+  <mxCell id="4" edge="1" parent="1" source="2" target="3">
+    <mxGeometry relative="1" as="geometry" />
+  </mxCell>
+</root></mxGraphModel></diagram></mxfile>"""
+
+
+def cells(xml: str) -> dict:
+    root = ET.fromstring(xml).find(".//root")
+    result = {}
+    for node in root:
+        cell = node if node.tag == "mxCell" else node.find("mxCell")
+        result[node.get("id")] = (node, cell)
+    return result
+
+
+def test_parse_patch_accepts_fenced_list_and_ops_object():
+    assert parse_patch('好的：\n```json\n[{"op": "remove", "id": "4"}]\n```') == [{"op": "remove", "id": "4"}]
+    assert parse_patch('{"ops": [{"op": "delete", "line": 1}]} 完成') == [{"op": "delete", "line": 1}]
+    with pytest.raises(PatchError):
+        parse_patch("<mxfile></mxfile>")
+    with pytest.raises(PatchError):
+        parse_patch('{"op": "remove"}')
+
+
+def test_drawio_add_update_remove():
+    patched = apply_drawio_patch(XML, [
+        {"op": "add", "cell": {
+            "id": "5", "value": "结束", "style": "ellipse;", "vertex": True,
+            "geometry": {"x": 300, "y": 250, "width": 120, "height": 60},
+        }},
+        {"op": "add", "cell": {"id": "6", "edge": True, "source": "3", "target": "5"}},
+        {"op": "update", "id": "2", "value": "启动", "geometry": {"y": 40.5}},
+        {"op": "update", "id": "3", "value": "审核"},
+    ])
+
+    assert patched.startswith('<?xml version="1.0" encoding="UTF-8"?>')
+    result = cells(patched)
+    assert result["5"][1].get("vertex") == "1"
+    assert result["5"][1].find("mxGeometry").get("height") == "60"
+    assert result["6"][1].get("source") == "3"
+    assert result["6"][1].find("mxGeometry").get("relative") == "1"
+    assert result["2"][1].get("value") == "启动"
+    assert result["2"][1].find("mxGeometry").attrib == {
+        "x": "300", "y": "40.5", "width": "120", "height": "60", "as": "geometry",
+    }
+    # Wrapped cells keep their custom properties; the label lives on the wrapper
+    assert result["3"][0].get("label") == "审核"
+    assert result["3"][0].get("owner") == "ops"
+
+
+def test_drawio_remove_takes_connected_edges_along():
+    result = cells(apply_drawio_patch(XML, [{"op": "remove", "id": "3"}]))
+
+    assert set(result) == {"0", "1", "2"}
+
+
+@pytest.mark.parametrize("ops, message", [
+    ([{"op": "add", "cell": {"id": "2", "geometry": {"x": 0}}}], "already exists"),
+    ([{"op": "add", "cell": {"id": "9"}}], "needs a geometry"),
+    ([{"op": "add", "cell": {"id": "9", "edge": True, "source": "2", "target": "99"}}], "does not exist"),
+    ([{"op": "update", "id": "99", "value": "x"}], "Unknown cell"),
+    ([{"op": "update", "id": "2", "geometry": {"x": "left"}}], "must be numbers"),
+    ([{"op": "remove", "id": "1"}], "layer root"),
+    ([{"op": "rename", "id": "2"}], "Unsupported"),
+])
+def test_drawio_invalid_operations_are_rejected(ops, message):
+    with pytest.raises(PatchError, match=message):
+        apply_drawio_patch(XML, ops)
+
+
+def test_drawio_bare_graph_model_is_patched():
+    bare = XML.split("<diagram id=\"d\">")[1].split("</diagram>")[0]
+    assert bare.startswith("<mxGraphModel>")
+
+    patched = apply_drawio_patch(bare, [{"op": "update", "id": "2", "value": "启动"}])
+
+    assert ET.fromstring(patched).tag == "mxGraphModel"
+    assert cells(patched)["2"][1].get("value") == "启动"
+
+
+def test_drawio_compressed_diagram_is_rejected():
+    with pytest.raises(PatchError):
+        apply_drawio_patch('<mxfile><diagram id="d">7ZdRb5swEMc/DY+TiE2a</diagram></mxfile>', [
+            {"op": "remove", "id": "2"},
+        ])
+
+
+def test_mermaid_line_edits_use_original_numbering():
+    code = "graph TD\n    A --> B\n    B --> C\n    C --> D"
+
+    patched = apply_mermaid_patch(code, [
+        {"op": "delete", "line": 2},
+        {"op": "replace", "line": 4, "text": "    C --> E"},
+        {"op": "insert", "after": 2, "text": "    A --> X\n    X --> B"},
+        {"op": "insert", "after": 0, "text": "%% edited"},
+    ])
+
+    assert patched == "%% edited\ngraph TD\n    A --> X\n    X --> B\n    B --> C\n    C --> E"
+
+
+@pytest.mark.parametrize("ops", [
+    [{"op": "delete", "line": 9}],
+    [{"op": "replace", "line": 1, "text": "a"}, {"op": "delete", "line": 1}],
+    [{"op": "insert", "after": -1, "text": "a"}],
+    [{"op": "replace", "line": 1}],
+    [{"op": "delete", "line": 1}, {"op": "delete", "line": 2}],
+])
+def test_mermaid_invalid_edits_are_rejected(ops):
+    with pytest.raises(PatchError):
+        apply_mermaid_patch("graph TD\n    A --> B", ops)
+
+
+def test_empty_patch_is_rejected():
+    with pytest.raises(PatchError):
+        apply_patch("graph TD", DiagramFormat.MERMAID, [])
+
+
+def test_mermaid_prompt_numbers_lines():
+    prompt = build_patch_prompt("graph TD\n    A --> B", "加一个C", DiagramFormat.MERMAID)
+
+    assert "   1 | graph TD" in prompt
+    assert "   2 |     A --> B" in prompt
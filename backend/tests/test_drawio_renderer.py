@@ -0,0 +1,140 @@
+import base64
+import io
+import time
+import zlib
+from urllib.parse import quote
+from xml.etree.ElementTree import fromstring
+
+import pytest
+from PIL import Image
+
+from app.models.diagram import Diagram, DiagramFormatEnum
+from app.services.ai.drawio_converter import DrawioXMLGenerator
+from app.services.drawio_renderer import (
+    DrawioRenderError,
+    build_scene,
+    parse_style,
+    render_drawio,
+    render_svg,
+)
+from app.services.export_service import export_service
+
+SAMPLE = '''<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>
+<mxCell id="user" value="User" style="shape=umlActor;verticalLabelPosition=bottom;html=1;" vertex="1" parent="1">
+  <mxGeometry x="20" y="60" width="30" height="60" as="geometry"/></mxCell>
+<mxCell id="api" value="&lt;b&gt;API&lt;/b&gt;&lt;br&gt;gateway" style="rounded=1;whiteSpace=wrap;html=1;fillColor=#dae8fc;" vertex="1" parent="1">
+  <mxGeometry x="120" y="60" width="120" height="60" as="geometry"/></mxCell>
+<mxCell id="ok" value="a &lt; b &amp; c" style="rhombus;" vertex="1" parent="1">
+  <mxGeometry x="300" y="50" width="80" height="80" as="geometry"/></mxCell>
+<mxCell id="lane" value="Lane" style="swimlane;" vertex="1" parent="1">
+  <mxGeometry x="20" y="300" width="300" height="120" as="geometry"/></mxCell>
+<mxCell id="inner" value="DB" style="shape=cylinder3;size=10;" vertex="1" parent="lane">
+  <mxGeometry x="20" y="40" width="60" height="60" as="geometry"/></mxCell>
+<mxCell id="e1" edge="1" parent="1" source="user" target="api"><mxGeometry relative="1" as="geometry"/></mxCell>
+<mxCell id="e2" value="call" style="edgeStyle=orthogonalEdgeStyle;endArrow=none;" edge="1" parent="1" source="api" target="inner">
+  <mxGeometry relative="1" as="geometry"/></mxCell>
+<mxCell id="e3" style="edgeStyle=orthogonalEdgeStyle;exitX=0.5;exitY=1;" edge="1" parent="1" source="ok" target="inner">
+  <mxGeometry relative="1" as="geometry"><Array as="points"><mxPoint x="340" y="370"/></Array></mxGeometry></mxCell>
+</root></mxGraphModel>'''
+
+
+def compressed(model_xml: str) -> str:
+    deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+    data = deflate.compress(quote(model_xml).encode()) + deflate.flush()
+    return f'<mxfile host="app.diagrams.net"><diagram id="p1" name="Page-1">{base64.b64encode(data).decode()}</diagram></mxfile>'
+
+
+def test_parse_style():
+    assert parse_style("ellipse;whiteSpace=wrap;fillColor=#fff;") == {
+        "shape": "ellipse", "whiteSpace": "wrap", "fillColor": "#fff",
+    }
+    assert parse_style("shape=cylinder3;rounded;")["shape"] == "cylinder3"
+
+
+def test_scene_resolves_containers_labels_and_routes():
+    scene = build_scene(SAMPLE)
+    cells = {cell.id: cell for cell in scene.cells}
+
+    assert [cell.id for cell in scene.cells] == ["user", "api", "ok", "lane", "inner", "e1", "e2", "e3"]
+    assert (cells["inner"].x, cells["inner"].y) == (40, 340)  # Relative to the swimlane
+    assert cells["api"].shape == "rounded"
+    assert cells["api"].label == "API\ngateway"
+    assert cells["ok"].label == "a < b & c"
+
+    straight = cells["e1"]
+    assert straight.points == [(50, 90), (120, 90)]  # Clipped to both outlines
+    assert straight.end_arrow.closed and straight.start_arrow is None
+
+    for edge in (cells["e2"], cells["e3"]):
+        assert all(a[0] == b[0] or a[1] == b[1] for a, b in zip(edge.points, edge.points[1:]))
+    assert cells["e2"].end_arrow is None
+    assert cells["e3"].points[0] == (340, 130)  # exitX/exitY
+    assert (340, 370) in cells["e3"].points
+    assert cells["e3"].points[-1] == (100, 370)  # Enters the cylinder from the waypoint's side
+
+
+def test_compressed_mxfile_is_read():
+    assert [cell.id for cell in build_scene(compressed(SAMPLE)).cells][:2] == ["user", "api"]
+
+
+@pytest.mark.parametrize("code", ["graph TD; A-->B", "<svg/>", "<mxfile><diagram>not base64!</diagram></mxfile>"])
+def test_unreadable_code_is_rejected(code):
+    with pytest.raises(DrawioRenderError):
+        build_scene(code)
+
+
+def test_svg_is_well_formed_and_escaped():
+    svg = render_drawio(SAMPLE, "svg", "transparent")
+    root = fromstring(svg)
+
+    assert root.get("viewBox") == "10 40 380 390"
+    assert b"a &lt; b &amp; c" in svg
+    assert len(root.findall("{http://www.w3.org/2000/svg}polyline")) == 3
+    assert root.find("{http://www.w3.org/2000/svg}rect").get("rx") is not None
+
+
+def test_png_and_pdf():
+    scene = build_scene(SAMPLE)
+    png = Image.open(io.BytesIO(render_drawio(SAMPLE, "png", "white", 2)))
+    pdf = render_drawio(SAMPLE, "pdf", "white", 3)
+
+    assert png.size == (scene.width * 2, scene.height * 2)
+    assert png.getpixel((0, 0))[:3] == (255, 255, 255)
+    assert pdf.startswith(b"%PDF")
+
+
+def test_thousands_of_cells_render_quickly():
+    generator = DrawioXMLGenerator()
+    shapes = ["rectangle", "rounded", "diamond", "ellipse", "hexagon", "cylinder"]
+    nodes = [
+        {"id": i, "label": f"Node {i}", "shape": shapes[i % 6], "x": (i % 50) * 160, "y": (i // 50) * 100}
+        for i in range(1000)
+    ]
+    xml = generator.create_flowchart(nodes, [{"from": i, "to": i + 1} for i in range(999)])
+
+    started = time.perf_counter()
+    svg = render_svg(build_scene(xml))
+
+    assert time.perf_counter() - started < 1.0
+    assert svg.count(b"<polyline") == 999
+
+
+def test_drawio_diagrams_export_without_a_browser(client, db_session, sample_diagram_data, monkeypatch):
+    async def no_mermaid(*args):
+        raise AssertionError("Draw.io exports must not go through mermaid-cli")
+
+    monkeypatch.setattr(export_service, "_render_mermaid", no_mermaid)
+    sample_diagram_data.update(code=SAMPLE, format=DiagramFormatEnum.DRAWIO)
+    db_session.add(Diagram(id="drawio", **sample_diagram_data))
+    sample_diagram_data.update(code="<mxGraphModel>", format=DiagramFormatEnum.DRAWIO)
+    db_session.add(Diagram(id="broken", **sample_diagram_data))
+    db_session.commit()
+
+    svg = client.get("/api/diagrams/drawio/export", params={"format": "svg"})
+    png = client.get("/api/diagrams/drawio/export", params={"format": "png"})
+    broken = client.get("/api/diagrams/broken/export")
+
+    assert svg.status_code == 200 and svg.content.startswith(b"<svg")
+    assert png.headers["content-type"] == "image/png"
+    assert broken.status_code == 400
+    assert "Invalid Draw.io diagram" in broken.json()["detail"]
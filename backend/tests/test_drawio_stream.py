@@ -0,0 +1,99 @@
+import time
+
+from app.services.ai.drawio_stream import DrawioCellParser, DrawioStreamTracker
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<mxfile><diagram><mxGraphModel><root>'
+FOOTER = "</root></mxGraphModel></diagram></mxfile>"
+
+
+def vertex(cell_id, label="节点", x=10, y=20):
+    return (
+        f'<mxCell id="{cell_id}" value="{label}" style="rounded=1;" vertex="1" parent="1">'
+        f'<mxGeometry x="{x}" y="{y}" width="120" height="60" as="geometry" /></mxCell>'
+    )
+
+
+def edge(cell_id, source, target):
+    return (
+        f'<mxCell id="{cell_id}" style="edgeStyle=orthogonalEdgeStyle;" edge="1" parent="1" '
+        f'source="{source}" target="{target}"><mxGeometry relative="1" as="geometry" /></mxCell>'
+    )
+
+
+def test_cell_is_reported_when_its_closing_tag_arrives():
+    parser = DrawioCellParser()
+    cell = vertex("2", "开始")
+
+    assert parser.feed(HEADER + '<mxCell id="0" /><mxCell id="1" parent="0" />') != []
+    assert parser.feed(cell[:-len("</mxCell>")]) == []
+    (reported,) = parser.feed("</mxCell>")
+
+    assert reported == {
+        "id": "2",
+        "parent": "1",
+        "value": "开始",
+        "style": "rounded=1;",
+        "vertex": True,
+        "edge": False,
+        "geometry": {"x": 10, "y": 20, "width": 120, "height": 60},
+    }
+
+
+def test_edges_carry_source_and_target():
+    parser = DrawioCellParser()
+    (cell,) = parser.feed(HEADER + edge("4", "2", "3"))
+
+    assert cell["edge"] is True
+    assert (cell["source"], cell["target"]) == ("2", "3")
+    assert cell["geometry"] == {"relative": True}
+
+
+def test_wrapped_cells_take_id_and_label_from_object():
+    parser = DrawioCellParser()
+    (cell,) = parser.feed(
+        HEADER + '<object label="服务" id="svc"><mxCell vertex="1" parent="1" style="" /></object>'
+    )
+
+    assert cell["id"] == "svc"
+    assert cell["value"] == "服务"
+
+
+def test_tiny_chunks_and_finished_cells_are_released():
+    parser = DrawioCellParser()
+    document = HEADER + "".join(vertex(str(i)) for i in range(2, 2000)) + FOOTER
+
+    started = time.perf_counter()
+    count = 0
+    max_root_children = 0
+    for i in range(0, len(document), 7):
+        count += len(parser.feed(document[i:i + 7]))
+        root = next((e for e in parser._stack if e.tag == "root"), None)
+        if root is not None:
+            max_root_children = max(max_root_children, len(root))
+    count += len(parser.close())
+    elapsed = time.perf_counter() - started
+
+    assert count == 1998
+    assert elapsed < 2.0
+    # Finished cells are detached, so the open <root> element does not grow
+    assert max_root_children <= 1
+
+
+def test_malformed_xml_stops_cell_extraction_quietly():
+    parser = DrawioCellParser()
+    parser.feed(HEADER + vertex("2"))
+    assert parser.feed("<mxCell id=3 broken>") == []
+    assert parser.failed
+    assert parser.feed(vertex("4")) == []
+
+
+def test_tracker_finds_xml_inside_chat_prose():
+    tracker = DrawioStreamTracker()
+    text = "好的，我添加了一个节点：\n```xml\n" + HEADER + vertex("2") + vertex("3") + FOOTER + "\n```\n完成。"
+
+    cells = []
+    for i in range(0, len(text), 11):
+        cells += tracker.feed(text[i:i + 11])
+    cells += tracker.finish()
+
+    assert [c["id"] for c in cells] == ["2", "3"]
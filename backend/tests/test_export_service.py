@@ -0,0 +1,112 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.services.export_service import export_service
+
+# Stands in for mermaid-cli: same arguments, and the diagram text picks the behaviour
+FAKE_MMDC = '''#!{python}
+import sys, time
+
+args = sys.argv[1:]
+source = open(args[args.index("-i") + 1]).read()
+if "fail" in source:
+    sys.stderr.write("Parse error on line 1")
+    sys.exit(1)
+if "slow" in source:
+    time.sleep(float(source.split()[-1]))
+with open(args[args.index("-o") + 1], "w") as output:
+    output.write(("%PDF " + source) if "--pdfFit" in args else ("<svg>" + source + "</svg>"))
+'''
+
+
+@pytest.fixture
+def fake_mmdc(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    mmdc = bin_dir / "mmdc"
+    mmdc.write_text(FAKE_MMDC.format(python=sys.executable))
+    mmdc.chmod(0o755)
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(tempfile, "tempdir", str(scratch))
+    monkeypatch.setattr(settings, "RENDER_POOL_ENABLED", False)
+    return scratch
+
+
+@pytest.mark.asyncio
+async def test_mmdc_export_cleans_up_its_files(fake_mmdc):
+    assert await export_service.export_svg("graph TD") == b"<svg>graph TD</svg>"
+
+    with pytest.raises(HTTPException) as failed:
+        await export_service.export_svg("fail")
+
+    assert failed.value.status_code == 500
+    assert "Parse error on line 1" in failed.value.detail
+    assert list(fake_mmdc.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_mmdc_timeout_kills_the_render(fake_mmdc, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_RENDER_TIMEOUT_SECONDS", 0.2)
+
+    with pytest.raises(HTTPException) as timed_out:
+        await export_service.export_png("slow 5")
+
+    assert timed_out.value.detail == "Export timeout"
+    assert list(fake_mmdc.iterdir()) == []
+
+
+@pytest.mark.asyncio
+async def test_render_does_not_block_the_event_loop(fake_mmdc):
+    gaps = []
+
+    async def ticker():
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticking = asyncio.create_task(ticker())
+    try:
+        await export_service.export_svg("slow 0.5")
+    finally:
+        ticking.cancel()
+
+    assert len(gaps) > 10
+    assert max(gaps) < 0.2
+
+
+@pytest.mark.asyncio
+async def test_exports_beyond_the_render_cap_get_503(fake_mmdc, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_MAX_CONCURRENT_RENDERS", 1)
+    monkeypatch.setattr(settings, "EXPORT_QUEUE_TIMEOUT_SECONDS", 0.1)
+    monkeypatch.setattr(export_service, "_loop", None)  # Pick up the new cap
+
+    slow = asyncio.create_task(export_service.export_svg("slow 0.5"))
+    await asyncio.sleep(0.05)
+    with pytest.raises(HTTPException) as queued:
+        await export_service.export_svg("graph TD")
+
+    assert queued.value.status_code == 503
+    assert queued.value.headers["Retry-After"] == "5"
+    assert await slow == b"<svg>slow 0.5</svg>"
+
+
+@pytest.mark.asyncio
+async def test_pdf_is_printed_as_vector_by_the_renderer(fake_mmdc, monkeypatch):
+    assert await export_service.export_pdf("graph TD") == b"%PDF graph TD"
+
+    # The raster mode still goes through a PNG, so the key must not collide
+    vector_key = export_service.cache_key("graph TD", "pdf")
+    monkeypatch.setattr(settings, "EXPORT_PDF_MODE", "raster")
+    assert export_service.cache_key("graph TD", "pdf") != vector_key
@@ -0,0 +1,91 @@
+import time
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from app.core.config import settings
+from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.fake_service import FakeLLMService, FakeProviderError
+from app.services.ai.usage import track_usage
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_ENABLED", True)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_LATENCY_MS", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TTFT_MS", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TOKENS_PER_SECOND", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_REASONING_CHUNKS", 0)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_ERROR_RATE", 0.0)
+    return FakeLLMService()
+
+
+@pytest.mark.asyncio
+async def test_generation_is_deterministic_and_well_formed(fake):
+    first = await fake.generate_diagram("登录，校验密码，进入首页", DiagramType.FLOWCHART, DiagramFormat.DRAWIO)
+    second = await fake.generate_diagram("登录，校验密码，进入首页", DiagramType.FLOWCHART, DiagramFormat.DRAWIO)
+    mermaid = await fake.generate_diagram("a, b, c, d", DiagramType.SEQUENCE, DiagramFormat.MERMAID)
+
+    assert first == second
+    labels = [c.get("value") for c in ET.fromstring(first.split("\n", 1)[1]).iter("mxCell") if c.get("vertex")]
+    assert labels == ["登录", "校验密码", "进入首页"]
+    assert mermaid.startswith("sequenceDiagram")
+
+
+@pytest.mark.asyncio
+async def test_timing_follows_ttft_and_token_rate(fake, monkeypatch):
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TTFT_MS", 100)
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_TOKENS_PER_SECOND", 2000)
+
+    started = time.perf_counter()
+    stream = fake.chat_stream([{"role": "user", "content": "a, b"}], DiagramType.FLOWCHART, DiagramFormat.MERMAID)
+    first = await stream.__anext__()
+    ttft = time.perf_counter() - started
+    with track_usage() as usage:
+        rest = [chunk async for chunk in stream]
+    total = time.perf_counter() - started
+
+    assert 0.1 <= ttft < 0.3
+    assert "".join([first, *rest]).startswith("好的")
+    assert total >= 0.1 + len(rest) / 2000
+    assert usage.output_tokens == len(rest) + 1
+
+
+@pytest.mark.asyncio
+async def test_reasoning_chunks_use_deepseek_shape(fake, monkeypatch):
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_REASONING_CHUNKS", 2)
+
+    chunks = [c async for c in fake.generate_stream("x", DiagramType.FLOWCHART, DiagramFormat.MERMAID)]
+
+    assert [c["type"] for c in chunks[:3]] == ["reasoning", "reasoning", "content"]
+    assert all(c["type"] == "content" for c in chunks[2:])
+
+
+@pytest.mark.asyncio
+async def test_error_injection_is_stable_per_input(fake, monkeypatch):
+    monkeypatch.setattr(settings, "FAKE_PROVIDER_ERROR_RATE", 0.5)
+    outcomes = {}
+    for i in range(40):
+        try:
+            await fake.explain_diagram(f"graph TD\n A{i} --> B", DiagramFormat.MERMAID)
+            outcomes[i] = True
+        except FakeProviderError:
+            outcomes[i] = False
+
+    assert 5 < sum(outcomes.values()) < 35
+    for i, ok in outcomes.items():
+        try:
+            await fake.explain_diagram(f"graph TD\n A{i} --> B", DiagramFormat.MERMAID)
+            assert ok
+        except FakeProviderError:
+            assert not ok
+
+
+@pytest.mark.asyncio
+async def test_refine_patch_output_applies(fake):
+    from app.services.ai.diagram_patch import apply_patch, parse_patch
+
+    code = await fake.generate_diagram("a, b, c", DiagramType.FLOWCHART, DiagramFormat.DRAWIO)
+    patch = await fake.refine_patch(code, "加一个审核节点", DiagramFormat.DRAWIO)
+
+    assert "加一个审核节点" in apply_patch(code, DiagramFormat.DRAWIO, parse_patch(patch))
@@ -0,0 +1,192 @@
+import asyncio
+import json
+
+import pytest
+
+from app.core.config import settings
+from app.services.jobs import DONE, ERROR, QUEUED, JobQueue, JobRetry, JobWorker, job_queue
+
+
+def generate_payload(**overrides):
+    payload = {
+        "description": "A slow reasoning flow",
+        "diagramType": "flowchart",
+        "format": "mermaid",
+        "aiProvider": "deepseek",
+    }
+    payload.update(overrides)
+    return payload
+
+
+async def run_next_job(queue=job_queue):
+    job_id = await queue.claim(0.1)
+    assert job_id is not None
+    await queue.run(job_id, "test-worker")
+    return job_id
+
+
+@pytest.fixture
+def queue(fake_redis):
+    return JobQueue(fake_redis, prefix="testjobs")
+
+
+def test_submitted_job_runs_after_the_request_returns(client, ai_services):
+    submitted = client.post(
+        "/api/ai/jobs/generate", json=generate_payload(), headers={"X-DeepSeek-Key": "sk-user"}
+    )
+
+    assert submitted.status_code == 202
+    job = submitted.json()
+    assert job["status"] == QUEUED
+    assert submitted.headers["Location"] == f"/api/ai/jobs/{job['id']}"
+    assert "sk-user" not in submitted.text
+    ai_services["deepseek"].generate_diagram.assert_not_called()
+
+    asyncio.run(run_next_job())
+
+    finished = client.get(f"/api/ai/jobs/{job['id']}").json()
+    assert finished["status"] == DONE
+    assert finished["attempts"] == 1
+    assert finished["result"]["code"] == "graph TD\n    A --> B"
+    assert finished["result"]["cache"] == "MISS"
+    ai_services["deepseek"].create_client.assert_called_once_with("sk-user", None)
+
+    body = client.get(f"/api/ai/jobs/{job['id']}/events").text
+    events = [json.loads(line[6:]) for line in body.split("\n\n") if line.startswith("data: ")]
+    assert [event["job"]["status"] for event in events] == [DONE]
+
+
+def test_unknown_job_is_404(client):
+    assert client.get("/api/ai/jobs/nope").status_code == 404
+    assert client.get("/api/ai/jobs/nope/events").status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_failed_handler_marks_job_and_drops_credentials(queue, fake_redis):
+    async def failing(payload, context):
+        assert context.headers == {"X-DeepSeek-Key": "sk-user"}
+        raise RuntimeError("upstream timed out")
+
+    queue.register("generate", failing)
+    job = await queue.submit("generate", {}, {"X-DeepSeek-Key": "sk-user"})
+    await run_next_job(queue)
+
+    stored = await queue.get(job["id"])
+    assert stored["status"] == ERROR
+    assert stored["error"] == "upstream timed out"
+    assert stored["finished_at"] is not None
+    assert not await fake_redis.exists(f"testjobs:headers:{job['id']}")
+    assert await queue.stats() == {"queued": 0, "scheduled": 0, "running": 0}
+
+
+@pytest.mark.asyncio
+async def test_retry_requeues_until_attempts_run_out(queue, monkeypatch):
+    monkeypatch.setattr(settings, "AI_JOBS_MAX_ATTEMPTS", 2)
+
+    async def limited(payload, context):
+        raise JobRetry("rate limited", delay=0)
+
+    queue.register("generate", limited)
+    job = await queue.submit("generate", {})
+
+    await run_next_job(queue)
+    assert (await queue.get(job["id"]))["status"] == QUEUED
+    await run_next_job(queue)
+
+    stored = await queue.get(job["id"])
+    assert stored["status"] == ERROR and stored["attempts"] == 2
+    assert await queue.claim(0.01) is None
+
+
+@pytest.mark.asyncio
+async def test_delayed_retry_waits_in_the_schedule_not_the_worker(queue, monkeypatch):
+    async def limited(payload, context):
+        if context.job["attempts"] == 1:
+            raise JobRetry("rate limited", delay=0.2)
+        return {"code": "graph TD"}
+
+    queue.register("generate", limited)
+    job = await queue.submit("generate", {})
+
+    # The worker is free again at once
+    await asyncio.wait_for(run_next_job(queue), 0.1)
+    assert await queue.stats() == {"queued": 0, "scheduled": 1, "running": 0}
+    assert await queue.promote_due() == 0
+    assert await queue.claim(0.01) is None
+
+    await asyncio.sleep(0.2)
+    assert await queue.promote_due() == 1
+    await run_next_job(queue)
+    assert (await queue.get(job["id"]))["status"] == DONE
+
+
+@pytest.mark.asyncio
+async def test_watch_follows_progress_to_the_result(queue):
+    async def generate(payload, context):
+        await context.progress(stage="generating")
+        return {"code": "graph TD"}
+
+    queue.register("generate", generate)
+    job = await queue.submit("generate", {})
+    seen = []
+
+    async def follow():
+        async for update in queue.watch(job["id"], keepalive=0.01):
+            if update is not None:
+                seen.append((update["status"], (update["progress"] or {}).get("stage")))
+
+    watcher = asyncio.create_task(follow())
+    await asyncio.sleep(0.05)
+    await run_next_job(queue)
+    await asyncio.wait_for(watcher, 2)
+
+    assert seen == [("queued", None), ("running", None), ("running", "generating"), ("done", "generating")]
+
+
+@pytest.mark.asyncio
+async def test_job_of_a_lost_worker_is_requeued(queue, monkeypatch):
+    monkeypatch.setattr(settings, "AI_JOBS_MAX_ATTEMPTS", 1)
+    queue.register("generate", lambda payload, context: None)
+    job = await queue.submit("generate", {})
+    lost = await queue.submit("generate", {})
+    for job_id in (await queue.claim(0.1), await queue.claim(0.1)):
+        if job_id == lost["id"]:
+            # The worker crashed after starting it once
+            await queue.save({**await queue.get(job_id), "status": "running", "attempts": 1})
+
+    suspects = await queue.requeue_stalled(set())
+    assert suspects == {job["id"], lost["id"]}
+    assert await queue.requeue_stalled(suspects) == set()
+
+    assert (await queue.get(job["id"]))["status"] == QUEUED
+    assert await queue.claim(0.1) == job["id"]
+    assert (await queue.get(lost["id"]))["status"] == ERROR
+
+
+@pytest.mark.asyncio
+async def test_worker_stops_after_running_jobs_finish(queue, fake_redis, monkeypatch):
+    async def claim(timeout):
+        # fakeredis serves BLMOVE by blocking the event loop; poll instead
+        job_id = await fake_redis.lmove(queue.queue_key, queue.processing_key, "RIGHT", "LEFT")
+        if job_id is None:
+            await asyncio.sleep(timeout)
+        return job_id
+
+    monkeypatch.setattr(queue, "claim", claim)
+    finished = asyncio.Event()
+
+    async def generate(payload, context):
+        await asyncio.sleep(0.05)
+        finished.set()
+        return {}
+
+    queue.register("generate", generate)
+    job = await queue.submit("generate", {})
+    worker = JobWorker(queue, concurrency=2)
+    task = asyncio.create_task(worker.run(poll_seconds=0.05))
+
+    await asyncio.wait_for(finished.wait(), 2)
+    worker.stop()
+    await asyncio.wait_for(task, 2)
+
+    assert (await queue.get(job["id"]))["status"] == DONE
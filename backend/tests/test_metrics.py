@@ -0,0 +1,101 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from sqlalchemy import create_engine, text
+
+from app.core.metrics import _current_route, error_type, instrument_engine, observe_ai_call
+from app.services.ai.usage import UsageCounter
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_requests_are_labelled_by_route_template(client, sample_diagram_data):
+    route = "/api/diagrams/{diagram_id}"
+    before = sample("http_requests_total", method="GET", route=route, status="4xx")
+
+    client.get("/api/diagrams/does-not-exist")
+    client.get("/api/diagrams/another-missing-id")
+    client.get("/no/such/path")
+
+    assert sample("http_requests_total", method="GET", route=route, status="4xx") == before + 2
+    assert sample("http_requests_total", method="GET", route="unmatched", status="4xx") >= 1
+    assert sample("http_requests_in_flight", method="GET", route=route) == 0
+
+
+def test_db_statements_are_timed_per_route():
+    engine = create_engine("sqlite://")
+    instrument_engine(engine)
+    before = sample("db_query_seconds_count", route="/api/test-db", statement="select")
+
+    token = _current_route.set("/api/test-db")
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("select 2"))
+    finally:
+        _current_route.reset(token)
+
+    assert sample("db_query_seconds_count", route="/api/test-db", statement="select") == before + 2
+
+
+def test_upstream_calls_record_latency_tokens_and_ttft(client, ai_services):
+    before = sample("ai_upstream_request_seconds_count",
+                    provider="claude", model="claude-test-model", operation="chat_stream", outcome="ok")
+    stream_before = sample("sse_stream_duration_seconds_count", route="chat_stream", outcome="done")
+    ttft_before = sample("ai_time_to_first_token_seconds_count",
+                         provider="claude", model="claude-test-model", operation="chat_stream")
+
+    response = client.post("/api/ai/chat/stream", json={
+        "messages": [{"role": "user", "content": "hi"}], "diagramType": "flowchart",
+        "format": "mermaid", "aiProvider": "claude",
+    })
+
+    assert response.status_code == 200
+    assert sample("ai_upstream_request_seconds_count",
+                  provider="claude", model="claude-test-model", operation="chat_stream", outcome="ok") == before + 1
+    assert sample("ai_time_to_first_token_seconds_count",
+                  provider="claude", model="claude-test-model", operation="chat_stream") == ttft_before + 1
+    assert sample("sse_stream_duration_seconds_count", route="chat_stream", outcome="done") == stream_before + 1
+
+
+def test_failed_upstream_call_counts_error_type(client, ai_services):
+    class APITimeoutError(Exception):
+        pass
+
+    ai_services["openai"].explain_diagram.side_effect = APITimeoutError("slow")
+    before = sample("ai_errors_total", provider="openai", operation="explain", error_type="timeout")
+
+    response = client.post("/api/ai/explain", json={"code": "graph TD\n A-->B", "format": "mermaid", "aiProvider": "openai"})
+
+    assert response.status_code == 500
+    assert sample("ai_errors_total", provider="openai", operation="explain", error_type="timeout") == before + 1
+
+
+def test_token_counters_only_count_the_calls_own_usage():
+    usage = UsageCounter(input_tokens=100, output_tokens=10, calls=1)
+    before = sample("ai_tokens_total", provider="fake", model="m", kind="output")
+
+    with observe_ai_call("fake", "m", "refine", usage):
+        usage.output_tokens += 25
+
+    assert sample("ai_tokens_total", provider="fake", model="m", kind="output") == before + 25
+    assert sample("ai_tokens_total", provider="fake", model="m", kind="input") == 0
+
+
+def test_error_types_are_bounded():
+    class AuthenticationError(Exception):
+        pass
+
+    assert error_type(AuthenticationError()) == "auth"
+    assert error_type(TimeoutError()) == "timeout"
+    assert error_type(KeyError("x")) == "other"
+
+
+def test_metrics_endpoint_exposes_prometheus_text(client):
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "ai_upstream_request_seconds" in response.text
@@ -0,0 +1,40 @@
+import pytest
+
+from app.schemas.diagram import DiagramType, DiagramFormat
+from app.services.ai.claude_service import ClaudeService
+from app.services.ai.deepseek_service import DeepSeekService
+from app.services.ai.openai_service import OpenAIService
+from app.services.ai.prompts import PromptTable
+
+
+@pytest.mark.parametrize("service_class", [ClaudeService, OpenAIService, DeepSeekService])
+def test_table_matches_builders_for_every_type_and_format(service_class):
+    service = service_class()
+
+    assert len(service.prompts) == len(DiagramType) * len(DiagramFormat)
+    for diagram_type in DiagramType:
+        for diagram_format in DiagramFormat:
+            expected = service._build_system_prompt(diagram_type, diagram_format)
+            assert service._get_system_prompt(diagram_type, diagram_format) == expected
+
+
+def test_hashes_are_stable_and_track_content():
+    build = lambda t, f: f"{t.value}/{f.value}"
+    first, second = PromptTable(build), PromptTable(build)
+    edited = PromptTable(lambda t, f: "changed" if t == DiagramType.ER else build(t, f))
+
+    flowchart = (DiagramType.FLOWCHART, DiagramFormat.DRAWIO)
+    er = (DiagramType.ER, DiagramFormat.DRAWIO)
+    assert first.get(*flowchart).hash == second.get(*flowchart).hash
+    assert first.hash == second.hash
+    assert edited.get(*flowchart).hash == first.get(*flowchart).hash
+    assert edited.get(*er).hash != first.get(*er).hash
+    assert edited.hash != first.hash
+
+
+def test_table_is_read_only():
+    table = PromptTable(lambda t, f: "prompt")
+    with pytest.raises(TypeError):
+        table._prompts[(DiagramType.ER, DiagramFormat.MERMAID)] = None
+    with pytest.raises(AttributeError):
+        table.get(DiagramType.ER, DiagramFormat.MERMAID).text = "other"
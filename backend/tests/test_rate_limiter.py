@@ -0,0 +1,192 @@
+import asyncio
+
+import fakeredis
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app.core.config import settings
+from app.core.metrics import AI_RATE_LIMIT_QUEUE_DEPTH
+from app.services.rate_limiter import ProviderRateLimiter, RateLimitExceeded
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    def apply(concurrency=0, per_minute=0, burst=10, max_queue=10, timeout=2.0):
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_ENABLED", True)
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_MAX_CONCURRENCY", {"claude": concurrency})
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_REQUESTS_PER_MINUTE", {"claude": per_minute})
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_BURST", burst)
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_MAX_QUEUE", max_queue)
+        monkeypatch.setattr(settings, "AI_RATE_LIMIT_QUEUE_TIMEOUT_SECONDS", timeout)
+    return apply
+
+
+def make_limiter(server=None):
+    server = server or fakeredis.FakeServer()
+    return ProviderRateLimiter(fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped_and_waiters_proceed_on_release(limits):
+    limits(concurrency=2)
+    limiter = make_limiter()
+    active = peak = 0
+
+    async def call():
+        nonlocal active, peak
+        async with limiter.limit("claude", "sk-a"):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.05)
+            active -= 1
+
+    await asyncio.gather(*(call() for _ in range(6)))
+
+    assert peak == 2
+    stats = (await limiter.stats())["claude"]
+    assert stats["acquired"] == 6
+    assert stats["waiting"] == 0
+
+
+@pytest.mark.asyncio
+async def test_limits_are_shared_across_workers_but_not_keys(limits):
+    limits(concurrency=1, timeout=0.2)
+    server = fakeredis.FakeServer()
+    worker_a, worker_b = make_limiter(server), make_limiter(server)
+
+    held = await worker_a.acquire("claude", "sk-a")
+    with pytest.raises(RateLimitExceeded):
+        await worker_b.acquire("claude", "sk-a")
+    other_key = await worker_b.acquire("claude", "sk-b")
+
+    await held.release()
+    await other_key.release()
+    again = await worker_b.acquire("claude", "sk-a")
+    await again.release()
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_rejects_with_retry_after(limits):
+    limits(per_minute=60, burst=2, timeout=0.1)
+    limiter = make_limiter()
+
+    for _ in range(2):
+        await (await limiter.acquire("claude", "sk-a")).release()
+    with pytest.raises(RateLimitExceeded) as excinfo:
+        await limiter.acquire("claude", "sk-a")
+
+    # One request per second refills; the hint is rounded up to whole seconds
+    assert excinfo.value.retry_after == 1
+    assert (await limiter.stats())["claude"]["rejected_timeout"] == 1
+
+
+@pytest.mark.asyncio
+async def test_full_queue_is_rejected_immediately(limits):
+    limits(concurrency=1, max_queue=1, timeout=1.0)
+    limiter = make_limiter()
+    held = await limiter.acquire("claude", "sk-a")
+
+    waiter = asyncio.create_task(limiter.acquire("claude", "sk-a"))
+    await asyncio.sleep(0.05)
+    assert (await limiter.stats())["claude"]["queue_depth"] == 1
+    with pytest.raises(RateLimitExceeded, match="queue is full"):
+        await limiter.acquire("claude", "sk-a")
+
+    await held.release()
+    await (await waiter).release()
+    stats = (await limiter.stats())["claude"]
+    assert stats["rejected_queue_full"] == 1
+    assert stats["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_admitted_in_arrival_order(limits):
+    limits(concurrency=1, timeout=2.0)
+    server = fakeredis.FakeServer()
+    workers = [make_limiter(server) for _ in range(3)]
+    held = await workers[0].acquire("claude", "sk-a")
+    depth = AI_RATE_LIMIT_QUEUE_DEPTH.labels("claude")
+    before = depth._value.get()
+    order = []
+
+    async def call(n):
+        async with workers[n % 3].limit("claude", "sk-a"):
+            order.append(n)
+            await asyncio.sleep(0.02)
+
+    waiters = []
+    for n in range(5):
+        waiters.append(asyncio.create_task(call(n)))
+        await asyncio.sleep(0.02)
+    assert depth._value.get() - before == 5
+
+    await held.release()
+    await asyncio.gather(*waiters)
+
+    assert order == [0, 1, 2, 3, 4]
+    assert depth._value.get() == before
+
+
+@pytest.mark.asyncio
+async def test_newcomers_do_not_take_tokens_from_waiters(limits):
+    limits(per_minute=600, burst=1, timeout=1.0)
+    limiter = make_limiter()
+    await (await limiter.acquire("claude", "sk-a")).release()
+    order = []
+
+    async def call(name):
+        await (await limiter.acquire("claude", "sk-a")).release()
+        order.append(name)
+
+    waiter = asyncio.create_task(call("waiter"))
+    await asyncio.sleep(0.05)
+    # Arrives just before the refill; the token that refills belongs to the waiter
+    await call("newcomer")
+    await waiter
+
+    assert order == ["waiter", "newcomer"]
+
+
+@pytest.mark.asyncio
+async def test_release_is_idempotent(limits):
+    limits(concurrency=1, timeout=0.1)
+    limiter = make_limiter()
+    lease = await limiter.acquire("claude", "sk-a")
+    await lease.release()
+    other = await limiter.acquire("claude", "sk-a")
+    # A second release of the first lease must not free the new holder's slot
+    await lease.release()
+    with pytest.raises(RateLimitExceeded):
+        await limiter.acquire("claude", "sk-a")
+    await other.release()
+
+
+@pytest.mark.asyncio
+async def test_unlimited_provider_and_disabled_limiter_skip_redis(limits, monkeypatch):
+    limits(concurrency=1)
+    limiter = make_limiter()
+    leases = [await limiter.acquire("openai", "sk-a") for _ in range(3)]
+    assert await limiter.stats() == {}
+
+    monkeypatch.setattr(settings, "AI_RATE_LIMIT_ENABLED", False)
+    leases += [await limiter.acquire("claude", "sk-a") for _ in range(3)]
+    for lease in leases:
+        await lease.release()
+
+
+@pytest.mark.asyncio
+async def test_redis_outage_fails_open(limits):
+    limits(concurrency=1)
+
+    class BrokenRedis:
+        async def eval(self, *args):
+            raise RedisConnectionError("down")
+
+        async def zrem(self, *args):
+            raise RedisConnectionError("down")
+
+    limiter = ProviderRateLimiter(BrokenRedis())
+    first = await limiter.acquire("claude", "sk-a")
+    second = await limiter.acquire("claude", "sk-a")
+    await first.release()
+    await second.release()
@@ -0,0 +1,144 @@
+import os
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import HTTPException
+
+from app.models.diagram import Diagram
+from app.services.export_service import export_service
+from app.services.render_cache import RenderCache, etag_matches
+
+
+@pytest.fixture
+def export_renders(monkeypatch):
+    render = AsyncMock(side_effect=lambda code, fmt, diagram_format: f"{fmt}:{code}".encode())
+    monkeypatch.setattr(export_service, "export", render)
+    return render
+
+
+@pytest.fixture
+def diagram(db_session, sample_diagram_data):
+    diagram = Diagram(id="test-export", **sample_diagram_data)
+    db_session.add(diagram)
+    db_session.commit()
+    return diagram
+
+
+def test_key_covers_everything_that_changes_the_output():
+    cache = RenderCache(None, max_bytes=0, version="v1")
+    base = cache.key("graph TD", "png", 2, "white")
+
+    assert cache.key("graph TD", "png", 2, "white") == base
+    assert len({
+        base,
+        cache.key("graph LR", "png", 2, "white"),
+        cache.key("graph TD", "svg", 2, "white"),
+        cache.key("graph TD", "png", 3, "white"),
+        cache.key("graph TD", "png", 2, "transparent"),
+        RenderCache(None, max_bytes=0, version="v2").key("graph TD", "png", 2, "white"),
+    }) == 6
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"old", "abc"', True),
+    ("*", True),
+    ('"abcd"', False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, '"abc"') is expected
+
+
+@pytest.mark.asyncio
+async def test_disk_tier_evicts_least_recently_used(tmp_path):
+    cache = RenderCache(tmp_path, max_bytes=10)
+    await cache.set("aa1", b"1111")
+    await cache.set("bb2", b"2222")
+    assert await cache.get("aa1") == b"1111"
+    await cache.set("cc3", b"3333")
+
+    assert await cache.get("bb2") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+    # Oversized artifacts are not stored at all
+    await cache.set("dd4", b"x" * 11)
+    assert await cache.get("dd4") is None
+
+    # A new process picks the entries and their order up from disk
+    os.utime(tmp_path / "aa" / "aa1", (1, 1))
+    reopened = RenderCache(tmp_path, max_bytes=10)
+    assert await reopened.get("cc3") == b"3333"
+    await reopened.set("ee5", b"5555")
+    assert await reopened.get("aa1") is None
+
+
+@pytest.mark.asyncio
+async def test_redis_tier_is_shared_between_processes(tmp_path, fake_redis):
+    first = RenderCache(tmp_path / "one", max_bytes=1024, redis_client=fake_redis, redis_ttl_seconds=60, redis_max_bytes=8)
+    second = RenderCache(tmp_path / "two", max_bytes=1024, redis_client=fake_redis, redis_ttl_seconds=60, redis_max_bytes=8)
+    await first.set("aa1", b"\x89PNG\x00")
+    await first.set("bb2", b"too large for redis")
+
+    assert await second.get("aa1") == b"\x89PNG\x00"
+    assert await second.get("bb2") is None
+    assert await second.get("aa1") == b"\x89PNG\x00"
+    assert second.stats()["redis_hits"] == 1
+    assert second.stats()["disk_hits"] == 1
+
+
+def test_repeat_export_is_served_from_cache(client, diagram, export_renders):
+    first = client.get("/api/diagrams/test-export/export", params={"format": "png"})
+    second = client.get("/api/diagrams/test-export/export", params={"format": "png"})
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers["x-cache"] == "MISS"
+    assert second.headers["x-cache"] == "HIT"
+    assert second.content == first.content == f"png:{diagram.code}".encode()
+    assert second.headers["content-type"] == "image/png"
+    assert second.headers["etag"] == first.headers["etag"]
+    assert export_renders.await_count == 1
+
+
+def test_if_none_match_returns_304_without_rendering(client, diagram, export_renders):
+    etag = client.get("/api/diagrams/test-export/export").headers["etag"]
+
+    response = client.get("/api/diagrams/test-export/export", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert export_renders.await_count == 1
+
+
+def test_editing_the_diagram_changes_the_etag(client, diagram, export_renders):
+    etag = client.get("/api/diagrams/test-export/export").headers["etag"]
+    client.put("/api/diagrams/test-export", json={"code": "graph LR\n    A --> C"})
+
+    response = client.get("/api/diagrams/test-export/export", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.content == b"svg:graph LR\n    A --> C"
+    assert export_renders.await_count == 2
+
+
+def test_download_name_survives_non_ascii_titles(client, diagram, export_renders):
+    client.put("/api/diagrams/test-export", json={"title": '用户登录 "v2"/draft'})
+
+    response = client.get("/api/diagrams/test-export/export", params={"format": "pdf"})
+
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == (
+        'attachment; filename="____ _v2_draft.pdf"; '
+        "filename*=UTF-8''%E7%94%A8%E6%88%B7%E7%99%BB%E5%BD%95%20_v2_draft.pdf"
+    )
+
+
+def test_export_errors_keep_their_status(client, diagram, monkeypatch):
+    monkeypatch.setattr(export_service, "export", AsyncMock(side_effect=HTTPException(503, "busy")))
+
+    assert client.get("/api/diagrams/test-export/export").status_code == 503
+    assert client.get("/api/diagrams/test-export/export", params={"format": "gif"}).status_code == 400
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from app.services.export_service import export_service
+from app.services.renderer_pool import (
+    RenderError,
+    RenderQueueFull,
+    RendererPool,
+    RendererUnavailable,
+    RenderTimeout,
+    process_tree_rss,
+)
+
+# Speaks the renderer protocol without Node or a browser
+STUB_WORKER = '''
+import base64, json, os, sys, time
+
+print(json.dumps({"type": "ready", "pid": os.getpid()}), flush=True)
+for line in sys.stdin:
+    job = json.loads(line)
+    if job["code"] == "crash":
+        sys.exit(3)
+    if job["code"] == "slow":
+        time.sleep(5)
+    if job["code"] == "bad":
+        print(json.dumps({"id": job["id"], "ok": False, "error": "Parse error on line 1"}), flush=True)
+        continue
+    body = f"{os.getpid()}:{job['format']}:{job['scale']}:{job['code']}".encode()
+    print(json.dumps({"id": job["id"], "ok": True, "data": base64.b64encode(body).decode()}), flush=True)
+'''
+
+
+@pytest.fixture
+def stub_command(tmp_path):
+    script = tmp_path / "worker.py"
+    script.write_text(STUB_WORKER)
+    return [sys.executable, str(script)]
+
+
+def make_pool(command, **overrides):
+    options = dict(size=2, max_jobs=100, max_rss_mb=0, max_queue=10, queue_timeout=1.0, job_timeout=2.0)
+    options.update(overrides)
+    return RendererPool(command, **options)
+
+
+def worker_pid(data: bytes) -> str:
+    return data.decode().split(":", 1)[0]
+
+
+@pytest.mark.asyncio
+async def test_renders_reuse_warm_workers(stub_command):
+    pool = make_pool(stub_command)
+    try:
+        results = await asyncio.gather(*(pool.render(f"graph {i}", "png", scale=3) for i in range(6)))
+        again = await pool.render("graph TD", "svg")
+    finally:
+        await pool.aclose()
+
+    assert results[0].decode().endswith(":png:3:graph 0")
+    assert len({worker_pid(data) for data in results}) <= 2
+    assert worker_pid(again) in {worker_pid(data) for data in results}
+    assert pool.stats()["renders"] == 7
+
+
+@pytest.mark.asyncio
+async def test_worker_is_replaced_after_max_jobs(stub_command):
+    pool = make_pool(stub_command, size=1, max_jobs=2)
+    try:
+        pids = [worker_pid(await pool.render("graph TD", "svg")) for _ in range(3)]
+    finally:
+        await pool.aclose()
+
+    assert pids[0] == pids[1] != pids[2]
+    assert pool.recycled == 1
+
+
+@pytest.mark.asyncio
+async def test_bad_diagram_keeps_the_worker(stub_command):
+    pool = make_pool(stub_command, size=1)
+    try:
+        first = worker_pid(await pool.render("graph TD", "svg"))
+        with pytest.raises(RenderError, match="Parse error"):
+            await pool.render("bad", "svg")
+        assert worker_pid(await pool.render("graph TD", "svg")) == first
+    finally:
+        await pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_timeouts_and_crashes_replace_the_worker(stub_command):
+    pool = make_pool(stub_command, size=1, job_timeout=0.3)
+    try:
+        first = worker_pid(await pool.render("graph TD", "svg"))
+        with pytest.raises(RenderTimeout):
+            await pool.render("slow", "svg")
+        second = worker_pid(await pool.render("graph TD", "svg"))
+        with pytest.raises(RendererUnavailable):
+            await pool.render("crash", "svg")
+        third = worker_pid(await pool.render("graph TD", "svg"))
+    finally:
+        await pool.aclose()
+
+    assert len({first, second, third}) == 3
+    assert pool.failures == 2
+
+
+@pytest.mark.asyncio
+async def test_callers_queue_for_a_free_worker(stub_command):
+    pool = make_pool(stub_command, size=1, job_timeout=1.0, queue_timeout=0.1)
+    try:
+        slow = asyncio.create_task(pool.render("slow", "svg"))
+        await asyncio.sleep(0.2)
+        with pytest.raises(RenderQueueFull):
+            await pool.render("graph TD", "svg")
+        with pytest.raises(RenderTimeout):
+            await slow
+    finally:
+        await pool.aclose()
+
+
+@pytest.mark.asyncio
+async def test_export_falls_back_to_mmdc_when_workers_cannot_start(monkeypatch):
+    pool = make_pool([sys.executable, "-c", "import sys; sys.exit(1)"])
+    monkeypatch.setattr("app.services.export_service.renderer_pool", pool)
+
+    async def mmdc(code, suffix, *options):
+        return f"mmdc{suffix}".encode()
+
+    monkeypatch.setattr(export_service, "_render", mmdc)
+
+    assert await export_service.export_svg("graph TD") == b"mmdc.svg"
+    # The failed start is remembered; no new process is spawned for the next export
+    assert await export_service.export_png("graph TD") == b"mmdc.png"
+
+
+def test_process_tree_rss_counts_this_process():
+    if not os.path.isdir("/proc"):
+        pytest.skip("needs /proc")
+    assert process_tree_rss(os.getpid()) > 0
+    assert process_tree_rss(2 ** 22 + 1) is None
+
+
+@pytest.mark.asyncio
+async def test_process_tree_rss_includes_children():
+    if not os.path.isdir("/proc"):
+        pytest.skip("needs /proc")
+    child = await asyncio.create_subprocess_exec(sys.executable, "-c", "import time; time.sleep(5)")
+    try:
+        await asyncio.sleep(0.2)
+        assert process_tree_rss(os.getpid()) > process_tree_rss(child.pid) > 0
+    finally:
+        child.kill()
+        await child.wait()
+
+
+@pytest.mark.asyncio
+async def test_memory_is_sampled_off_the_event_loop(stub_command, monkeypatch):
+    checks = []
+
+    def fake_rss(pid):
+        checks.append(pid)
+        return (2 if len(checks) == 1 else 0) * 1024 * 1024
+
+    monkeypatch.setattr("app.services.renderer_pool.process_tree_rss", fake_rss)
+    pool = make_pool(stub_command, size=1, max_rss_mb=1)
+    try:
+        first, second, third = [worker_pid(await pool.render("graph TD", "svg")) for _ in range(3)]
+    finally:
+        await pool.aclose()
+
+    assert first != second == third and pool.stats()["recycled"] == 1
+    assert len(checks) == 2  # Each worker is read after its first job, then not for a while
@@ -0,0 +1,141 @@
+import time
+
+import numpy as np
+import pytest
+
+from app.services.semantic_cache import (
+    DEFAULT_SYNONYMS,
+    PromptVectorizer,
+    SemanticCache,
+    VectorIndex,
+)
+
+
+@pytest.fixture
+def vectorizer():
+    return PromptVectorizer(dimensions=1024, synonyms=DEFAULT_SYNONYMS)
+
+
+def similarity(vectorizer, a, b):
+    return float(vectorizer.embed(a) @ vectorizer.embed(b))
+
+
+def test_reordered_clauses_and_whitespace_are_near_duplicates(vectorizer):
+    a = "用户登录流程，输入用户名和密码，验证通过后进入首页"
+    b = "验证通过后进入首页，  输入用户名和密码，用户登录流程"
+    assert similarity(vectorizer, a, b) > 0.99
+
+
+def test_synonyms_map_to_the_same_vector(vectorizer):
+    assert similarity(vectorizer, "用户登陆流程", "用户登录流程") > 0.99
+    assert similarity(vectorizer, "User sign in flow", "user login flow") > 0.99
+
+
+def test_synonyms_only_replace_whole_latin_words(vectorizer):
+    assert vectorizer.normalize("feedback db") == "feedback 数据库"
+
+
+def test_different_prompts_stay_apart(vectorizer):
+    a = "用户登录流程，输入用户名和密码"
+    b = "订单支付流程，选择商品后下单并支付"
+    assert similarity(vectorizer, a, b) < 0.5
+
+
+def test_index_search_is_namespaced_and_ranked(vectorizer):
+    index = VectorIndex(dimensions=1024, capacity=8)
+    index.add(vectorizer.embed("login flow"), "claude:flowchart", {"code": "a"})
+    index.add(vectorizer.embed("payment flow"), "claude:flowchart", {"code": "b"})
+    index.add(vectorizer.embed("login flow"), "openai:flowchart", {"code": "c"})
+
+    results = index.search(vectorizer.embed("login flow"), "claude:flowchart", k=2)
+
+    assert [payload["code"] for _, payload in results] == ["a", "b"]
+    assert results[0][0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_index_evicts_oldest_when_full(vectorizer):
+    index = VectorIndex(dimensions=1024, capacity=2)
+    for code in ("one", "two", "three"):
+        index.add(vectorizer.embed(code), "ns", {"code": code})
+
+    assert len(index) == 2
+    codes = {payload["code"] for _, payload in index.search(vectorizer.embed("one"), "ns", k=2)}
+    assert codes == {"two", "three"}
+
+
+@pytest.mark.asyncio
+async def test_cache_persists_to_disk(tmp_path):
+    cache = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path, save_every=1)
+    await cache.add("ns", "login flow with password", {"code": "graph TD"})
+
+    reloaded = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path)
+    match = await reloaded.lookup("ns", "password, login flow with")
+
+    assert match is not None
+    assert match[0] == {"code": "graph TD"}
+    assert np.isclose(match[1], 1.0, atol=1e-5)
+
+
+@pytest.mark.asyncio
+async def test_workers_sharing_a_directory_keep_each_others_entries(tmp_path):
+    workers = [
+        SemanticCache(threshold=0.9, dimensions=256, capacity=3, directory=tmp_path, save_every=1)
+        for _ in range(2)
+    ]
+    await workers[0].add("ns", "login flow", {"code": "a"})
+    await workers[1].add("ns", "payment flow", {"code": "b"})
+    await workers[0].add("ns", "signup flow", {"code": "c"})
+    await workers[0].add("ns", "signup flow", {"code": "c"})  # Saved again, not duplicated
+
+    reloaded = SemanticCache(threshold=0.9, dimensions=256, capacity=3, directory=tmp_path)
+    codes = [(await reloaded.lookup("ns", text) or [{}])[0].get("code") for text in ("login flow", "payment flow")]
+
+    # Capacity 3 keeps the newest entries across both workers
+    assert codes == [None, "b"]
+    assert len(reloaded.index) == 3
+
+
+@pytest.mark.asyncio
+async def test_unreadable_index_starts_empty(tmp_path, caplog):
+    (tmp_path / "meta.json").write_text("{not json", encoding="utf-8")
+    (tmp_path / "vectors.npy").write_bytes(b"garbage")
+    cache = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path, save_every=1)
+
+    assert await cache.lookup("ns", "login flow") is None
+    assert "unreadable semantic cache index" in caplog.text
+    # Loading is not retried, and the next save replaces the damaged files
+    await cache.add("ns", "login flow", {"code": "a"})
+    reloaded = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path)
+    assert (await reloaded.lookup("ns", "login flow"))[0] == {"code": "a"}
+
+
+@pytest.mark.asyncio
+async def test_stats_track_hit_rate_and_scores():
+    cache = SemanticCache(threshold=0.9, dimensions=256, capacity=16)
+    await cache.add("ns", "login flow", {"code": "x"})
+
+    assert await cache.lookup("ns", "login  flow") is not None
+    assert await cache.lookup("ns", "database schema for orders") is None
+
+    stats = cache.stats()
+    assert stats["lookups"] == 2
+    assert stats["hits"] == 1
+    assert stats["hit_rate"] == 0.5
+    assert sum(stats["best_score_histogram"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_entries_expire_after_the_ttl(tmp_path):
+    cache = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path, save_every=1, ttl_seconds=60)
+    await cache.add("ns", "login flow", {"code": "fresh"})
+    cache.index.add(cache.vectorizer.embed("payment flow"), "ns", {"code": "stale"}, added_at=time.time() - 61)
+
+    assert (await cache.lookup("ns", "login flow"))[0] == {"code": "fresh"}
+    assert await cache.lookup("ns", "payment flow") is None
+    assert cache.stats()["entries"] == 1
+
+    # Ages survive a restart
+    await cache.add("ns", "signup flow", {"code": "also fresh"})
+    reloaded = SemanticCache(threshold=0.9, dimensions=256, capacity=16, directory=tmp_path, ttl_seconds=60)
+    assert await reloaded.lookup("ns", "payment flow") is None
+    assert await reloaded.lookup("ns", "login flow") is not None
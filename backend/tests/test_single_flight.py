@@ -0,0 +1,154 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from app.services.rate_limiter import RateLimitExceeded
+from app.services.single_flight import SingleFlight, SingleFlightError
+
+
+def make_flight(server, **overrides):
+    options = {"lock_ttl_seconds": 30, "wait_timeout_seconds": 5}
+    options.update(overrides)
+    return SingleFlight(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), **options)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_call():
+    flight = make_flight(fakeredis.FakeServer())
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"code": "graph TD"}
+
+    results = await asyncio.gather(*(flight.do("k", call) for _ in range(5)))
+
+    assert calls == 1
+    assert [result for result, _ in results] == [{"code": "graph TD"}] * 5
+    assert sum(shared for _, shared in results) == 4
+    assert flight.stats()["coalesced_local"] == 4
+
+
+@pytest.mark.asyncio
+async def test_different_keys_do_not_coalesce():
+    flight = make_flight(fakeredis.FakeServer())
+
+    async def call():
+        await asyncio.sleep(0.01)
+        return {"code": "x"}
+
+    await asyncio.gather(flight.do("a", call), flight.do("b", call))
+
+    assert flight.stats()["leaders"] == 2
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_waiter_and_key_is_released():
+    flight = make_flight(fakeredis.FakeServer())
+
+    async def failing():
+        await asyncio.sleep(0.02)
+        raise RuntimeError("upstream 500")
+
+    results = await asyncio.gather(*(flight.do("k", failing) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+    async def ok():
+        return {"code": "recovered"}
+
+    assert await flight.do("k", ok) == ({"code": "recovered"}, False)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_shared_call():
+    flight = make_flight(fakeredis.FakeServer())
+
+    async def call():
+        await asyncio.sleep(0.05)
+        return {"code": "done"}
+
+    leader = asyncio.ensure_future(flight.do("k", call))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(flight.do("k", call))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+
+    assert await follower == ({"code": "done"}, True)
+
+
+@pytest.mark.asyncio
+async def test_workers_coalesce_through_redis():
+    server = fakeredis.FakeServer()
+    worker_a = make_flight(server)
+    worker_b = make_flight(server)
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return {"code": "shared"}
+
+    first = asyncio.ensure_future(worker_a.do("k", call))
+    await asyncio.sleep(0.02)
+    second = await worker_b.do("k", call)
+
+    assert await first == ({"code": "shared"}, False)
+    assert second == ({"code": "shared"}, True)
+    assert calls == 1
+    assert worker_b.stats()["coalesced_remote"] == 1
+
+
+@pytest.mark.asyncio
+async def test_remote_failure_is_reported():
+    server = fakeredis.FakeServer()
+    worker_a = make_flight(server)
+    worker_b = make_flight(server)
+
+    async def failing():
+        await asyncio.sleep(0.1)
+        raise RuntimeError("rate limited")
+
+    first = asyncio.ensure_future(worker_a.do("k", failing))
+    await asyncio.sleep(0.02)
+    with pytest.raises(SingleFlightError, match="rate limited") as failed:
+        await worker_b.do("k", failing)
+    with pytest.raises(RuntimeError):
+        await first
+    assert (failed.value.status_code, failed.value.retry_after) == (500, None)
+
+
+@pytest.mark.asyncio
+async def test_remote_failure_keeps_its_status():
+    server = fakeredis.FakeServer()
+    worker_a = make_flight(server)
+    worker_b = make_flight(server)
+
+    async def limited():
+        await asyncio.sleep(0.1)
+        raise RateLimitExceeded("claude", "requests per minute", retry_after=7)
+
+    first = asyncio.ensure_future(worker_a.do("k", limited))
+    await asyncio.sleep(0.02)
+    with pytest.raises(SingleFlightError) as failed:
+        await worker_b.do("k", limited)
+    with pytest.raises(RateLimitExceeded):
+        await first
+
+    assert (failed.value.status_code, failed.value.retry_after) == (429, 7)
+
+
+@pytest.mark.asyncio
+async def test_follower_takes_over_when_leader_disappears():
+    server = fakeredis.FakeServer()
+    flight = make_flight(server)
+    # A crashed worker left its lock behind; it expires shortly
+    await flight.redis.set("aiflight:v1:lock:k", "dead", ex=1)
+
+    async def call():
+        return {"code": "fallback"}
+
+    assert await flight.do("k", call) == ({"code": "fallback"}, False)
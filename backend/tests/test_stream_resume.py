@@ -0,0 +1,159 @@
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.services.stream_resume import StreamRegistry
+
+
+@pytest.fixture
+def registry(fake_redis):
+    return StreamRegistry(fake_redis, prefix="teststream")
+
+
+async def collect(events, limit=None):
+    received = []
+    async for item in events:
+        if item is None:
+            continue
+        received.append(item)
+        if limit is not None and len(received) == limit:
+            break
+    return received
+
+
+@pytest.mark.asyncio
+async def test_producer_keeps_running_after_the_reader_leaves(registry):
+    release = asyncio.Event()
+    turn = registry.open()
+
+    async def produce():
+        await turn.emit({"type": "chunk", "content": "a"})
+        await release.wait()
+        await turn.emit({"type": "chunk", "content": "b"})
+        await turn.emit({"type": "done"})
+        await turn.close()
+
+    task = registry.start(turn, produce())
+    reader = turn.tail()
+    assert await collect(reader, limit=1) == [(1, {"type": "chunk", "content": "a"})]
+    await reader.aclose()  # Client disconnected
+
+    release.set()
+    await asyncio.wait_for(task, 1)
+
+    # Another worker: no local copy, so the events come from Redis
+    resumed = await registry.resume(turn.id, 1)
+    assert await collect(resumed) == [(2, {"type": "chunk", "content": "b"}), (3, {"type": "done"})]
+
+
+@pytest.mark.asyncio
+async def test_reconnect_follows_a_running_turn_live(registry):
+    turn = registry.open()
+    step = asyncio.Event()
+
+    async def produce():
+        for content in ("a", "b"):
+            await turn.emit({"type": "chunk", "content": content})
+            await step.wait()
+        await turn.emit({"type": "done"})
+        await turn.close()
+
+    registry.start(turn, produce())
+    await asyncio.sleep(0)
+    resumed = await registry.resume(turn.id, 1)
+    reading = asyncio.create_task(collect(resumed))
+    await asyncio.sleep(0.01)
+    step.set()
+
+    assert [event_id for event_id, _ in await asyncio.wait_for(reading, 1)] == [2, 3]
+
+
+@pytest.mark.asyncio
+async def test_producer_failure_ends_the_stream_with_an_error(registry):
+    turn = registry.open()
+
+    async def produce():
+        try:
+            await turn.emit({"type": "chunk", "content": "a"})
+            raise asyncio.CancelledError
+        finally:
+            await turn.close()
+
+    task = registry.start(turn, produce())
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    events = await collect(await registry.resume(turn.id, 0))
+    assert events[-1] == (2, {"type": "error", "message": "Stream interrupted"})
+
+
+@pytest.mark.asyncio
+async def test_producing_does_not_wait_for_redis(registry, monkeypatch):
+    original_mirror = registry.mirror
+    writes = []
+
+    async def slow_mirror(stream_id, payloads):
+        writes.append(len(payloads))
+        await asyncio.sleep(0.05)
+        await original_mirror(stream_id, payloads)
+
+    monkeypatch.setattr(registry, "mirror", slow_mirror)
+    turn = registry.open()
+
+    started = asyncio.get_running_loop().time()
+    for n in range(50):
+        await turn.emit({"type": "chunk", "content": str(n)})
+    assert asyncio.get_running_loop().time() - started < 0.05
+    await turn.emit({"type": "done"})
+    await turn.close()
+
+    # Events that piled up behind a write went out together, and all of them reached Redis
+    assert sum(writes) == 51 and len(writes) <= 3
+    assert len(await collect(await registry.resume(turn.id, 0))) == 51
+
+
+@pytest.mark.asyncio
+async def test_stop_cancels_the_producer_on_any_worker(registry, fake_redis):
+    other_worker = StreamRegistry(fake_redis, prefix="teststream")
+    upstream_calls_finished = []
+
+    async def produce(turn):
+        try:
+            await turn.emit({"type": "chunk", "content": "a"})
+            await asyncio.sleep(10)  # The upstream call
+            upstream_calls_finished.append(turn.id)
+        finally:
+            await turn.close()
+
+    local = registry.open()
+    local_task = registry.start(local, produce(local))
+    remote = registry.open()
+    remote_task = registry.start(remote, produce(remote))
+    await asyncio.sleep(0.05)  # Mirrored, and the cancel listener subscribed
+
+    assert await registry.stop(local.id)
+    assert await other_worker.stop(remote.id)
+    assert not await other_worker.stop("unknown")
+    for task in (local_task, remote_task):
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 2)
+
+    assert upstream_calls_finished == []
+    events = await collect(await other_worker.resume(remote.id, 0))
+    assert events[-1] == (2, {"type": "error", "message": "Stream interrupted"})
+
+
+@pytest.mark.asyncio
+async def test_nothing_is_kept_when_resume_is_disabled(registry, fake_redis, monkeypatch):
+    monkeypatch.setattr(settings, "CHAT_STREAM_RESUME_TTL_SECONDS", 0)
+    turn = registry.open()
+
+    async def produce():
+        await turn.emit({"type": "done"})
+        await turn.close()
+
+    await registry.start(turn, produce())
+
+    assert await fake_redis.keys("teststream:*") == []
+    assert await registry.resume(turn.id, 0) is None
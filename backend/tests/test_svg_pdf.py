@@ -0,0 +1,74 @@
+import re
+import zlib
+
+import pytest
+
+from app.services.drawio_renderer import render_drawio
+from app.services.svg_pdf import SvgPdfError, parse_transform, path_operators, svg_to_pdf
+from benchmarks.scenarios import drawio_sample
+
+SVG = '''<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100" viewBox="0 0 200 100">
+<g transform="translate(10,5)" stroke="#333" fill="none">
+  <rect x="0" y="0" width="80" height="40" rx="6" fill="#dae8fc" fill-opacity="0.5"/>
+  <path d="M 100 20 a 10 10 0 0 1 20 0 z"/>
+  <text x="40" y="25" text-anchor="middle" font-size="12" fill="#000">(API)</text>
+  <text x="40" y="60" font-size="12" fill="#000"><tspan>网关</tspan></text>
+</g>
+</svg>'''
+
+
+def content_stream(pdf: bytes) -> str:
+    compressed = re.search(rb"/FlateDecode >>\nstream\n(.*?)\nendstream", pdf, re.S).group(1)
+    return zlib.decompress(compressed).decode("latin-1")
+
+
+def test_pdf_structure_and_text():
+    pdf = svg_to_pdf(SVG, title="Sample")
+    ops = content_stream(pdf)
+
+    assert pdf.startswith(b"%PDF-1.4") and pdf.rstrip().endswith(b"%%EOF")
+    assert b"/MediaBox [0 0 200 100]" in pdf
+    assert b"/Title (Sample)" in pdf
+    assert r"(\(API\)) Tj" in ops
+    assert "<7F515173> Tj" in ops  # 网关 as UCS-2
+    assert b"/BaseFont /STSong-Light /Encoding /UniGB-UCS2-H" in pdf
+    assert b"/ca 0.5" in pdf
+
+    # The xref offsets point at the objects they name
+    xref = int(pdf.rsplit(b"startxref\n", 1)[1].split()[0])
+    entries = pdf[xref:].split(b"\n")[3:]
+    for number, entry in enumerate(entries[:3], start=1):
+        offset = int(entry.split()[0])
+        assert pdf[offset:].startswith(f"{number} 0 obj".encode())
+
+
+def test_transforms_compose_left_to_right():
+    assert parse_transform("translate(10, 20)") == (1, 0, 0, 1, 10, 20)
+    a, b, c, d, e, f = parse_transform("translate(10 20) scale(2) rotate(90)")
+    assert (round(a), round(b), round(c), round(d), e, f) == (0, 2, -2, 0, 10, 20)
+    assert parse_transform("") is None
+
+
+def test_path_commands_become_pdf_operators():
+    ops = path_operators("M10,10 h20 v20 H10 Z m5 5 q5 -5 10 0 t10 0 A5 5 0 0 1 45 15")
+
+    assert ops[:5] == ["10 10 m", "30 10 l", "30 30 l", "10 30 l", "h"]
+    assert ops[5] == "15 15 m"
+    assert all(op.endswith(" c") for op in ops[6:])  # Quadratics and arcs as cubic Beziers
+    assert ops[-1].endswith("45 15 c")
+
+
+@pytest.mark.parametrize("svg", ["<svg", "<html/>"])
+def test_invalid_svg_is_rejected(svg):
+    with pytest.raises(SvgPdfError):
+        svg_to_pdf(svg)
+
+
+def test_vector_pdf_is_a_fraction_of_the_raster():
+    code = drawio_sample(30)
+    vector = render_drawio(code, "pdf", "white", 3)
+    raster = render_drawio(code, "pdf", "white", 3, pdf_mode="raster")
+
+    assert vector.startswith(b"%PDF") and raster.startswith(b"%PDF")
+    assert len(vector) * 10 < len(raster)
+    assert "步骤" not in content_stream(vector) and "Tj" in content_stream(vector)
@@ -0,0 +1,137 @@
+import json
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from app.core import tracing
+from app.core.config import settings
+from app.core.tracing import JsonLinesExporter, span, start_trace, traced_stream
+
+
+@pytest.fixture
+def export_all(monkeypatch):
+    monkeypatch.setattr(settings, "TRACING_SLOW_MS", 0)
+
+
+def spans_by_name(trace):
+    return {s["name"]: s for s in trace["spans"]}
+
+
+def test_span_outside_a_trace_is_a_noop(trace_exporter):
+    with span("orphan", x=1) as s:
+        s.set(y=2)
+
+    assert trace_exporter.traces == []
+
+
+def test_slow_trace_is_exported_with_every_nested_span(trace_exporter, monkeypatch):
+    monkeypatch.setattr(settings, "TRACING_SLOW_MS", 20)
+    monkeypatch.setattr(settings, "TRACING_SAMPLE_RATE", 0.0)
+
+    with start_trace("fast"):
+        with span("child"):
+            pass
+    with start_trace("slow", route="/x"):
+        with span("db.query") as query:
+            with span("inner"):
+                time.sleep(0.03)
+        query.set(rows=3)
+
+    assert [t["name"] for t in trace_exporter.traces] == ["slow"]
+    trace = trace_exporter.traces[0]
+    spans = spans_by_name(trace)
+    assert trace["slow"] is True
+    assert spans["db.query"]["parent_id"] == spans["slow"]["span_id"]
+    assert spans["inner"]["parent_id"] == spans["db.query"]["span_id"]
+    assert spans["db.query"]["attributes"] == {"rows": 3}
+    assert spans["inner"]["duration_ms"] >= 30
+
+
+def test_errors_are_always_exported(trace_exporter, monkeypatch):
+    monkeypatch.setattr(settings, "TRACING_SAMPLE_RATE", 0.0)
+
+    with pytest.raises(ValueError):
+        with start_trace("request"):
+            with span("parse"):
+                raise ValueError("bad input")
+
+    spans = spans_by_name(trace_exporter.traces[0])
+    assert spans["parse"]["status"] == "error"
+    assert spans["parse"]["attributes"]["error.type"] == "ValueError"
+
+
+def test_span_count_is_capped(trace_exporter, export_all, monkeypatch):
+    monkeypatch.setattr(settings, "TRACING_MAX_SPANS", 3)
+
+    with start_trace("request"):
+        for _ in range(5):
+            with span("db.query"):
+                pass
+
+    assert len(trace_exporter.traces[0]["spans"]) == 3
+    assert trace_exporter.traces[0]["dropped_spans"] == 3
+
+
+@pytest.mark.asyncio
+async def test_traced_stream_records_first_chunk_and_count(trace_exporter, export_all):
+    async def chunks():
+        for chunk in ("a", "b", "c"):
+            yield chunk
+
+    with start_trace("request"):
+        received = [c async for c in traced_stream("llm.stream", chunks(), provider="fake")]
+
+    attributes = spans_by_name(trace_exporter.traces[0])["llm.stream"]["attributes"]
+    assert received == ["a", "b", "c"]
+    assert attributes["chunks"] == 3 and attributes["provider"] == "fake" and "ttft_ms" in attributes
+
+
+def test_db_statements_become_spans(trace_exporter, export_all):
+    engine = create_engine("sqlite://")
+    tracing.instrument_engine(engine)
+
+    with start_trace("request"):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    query = spans_by_name(trace_exporter.traces[0])["db.query"]
+    assert query["attributes"]["db.operation"] == "SELECT"
+
+
+def test_jsonl_exporter_appends_one_line_per_trace(tmp_path):
+    path = tmp_path / "traces" / "out.jsonl"
+    exporter = JsonLinesExporter(str(path))
+
+    exporter.export({"trace_id": "a", "spans": []})
+    exporter.export({"trace_id": "b", "spans": []})
+    for _ in range(100):
+        if path.exists() and len(path.read_text().splitlines()) == 2:
+            break
+        time.sleep(0.01)
+
+    assert [json.loads(line)["trace_id"] for line in path.read_text().splitlines()] == ["a", "b"]
+
+
+def test_exporter_can_be_plugged_in_by_name(monkeypatch):
+    monkeypatch.setattr(settings, "TRACING_EXPORTER", "app.core.tracing:InMemoryExporter")
+    assert isinstance(tracing._load_exporter(), tracing.InMemoryExporter)
+
+    monkeypatch.setattr(settings, "TRACING_EXPORTER", "none")
+    assert tracing._load_exporter() is None
+
+
+def test_chat_stream_trace_nests_route_and_provider_spans(client, ai_services, trace_exporter, export_all):
+    response = client.post("/api/ai/chat/stream", json={
+        "messages": [{"role": "user", "content": "hi"}], "diagramType": "flowchart",
+        "format": "mermaid", "aiProvider": "claude",
+    })
+
+    assert response.status_code == 200
+    trace = trace_exporter.traces[-1]
+    spans = spans_by_name(trace)
+    root = spans["POST /api/ai/chat/stream"]
+    assert root["attributes"]["http.status_code"] == 200
+    for name in ("chat.compact_history", "ratelimit.acquire", "llm.stream"):
+        assert spans[name]["parent_id"] == root["span_id"]
+    assert spans["llm.stream"]["attributes"]["chunks"] == 2
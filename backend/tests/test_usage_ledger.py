@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core.config import settings
+from app.models.usage import AIUsageRecord
+from app.services.ai.client_pool import key_fingerprint
+from app.services.ai.usage import record_usage
+from app.services.usage_ledger import BudgetExceeded, UsageEntry, summarize
+from tests.conftest import TestingSessionLocal
+
+
+def entry(**overrides):
+    values = dict(
+        key_hash="k1", provider="claude", model="m", endpoint="generate", latency_ms=100,
+        diagram_type="flowchart", diagram_format="drawio", input_tokens=1000, output_tokens=200,
+    )
+    values.update(overrides)
+    return UsageEntry(**values)
+
+
+def generate_payload(**overrides):
+    payload = {"description": "Login flow", "diagramType": "flowchart", "format": "mermaid", "aiProvider": "claude"}
+    payload.update(overrides)
+    return payload
+
+
+@pytest.mark.asyncio
+async def test_records_are_stored_and_summarized(db_session, usage_ledger_db):
+    await usage_ledger_db.record(entry())
+    await usage_ledger_db.record(entry(diagram_type="sequence", output_tokens=50, latency_ms=300))
+    await usage_ledger_db.record(entry(status="error", input_tokens=0, output_tokens=0, latency_ms=20))
+
+    rows = summarize(db_session, ["diagram_type"])
+
+    assert [r["diagram_type"] for r in rows] == ["flowchart", "sequence"]
+    assert rows[0] == {
+        "diagram_type": "flowchart", "calls": 2, "errors": 1, "input_tokens": 1000, "output_tokens": 200,
+        "reasoning_tokens": 0, "cached_input_tokens": 0, "cache_write_tokens": 0, "total_tokens": 1200,
+        "avg_latency_ms": 60.0, "max_latency_ms": 100,
+    }
+    assert summarize(db_session, [], since=datetime.utcnow() + timedelta(hours=1)) == []
+
+
+@pytest.mark.asyncio
+async def test_budget_blocks_a_key_after_its_daily_tokens(usage_ledger_db, monkeypatch):
+    monkeypatch.setattr(settings, "AI_USAGE_DAILY_TOKEN_BUDGET", 2000)
+    monkeypatch.setattr(settings, "AI_USAGE_KEY_BUDGETS", {"vip": 0})
+
+    await usage_ledger_db.check_budget("k1")
+    await usage_ledger_db.record(entry(input_tokens=1500, output_tokens=600))
+
+    with pytest.raises(BudgetExceeded) as exc:
+        await usage_ledger_db.check_budget("k1")
+    assert exc.value.used == 2100 and 0 < exc.value.retry_after <= 86400
+    await usage_ledger_db.check_budget("other")
+    await usage_ledger_db.record(entry(key_hash="vip", input_tokens=10**6))
+    await usage_ledger_db.check_budget("vip")
+
+
+def test_generate_records_usage_against_key_and_diagram(client, ai_services, sample_diagram_data):
+    diagram_id = client.post("/api/diagrams", json=sample_diagram_data).json()["id"]
+
+    async def generate(*args, **kwargs):
+        record_usage(input_tokens=900, output_tokens=120, reasoning_tokens=20)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = generate
+    response = client.post(
+        "/api/ai/generate", json=generate_payload(diagramId=diagram_id), headers={"X-Anthropic-Key": "sk-test"}
+    )
+
+    assert response.status_code == 200
+    with TestingSessionLocal() as db:
+        record = db.query(AIUsageRecord).one()
+    assert record.key_hash == key_fingerprint("sk-test")
+    assert record.diagram_id == diagram_id
+    assert (record.endpoint, record.model, record.diagram_type) == ("generate", "claude-test-model", "flowchart")
+    assert (record.input_tokens, record.output_tokens, record.reasoning_tokens) == (900, 120, 20)
+
+    usage = client.get("/api/ai/usage", params={"group_by": ["diagram_id", "endpoint"]}).json()
+    assert usage["rows"][0]["diagram_id"] == diagram_id and usage["rows"][0]["total_tokens"] == 1020
+    assert client.get("/api/ai/usage", params={"group_by": "password"}).status_code == 400
+
+
+def test_cache_hits_are_not_recorded(client, ai_services):
+    async def generate(*args, **kwargs):
+        record_usage(input_tokens=10, output_tokens=5)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = generate
+    client.post("/api/ai/generate", json=generate_payload())
+    client.post("/api/ai/generate", json=generate_payload())
+
+    with TestingSessionLocal() as db:
+        assert db.query(AIUsageRecord).count() == 1
+
+
+def test_exhausted_budget_rejects_before_calling_the_provider(client, ai_services, monkeypatch):
+    monkeypatch.setattr(settings, "AI_USAGE_KEY_BUDGETS", {key_fingerprint("sk-heavy"): 100})
+
+    async def generate(*args, **kwargs):
+        record_usage(input_tokens=80, output_tokens=40)
+        return "graph TD\n    A --> B"
+
+    ai_services["claude"].generate_diagram.side_effect = generate
+    headers = {"X-Anthropic-Key": "sk-heavy", "Cache-Control": "no-cache"}
+    first = client.post("/api/ai/generate", json=generate_payload(), headers=headers)
+    second = client.post("/api/ai/generate", json=generate_payload(description="Other"), headers=headers)
+    stream = client.post("/api/ai/chat/stream", headers=headers, json={
+        "messages": [{"role": "user", "content": "hi"}], "diagramType": "flowchart", "aiProvider": "claude",
+    })
+    budget = client.get("/api/ai/usage/budget", params={"provider": "claude"}, headers=headers).json()
+
+    assert first.status_code == 200
+    assert second.status_code == 429 and int(second.headers["Retry-After"]) > 0
+    assert stream.status_code == 429
+    assert ai_services["claude"].generate_diagram.await_count == 1
+    assert budget == {"key_hash": key_fingerprint("sk-heavy"), "budget": 100, "used_today": 120, "remaining": 0}
@@ -37,6 +37,7 @@ function AIChatPanel({ onGenerate, onGeneratingChange }: AIChatPanelProps) {
   const messagesEndRef = useRef<HTMLDivElement>(null)
   const inputRef = useRef<HTMLTextAreaElement>(null)
   const abortControllerRef = useRef<AbortController | null>(null)
+  const streamIdRef = useRef<string | null>(null)
 
   const {
     createConversation,
@@ -167,6 +168,7 @@ function AIChatPanel({ onGenerate, onGeneratingChange }: AIChatPanelProps) {
       if (!response.ok) {
         throw new Error('Stream request failed')
       }
+      streamIdRef.current = response.headers.get('X-Stream-Id')
 
       const reader = response.body?.getReader()
       const decoder = new TextDecoder()
@@ -236,9 +238,26 @@ function AIChatPanel({ onGenerate, onGeneratingChange }: AIChatPanelProps) {
       setIsStreaming(false)
       onGeneratingChange(false)
       abortControllerRef.current = null
+      streamIdRef.current = null
     }
   }
 
+  // The turn keeps running on the server after the fetch is aborted, so stop it there too
+  const stopStreaming = () => {
+    const streamId = streamIdRef.current
+    abortControllerRef.current?.abort()
+    abortControllerRef.current = null
+    streamIdRef.current = null
+    if (streamId) {
+      void fetch(`${apiClient.defaults.baseURL}/ai/chat/stream/${encodeURIComponent(streamId)}`, {
+        method: 'DELETE',
+        keepalive: true,
+      }).catch((e) => console.error('Failed to stop stream:', e))
+    }
+    setIsStreaming(false)
+    onGeneratingChange(false)
+  }
+
   const handleSend = () => {
     void sendPrompt(input)
   }
@@ -248,10 +267,7 @@ function AIChatPanel({ onGenerate, onGeneratingChange }: AIChatPanelProps) {
     if (!confirm('确定要清空对话历史吗？')) return
 
     if (isStreaming) {
-      abortControllerRef.current?.abort()
-      abortControllerRef.current = null
-      setIsStreaming(false)
-      onGeneratingChange(false)
+      stopStreaming()
     }
 
     clearConversation(currentConversationId)
@@ -283,10 +299,7 @@ function AIChatPanel({ onGenerate, onGeneratingChange }: AIChatPanelProps) {
     if (!currentConversationId) return
 
     if (message.isStreaming) {
-      abortControllerRef.current?.abort()
-      abortControllerRef.current = null
-      setIsStreaming(false)
-      onGeneratingChange(false)
+      stopStreaming()
     }
 
     deleteMessage(currentConversationId, message.id)